@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#########################################################################
+# Benchmark: ctypes vs. cffi libmunge backends
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""Compares the per-call cost of the libmunge backends (see
+`pymunge.backend`) for option access, encoding and decoding with a
+`MungeContext`. Run it with both CPython and PyPy to see the effect of
+the interpreter; backends which cannot be used (e.g. cffi if it is not
+installed) are skipped. The option benchmarks do not contact munged; the
+encode/decode benchmarks require a running munged, or --fake-munged to
+run them against a `pymunge.testing.FakeMungeDaemon`."""
+
+import argparse
+import time
+
+import pymunge
+import pymunge.backend
+import pymunge.testing
+
+
+def timed(fn, count):
+    start = time.time()
+    for i in range(count):
+        fn()
+    return time.time() - start
+
+
+def option_benchmarks(ctx):
+    def get_ttl():
+        return ctx.ttl
+
+    def set_ttl():
+        ctx.ttl = 60
+
+    def get_socket():
+        return ctx.socket
+
+    return [('ttl get', get_ttl),
+            ('ttl set', set_ttl),
+            ('socket get', get_socket)]
+
+
+def codec_benchmarks(ctx, payload):
+    cred = ctx.encode(payload)
+
+    def encode():
+        ctx.encode(payload)
+
+    def decode():
+        try:
+            ctx.decode(cred)
+        except pymunge.MungeError as e:
+            if e.code != pymunge.MungeErrorCode.EMUNGE_CRED_REPLAYED:
+                raise
+
+    def decode_snapshot():
+        try:
+            ctx.decode(cred, snapshot=True)
+        except pymunge.MungeError as e:
+            if e.code != pymunge.MungeErrorCode.EMUNGE_CRED_REPLAYED:
+                raise
+
+    return [('encode', encode),
+            ('decode', decode),
+            ('decode (snapshot)', decode_snapshot)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=100000,
+                        help='number of calls per option benchmark run')
+    parser.add_argument('-c', '--codec-count', type=int, default=5000,
+                        help='number of calls per encode/decode run')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='number of runs (the best run is reported)')
+    parser.add_argument('-s', '--payload-size', type=int, default=64,
+                        help='payload size in bytes')
+    parser.add_argument('-b', '--backend', action='append',
+                        help='backend to benchmark (default: all available)')
+    parser.add_argument('--no-daemon', action='store_true',
+                        help='skip the encode/decode benchmarks')
+    parser.add_argument('--fake-munged', action='store_true',
+                        help='run against a stand-in daemon (see '
+                        'pymunge.testing) instead of munged')
+    args = parser.parse_args()
+
+    if args.fake_munged:
+        with pymunge.testing.FakeMungeDaemon() as daemon:
+            with daemon.install():
+                run(args)
+    else:
+        run(args)
+
+
+def run(args):
+
+    backends = args.backend or pymunge.backend.available_backends()
+    results = {}
+    names = []
+    for backend in backends:
+        with pymunge.MungeContext(backend=backend) as ctx:
+            runs = [(name, fn, args.count)
+                    for name, fn in option_benchmarks(ctx)]
+            if not args.no_daemon:
+                runs += [(name, fn, args.codec_count) for name, fn
+                         in codec_benchmarks(ctx, b'x' * args.payload_size)]
+            for name, fn, count in runs:
+                if name not in names:
+                    names.append(name)
+                best = min(timed(fn, count) for i in range(args.repeat))
+                results[backend, name] = best / count * 1e6
+
+    print('%-20s' % 'us/call' + ''.join('%12s' % b for b in backends))
+    for name in names:
+        print('%-20s' % name + ''.join('%12.3f' % results[backend, name]
+                                       for backend in backends))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#########################################################################
+# Benchmark: DecodeResult snapshot vs. context properties
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""Compares reading the metadata of a decoded credential via the
+`MungeContext` properties with taking a `DecodeResult` snapshot, both in
+time to read all fields and in memory per retained result. Requires a
+running munged (for a single decode)."""
+
+import argparse
+import time
+import tracemalloc
+
+import pymunge
+
+FIELDS = ('cipher_type', 'mac_type', 'zip_type', 'realm', 'ttl', 'addr4',
+          'encode_time', 'decode_time', 'uid_restriction', 'gid_restriction')
+
+
+def read_properties(ctx, payload, uid, gid):
+    result = {'payload': payload, 'uid': uid, 'gid': gid}
+    for name in FIELDS:
+        result[name] = getattr(ctx, name)
+    return result
+
+
+def read_snapshot(ctx, payload, uid, gid):
+    result = pymunge.DecodeResult.from_context(ctx, payload, uid, gid)
+    for name in FIELDS:
+        getattr(result, name)
+    return result
+
+
+def take_snapshot(ctx, payload, uid, gid):
+    return pymunge.DecodeResult.from_context(ctx, payload, uid, gid)
+
+
+def bench_time(fn, ctx, decoded, count):
+    start = time.time()
+    for i in range(count):
+        fn(ctx, *decoded)
+    return time.time() - start
+
+
+def bench_memory(fn, ctx, decoded, count):
+    tracemalloc.start()
+    results = [fn(ctx, *decoded) for i in range(count)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del results
+    return size / float(count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=100000,
+                        help='number of reads per run')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='number of runs (the best run is reported)')
+    args = parser.parse_args()
+
+    with pymunge.MungeContext() as ctx:
+        decoded = ctx.decode(pymunge.encode(b'x' * 32))
+        print('Time to read all fields:')
+        for name, fn in (('properties', read_properties),
+                         ('DecodeResult', read_snapshot)):
+            best = min(bench_time(fn, ctx, decoded, args.count)
+                       for i in range(args.repeat))
+            print('  %-15s %8.2f us/result' %
+                  (name, best / args.count * 1e6))
+        print('Memory per retained result (Python heap):')
+        for name, fn in (('dict', read_properties),
+                         ('DecodeResult', take_snapshot)):
+            print('  %-15s %8.0f bytes/result' %
+                  (name, bench_memory(fn, ctx, decoded, args.count)))
+
+
+if __name__ == '__main__':
+    main()
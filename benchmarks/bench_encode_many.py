@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+#########################################################################
+# Benchmark: MungeContext.encode_many vs. a loop of encode() calls
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""Compares the throughput of `MungeContext.encode_many()` with that of
+calling `MungeContext.encode()` in a loop. Requires a running munged."""
+
+import argparse
+import time
+
+import pymunge
+
+
+def bench_encode_loop(payloads):
+    with pymunge.MungeContext() as ctx:
+        start = time.time()
+        for payload in payloads:
+            ctx.encode(payload)
+        return time.time() - start
+
+
+def bench_encode_many(payloads):
+    with pymunge.MungeContext() as ctx:
+        start = time.time()
+        ctx.encode_many(payloads)
+        return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=10000,
+                        help='number of credentials per run')
+    parser.add_argument('-s', '--size', type=int, default=0,
+                        help='payload size in bytes')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='number of runs (the best run is reported)')
+    args = parser.parse_args()
+
+    payloads = [b'x' * args.size] * args.count
+    for name, bench in (('encode() loop', bench_encode_loop),
+                        ('encode_many()', bench_encode_many)):
+        best = min(bench(payloads) for i in range(args.repeat))
+        print('%-15s %10.0f creds/s  (%.2f us/cred)' %
+              (name, args.count / best, best / args.count * 1e6))
+
+
+if __name__ == '__main__':
+    main()
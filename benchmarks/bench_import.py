@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#########################################################################
+# Benchmark: import time of pymunge
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""Measures the time taken by `import pymunge` in a fresh interpreter,
+using the `-X importtime` option of Python 3.7+, and reports the modules
+which take the longest to import. With --budget-ms, exits with status 1
+if the median import time exceeds the budget, so that the benchmark can
+guard against import-time regressions (e.g. in short-lived command line
+tools). Does not require a running munged."""
+
+import argparse
+import os
+import subprocess
+import sys
+
+
+def import_times(module):
+    """Import module in a fresh interpreter. Returns a dict mapping each
+    imported module name to its cumulative import time in microseconds."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+        sys.path)
+    process = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(stderr.decode('utf-8', 'replace'))
+    times = {}
+    for line in stderr.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            continue  # the header line
+        times[fields[2].strip()] = cumulative
+    return times
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-m', '--module', default='pymunge',
+                        help='module to import (default: pymunge)')
+    parser.add_argument('-r', '--repeat', type=int, default=11,
+                        help='number of fresh interpreters to run')
+    parser.add_argument('-t', '--top', type=int, default=10,
+                        help='number of slowest modules to report')
+    parser.add_argument('--budget-ms', type=float, default=None,
+                        help='fail if the median import time exceeds this')
+    args = parser.parse_args()
+    if sys.version_info < (3, 7):
+        parser.error('-X importtime requires Python 3.7 or later')
+
+    runs = [import_times(args.module) for i in range(args.repeat)]
+    total = median([run[args.module] for run in runs]) / 1000.0
+    modules = set()
+    for run in runs:
+        modules.update(run)
+    slowest = sorted(((median([run.get(name, 0) for run in runs]), name)
+                      for name in modules if name != args.module),
+                     reverse=True)
+
+    print('import %s: %.1f ms (median of %d runs)' %
+          (args.module, total, args.repeat))
+    for cumulative, name in slowest[:args.top]:
+        print('  %-30s %8.1f ms' % (name, cumulative / 1000.0))
+    for name in ('pymunge._libmunge', 'pymunge.executor',
+                 'concurrent.futures', 'socket', 'numpy'):
+        if any(name in run for run in runs):
+            print('  note: %s is imported eagerly' % name)
+
+    if args.budget_ms is not None and total > args.budget_ms:
+        print('FAIL: %.1f ms exceeds the budget of %.1f ms' %
+              (total, args.budget_ms))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
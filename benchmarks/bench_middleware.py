@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#########################################################################
+# Benchmark: WSGI/ASGI middleware vs. inline decode under load
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""Load test of the WSGI and ASGI middleware of `pymunge.middleware`,
+compared with the naive approach of calling `pymunge.decode()` inline in
+the request handler. The applications are driven in-process (by
+concurrent asyncio tasks for ASGI and by a thread pool, like a threaded
+server, for WSGI) against a `pymunge.testing.FakeMungeDaemon` with the
+given latency, so the results measure the cost of authentication rather
+than of an HTTP server.
+
+A fraction of the requests (--retries) repeats the credential of the
+previous request, like a client retrying a request. munged rejects these
+as replayed, so the inline decode rejects them; the middleware is used
+with a `CredentialCache` and accepts them."""
+
+import argparse
+import asyncio
+import concurrent.futures
+import random
+import time
+
+import pymunge
+import pymunge.cache
+import pymunge.middleware
+import pymunge.testing
+
+
+def wsgi_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'ok']
+
+
+async def asgi_app(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': []})
+    await send({'type': 'http.response.body', 'body': b'ok'})
+
+
+def inline_decode(value):
+    """Decodes the credential of an Authorization header value, returning
+    True if it is valid."""
+    try:
+        payload, uid, gid, ctx = pymunge.decode(value.split()[-1])
+    except pymunge.MungeError:
+        return False
+    ctx.close()
+    return True
+
+
+def inline_wsgi(app):
+    def middleware(environ, start_response):
+        value = environ['HTTP_AUTHORIZATION'].encode('latin-1')
+        if not inline_decode(value):
+            start_response('401 Unauthorized', [])
+            return [b'']
+        return app(environ, start_response)
+    return middleware
+
+
+def inline_asgi(app):
+    async def middleware(scope, receive, send):
+        if not inline_decode(dict(scope['headers'])[b'authorization']):
+            await send({'type': 'http.response.start', 'status': 401,
+                        'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        await app(scope, receive, send)
+    return middleware
+
+
+def make_requests(count, retries, rng):
+    """Returns a list of Authorization header values (bytes)."""
+    creds = pymunge.encode_many([b'request'] * count)
+    values = []
+    for cred in creds:
+        if values and rng.random() < retries:
+            values.append(values[-1])
+        else:
+            values.append(b'MUNGE ' + cred)
+    return values
+
+
+def run_wsgi(app, values, clients):
+    def request(value):
+        environ = {'REQUEST_METHOD': 'GET',
+                   'HTTP_AUTHORIZATION': value.decode('latin-1')}
+        statuses = []
+
+        def start_response(status, headers):
+            statuses.append(status)
+        b''.join(app(environ, start_response))
+        return statuses[0].startswith('200')
+
+    with concurrent.futures.ThreadPoolExecutor(clients) as executor:
+        start = time.time()
+        accepted = sum(executor.map(request, values))
+        return time.time() - start, accepted
+
+
+def run_asgi(app, values, clients):
+    async def receive():
+        return {'type': 'http.request'}
+
+    async def client(requests, accepted):
+        for value in requests:
+            statuses = []
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    statuses.append(message['status'])
+            await app({'type': 'http', 'method': 'GET',
+                       'headers': [(b'authorization', value)]},
+                      receive, send)
+            accepted.append(statuses[0] == 200)
+
+    async def main():
+        requests = iter(values)
+        accepted = []
+        start = time.time()
+        await asyncio.gather(*[client(requests, accepted)
+                               for i in range(clients)])
+        return time.time() - start, sum(accepted)
+
+    return asyncio.new_event_loop().run_until_complete(main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=5000,
+                        help='number of requests per run')
+    parser.add_argument('-c', '--clients', type=int, default=64,
+                        help='number of concurrent clients')
+    parser.add_argument('-w', '--workers', type=int, default=16,
+                        help='number of middleware worker threads')
+    parser.add_argument('-l', '--latency', type=float, default=0.001,
+                        help='latency of the stand-in daemon in seconds')
+    parser.add_argument('-r', '--retries', type=float, default=0.1,
+                        help='fraction of requests retrying the previous '
+                        'request')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='seed for choosing the retried requests')
+    args = parser.parse_args()
+
+    with pymunge.testing.FakeMungeDaemon(workers=32,
+                                         latency=args.latency) as daemon:
+        with daemon.install():
+            run(args)
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    authenticator = pymunge.middleware.MungeAuthenticator(
+        workers=args.workers, max_pending=args.count,
+        cache=pymunge.cache.CredentialCache())
+    scenarios = [
+        ('WSGI inline decode', run_wsgi, inline_wsgi(wsgi_app)),
+        ('WSGI middleware', run_wsgi,
+         pymunge.middleware.MungeWSGIMiddleware(wsgi_app, authenticator)),
+        ('ASGI inline decode', run_asgi, inline_asgi(asgi_app)),
+        ('ASGI middleware', run_asgi,
+         pymunge.middleware.MungeASGIMiddleware(asgi_app, authenticator)),
+    ]
+    print('%-20s%12s%12s' % ('', 'requests/s', 'accepted'))
+    try:
+        for name, run_scenario, app in scenarios:
+            values = make_requests(args.count, args.retries, rng)
+            elapsed, accepted = run_scenario(app, values, args.clients)
+            print('%-20s%12.0f%11.1f%%' % (name, len(values) / elapsed,
+                                           100.0 * accepted / len(values)))
+    finally:
+        authenticator.close()
+
+
+if __name__ == '__main__':
+    main()
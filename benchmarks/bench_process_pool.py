@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+#########################################################################
+# Benchmark: ProcessPoolDecoder scaling
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""Measures how the decode throughput of `ProcessPoolDecoder` scales
+with the number of worker processes, with a CPU-heavy payload
+post-processing step. Requires a running munged."""
+
+import argparse
+import functools
+import hashlib
+import os
+import time
+
+import pymunge
+
+
+def postprocess(payload, uid, gid, iterations):
+    """Simulates CPU-heavy payload processing."""
+    return hashlib.pbkdf2_hmac('sha256', payload, b'salt', iterations)
+
+
+def bench_decode(processes, creds, iterations):
+    fn = functools.partial(postprocess, iterations=iterations)
+    with pymunge.ProcessPoolDecoder(processes, postprocess=fn) as decoder:
+        # start the worker processes before measuring
+        list(decoder.decode([b'MUNGE:warmup:'] * processes))
+        start = time.time()
+        for code, result, uid, gid in decoder.decode(creds):
+            assert code == 0
+        return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=5000,
+                        help='number of credentials per run')
+    parser.add_argument('-p', '--max-processes', type=int,
+                        default=os.cpu_count(),
+                        help='maximum number of worker processes')
+    parser.add_argument('-i', '--iterations', type=int, default=1000,
+                        help='PBKDF2 iterations per payload (CPU cost)')
+    args = parser.parse_args()
+
+    baseline = None
+    for processes in range(1, args.max_processes + 1):
+        creds = pymunge.encode_many([b'payload'] * args.count)
+        elapsed = bench_decode(processes, creds, args.iterations)
+        if baseline is None:
+            baseline = elapsed
+        print('%3d processes  %10.0f creds/s  speedup %.2fx' %
+              (processes, args.count / elapsed, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#########################################################################
+# Benchmark: pymunge.raw wrapper call overhead vs. the fast path
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""Measures the per-call overhead of the compatibility wrappers in
+`pymunge.raw` (variadic `munge_ctx_get`/`munge_ctx_set`, `munge_encode`/
+`munge_decode` with parameter flags and error check callbacks) against
+the fast path used by `MungeContext` (typed prototypes, preallocated
+out-parameters, inline error checks). The option benchmarks do not
+contact munged; the encode/decode benchmarks require a running munged."""
+
+import argparse
+import ctypes
+import time
+
+import pymunge
+import pymunge.raw as raw
+
+
+def timed(fn, count):
+    start = time.time()
+    for i in range(count):
+        fn()
+    return time.time() - start
+
+
+def option_benchmarks(ctx):
+    handle = ctx.ctx
+    buffers = ctx._buffers
+    get_int, int_val, int_ref = buffers.getters[ctypes.c_int]
+    set_int = buffers.setters[ctypes.c_int]
+
+    def shim_get():
+        val = ctypes.c_int()
+        raw.munge_ctx_get(handle, raw.MUNGE_OPT_TTL, ctypes.byref(val))
+        return val.value
+
+    def shim_set():
+        raw.munge_ctx_set(handle, raw.MUNGE_OPT_TTL, ctypes.c_int(60))
+
+    def typed_get():
+        if get_int(handle, raw.MUNGE_OPT_TTL, int_ref):
+            raise RuntimeError('munge_ctx_get failed')
+        return int_val.value
+
+    def typed_set():
+        if set_int(handle, raw.MUNGE_OPT_TTL, 60):
+            raise RuntimeError('munge_ctx_set failed')
+
+    def property_get():
+        return ctx.ttl
+
+    def property_set():
+        ctx.ttl = 60
+
+    return [('munge_ctx_get (compat)', shim_get),
+            ('munge_ctx_get (typed)', typed_get),
+            ('MungeContext.ttl get', property_get),
+            ('munge_ctx_set (compat)', shim_set),
+            ('munge_ctx_set (typed)', typed_set),
+            ('MungeContext.ttl set', property_set)]
+
+
+def codec_benchmarks(ctx):
+    handle = ctx.ctx
+    payload = b'x' * 64
+
+    def compat():
+        cred = raw.munge_encode(handle, payload, len(payload))
+        raw.munge_decode(cred, handle)
+
+    def fast():
+        ctx.decode(ctx.encode(payload))
+
+    return [('encode+decode (compat)', compat),
+            ('encode+decode (fast)', fast)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=200000,
+                        help='number of calls per option benchmark run')
+    parser.add_argument('-c', '--codec-count', type=int, default=5000,
+                        help='number of calls per encode/decode run')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='number of runs (the best run is reported)')
+    parser.add_argument('--no-daemon', action='store_true',
+                        help='skip the encode/decode benchmarks')
+    args = parser.parse_args()
+
+    with pymunge.MungeContext() as ctx:
+        runs = [(name, fn, args.count) for name, fn in option_benchmarks(ctx)]
+        if not args.no_daemon:
+            runs += [(name, fn, args.codec_count)
+                     for name, fn in codec_benchmarks(ctx)]
+        for name, fn, count in runs:
+            best = min(timed(fn, count) for i in range(args.repeat))
+            print('%-25s %8.3f us/call' % (name, best / count * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,458 @@
+#!/usr/bin/env python
+#########################################################################
+# Benchmark suite: the hot paths of pymunge, with revision comparison
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""Measures each hot path of pymunge separately: creating, copying and
+closing a `MungeContext`, every option getter and setter, encoding and
+decoding across payload sizes from 0 bytes up to the largest payload
+the daemon accepts, the cost of raising a `MungeError`, and the
+module-level `pymunge.encode()`/`pymunge.decode()` functions compared
+with reusing a context.
+
+Each benchmark is calibrated so that a run takes at least --min-time
+seconds, and is repeated --repeat times. `run` prints a table and, with
+-o, writes the results and the environment (Python, pymunge revision,
+backend, daemon) as JSON. `compare` reports the change between two such
+files. To compare two revisions, either run the suite on each checkout,
+or let it check out a revision into a temporary git worktree:
+
+    bench_suite.py run --fake-munged -o new.json
+    bench_suite.py run --fake-munged --revision master -o old.json
+    bench_suite.py compare old.json new.json
+
+The benchmarks run against munged, or against a
+`pymunge.testing.FakeMungeDaemon` with --fake-munged (the revision
+being measured must provide `pymunge.testing`). Benchmarks for features
+which a revision does not have are skipped."""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import pymunge
+
+#: Default payload sizes for the encode/decode benchmarks; the largest
+#: payload accepted by the daemon is added.
+PAYLOAD_SIZES = [0, 64, 1024, 16384, 262144]
+
+#: Upper bound of the search for the largest payload (munged rejects
+#: requests of more than 1 MiB by default).
+MAX_PAYLOAD = 1 << 20
+
+#: Format version of the JSON results
+RESULTS_VERSION = 1
+
+
+def timed(fn, count):
+    start = time.perf_counter()
+    for i in range(count):
+        fn()
+    return time.perf_counter() - start
+
+
+def calibrate(fn, min_time):
+    """Return the number of calls of fn taking at least min_time seconds."""
+    count = 1
+    while True:
+        elapsed = timed(fn, count)
+        if elapsed >= min_time:
+            return count
+        if elapsed <= 0:
+            count *= 10
+        else:
+            count = max(count * 2,
+                        int(count * min_time * 1.2 / elapsed) + 1)
+
+
+def decode_replayed(ctx, cred):
+    """Decode cred, accepting EMUNGE_CRED_REPLAYED (munged checks for
+    replays after validating the credential, so the cost is the same)."""
+    try:
+        return ctx.decode(cred)
+    except pymunge.MungeError as e:
+        if e.code != pymunge.MungeErrorCode.EMUNGE_CRED_REPLAYED:
+            raise
+
+
+def max_payload(ctx, limit):
+    """Return the largest payload size up to limit for which a credential
+    can be encoded and decoded."""
+    def accepted(size):
+        try:
+            ctx.decode(ctx.encode(b'x' * size))
+        except pymunge.MungeError:
+            return False
+        return True
+
+    if accepted(limit):
+        return limit
+    good, bad = 0, limit
+    while bad - good > max(1, good // 100):
+        middle = (good + bad) // 2
+        if accepted(middle):
+            good = middle
+        else:
+            bad = middle
+    return good
+
+
+def context_benchmarks(ctx, args):
+    def create_close():
+        pymunge.MungeContext().close()
+
+    def copy_close():
+        pymunge.MungeContext(ctx).close()
+
+    return [('context.create+close', create_close),
+            ('context.copy+close', copy_close)]
+
+
+def option_benchmarks(ctx, args):
+    benchmarks = []
+    for name in ('cipher_type', 'mac_type', 'zip_type', 'realm', 'ttl',
+                 'addr4', 'encode_time', 'decode_time', 'socket',
+                 'uid_restriction', 'gid_restriction'):
+        prop = getattr(type(ctx), name)
+        value = prop.__get__(ctx)
+        benchmarks.append(('option.%s.get' % name,
+                           lambda getter=prop.__get__: getter(ctx)))
+        if prop.fset is not None:
+            benchmarks.append(('option.%s.set' % name,
+                               lambda setter=prop.fset, value=value:
+                               setter(ctx, value)))
+    return benchmarks
+
+
+def codec_benchmarks(ctx, args):
+    sizes = sorted(set(args.payload_sizes +
+                       [max_payload(ctx, args.max_payload)]))
+    benchmarks = []
+    for size in sizes:
+        payload = b'x' * size
+        cred = ctx.encode(payload)
+        benchmarks.append(('encode[%d]' % size,
+                           lambda payload=payload: ctx.encode(payload)))
+        benchmarks.append(('decode[%d]' % size,
+                           lambda cred=cred: decode_replayed(ctx, cred)))
+    return benchmarks
+
+
+def error_benchmarks(ctx, args):
+    closed = pymunge.MungeContext()
+    closed.close()
+    invalid = b'MUNGE:' + b'A' * 100 + b':'
+    cred = ctx.encode(b'x' * 64)
+    decode_replayed(ctx, cred)
+
+    def expect_error(fn, *fn_args):
+        def call():
+            try:
+                fn(*fn_args)
+            except pymunge.MungeError:
+                return
+            raise RuntimeError('no MungeError raised')
+        return call
+
+    def get_ttl(context):
+        return context.ttl
+
+    return [('error.closed_context', expect_error(get_ttl, closed)),
+            ('error.invalid_cred', expect_error(ctx.decode, invalid)),
+            ('error.replayed', expect_error(ctx.decode, cred))]
+
+
+def reuse_benchmarks(ctx, args):
+    payload = b'x' * 64
+    cred = ctx.encode(payload)
+
+    def module_decode():
+        try:
+            pymunge.decode(cred)[3].close()
+        except pymunge.MungeError as e:
+            if e.code != pymunge.MungeErrorCode.EMUNGE_CRED_REPLAYED:
+                raise
+
+    def fresh_encode():
+        with pymunge.MungeContext() as context:
+            context.encode(payload)
+
+    def fresh_decode():
+        with pymunge.MungeContext() as context:
+            decode_replayed(context, cred)
+
+    return [('module.encode', lambda: pymunge.encode(payload)),
+            ('module.decode', module_decode),
+            ('fresh_context.encode', fresh_encode),
+            ('fresh_context.decode', fresh_decode),
+            ('reused_context.encode', lambda: ctx.encode(payload)),
+            ('reused_context.decode', lambda: decode_replayed(ctx, cred))]
+
+
+GROUPS = [('context', context_benchmarks, False),
+          ('option', option_benchmarks, False),
+          ('codec', codec_benchmarks, True),
+          ('error', error_benchmarks, True),
+          ('reuse', reuse_benchmarks, True)]
+
+
+def git_revision(path):
+    """Return (revision, dirty) of the git checkout containing path, or
+    (None, None) if it is not in a git checkout."""
+    def git(*git_args):
+        process = subprocess.Popen(['git', '-C', path] + list(git_args),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        if process.returncode != 0:
+            raise OSError(stderr.decode('utf-8', 'replace'))
+        return stdout.decode('utf-8').strip()
+
+    try:
+        return (git('rev-parse', 'HEAD'),
+                bool(git('status', '--porcelain', '--untracked-files=no')))
+    except OSError:
+        return None, None
+
+
+def environment(args):
+    revision, dirty = git_revision(
+        os.path.dirname(os.path.abspath(pymunge.__file__)))
+    backend = None
+    if hasattr(pymunge, 'MungeContext') and \
+            hasattr(pymunge.MungeContext, 'backend'):
+        with pymunge.MungeContext() as ctx:
+            backend = ctx.backend.name
+    return {'python': sys.version.split()[0],
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'pymunge': os.path.dirname(os.path.abspath(pymunge.__file__)),
+            'revision': revision,
+            'dirty': dirty,
+            'backend': backend,
+            'daemon': 'fake' if args.fake_munged else
+                      ('none' if args.no_daemon else 'munged'),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def run_benchmarks(args):
+    results = []
+    with pymunge.MungeContext() as ctx:
+        for group, make_benchmarks, needs_daemon in GROUPS:
+            if needs_daemon and args.no_daemon:
+                continue
+            try:
+                benchmarks = make_benchmarks(ctx, args)
+            except (AttributeError, ImportError) as e:
+                print('%-32s skipped (%s)' % (group, e))
+                continue
+            for name, fn in benchmarks:
+                if args.filter and not any(pattern in name
+                                           for pattern in args.filter):
+                    continue
+                count = calibrate(fn, args.min_time)
+                runs = [timed(fn, count) / count * 1e6
+                        for i in range(args.repeat)]
+                result = {'name': name, 'group': group, 'count': count,
+                          'runs': runs, 'best': min(runs),
+                          'median': statistics.median(runs),
+                          'stdev': statistics.stdev(runs)
+                                   if len(runs) > 1 else 0.0}
+                print('%-32s %12.3f %12.3f %7.1f%%' % (
+                    name, result['best'], result['median'],
+                    100 * result['stdev'] / result['median']
+                    if result['median'] else 0.0))
+                results.append(result)
+    return results
+
+
+def run(args):
+    if args.revision is not None:
+        return run_revision(args)
+    if args.backend is not None:
+        import pymunge.backend
+        pymunge.backend.set_backend(args.backend)
+    env = environment(args)
+    print('%-32s %12s %12s %8s' % ('us/call', 'best', 'median', 'stdev'))
+    if args.fake_munged:
+        import pymunge.testing
+        with pymunge.testing.FakeMungeDaemon() as daemon:
+            with daemon.install():
+                results = run_benchmarks(args)
+    else:
+        results = run_benchmarks(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'version': RESULTS_VERSION, 'environment': env,
+                       'benchmarks': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+    return 0
+
+
+def run_revision(args):
+    """Check out args.revision into a temporary git worktree and run the
+    suite (this version of it) against the pymunge of that revision in
+    a subprocess."""
+    checkout = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    tmpdir = tempfile.mkdtemp(prefix='pymunge-bench-')
+    tree = os.path.join(tmpdir, 'tree')
+    command = [sys.executable, os.path.abspath(__file__), 'run',
+               '--min-time', str(args.min_time),
+               '--repeat', str(args.repeat),
+               '--max-payload', str(args.max_payload),
+               '--payload-sizes',
+               ','.join(str(size) for size in args.payload_sizes)]
+    for flag in ('fake_munged', 'no_daemon'):
+        if getattr(args, flag):
+            command.append('--' + flag.replace('_', '-'))
+    for pattern in args.filter or []:
+        command += ['-k', pattern]
+    if args.backend is not None:
+        command += ['--backend', args.backend]
+    if args.output is not None:
+        command += ['--output', os.path.abspath(args.output)]
+    env = dict(os.environ)
+    env['PYTHONPATH'] = tree
+    try:
+        status = subprocess.call(['git', '-C', checkout, 'worktree', 'add',
+                                  '--detach', tree, args.revision])
+        if status != 0:
+            return status
+        try:
+            return subprocess.call(command, env=env, cwd=tmpdir)
+        finally:
+            subprocess.call(['git', '-C', checkout, 'worktree', 'remove',
+                             '--force', tree])
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def describe(env):
+    revision = (env.get('revision') or 'unknown revision')[:12]
+    if env.get('dirty'):
+        revision += ' (modified)'
+    return '%s, %s %s, backend %s, daemon %s' % (
+        revision, env.get('implementation'), env.get('python'),
+        env.get('backend'), env.get('daemon'))
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print('base: %s' % describe(base['environment']))
+    print('new:  %s' % describe(new['environment']))
+    print()
+    base_results = dict((result['name'], result)
+                        for result in base['benchmarks'])
+    print('%-32s %12s %12s %8s' % ('us/call (best)', 'base', 'new',
+                                   'change'))
+    slower = 0
+    for result in new['benchmarks']:
+        name = result['name']
+        old = base_results.pop(name, None)
+        if old is None:
+            print('%-32s %12s %12.3f %8s' % (name, '-', result['best'],
+                                             'added'))
+            continue
+        change = (result['best'] / old['best'] - 1) * 100 \
+            if old['best'] else 0.0
+        # a change counts if it exceeds the threshold and the runs of
+        # both results do not overlap
+        verdict = ''
+        if abs(change) >= args.threshold:
+            if min(result['runs']) > max(old['runs']):
+                verdict = 'slower'
+                slower += 1
+            elif max(result['runs']) < min(old['runs']):
+                verdict = 'faster'
+        print(('%-32s %12.3f %12.3f %+7.1f%% %s' % (
+            name, old['best'], result['best'], change, verdict)).rstrip())
+    for name in base_results:
+        print('%-32s %12.3f %12s %8s' % (name, base_results[name]['best'],
+                                         '-', 'removed'))
+    return 1 if slower and args.fail_slower else 0
+
+
+def sizes(value):
+    return [int(size) for size in value.split(',') if size]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('-o', '--output',
+                            help='write the results to this JSON file')
+    run_parser.add_argument('-r', '--repeat', type=int, default=5,
+                            help='number of runs per benchmark')
+    run_parser.add_argument('--min-time', type=float, default=0.1,
+                            help='minimum duration of a run in seconds')
+    run_parser.add_argument('-k', '--filter', action='append',
+                            help='only run benchmarks whose name contains '
+                            'this string (can be given more than once)')
+    run_parser.add_argument('--payload-sizes', type=sizes,
+                            default=PAYLOAD_SIZES,
+                            help='comma-separated payload sizes in bytes')
+    run_parser.add_argument('--max-payload', type=int, default=MAX_PAYLOAD,
+                            help='upper bound of the largest payload size')
+    run_parser.add_argument('-b', '--backend',
+                            help='libmunge backend (see pymunge.backend)')
+    run_parser.add_argument('--fake-munged', action='store_true',
+                            help='run against a stand-in daemon (see '
+                            'pymunge.testing) instead of munged')
+    run_parser.add_argument('--no-daemon', action='store_true',
+                            help='skip the benchmarks which need a daemon')
+    run_parser.add_argument('--revision',
+                            help='benchmark this git revision, checked out '
+                            'into a temporary worktree')
+    run_parser.set_defaults(fn=run)
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='compare the results of two runs')
+    compare_parser.add_argument('base', help='JSON results of the baseline')
+    compare_parser.add_argument('new', help='JSON results to compare')
+    compare_parser.add_argument('-t', '--threshold', type=float, default=5,
+                                help='minimum change in percent to report '
+                                'as faster/slower')
+    compare_parser.add_argument('--fail-slower', action='store_true',
+                                help='exit with status 1 if a benchmark '
+                                'got slower')
+    compare_parser.set_defaults(fn=compare)
+
+    args = parser.parse_args()
+    sys.exit(args.fn(args))
+
+
+if __name__ == '__main__':
+    main()
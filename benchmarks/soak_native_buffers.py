@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#########################################################################
+# Soak test: native buffer memory stays flat across encode/decode
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""Soak test for native memory management: runs many encode/decode
+cycles and checks that the resident set size stays flat, i.e. that the
+memory libmunge allocates for credentials and payloads is released.
+Exits with status 1 if the RSS grows by more than the allowed amount
+after the warm-up phase. Requires a running munged."""
+
+import argparse
+import resource
+import sys
+import time
+
+import pymunge
+
+
+def rss_kib():
+    """Return the current resident set size in KiB."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+    except (IOError, OSError):
+        # peak RSS (KiB on Linux, bytes on macOS); still flat without leaks
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def run_cycles(ctx, payload, count, batch):
+    """Run `count` encode/decode cycles, alternating between single and
+    batch calls to exercise all code paths that free native memory."""
+    done = 0
+    while done < count:
+        n = min(batch, count - done)
+        creds = ctx.encode_many([payload] * n)
+        ctx.decode_many(creds)
+        for i in range(n):
+            ctx.decode(ctx.encode(payload))
+        try:
+            ctx.decode(creds[0])   # replayed: error path with a result
+        except pymunge.MungeError:
+            pass
+        done += n
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=1000000,
+                        help='number of encode/decode cycles (each cycle '
+                             'encodes and decodes two credentials)')
+    parser.add_argument('-s', '--size', type=int, default=4096,
+                        help='payload size in bytes')
+    parser.add_argument('-w', '--warmup', type=int, default=10000,
+                        help='number of cycles before the baseline RSS '
+                             'is taken')
+    parser.add_argument('-i', '--interval', type=int, default=100000,
+                        help='number of cycles between RSS reports')
+    parser.add_argument('--max-growth', type=int, default=4096,
+                        help='allowed RSS growth after warm-up in KiB')
+    args = parser.parse_args()
+
+    payload = b'x' * args.size
+    batch = 100
+    with pymunge.MungeContext() as ctx:
+        run_cycles(ctx, payload, args.warmup, batch)
+        baseline = rss_kib()
+        print('baseline RSS after %d cycles: %d KiB' %
+              (args.warmup, baseline))
+        start = time.time()
+        done = 0
+        while done < args.count:
+            n = min(args.interval, args.count - done)
+            run_cycles(ctx, payload, n, batch)
+            done += n
+            print('%10d cycles  RSS %8d KiB  (%+d KiB)  %.0f cycles/s' %
+                  (done, rss_kib(), rss_kib() - baseline,
+                   done / (time.time() - start)))
+    growth = rss_kib() - baseline
+    if growth > args.max_growth:
+        print('FAIL: RSS grew by %d KiB (allowed: %d KiB)' %
+              (growth, args.max_growth))
+        sys.exit(1)
+    print('OK: RSS grew by %d KiB (allowed: %d KiB)' %
+          (growth, args.max_growth))
+
+
+if __name__ == '__main__':
+    main()
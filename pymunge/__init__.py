@@ -52,7 +52,14 @@ MUNGE links:
 from pymunge._version import __version__
 
 import pymunge.context
-from pymunge.context import MungeContext, encode, decode
+from pymunge.context import MungeContext, encode, encode_many, \
+    decode, decode_many
+
+import pymunge.batch
+from pymunge.batch import DecodeBatch
+
+import pymunge.result
+from pymunge.result import DecodeResult
 
 import pymunge.error
 from pymunge.error import MungeError, MungeErrorCode
@@ -61,9 +68,69 @@ import pymunge.enums
 from pymunge.enums import CipherType, MACType, ZipType, \
     TTL_MAXIMUM, TTL_DEFAULT, UID_ANY, GID_ANY
 
+import pymunge.spec
+from pymunge.spec import ContextSpec
+
+import pymunge.pool
+from pymunge.pool import MungeContextPool
+
+import pymunge.metrics
+
+import pymunge.hooks
+
 import pymunge.raw
 
-__all__ = ['MungeContext', 'encode', 'decode',
+import sys as _sys
+
+# pymunge.executor imports concurrent.futures, pymunge.cache,
+# pymunge.stream and pymunge.files import hashlib, and pymunge.tune and
+# pymunge.audit import json, which are slow to import; they (and the
+# rarely used pymunge.prefetch) are imported when one of their names is
+# first used.
+_LAZY_NAMES = {
+    'executor': ('executor', None),
+    'MungeExecutor': ('executor', 'MungeExecutor'),
+    'ProcessPoolDecoder': ('executor', 'ProcessPoolDecoder'),
+    'cache': ('cache', None),
+    'CredentialCache': ('cache', 'CredentialCache'),
+    'prefetch': ('prefetch', None),
+    'CredentialPrefetcher': ('prefetch', 'CredentialPrefetcher'),
+    'stream': ('stream', None),
+    'files': ('files', None),
+    'encode_file': ('files', 'encode_file'),
+    'verify_file': ('files', 'verify_file'),
+    'tune': ('tune', None),
+    'audit': ('audit', None),
+}
+
+def __getattr__(name):
+    if name not in _LAZY_NAMES:
+        raise AttributeError("module %r has no attribute %r" %
+                             (__name__, name))
+    module_name, attr = _LAZY_NAMES[name]
+    module = __import__('pymunge.' + module_name, fromlist=[attr or '_'])
+    if attr is None:
+        return module
+    return getattr(module, attr)
+
+if _sys.version_info < (3, 7):
+    import pymunge.executor
+    from pymunge.executor import MungeExecutor, ProcessPoolDecoder
+    import pymunge.cache
+    from pymunge.cache import CredentialCache
+    import pymunge.prefetch
+    from pymunge.prefetch import CredentialPrefetcher
+    import pymunge.stream
+    import pymunge.files
+    from pymunge.files import encode_file, verify_file
+    import pymunge.tune
+    import pymunge.audit
+
+__all__ = ['MungeContext', 'encode', 'encode_many', 'decode', 'decode_many',
+           'DecodeBatch', 'DecodeResult', 'ContextSpec', 'MungeContextPool',
+           'CredentialCache', 'CredentialPrefetcher', 'encode_file',
+           'verify_file',
+           'MungeExecutor', 'ProcessPoolDecoder',
            'MungeError', 'MungeErrorCode',
            'CipherType', 'MACType', 'ZipType',
            'TTL_MAXIMUM', 'TTL_DEFAULT', 'UID_ANY', 'GID_ANY']
@@ -0,0 +1,174 @@
+#########################################################################
+# Module pymunge._instrument - instrumented libmunge calls
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""pymunge internal - this module performs the libmunge calls of
+`MungeContext` and `MungeContextPool` while metrics (`pymunge.metrics`)
+or hooks (`pymunge.hooks`) are enabled. The callers check `active`
+before each call, and call the functions of this module instead of the
+backend if it is True, so that disabled instrumentation costs a single
+branch."""
+
+from pymunge.error import MungeError, MungeErrorCode
+import pymunge.hooks
+import pymunge.metrics
+import pymunge.raw
+import ctypes
+import time
+
+#: True if metrics or hooks are enabled.
+active = False
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+_SUCCESS = MungeErrorCode.EMUNGE_SUCCESS.value
+
+# libmunge function called by each operation, as reported to hooks
+_FUNCTIONS = {
+    'ctx_create': 'munge_ctx_create',
+    'ctx_copy': 'munge_ctx_copy',
+    'ctx_destroy': 'munge_ctx_destroy',
+    'option_get': 'munge_ctx_get',
+    'option_set': 'munge_ctx_set',
+}
+
+def update():
+    """pymunge internal - recompute `active`; called when metrics or hooks
+    are enabled or disabled"""
+    global active
+    active = pymunge.metrics.enabled or pymunge.hooks.active
+
+def encode(backend, buffers, handle, payload):
+    """pymunge internal - call backend.encode()"""
+    size = len(payload) if payload is not None else 0
+    info = _begin('munge_encode', backend, buffers, handle, size)
+    start = _clock()
+    if info is None:
+        error_code, cred = backend.encode(buffers, handle, payload)
+    else:
+        with _NativeTimer(buffers, 'munge_encode', info):
+            error_code, cred = backend.encode(buffers, handle, payload)
+    elapsed = _clock() - start
+    if pymunge.metrics.enabled:
+        pymunge.metrics.record_codec('encode', backend, buffers, handle,
+                                     error_code, size, elapsed)
+    if info is not None:
+        pymunge.hooks.end(info, error_code, elapsed)
+    return error_code, cred
+
+def decode(backend, buffers, handle, cred):
+    """pymunge internal - call backend.decode()"""
+    info = _begin('munge_decode', backend, buffers, handle, None)
+    start = _clock()
+    if info is None:
+        result = backend.decode(buffers, handle, cred)
+    else:
+        with _NativeTimer(buffers, 'munge_decode', info):
+            result = backend.decode(buffers, handle, cred)
+    elapsed = _clock() - start
+    if pymunge.metrics.enabled:
+        pymunge.metrics.record_codec('decode', backend, buffers, handle,
+                                     result[0], result[2], elapsed)
+    if info is not None:
+        info.payload_length = result[2]
+        pymunge.hooks.end(info, result[0], elapsed)
+    return result
+
+def call(operation, fn, *args):
+    """pymunge internal - return fn(*args), where fn is the backend's
+    ctx_create(), ctx_copy() or ctx_destroy() (as given by operation)"""
+    return _call(operation, None, fn, args)
+
+def option(operation, fn, buffers, handle, option, *args):
+    """pymunge internal - call fn, the backend's get_option() or
+    set_option() (as given by operation), for the `MUNGE_OPT_*` value
+    option"""
+    return _call(operation, option, fn, (buffers, handle, option) + args)
+
+def _call(operation, option, fn, args):
+    info = None
+    if pymunge.hooks.active and pymunge.hooks.sample():
+        info = pymunge.hooks.begin(_FUNCTIONS[operation], None, None)
+    error_code = None
+    start = _clock()
+    try:
+        result = fn(*args)
+        error_code = _SUCCESS
+        return result
+    except MungeError as e:
+        error_code = e.code.value
+        raise
+    finally:
+        elapsed = _clock() - start
+        if pymunge.metrics.enabled and error_code is not None:
+            pymunge.metrics.record_call(operation, error_code, option,
+                                        elapsed)
+        if info is not None:
+            pymunge.hooks.end(info, error_code, elapsed)
+
+def _begin(function, backend, buffers, handle, payload_length):
+    """Return a `pymunge.hooks.CallInfo` for a call of function if hooks
+    are enabled and the call is sampled, otherwise None."""
+    if not pymunge.hooks.active or not pymunge.hooks.sample():
+        return None
+    try:
+        socket = backend.get_option(buffers, handle,
+                                    pymunge.raw.MUNGE_OPT_SOCKET,
+                                    ctypes.c_char_p)
+    except MungeError:
+        socket = None
+    if socket is not None:
+        socket = socket.decode('utf-8')
+    return pymunge.hooks.begin(function, socket, payload_length)
+
+class _NativeTimer(object):
+    """pymunge internal - replaces the native function `name` of a
+    context's buffers (see `pymunge.backend.Backend.new_buffers()`) by a
+    wrapper which stores the time spent in it as the `native_time` of
+    info. Buffers belong to one context, which is used by one thread at
+    a time, so this does not affect other threads."""
+
+    def __init__(self, buffers, name, info):
+        self.buffers = buffers
+        self.name = name
+        self.info = info
+        self.function = None
+
+    def __enter__(self):
+        function = getattr(self.buffers, self.name, None)
+        if function is None:
+            return self
+        info = self.info
+
+        def timed(*args):
+            start = _clock()
+            try:
+                return function(*args)
+            finally:
+                info.native_time = _clock() - start
+
+        self.function = function
+        setattr(self.buffers, self.name, timed)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.function is not None:
+            setattr(self.buffers, self.name, self.function)
@@ -0,0 +1,390 @@
+#########################################################################
+# Module pymunge._libmunge - loading and binding of libmunge
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""pymunge internal - this module loads the libmunge shared library and
+declares its functions. It is imported by `pymunge.raw` on first use of
+a libmunge function (see `pymunge.raw.load()`), which then provides all
+of the names declared here; use `pymunge.raw` instead of importing this
+module directly.
+
+libmunge is located as follows:
+
+* If the environment variable `PYMUNGE_LIBMUNGE` is set, the library at
+  that path (or with that name) is loaded; failing to load it is an
+  error.
+* Otherwise, the known sonames of libmunge (`SONAMES`) are loaded
+  directly, which is fast since it does not search the file system.
+* Otherwise, `ctypes.util.find_library('munge')` is used, which may run
+  external programs (e.g. ldconfig) to locate the library.
+"""
+
+from pymunge.raw import check_and_raise, take_bytes, munge_ctx_t, \
+    munge_err_t, munge_opt_t, munge_enum_t, uid_t, gid_t, time_t
+import ctypes
+import os
+import sys
+
+#: Name of the environment variable overriding the libmunge path.
+LIBMUNGE_ENV = 'PYMUNGE_LIBMUNGE'
+
+#: Sonames of libmunge which are tried before searching for the library.
+SONAMES = ('libmunge.so.2', 'libmunge.2.dylib', 'libmunge.so')
+
+def find_libmunge(open_library=ctypes.CDLL):
+    """pymunge internal - locate and load libmunge with open_library (a
+    callable taking the filename and raising OSError on failure, e.g.
+    `ctypes.CDLL`). Returns `(filename, handle)`, or `(None, None)` if
+    libmunge was not found."""
+    path = os.environ.get(LIBMUNGE_ENV)
+    if path:
+        try:
+            return path, open_library(path)
+        except OSError as e:
+            raise ImportError('Failed to load libmunge from %s=%s: %s' %
+                              (LIBMUNGE_ENV, path, e))
+    for soname in SONAMES:
+        try:
+            return soname, open_library(soname)
+        except OSError:
+            pass
+    from ctypes.util import find_library
+    filename = find_library('munge')
+    if filename is not None:
+        try:
+            return filename, open_library(filename)
+        except OSError:
+            pass
+    return None, None
+
+_filename, _handle = find_libmunge()
+
+#: Name of the libmunge shared object.
+libmunge_filename = _filename
+
+#: Handle to the loaded libmunge shared object (a `ctypes.CDLL` object).
+libmunge = _handle
+if libmunge is None:
+    import warnings
+    warnings.warn("libmunge not found. All calls to pymunge.raw will fail.")
+
+#: Handle to the C library, whose `free()` releases memory allocated by
+#: libmunge (the symbols of the running process, which include libc).
+libc = ctypes.CDLL(None)
+
+_free = libc.free
+_free.restype = None
+_free.argtypes = [ctypes.c_void_p]
+
+
+def load_function(name, restype, argtypes, paramflags, errcheck=None):
+    """pymunge internal - helper to load functions from libmunge.
+    If paramflags is None, the function is loaded without parameter
+    flags, i.e. all arguments are passed through to the C function."""
+    if libmunge is None:
+        # Mock libmunge functions if the library was not found. This allows
+        # readthedocs to build the sphinx docs for the package without
+        # having libmunge installed.
+        if argtypes == "*" or paramflags is None:
+            args = "*args"
+        else:
+            argnames = [flag[1] for flag in paramflags if flag[0] & 2 == 0]
+            args = ", ".join(argnames)
+        l = {}
+        exec("def function(" + args + "):\n" +
+             "\traise ImportError('Failed to call C function " + name +
+             ": libmunge C library not found')", {}, l)
+        return l['function']
+    else:
+        if argtypes == "*":
+            function = getattr(libmunge, name)
+            function.restype = restype
+        elif paramflags is None:
+            prototype = ctypes.CFUNCTYPE(restype, *argtypes)
+            function = prototype((name, libmunge))
+        else:
+            prototype = ctypes.CFUNCTYPE(restype, *argtypes)
+            function = prototype((name, libmunge), paramflags)
+        if errcheck is not None:
+            function.errcheck = errcheck
+        return function
+
+
+# libmunge functions
+
+def errcheck_munge_encode(error_code, func, arguments):
+    """pymunge internal - error check function for munge_encode"""
+    ctx = arguments[1]
+    address = arguments[0].value
+    result = take_bytes(address) if address else None
+    check_and_raise(error_code, ctx, result)
+    return result
+
+munge_encode = load_function("munge_encode",
+    munge_err_t, [ctypes.POINTER(ctypes.c_void_p),
+        munge_ctx_t, ctypes.c_void_p, ctypes.c_int],
+    ((2, "cred"), (1, "ctx", None), (1, "buf", None), (1, "len", 0)),
+    errcheck_munge_encode)
+"""
+C prototype: `munge_err_t munge_encode(char **cred, munge_ctx_t ctx,
+const void *buf, int len);`
+
+Note: when called from Python, returns `cred` instead of the `munge_err_t`.
+
+Creates a credential contained in a base64 string.
+A payload specified by a buffer `buf` (a byte string) of length `len`
+can be encapsulated in as well.
+If the munge context `ctx` is None, the default context will be used.
+Returns the credential `cred` if the credential is successfully created;
+otherwise, raises a `MungeError` containing the error code and message.
+The error message may be more detailed if a `ctx` was specified.
+"""
+
+_munge_encode = load_function("munge_encode",
+    munge_err_t, [ctypes.POINTER(ctypes.c_void_p),
+        munge_ctx_t, ctypes.c_void_p, ctypes.c_int],
+    None)
+"""
+pymunge internal - `munge_encode` without parameter flags and error
+checking. Returns the `munge_err_t` and stores the address of the
+credential in the `cred` pointer passed as the first argument; the
+caller must release it with `free()` (e.g. via `take_bytes()`).
+Used for batch encoding.
+"""
+
+def errcheck_munge_decode(error_code, func, arguments):
+    """pymunge internal - error check function for munge_decode"""
+    ctx = arguments[1]
+    buf = take_bytes(arguments[2].value, arguments[3].value)
+    result = (buf, arguments[4].value, arguments[5].value)
+    check_and_raise(error_code, ctx, result)
+    return result
+
+munge_decode = load_function("munge_decode",
+    munge_err_t, [ctypes.c_char_p, munge_ctx_t,
+        ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_int),
+        ctypes.POINTER(uid_t), ctypes.POINTER(gid_t)],
+    ((1, "cred"), (1, "ctx", None), (2, "buf"), (2, "len"),
+     (2, "uid"), (2, "gid")),
+    errcheck_munge_decode)
+"""
+C prototype: `munge_err_t munge_decode(const char *cred, munge_ctx_t ctx,
+void **buf, int *len, uid_t *uid, gid_t *gid);`
+
+Note: when called from Python, returns `(payload, uid, gid)` instead of the
+`munge_err_t`, where `payload` is the contents of `buf` of length `len`.
+Example usage:
+
+>>> payload, uid, gid = munge_decode(cred, ctx)
+
+Validates the credential `cred`.
+If the munge context `ctx` is not None, it will be set to that used
+to encode the credential.
+If the credential is valid, returns the encapsulated payload byte string
+`payload` as well as the numeric UID `uid` and GID `gid` of the process
+that created the credential.
+If the credential is not valid, raises a `MungeError` containing the
+error code and message. The error message may be more detailed if a `ctx`
+was specified. For certain errors (ie, `EMUNGE_CRED_EXPIRED`,
+`EMUNGE_CRED_REWOUND`, `EMUNGE_CRED_REPLAYED`), the raised `MungeError` will
+contain the result `(payload, uid, gid)` which would have been returned
+if the credential were still valid.
+"""
+
+_munge_decode = load_function("munge_decode",
+    munge_err_t, [ctypes.c_char_p, munge_ctx_t,
+        ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_int),
+        ctypes.POINTER(uid_t), ctypes.POINTER(gid_t)],
+    None)
+"""
+pymunge internal - `munge_decode` without parameter flags and error
+checking. Returns the `munge_err_t` and stores the results in the
+pointers passed as the last four arguments; the caller must release the
+payload buffer with `free()` (e.g. via `take_bytes()`). Used for batch
+decoding.
+"""
+
+munge_strerror = load_function("munge_strerror",
+    ctypes.c_char_p, [munge_err_t],
+    ((1, "e"),))
+"""
+C prototype: `const char * munge_strerror(munge_err_t e);`
+
+Returns a descriptive string describing the munge errno `e`.
+"""
+
+munge_ctx_create = load_function("munge_ctx_create",
+    munge_ctx_t, [], ())
+"""
+C prototype: `munge_ctx_t munge_ctx_create(void);`
+
+Creates and returns a new munge context or None on error.
+Abandoning a context without calling `munge_ctx_destroy()` will result
+in a memory leak.
+"""
+
+munge_ctx_copy = load_function("munge_ctx_copy",
+    munge_ctx_t, [munge_ctx_t],
+    ((1, "ctx"),))
+"""
+C prototype: `munge_ctx_t munge_ctx_copy(munge_ctx_t ctx);`
+
+Copies the context `ctx`, returning a new munge context or None on error.
+Abandoning a context without calling `munge_ctx_destroy()` will result
+in a memory leak.
+"""
+
+munge_ctx_destroy = load_function("munge_ctx_destroy",
+    None, [munge_ctx_t],
+    ((1, "ctx"),))
+"""
+C prototype: `void munge_ctx_destroy(munge_ctx_t ctx);`
+
+Destroys the context `ctx`.
+"""
+
+munge_ctx_strerror = load_function("munge_ctx_strerror",
+    ctypes.c_char_p, [munge_ctx_t],
+    ((1, "ctx"),))
+"""
+C prototype: `const char * munge_ctx_strerror(munge_ctx_t ctx);`
+
+Returns a descriptive text string describing the munge error number
+according to the context `ctx`, or None if no error condition exists.
+This message may be more detailed than that returned by `munge_strerror()`.
+"""
+
+def errcheck_munge_ctx_getset(error_code, func, arguments):
+    """pymunge internal - error check function for munge_ctx_get
+    and munge_ctx_set"""
+    ctx = arguments[0]
+    check_and_raise(error_code, ctx, None)
+    return arguments
+
+_munge_ctx_get = load_function("munge_ctx_get",
+    munge_err_t, "*",
+    (),
+    errcheck_munge_ctx_getset)
+
+def munge_ctx_get(ctx, opt, ptr):
+    """
+    C prototype: `munge_err_t munge_ctx_get(munge_ctx_t ctx,
+    munge_opt_t opt, ...);`
+
+    Note: when called from Python, returns nothing.
+
+    Gets the value for the option `opt` associated with the munge context
+    `ctx`, storing the result in the subsequent pointer argument. Refer to
+    the `munge_opt_t` enum comments for argument types. If the result is a
+    string, that string should not be freed or modified by the caller.
+    Raises a `MungeError` upon failure.
+    """
+    return _munge_ctx_get(munge_ctx_t(ctx), munge_opt_t(opt), ptr)
+
+_munge_ctx_set = load_function("munge_ctx_set",
+    munge_err_t, "*",
+    (),
+    errcheck_munge_ctx_getset)
+
+def munge_ctx_set(ctx, opt, val):
+    """
+    C prototype: `munge_err_t munge_ctx_set(munge_ctx_t ctx,
+    munge_opt_t opt, ...);`
+
+    Note: when called from Python, returns nothing.
+
+    Sets the value for the option `opt` associated with the munge context
+    `ctx`, using the value of the subsequent argument. Refer to the
+    `munge_opt_t` enum comments for argument types. Raises a `MungeError`
+    upon failure.
+    """
+    return _munge_ctx_set(munge_ctx_t(ctx), munge_opt_t(opt), val)
+
+def load_option_function(name, argtype):
+    """pymunge internal - load munge_ctx_get or munge_ctx_set with a fixed
+    type for the variadic argument, and without error checking (the
+    `munge_err_t` is returned). Where variadic arguments are passed
+    differently from fixed ones (macOS), the function is called as a
+    variadic function instead."""
+    if libmunge is None or not _VARIADIC_CALLS:
+        return load_function(name, munge_err_t,
+                             [munge_ctx_t, munge_opt_t, argtype], None)
+    function = libmunge[name]
+    function.restype = munge_err_t
+
+    def call(ctx, opt, arg):
+        return function(munge_ctx_t(ctx), munge_opt_t(opt), arg)
+    return call
+
+# Variadic arguments are passed like fixed ones on the supported
+# Linux/BSD ABIs, but on the stack on e.g. macOS/arm64.
+_VARIADIC_CALLS = sys.platform == 'darwin'
+
+# Typed, unchecked versions of munge_ctx_get/munge_ctx_set used by
+# MungeContext, which avoid converting the variadic arguments
+# dynamically on every call.
+_munge_ctx_get_int = load_option_function("munge_ctx_get",
+    ctypes.POINTER(ctypes.c_int))
+_munge_ctx_get_uint = load_option_function("munge_ctx_get",
+    ctypes.POINTER(ctypes.c_uint))
+_munge_ctx_get_time = load_option_function("munge_ctx_get",
+    ctypes.POINTER(time_t))
+_munge_ctx_get_str = load_option_function("munge_ctx_get",
+    ctypes.POINTER(ctypes.c_char_p))
+_munge_ctx_set_int = load_option_function("munge_ctx_set", ctypes.c_int)
+_munge_ctx_set_uint = load_option_function("munge_ctx_set", ctypes.c_uint)
+_munge_ctx_set_str = load_option_function("munge_ctx_set", ctypes.c_char_p)
+
+
+munge_enum_is_valid = load_function("munge_enum_is_valid",
+    ctypes.c_bool, [munge_enum_t, ctypes.c_int],
+    ((1, "type"), (1, "val")))
+"""
+C prototype: `int munge_enum_is_valid(munge_enum_t type, int val);`
+
+Note: when called from Python, the returned int is converted to a boolean.
+
+Returns True if the given value `val` is a valid enumeration of the
+specified type `type` in the software configuration as currently compiled;
+otherwise returns False. Some enumerations correspond to options that can
+only be enabled at compile-time.
+"""
+
+munge_enum_int_to_str = load_function("munge_enum_int_to_str",
+    ctypes.c_char_p, [munge_enum_t, ctypes.c_int],
+    ((1, "type"), (1, "val")))
+"""
+C prototype: `const char * munge_enum_int_to_str(munge_enum_t type, int val);`
+
+Converts the munge enumeration `val` of the specified type `type`
+into a text string. Returns the text string, or None on error.
+"""
+
+munge_enum_str_to_int = load_function("munge_enum_str_to_int",
+    ctypes.c_int, [munge_enum_t, ctypes.c_char_p],
+    ((1, "type"), (1, "str")))
+"""
+C prototype: `int munge_enum_str_to_int(munge_enum_t type, const char *str);`
+
+Converts the case-insensitive byte string `str` into the corresponding
+munge enumeration of the specified type `type`. Returns a munge
+enumeration on success (>= 0), or -1 on error.
+"""
@@ -0,0 +1,379 @@
+#########################################################################
+# Module pymunge.aio - asyncio interface
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""This module provides an asyncio interface to pymunge: awaitable
+versions of `encode()` and `decode()`, and the `AsyncMungeContext` class.
+
+The blocking libmunge calls run on worker threads (each with its own
+MUNGE context), so they do not block the event loop. Alternatively,
+`AsyncWireClient` talks to munged directly on the event loop, without
+libmunge and without worker threads (see `pymunge.client`). This module
+requires Python 3.5 or later and is not imported by `import pymunge`;
+use `import pymunge.aio`."""
+
+from pymunge.context import MungeContext
+from pymunge.error import MungeError, MungeErrorCode
+from pymunge.executor import ThreadContexts
+from pymunge.client import as_spec, check_response_type, \
+    connect_failed, start_connect, CONNECT_ATTEMPTS, CONNECT_RETRY_DELAY, \
+    DEFAULT_MAX_CONNECTIONS, DEFAULT_TIMEOUT
+import pymunge.wire
+import asyncio
+import collections
+import concurrent.futures
+import threading
+
+#: Default maximum number of concurrent libmunge calls per
+#: `AsyncMungeContext`.
+DEFAULT_CONCURRENCY = 8
+
+# the loop of the running coroutine (get_event_loop() is deprecated
+# there since Python 3.7, which added get_running_loop())
+_get_running_loop = getattr(asyncio, 'get_running_loop',
+                            asyncio.get_event_loop)
+
+class AsyncMungeContext(object):
+    """A MUNGE context for use with asyncio.
+
+    `AsyncMungeContext(ctx, max_concurrency, executor, timeout)` creates
+    a context with the options of the `MungeContext` `ctx` (or default
+    options, if `ctx` is None). Like a `MungeContext`, its options can be
+    read and modified via attributes (e.g. `cipher_type`, `ttl`, ...);
+    the decode-only attributes (e.g. `encode_time`) are not available,
+    since several decodes can be in progress at the same time.
+
+    At most `max_concurrency` encodes/decodes run at the same time;
+    further calls wait for a free slot without blocking the event loop.
+    The calls run on `executor` (a `concurrent.futures.Executor`), or on
+    a thread pool owned by the context if `executor` is None. Each
+    worker thread uses its own native MUNGE context, so no context is
+    created or destroyed per call.
+
+    If an encode or decode does not finish within `timeout` seconds
+    (None means no timeout), a `MungeError` with code `EMUNGE_TIMEOUT`
+    is raised. Cancelling an encode or decode that has not started yet
+    prevents the libmunge call; one that is already running on a worker
+    thread runs to completion, but its result is discarded.
+
+    An `AsyncMungeContext` should be closed when no longer used, e.g.:
+
+    >>> async with AsyncMungeContext() as actx:
+    >>>     cred = await actx.encode(payload)
+    """
+
+    def __init__(self, ctx=None, max_concurrency=None, executor=None,
+                 timeout=None):
+        if max_concurrency is None:
+            max_concurrency = DEFAULT_CONCURRENCY
+        if max_concurrency < 1:
+            raise ValueError('max_concurrency must be at least 1')
+        self._contexts = ThreadContexts(ctx)
+        self._max_concurrency = max_concurrency
+        self._owns_executor = executor is None
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_concurrency)
+        self._executor = executor
+        # The slots are shared by all event loops using the context, and
+        # are released by the worker threads, so they are counted under
+        # a thread lock instead of by an asyncio.Semaphore.
+        self._slots_lock = threading.Lock()
+        self._in_use = 0
+        self._waiters = collections.deque()
+        self.timeout = timeout
+        self._closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        # close() waits for the thread pool, so it must not run on the
+        # event loop
+        await _get_running_loop().run_in_executor(None, self.close)
+
+    def close(self):
+        """Close this context. If the context owns its thread pool, this
+        waits for running calls to finish (so in a coroutine, prefer an
+        'async with' statement, which does not block the event loop).
+        Calling `close()` on an already closed context has no effect."""
+        if not self._closed:
+            self._closed = True
+            if self._owns_executor:
+                self._executor.shutdown(True)
+            self._contexts.close()
+
+    @property
+    def closed(self):
+        """True if this context is closed, False otherwise."""
+        return self._closed
+
+    @property
+    def max_concurrency(self):
+        """The maximum number of concurrent libmunge calls."""
+        return self._max_concurrency
+
+    async def encode(self, payload=None, timeout=None):
+        """Create a MUNGE credential using the options defined in this
+        context, like `MungeContext.encode()`. If `timeout` is None, the
+        context's `timeout` is used."""
+        return await self._call(_encode, payload, timeout)
+
+    async def decode(self, cred, timeout=None):
+        """Validate a MUNGE credential, like `MungeContext.decode()`.
+        Returns `(payload, uid, gid)` or raises a `MungeError`. If
+        `timeout` is None, the context's `timeout` is used."""
+        return await self._call(_decode, cred, timeout)
+
+    async def _decode_with_context(self, cred, timeout=None):
+        """pymunge internal - decode, additionally returning a
+        `DecodeResult` with the metadata of the credential"""
+        return await self._call(_decode_with_context, cred, timeout)
+
+    async def _call(self, fn, arg, timeout):
+        if self._closed:
+            raise MungeError(MungeErrorCode.EMUNGE_BAD_ARG,
+                             "Context is closed")
+        if timeout is None:
+            timeout = self.timeout
+        loop = _get_running_loop()
+        await self._acquire(loop)
+        try:
+            future = self._executor.submit(fn, self._contexts, arg)
+        except:
+            self._release()
+            raise
+
+        # The slot is released when the libmunge call has finished (or
+        # has been cancelled before it started), not when the awaiting
+        # coroutine gives up, so that at most max_concurrency calls
+        # occupy worker threads. This also works if the event loop has
+        # been closed in the meantime.
+        future.add_done_callback(lambda future: self._release())
+
+        try:
+            return await asyncio.wait_for(
+                asyncio.wrap_future(future, loop=loop), timeout)
+        except asyncio.TimeoutError:
+            raise MungeError(MungeErrorCode.EMUNGE_TIMEOUT,
+                             "Timed out after %g seconds" % timeout)
+
+    async def _acquire(self, loop):
+        """pymunge internal - wait for a free slot"""
+        with self._slots_lock:
+            if self._in_use < self._max_concurrency:
+                self._in_use += 1
+                return
+            waiter = loop.create_future()
+            entry = (loop, waiter)
+            self._waiters.append(entry)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            with self._slots_lock:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                    raise
+            # the slot has been handed to this waiter; if the waiter was
+            # cancelled before, _grant() releases it
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        """pymunge internal - release a slot, handing it to the next
+        waiter whose event loop is still running; may be called from
+        any thread"""
+        with self._slots_lock:
+            while self._waiters:
+                loop, waiter = self._waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self._grant, waiter)
+                    return
+                except RuntimeError:
+                    pass  # event loop closed, the waiter is gone
+            self._in_use -= 1
+
+    def _grant(self, waiter):
+        if waiter.cancelled():
+            self._release()
+        else:
+            waiter.set_result(None)
+
+class AsyncWireClient(object):
+    """An asyncio munged client which talks to munged directly over its
+    Unix domain socket, without libmunge and without worker threads.
+    This is the asyncio version of `pymunge.client.SelectorClient`.
+
+    `AsyncWireClient(options, timeout, max_connections)` creates a client
+    which encodes credentials with `options` (a `ContextSpec`, a
+    `MungeContext` whose options are used, or None for the default
+    options), and connects to the socket given by its `socket` option.
+    At most `max_connections` connections are open at the same time.
+    Requests that do not complete within `timeout` seconds
+    (`pymunge.client.DEFAULT_TIMEOUT` by default, None means no timeout)
+    raise a `MungeError` with code `EMUNGE_TIMEOUT`.
+    """
+
+    def __init__(self, options=None, timeout=DEFAULT_TIMEOUT,
+                 max_connections=DEFAULT_MAX_CONNECTIONS):
+        if max_connections < 1:
+            raise ValueError('max_connections must be at least 1')
+        self._spec = as_spec(options)
+        self.timeout = timeout
+        self._max_connections = max_connections
+        self._semaphore = None
+
+    @property
+    def spec(self):
+        """The `ContextSpec` used by this client."""
+        return self._spec
+
+    async def encode(self, payload=None, timeout=None):
+        """Create a MUNGE credential with the given payload (bytes or
+        None). Returns the credential or raises a `MungeError`."""
+        if payload is not None and not isinstance(payload, bytes):
+            raise TypeError('Payload must be bytes or None, got %s' %
+                            type(payload).__name__)
+        message = pymunge.wire.pack_encode_request(self._spec, payload)
+        body = await self._request(message, pymunge.wire.MSG_ENC_RSP,
+                                   timeout)
+        return pymunge.wire.encode_result(
+            pymunge.wire.unpack_encode_response(body))
+
+    async def decode(self, cred, timeout=None):
+        """Validate a MUNGE credential. Returns `(payload, uid, gid)` or
+        raises a `MungeError`."""
+        response = await self.decode_response(cred, timeout)
+        return pymunge.wire.decode_result(response)
+
+    async def decode_response(self, cred, timeout=None):
+        """Validate a MUNGE credential, returning the complete
+        `pymunge.wire.DecodeResponse` (including the options used to
+        encode the credential) instead of raising a `MungeError` for
+        an invalid credential."""
+        if not isinstance(cred, bytes):
+            raise TypeError('Credential must be bytes, got %s' %
+                            type(cred).__name__)
+        body = await self._request(pymunge.wire.pack_decode_request(cred),
+                                   pymunge.wire.MSG_DEC_RSP, timeout)
+        return pymunge.wire.unpack_decode_response(body)
+
+    async def _request(self, message, msg_type, timeout):
+        if timeout is None:
+            timeout = self.timeout
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_connections)
+        async with self._semaphore:
+            try:
+                return await asyncio.wait_for(
+                    self._exchange(message, msg_type), timeout)
+            except asyncio.TimeoutError:
+                raise MungeError(MungeErrorCode.EMUNGE_TIMEOUT,
+                                 "Timed out after %g seconds" % timeout)
+
+    async def _connect(self):
+        path = self._spec.socket
+        for attempt in range(1, CONNECT_ATTEMPTS + 1):
+            sock = start_connect(path)
+            if sock is not None:
+                break
+            if attempt < CONNECT_ATTEMPTS:
+                await asyncio.sleep(attempt * CONNECT_RETRY_DELAY)
+        else:
+            raise connect_failed(path, CONNECT_ATTEMPTS)
+        try:
+            return await asyncio.open_unix_connection(sock=sock)
+        except OSError as e:
+            sock.close()
+            raise MungeError(MungeErrorCode.EMUNGE_SOCKET,
+                             'Failed to connect to "%s": %s' %
+                             (path, e.strerror))
+
+    async def _exchange(self, message, expected_type):
+        reader, writer = await self._connect()
+        try:
+            writer.write(message)
+            header = await reader.readexactly(pymunge.wire.HEADER_SIZE)
+            msg_type, retry, length = pymunge.wire.unpack_header(header)
+            check_response_type(msg_type, expected_type)
+            return await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            raise MungeError(MungeErrorCode.EMUNGE_SOCKET,
+                             'Connection closed by munged')
+        except OSError as e:
+            raise MungeError(MungeErrorCode.EMUNGE_SOCKET,
+                             'Failed to communicate with munged: %s' %
+                             e.strerror)
+        finally:
+            writer.close()
+
+def _make_option_property(name):
+    def getter(self):
+        return getattr(self._contexts.template, name)
+
+    def setter(self, value):
+        self._contexts.set_option(name, value)
+
+    return property(getter, setter,
+                    doc=getattr(MungeContext, name).__doc__)
+
+for _name in ('cipher_type', 'mac_type', 'zip_type', 'realm', 'ttl',
+              'socket', 'uid_restriction', 'gid_restriction'):
+    setattr(AsyncMungeContext, _name, _make_option_property(_name))
+del _name
+
+def _encode(contexts, payload):
+    return contexts.get().encode(payload)
+
+def _decode(contexts, cred):
+    return contexts.get().decode(cred)
+
+def _decode_with_context(contexts, cred):
+    result = contexts.get().decode(cred, True)
+    return result.payload, result.uid, result.gid, result
+
+_default_context = None
+
+def _get_default_context():
+    global _default_context
+    if _default_context is None or _default_context.closed:
+        _default_context = AsyncMungeContext()
+    return _default_context
+
+async def encode(payload=None, timeout=None):
+    """Create a MUNGE credential using the default options, like
+    `pymunge.encode()`, without blocking the event loop.
+
+    If the credential is not created within `timeout` seconds, a
+    `MungeError` with code `EMUNGE_TIMEOUT` is raised."""
+    return await _get_default_context().encode(payload, timeout)
+
+async def decode(cred, timeout=None):
+    """Validate a MUNGE credential using the default context, like
+    `pymunge.decode()`, without blocking the event loop.
+
+    Returns `(payload, uid, gid, ctx)`, where `ctx` is a
+    `pymunge.result.DecodeResult` holding the options of the context used
+    to create the credential (such as `cipher_type` and `encode_time`),
+    or raises a `MungeError`. If the credential is not validated within
+    `timeout` seconds, a `MungeError` with code `EMUNGE_TIMEOUT` is
+    raised."""
+    return await _get_default_context()._decode_with_context(cred, timeout)
@@ -0,0 +1,411 @@
+#########################################################################
+# Module pymunge.audit - bulk audits of logged credentials
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""This module re-validates the MUNGE credentials found in (possibly very
+large) log files. `audit()` decodes them in parallel and records the
+decoded fields of each credential in an audit file, a compact columnar
+binary format; `read_audit()` loads an audit file as an `AuditTable`,
+and `summarize()` aggregates it into histograms by status, UID, GID,
+cipher, MAC and zip type and encode time. These are used by the
+`python -m pymunge audit` command.
+
+At most one credential is taken from each line of a log file; lines
+without a credential are skipped. The credentials are decoded in
+batches with `MungeContext.decode_many()` on the worker threads of a
+`MungeExecutor`, and each batch is appended to the audit file as one
+block. Since every block records the part of the log files it covers,
+the audit file is its own checkpoint: an interrupted audit resumes after
+the last complete block. This matters beyond saving time, as munged
+rejects credentials it has already decoded, so decoding them again
+would report them as replayed.
+
+Blocks which were decoded but not yet written when an audit was
+interrupted are lost, however: up to `max_in_flight * batch_size`
+credentials after the last complete block are decoded again on resume
+and recorded as replayed (`EMUNGE_CRED_REPLAYED`), and cannot be told
+apart from credentials which were really replayed. `max_in_flight`
+therefore defaults to the small `DEFAULT_MAX_IN_FLIGHT`, which costs
+little throughput, as most of the time per credential is spent
+holding the GIL.
+
+The audit file consists of a header and a sequence of blocks. The
+header is: magic (`MAGIC`), version (uint8), length of the metadata
+(uint32), metadata (a JSON object holding the list of 'inputs'). Each
+block is: magic (`BLOCK_MAGIC`), index of the log file in the inputs
+(uint32), start and end byte offset and start and end line number of
+the part of the log file covered by the block (uint64 each), number of
+rows (uint32), the columns, and a CRC-32 of the block (uint32). These
+integers are in network byte order. The columns are stored one after
+another as little-endian arrays, with one entry per row: line number
+(uint64), UID, GID (uint32 each), error code (uint8), encode and decode
+time (int64 each), cipher, MAC and zip type (uint8 each)."""
+
+from pymunge.batch import RESULT_CODES, _check_numpy, _import_numpy
+from pymunge.enums import CipherType, MACType, ZipType
+from pymunge.error import MungeErrorCode
+import pymunge.executor
+import array
+import collections
+import itertools
+import json
+import os
+import re
+import struct
+import sys
+import zlib
+
+#: Default maximum number of log lines per block.
+DEFAULT_BATCH_SIZE = 1024
+
+#: Default maximum number of blocks being decoded at the same time. This
+#: bounds the number of credentials reported as replayed after resuming
+#: an interrupted audit (see `pymunge.audit`).
+DEFAULT_MAX_IN_FLIGHT = 2
+
+#: Default width of the encode time buckets of `summarize()`, in seconds.
+DEFAULT_TIME_BUCKET = 3600
+
+MAGIC = b'PMAU'             #: Magic number at the start of an audit file
+BLOCK_MAGIC = b'PMAB'       #: Magic number at the start of each block
+VERSION = 1                 #: Version of the audit file format
+
+#: Regular expression matching a credential in a log line.
+CRED_PATTERN = re.compile(br'MUNGE:[A-Za-z0-9+/]+=*:')
+
+_header = struct.Struct('>4sBI')
+_block_header = struct.Struct('>4sIQQQQI')
+_u32 = struct.Struct('>I')
+
+# (name, array typecode) of the columns, in the order they are stored
+_COLUMNS = (('lines', 'Q'), ('uids', 'I'), ('gids', 'I'), ('codes', 'B'),
+            ('encode_times', 'q'), ('decode_times', 'q'),
+            ('cipher_types', 'B'), ('mac_types', 'B'), ('zip_types', 'B'))
+_ROW_SIZE = sum(array.array(typecode).itemsize
+                for name, typecode in _COLUMNS)
+
+#: The part of a log file covered by a block of an audit file: the
+#: index of the log file in the inputs, the start and end byte offset,
+#: the start and end line number (0-based; the end is exclusive) and
+#: the number of rows.
+BlockInfo = collections.namedtuple('BlockInfo', [
+    'input', 'start_offset', 'end_offset', 'start_line', 'end_line',
+    'rows'])
+
+#: Aggregated contents of an audit file, as returned by `summarize()`:
+#:
+#: * `rows`: number of credentials audited
+#: * `lines`: number of log lines read
+#: * `skipped`: number of log lines without a credential
+#: * `statuses`: dict mapping the name of each `MungeErrorCode` to the
+#:   number of credentials with that decode status
+#: * `uids`, `gids`: dicts mapping UIDs/GIDs to the number of credentials
+#:   created by them
+#: * `cipher_types`, `mac_types`, `zip_types`: dicts mapping the names of
+#:   the types to the number of credentials using them
+#: * `encode_times`: dict mapping the start of each encode time bucket
+#:   to the number of credentials created within it
+#:
+#: Only credentials with a result (valid, expired, rewound or replayed)
+#: are counted in the dicts other than `statuses`.
+AuditSummary = collections.namedtuple('AuditSummary', [
+    'rows', 'lines', 'skipped', 'statuses', 'uids', 'gids', 'cipher_types',
+    'mac_types', 'zip_types', 'encode_times'])
+
+class AuditTable(object):
+    """The rows of an audit file, in columns. Row `i` describes the `i`-th
+    audited credential. The columns are:
+
+    * `inputs`: index of the log file holding the credential, in the
+      inputs of the audit.
+    * `lines`: line number (0-based) of the credential in the log file.
+    * `uids`, `gids`, `codes`, `encode_times`, `decode_times`,
+      `cipher_types`, `mac_types`, `zip_types`: as in a
+      `pymunge.batch.DecodeBatch`.
+
+    All columns are `array.array` buffers, or NumPy arrays if NumPy is
+    used. As in a `DecodeBatch`, expired, rewound and replayed
+    credentials have the same fields as valid ones, and are told apart
+    by their error code. The paths of the log files are held by `paths`.
+    """
+
+    def __init__(self, paths=(), use_numpy=None):
+        """Create an empty table. If use_numpy is None, NumPy arrays are
+        used if NumPy is installed. Raises ImportError if use_numpy is
+        True and NumPy is not installed."""
+        self._use_numpy = _check_numpy(use_numpy)
+        self.paths = list(paths)
+        self.inputs = array.array('I')
+        for name, typecode in _COLUMNS:
+            setattr(self, name, array.array(typecode))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def error_code(self, i):
+        """Return the error code of row `i` as a `MungeErrorCode`."""
+        return MungeErrorCode(self.codes[i])
+
+    def _extend(self, info, columns):
+        """pymunge internal - append the rows of a block"""
+        self.inputs.extend(itertools.repeat(info.input, info.rows))
+        for (name, typecode), column in zip(_COLUMNS, columns):
+            getattr(self, name).extend(column)
+
+    def _finish(self):
+        """pymunge internal - convert the columns to NumPy arrays,
+        if requested"""
+        if self._use_numpy:
+            numpy = _import_numpy()
+            for name in ['inputs'] + [name for name, typecode in _COLUMNS]:
+                setattr(self, name,
+                        numpy.asarray(memoryview(getattr(self, name))))
+        return self
+
+def audit(inputs, output, ctx=None, workers=None,
+          batch_size=DEFAULT_BATCH_SIZE,
+          max_in_flight=DEFAULT_MAX_IN_FLIGHT, resume=True, sync=True):
+    """Decode the credentials found in the log files `inputs` (a list of
+    paths), writing their decoded fields to the audit file `output`.
+    Returns the number of credentials decoded by this call.
+
+    If `output` exists and `resume` is True, the audit continues after
+    the last complete block of `output`, which must be an audit of the
+    same `inputs` (a `ValueError` is raised otherwise). An incomplete
+    block at the end of `output`, e.g. left by an interrupted audit, is
+    discarded. If `resume` is False, `output` is overwritten. The
+    credentials of up to `max_in_flight` blocks which were decoded but
+    not written by the interrupted audit are recorded as replayed.
+
+    The credentials are decoded with the options of the `MungeContext`
+    `ctx` (default options, if None) on `workers` threads (see
+    `MungeExecutor`), in blocks of at most `batch_size` log lines; see
+    `MungeExecutor.imap()` for `max_in_flight` (None means twice the
+    number of workers). If `sync` is True, each
+    block is flushed to disk (with `os.fsync()`) before the next one is
+    written."""
+    if batch_size < 1:
+        raise ValueError('batch_size must be at least 1')
+    inputs = list(inputs)
+    if resume and os.path.exists(output):
+        out = open(output, 'r+b')
+        try:
+            position = _resume(out, output, inputs)
+        except:
+            out.close()
+            raise
+    else:
+        out = open(output, 'w+b')
+        metadata = json.dumps({'inputs': inputs}).encode('utf-8')
+        out.write(_header.pack(MAGIC, VERSION, len(metadata)) + metadata)
+        position = (0, 0, 0)
+    rows = 0
+    try:
+        _flush(out, sync)
+        with pymunge.executor.MungeExecutor(workers, ctx) as executor:
+            batches = _read_batches(inputs, position, batch_size)
+            for block, count in executor.imap(_decode_batch, batches,
+                                              max_in_flight):
+                out.write(block)
+                _flush(out, sync)
+                rows += count
+    finally:
+        out.close()
+    return rows
+
+def read_audit(path, use_numpy=None):
+    """Return the rows of the audit file at `path` as an `AuditTable`.
+    An incomplete block at the end of the file is ignored. If use_numpy
+    is None, NumPy arrays are returned if NumPy is installed; if it is
+    True and NumPy is not installed, ImportError is raised before any
+    block is read."""
+    with open(path, 'rb') as f:
+        table = AuditTable(_read_header(f, path)['inputs'], use_numpy)
+        for end, info, columns in _iter_blocks(f):
+            table._extend(info, columns)
+    return table._finish()
+
+def iter_blocks(path):
+    """Iterate over the complete blocks of the audit file at `path`,
+    yielding a `BlockInfo` for each."""
+    with open(path, 'rb') as f:
+        _read_header(f, path)
+        for end, info, columns in _iter_blocks(f):
+            yield info
+
+def summarize(path, time_bucket=DEFAULT_TIME_BUCKET):
+    """Aggregate the audit file at `path` into an `AuditSummary`. The
+    encode times are counted in buckets of `time_bucket` seconds."""
+    if time_bucket < 1:
+        raise ValueError('time_bucket must be at least 1')
+    rows = lines = 0
+    statuses = collections.Counter()
+    counters = dict((name, collections.Counter())
+                    for name in ('uids', 'gids', 'cipher_types',
+                                 'mac_types', 'zip_types', 'encode_times'))
+    with open(path, 'rb') as f:
+        _read_header(f, path)
+        for end, info, columns in _iter_blocks(f):
+            rows += info.rows
+            lines += info.end_line - info.start_line
+            columns = dict(zip([name for name, typecode in _COLUMNS],
+                               columns))
+            codes = columns['codes']
+            statuses.update(codes)
+            selected = [code in RESULT_CODES for code in codes]
+            for name, counter in counters.items():
+                values = itertools.compress(columns[name], selected)
+                if name == 'encode_times':
+                    values = (value - value % time_bucket
+                              for value in values)
+                counter.update(values)
+    return AuditSummary(
+        rows, lines, lines - rows,
+        _named(statuses, MungeErrorCode), dict(counters['uids']),
+        dict(counters['gids']), _named(counters['cipher_types'], CipherType),
+        _named(counters['mac_types'], MACType),
+        _named(counters['zip_types'], ZipType),
+        dict(counters['encode_times']))
+
+def _named(counter, enum_class):
+    """pymunge internal - return a dict mapping the names of the enum
+    values counted by counter to their counts"""
+    names = {}
+    for value, count in counter.items():
+        try:
+            name = enum_class(value).name
+        except ValueError:
+            name = str(value)
+        names[name] = count
+    return names
+
+def _flush(f, sync):
+    f.flush()
+    if sync:
+        os.fsync(f.fileno())
+
+def _read_header(f, path):
+    """pymunge internal - read the header of an audit file, returning its
+    metadata"""
+    data = f.read(_header.size)
+    try:
+        magic, version, length = _header.unpack(data)
+        if magic != MAGIC:
+            raise ValueError
+    except (ValueError, struct.error):
+        raise ValueError('%s is not an audit file' % path)
+    if version != VERSION:
+        raise ValueError('%s has unsupported version %d' % (path, version))
+    try:
+        return json.loads(f.read(length).decode('utf-8'))
+    except ValueError:
+        raise ValueError('%s has invalid metadata' % path)
+
+def _resume(f, path, inputs):
+    """pymunge internal - position the audit file f after its last complete
+    block, discarding the rest, and return the position (input index,
+    byte offset, line number) at which the audit continues"""
+    if _read_header(f, path).get('inputs') != inputs:
+        raise ValueError('%s is an audit of different inputs' % path)
+    end = f.tell()
+    position = (0, 0, 0)
+    for end, info, columns in _iter_blocks(f):
+        position = (info.input, info.end_offset, info.end_line)
+    index, offset, line = position
+    if index < len(inputs) and os.path.getsize(inputs[index]) < offset:
+        raise ValueError('%s is shorter than when it was audited' %
+                         inputs[index])
+    f.seek(end)
+    f.truncate()
+    return position
+
+def _iter_blocks(f):
+    """pymunge internal - iterate over the complete blocks of an audit file
+    from the current position, yielding (end position, `BlockInfo`,
+    columns) for each; stops at the first incomplete or corrupt block"""
+    while True:
+        header = f.read(_block_header.size)
+        if len(header) < _block_header.size:
+            return
+        fields = _block_header.unpack(header)
+        if fields[0] != BLOCK_MAGIC:
+            return
+        info = BlockInfo(*fields[1:])
+        data = f.read(info.rows * _ROW_SIZE + _u32.size)
+        if len(data) < info.rows * _ROW_SIZE + _u32.size or \
+                _u32.unpack(data[-_u32.size:])[0] != \
+                zlib.crc32(data[:-_u32.size], zlib.crc32(header)) & \
+                0xffffffff:
+            return
+        columns = []
+        start = 0
+        for name, typecode in _COLUMNS:
+            column = array.array(typecode)
+            end = start + info.rows * column.itemsize
+            column.frombytes(data[start:end])
+            if sys.byteorder == 'big':
+                column.byteswap()
+            columns.append(column)
+            start = end
+        yield f.tell(), info, columns
+
+def _read_batches(inputs, position, batch_size):
+    """pymunge internal - read the log files from position, yielding
+    (`BlockInfo` without rows, credentials, line numbers) for each block
+    of up to batch_size lines"""
+    index, offset, line = position
+    for index in range(index, len(inputs)):
+        with open(inputs[index], 'rb') as f:
+            f.seek(offset)
+            while True:
+                start_offset = offset
+                start_line = line
+                creds = []
+                lines = array.array('Q')
+                for text in itertools.islice(f, batch_size):
+                    match = CRED_PATTERN.search(text)
+                    if match is not None:
+                        creds.append(match.group())
+                        lines.append(line)
+                    line += 1
+                    offset += len(text)
+                if line == start_line:
+                    break
+                yield (BlockInfo(index, start_offset, offset, start_line,
+                                 line, len(creds)), creds, lines)
+        offset = line = 0
+
+def _decode_batch(ctx, batch):
+    """pymunge internal - decode the credentials of a batch, returning
+    (block, number of rows)"""
+    info, creds, lines = batch
+    results = ctx.decode_many(creds, use_numpy=False)
+    columns = [lines] + [getattr(results, name)
+                         for name, typecode in _COLUMNS[1:]]
+    if sys.byteorder == 'big':
+        columns = [array.array(column.typecode, column)
+                   for column in columns]
+        for column in columns:
+            column.byteswap()
+    header = _block_header.pack(BLOCK_MAGIC, *info)
+    data = b''.join(column.tobytes() for column in columns)
+    crc = zlib.crc32(data, zlib.crc32(header)) & 0xffffffff
+    return b''.join([header, data, _u32.pack(crc)]), info.rows
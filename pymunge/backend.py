@@ -0,0 +1,477 @@
+#########################################################################
+# Module pymunge.backend - libmunge call backends
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""This module provides the backends through which `MungeContext` calls
+libmunge:
+
+* `CtypesBackend` (name 'ctypes', the default) uses the ctypes
+  prototypes declared in `pymunge.raw`.
+* `CffiBackend` (name 'cffi') uses cffi in ABI mode, i.e. it loads
+  libmunge at runtime without compiling anything. It requires the cffi
+  package, and is considerably faster than ctypes on PyPy, whose JIT
+  cannot optimize ctypes calls.
+
+The default backend is the one set by `set_backend()`, or else the one
+named by the environment variable `PYMUNGE_BACKEND`. Each `MungeContext`
+uses the backend that was the default when it was created, unless a
+backend is passed to it explicitly. Both backends report errors as a
+`MungeError` in the same way (see `Backend.make_error()`)."""
+
+from pymunge.error import MungeError
+import pymunge.raw
+import ctypes
+import os
+import threading
+
+#: Name of the environment variable selecting the default backend.
+BACKEND_ENV = 'PYMUNGE_BACKEND'
+
+#: Name of the backend used if no backend is selected.
+DEFAULT_BACKEND = 'ctypes'
+
+class Backend(object):
+    """Base class of the libmunge backends, which perform the libmunge
+    calls of a `MungeContext`.
+
+    Native contexts are referred to by handles, whose type depends on the
+    backend. Each `MungeContext` additionally has backend-specific
+    preallocated out-parameters (see `new_buffers()`), passed as the
+    `buffers` argument. Options are identified by their `MUNGE_OPT_*`
+    value and the ctypes type of their value (as in `pymunge.raw`), which
+    is `c_int`, `c_uint` (for `uid_t`, `gid_t` and the IPv4 address),
+    `time_t` or `c_char_p`. Payloads returned by `decode()` are referred
+    to by an address, which must be released with one of `take_bytes()`,
+    `take_view()` or `free()`."""
+
+    #: Name of the backend, as accepted by `get_backend()`.
+    name = None
+
+    def make_error(self, error_code, handle, result):
+        """Return a `MungeError` for the (non-success) error_code, with
+        the message of the native context `handle` (if not None and the
+        context has an error message) or else the generic message of the
+        error code."""
+        message = None
+        if handle is not None:
+            message = self.ctx_strerror(handle)
+        if message is None:
+            message = self.strerror(error_code)
+        return MungeError(error_code, message.decode('utf-8'), result)
+
+    def strerror(self, error_code):
+        """Return the generic message of error_code (bytes)."""
+        raise NotImplementedError
+
+    def ctx_strerror(self, handle):
+        """Return the error message of a native context (bytes), or None
+        if the context has no error."""
+        raise NotImplementedError
+
+    def ctx_create(self):
+        """Create a native context with default options."""
+        raise NotImplementedError
+
+    def ctx_copy(self, handle):
+        """Return a copy of a native context."""
+        raise NotImplementedError
+
+    def ctx_destroy(self, handle):
+        """Destroy a native context."""
+        raise NotImplementedError
+
+    def new_buffers(self):
+        """Return the preallocated out-parameters for one context. If they
+        have `munge_encode` and `munge_decode` attributes holding the native
+        functions called by `encode()` and `decode()`, `pymunge.hooks`
+        reports the time spent in these functions separately."""
+        raise NotImplementedError
+
+    def encode(self, buffers, handle, payload):
+        """Encode a credential with payload (bytes or None). Returns
+        `(error_code, cred)`, where `cred` is None on error."""
+        raise NotImplementedError
+
+    def decode(self, buffers, handle, cred):
+        """Decode the credential cred (bytes, or a ctypes char array).
+        Returns `(error_code, address, length, uid, gid)`."""
+        raise NotImplementedError
+
+    def take_bytes(self, address, length):
+        """Copy the payload at address into a byte string and free it."""
+        raise NotImplementedError
+
+    def take_view(self, address, length):
+        """Return a memoryview of the payload at address which frees the
+        payload once it is released (see `pymunge.raw.take_view()`)."""
+        raise NotImplementedError
+
+    def copy_into(self, view, address, length):
+        """Copy length bytes of the payload at address into the writable
+        memoryview view, without freeing the payload."""
+        raise NotImplementedError
+
+    def free(self, address):
+        """Free the payload at address (which may be a null pointer)."""
+        raise NotImplementedError
+
+    def get_option(self, buffers, handle, option, option_type):
+        """Return the value of an option of a native context, raising a
+        `MungeError` on failure. Strings are returned as bytes."""
+        raise NotImplementedError
+
+    def set_option(self, buffers, handle, option, option_type, value):
+        """Set an option of a native context, raising a `MungeError` on
+        failure. Strings are passed as bytes (or None)."""
+        raise NotImplementedError
+
+    def read_options(self, buffers, handle, options):
+        """Read several options of a native context at once. options is a
+        tuple of `(option, option_type)` pairs. Returns `(status, values)`,
+        where `status` is nonzero if reading any option failed."""
+        raise NotImplementedError
+
+class CtypesBackend(Backend):
+    """The ctypes backend, using the fast call path of `pymunge.raw`:
+    unchecked prototypes of `munge_encode`/`munge_decode`, typed
+    prototypes of `munge_ctx_get`/`munge_ctx_set` and preallocated
+    out-parameters (`pymunge.raw.ContextBuffers`)."""
+
+    name = 'ctypes'
+
+    def __init__(self):
+        raw = pymunge.raw
+        raw.load()
+        # The functions are taken from pymunge._libmunge, since those of
+        # pymunge.raw are replaced while hooks are registered (see
+        # pymunge.hooks), and MungeContext reports its calls itself.
+        import pymunge._libmunge as libmunge
+        self._take_bytes = raw.take_bytes
+        self.strerror = libmunge.munge_strerror
+        self.ctx_strerror = libmunge.munge_ctx_strerror
+        self.ctx_create = libmunge.munge_ctx_create
+        self.ctx_copy = libmunge.munge_ctx_copy
+        self.ctx_destroy = libmunge.munge_ctx_destroy
+        self.new_buffers = raw.ContextBuffers
+        self.take_view = raw.take_view
+        self.free = raw.free
+
+    def encode(self, buffers, handle, payload):
+        if payload is None:
+            error_code = buffers.munge_encode(buffers.cred_ref, handle, None,
+                                              0)
+        else:
+            error_code = buffers.munge_encode(buffers.cred_ref, handle,
+                                              payload, len(payload))
+        cred = buffers.cred
+        address = cred.value
+        cred.value = None
+        if error_code:
+            self.free(address)
+            return error_code, None
+        return error_code, self._take_bytes(address)
+
+    def decode(self, buffers, handle, cred):
+        error_code = buffers.munge_decode(
+            cred, handle, buffers.buf_ref, buffers.buflen_ref,
+            buffers.uid_ref, buffers.gid_ref)
+        buf = buffers.buf
+        address = buf.value
+        buf.value = None
+        return (error_code, address, buffers.buflen.value,
+                buffers.uid.value, buffers.gid.value)
+
+    def take_bytes(self, address, length):
+        return self._take_bytes(address, length)
+
+    def copy_into(self, view, address, length):
+        if length > 0:
+            target = (ctypes.c_char * length).from_buffer(view)
+            ctypes.memmove(target, address, length)
+            del target
+
+    def get_option(self, buffers, handle, option, option_type):
+        function, value, ref = buffers.getters[option_type]
+        error_code = function(handle, option, ref)
+        if error_code:
+            raise self.make_error(error_code, handle, None)
+        return value.value
+
+    def set_option(self, buffers, handle, option, option_type, value):
+        error_code = buffers.setters[option_type](handle, option, value)
+        if error_code:
+            raise self.make_error(error_code, handle, None)
+
+    def read_options(self, buffers, handle, options):
+        readers = buffers.readers.get(options)
+        if readers is None:
+            getters = buffers.getters
+            readers = buffers.readers[options] = tuple(
+                getters[option_type] + (option,)
+                for option, option_type in options)
+        status = 0
+        values = []
+        append = values.append
+        for function, value, ref, option in readers:
+            status |= function(handle, option, ref)
+            append(value.value)
+        return status, values
+
+# C declarations of the libmunge functions used by CffiBackend; the
+# munge_*_t enumerations are declared as int, as in pymunge.raw
+_CDEF = """
+typedef struct munge_ctx *munge_ctx_t;
+typedef int munge_err_t;
+typedef unsigned int uid_t;
+typedef unsigned int gid_t;
+typedef long time_t;
+
+munge_err_t munge_encode(char **cred, munge_ctx_t ctx, const char *buf,
+                         int len);
+munge_err_t munge_decode(const char *cred, munge_ctx_t ctx, void **buf,
+                         int *len, uid_t *uid, gid_t *gid);
+const char *munge_strerror(munge_err_t e);
+munge_ctx_t munge_ctx_create(void);
+munge_ctx_t munge_ctx_copy(munge_ctx_t ctx);
+void munge_ctx_destroy(munge_ctx_t ctx);
+const char *munge_ctx_strerror(munge_ctx_t ctx);
+munge_err_t munge_ctx_get(munge_ctx_t ctx, int opt, ...);
+munge_err_t munge_ctx_set(munge_ctx_t ctx, int opt, ...);
+
+void free(void *ptr);
+"""
+
+# C types of the option values, by their ctypes type
+_CFFI_OPTION_TYPES = {
+    ctypes.c_int: 'int',
+    ctypes.c_uint: 'unsigned int',
+    pymunge.raw.time_t: 'time_t',
+    ctypes.c_char_p: 'char *',
+}
+
+class CffiBuffers(object):
+    """pymunge internal - preallocated out-parameters of `CffiBackend`
+    for one context. Like `pymunge.raw.ContextBuffers`, it holds the
+    native `munge_encode`/`munge_decode` functions."""
+
+    def __init__(self, ffi, lib):
+        self.munge_encode = lib.munge_encode
+        self.munge_decode = lib.munge_decode
+        self.cred = ffi.new('char **')
+        self.buf = ffi.new('void **')
+        self.buflen = ffi.new('int *')
+        self.uid = ffi.new('uid_t *')
+        self.gid = ffi.new('gid_t *')
+        self.values = dict((option_type, ffi.new(c_type + ' *'))
+                           for option_type, c_type
+                           in _CFFI_OPTION_TYPES.items())
+
+class CffiBackend(Backend):
+    """The cffi backend. libmunge is loaded in cffi's ABI mode, located
+    as described in `pymunge._libmunge` (including the
+    `PYMUNGE_LIBMUNGE` override). Raises ImportError if cffi is not
+    installed or libmunge cannot be loaded."""
+
+    name = 'cffi'
+
+    def __init__(self):
+        import cffi
+        from pymunge._libmunge import find_libmunge
+        ffi = self._ffi = cffi.FFI()
+        ffi.cdef(_CDEF)
+        filename, lib = find_libmunge(ffi.dlopen)
+        if lib is None:
+            raise ImportError('libmunge not found')
+        self.libmunge_filename = filename
+        self._lib = lib
+        # free() of the C library, which allocates libmunge's buffers
+        self._free = ffi.dlopen(None).free
+        self._null = ffi.NULL
+        self._string = ffi.string
+        self._buffer = ffi.buffer
+        self._from_buffer = ffi.from_buffer
+        self._setter_types = dict(
+            (option_type, ffi.typeof(c_type))
+            for option_type, c_type in _CFFI_OPTION_TYPES.items())
+        self.ctx_create = lib.munge_ctx_create
+        self.ctx_copy = lib.munge_ctx_copy
+        self.ctx_destroy = lib.munge_ctx_destroy
+
+    def strerror(self, error_code):
+        return self._string(self._lib.munge_strerror(error_code))
+
+    def ctx_strerror(self, handle):
+        message = self._lib.munge_ctx_strerror(handle)
+        if message == self._null:
+            return None
+        return self._string(message)
+
+    def new_buffers(self):
+        return CffiBuffers(self._ffi, self._lib)
+
+    def encode(self, buffers, handle, payload):
+        cred = buffers.cred
+        if payload is None:
+            error_code = buffers.munge_encode(cred, handle, self._null, 0)
+        else:
+            error_code = buffers.munge_encode(cred, handle, payload,
+                                              len(payload))
+        address = cred[0]
+        cred[0] = self._null
+        if address == self._null:
+            return error_code, None
+        if error_code:
+            self._free(address)
+            return error_code, None
+        try:
+            return error_code, self._string(address)
+        finally:
+            self._free(address)
+
+    def decode(self, buffers, handle, cred):
+        if not isinstance(cred, bytes):
+            cred = self._from_buffer(cred)
+        error_code = buffers.munge_decode(
+            cred, handle, buffers.buf, buffers.buflen, buffers.uid,
+            buffers.gid)
+        buf = buffers.buf
+        address = buf[0]
+        buf[0] = self._null
+        return (error_code, address, buffers.buflen[0], buffers.uid[0],
+                buffers.gid[0])
+
+    def take_bytes(self, address, length):
+        if address == self._null:
+            return b''
+        try:
+            return self._buffer(address, length)[:]
+        finally:
+            self._free(address)
+
+    def take_view(self, address, length):
+        if address == self._null or length <= 0:
+            self.free(address)
+            return memoryview(b'')
+        address = self._ffi.gc(address, self._free)
+        view = memoryview(self._buffer(address, length)).cast('B')
+        if hasattr(view, 'toreadonly'):
+            view = view.toreadonly()
+        return view
+
+    def copy_into(self, view, address, length):
+        if length > 0:
+            self._ffi.memmove(view, address, length)
+
+    def free(self, address):
+        if address != self._null:
+            self._free(address)
+
+    def get_option(self, buffers, handle, option, option_type):
+        value = buffers.values[option_type]
+        error_code = self._lib.munge_ctx_get(handle, option, value)
+        if error_code:
+            raise self.make_error(error_code, handle, None)
+        return self._value(value[0], option_type)
+
+    def set_option(self, buffers, handle, option, option_type, value):
+        if option_type is ctypes.c_char_p:
+            if value is None:
+                value = self._ffi.cast('char *', self._null)
+            else:
+                value = self._ffi.new('char[]', value)
+        else:
+            value = self._ffi.cast(self._setter_types[option_type], value)
+        error_code = self._lib.munge_ctx_set(handle, option, value)
+        if error_code:
+            raise self.make_error(error_code, handle, None)
+
+    def read_options(self, buffers, handle, options):
+        munge_ctx_get = self._lib.munge_ctx_get
+        values = buffers.values
+        status = 0
+        result = []
+        for option, option_type in options:
+            value = values[option_type]
+            status |= munge_ctx_get(handle, option, value)
+            result.append(self._value(value[0], option_type))
+        return status, result
+
+    def _value(self, value, option_type):
+        if option_type is ctypes.c_char_p:
+            if value == self._null:
+                return None
+            return self._string(value)
+        return value
+
+_BACKENDS = {
+    'ctypes': CtypesBackend,
+    'cffi': CffiBackend,
+}
+
+_instances = {}
+_default = None
+_lock = threading.Lock()
+
+def available_backends():
+    """Return the names of the backends which can be used, i.e. whose
+    dependencies are installed and which can load libmunge."""
+    names = []
+    for name in sorted(_BACKENDS):
+        try:
+            get_backend(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+def get_backend(backend=None):
+    """Return the backend `backend`, which is a backend name, a `Backend`
+    or None for the default backend. Backends are created once, on first
+    use. Raises ValueError for an unknown name and ImportError if the
+    backend cannot be used."""
+    if isinstance(backend, Backend):
+        return backend
+    if backend is None:
+        if _default is not None:
+            return _default
+        backend = os.environ.get(BACKEND_ENV) or DEFAULT_BACKEND
+    instance = _instances.get(backend)
+    if instance is None:
+        if backend not in _BACKENDS:
+            raise ValueError('Unknown backend %r (known backends: %s)' %
+                             (backend, ', '.join(sorted(_BACKENDS))))
+        with _lock:
+            instance = _instances.get(backend)
+            if instance is None:
+                instance = _instances[backend] = _BACKENDS[backend]()
+    return instance
+
+def set_backend(backend):
+    """Set the default backend to `backend` (a backend name, a `Backend`,
+    or None to select it by the environment variable `PYMUNGE_BACKEND`
+    again). Contexts created earlier keep using their backend. Returns
+    the new default backend."""
+    global _default
+    if backend is None:
+        _default = None
+        return get_backend()
+    _default = get_backend(backend)
+    return _default
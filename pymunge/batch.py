@@ -0,0 +1,150 @@
+#########################################################################
+# Module pymunge.batch - columnar results of batch operations
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""This module provides the `DecodeBatch` class, the columnar result
+of `MungeContext.decode_many()`, and helpers for batch input."""
+
+from pymunge.error import MungeErrorCode
+import array
+import ctypes
+
+_numpy = None
+
+def _import_numpy():
+    """pymunge internal - return the numpy module, or None if NumPy is not
+    installed. NumPy is imported on first use, as importing it is slow."""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+def _check_numpy(use_numpy):
+    """pymunge internal - return whether NumPy arrays are used for the
+    use_numpy argument (None for NumPy arrays if NumPy is installed).
+    Raises ImportError if use_numpy is True and NumPy is not installed,
+    so that the caller fails before doing any work."""
+    numpy = _import_numpy()
+    if use_numpy is None:
+        return numpy is not None
+    if use_numpy and numpy is None:
+        raise ImportError('use_numpy requires NumPy, which is not '
+                          'installed')
+    return use_numpy
+
+#: Error codes for which a failed decode still yields a result
+#: (payload, uid, gid and context metadata).
+RESULT_CODES = frozenset([
+    MungeErrorCode.EMUNGE_SUCCESS.value,
+    MungeErrorCode.EMUNGE_CRED_EXPIRED.value,
+    MungeErrorCode.EMUNGE_CRED_REWOUND.value,
+    MungeErrorCode.EMUNGE_CRED_REPLAYED.value,
+])
+
+class DecodeBatch(object):
+    """Columnar result of decoding a batch of credentials.
+
+    Row `i` describes the `i`-th credential of the batch. The columns are:
+
+    * `payloads`: a list of payloads (byte strings).
+    * `uids`, `gids`: UID/GID of the process that created the credential.
+    * `codes`: the error code of the decode (an integer, i.e. the `value`
+      of a `MungeErrorCode`). `EMUNGE_SUCCESS` (0) for valid credentials.
+    * `encode_times`, `decode_times`: encode/decode time (in seconds
+      since the epoch).
+    * `cipher_types`, `mac_types`, `zip_types`: integer values of the
+      `CipherType`, `MACType` and `ZipType` used to encode the credential.
+
+    All columns except `payloads` are `array.array` buffers, or NumPy
+    arrays sharing the same memory if NumPy is used.
+
+    Rows of expired, rewound or replayed credentials contain the same
+    data as valid ones and can be told apart by their error code. For
+    rows with any other error, the payload is None and all other fields
+    except the error code are 0.
+    """
+
+    def __init__(self, use_numpy=None):
+        """Create an empty batch. If use_numpy is None, NumPy arrays are
+        used if NumPy is installed. Raises ImportError if use_numpy is
+        True and NumPy is not installed."""
+        self._use_numpy = _check_numpy(use_numpy)
+        self.payloads = []
+        self.uids = array.array('I')
+        self.gids = array.array('I')
+        self.codes = array.array('B')
+        self.encode_times = array.array('q')
+        self.decode_times = array.array('q')
+        self.cipher_types = array.array('B')
+        self.mac_types = array.array('B')
+        self.zip_types = array.array('B')
+
+    def __len__(self):
+        return len(self.payloads)
+
+    def error_code(self, i):
+        """Return the error code of row `i` as a `MungeErrorCode`."""
+        return MungeErrorCode(self.codes[i])
+
+    def _finish(self):
+        """pymunge internal - convert the columns to NumPy arrays,
+        if requested"""
+        if self._use_numpy:
+            numpy = _import_numpy()
+            for name in ('uids', 'gids', 'codes', 'encode_times',
+                         'decode_times', 'cipher_types', 'mac_types',
+                         'zip_types'):
+                setattr(self, name,
+                        numpy.asarray(memoryview(getattr(self, name))))
+        return self
+
+def iter_packed(buf, offsets):
+    """pymunge internal - iterate over the credentials in the packed
+    buffer buf, where credential `i` is `buf[offsets[i]:offsets[i+1]]`.
+    Each credential is copied into a reusable, NUL-terminated ctypes
+    char buffer, which is yielded instead of a new byte string. The
+    offsets are checked (raising ValueError) before the first credential
+    is yielded."""
+    view = memoryview(buf).cast('B')
+    for i in range(len(offsets) - 1):
+        if offsets[i + 1] < offsets[i]:
+            raise ValueError('offsets must be non-decreasing')
+    if len(offsets) > 1 and (offsets[0] < 0 or offsets[-1] > len(view)):
+        raise ValueError('offsets must lie within the buffer')
+    return _iter_packed(view, offsets)
+
+def _iter_packed(view, offsets):
+    scratch = ctypes.create_string_buffer(256)
+    scratch_view = memoryview(scratch).cast('B')
+    for i in range(len(offsets) - 1):
+        start = offsets[i]
+        end = offsets[i + 1]
+        length = end - start
+        if length >= len(scratch_view):
+            scratch = ctypes.create_string_buffer(2 * length)
+            scratch_view = memoryview(scratch).cast('B')
+        scratch_view[:length] = view[start:end]
+        scratch_view[length] = 0
+        yield scratch
@@ -0,0 +1,224 @@
+#########################################################################
+# Module pymunge.cache - cache of verified credentials
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""This module provides the `CredentialCache` class, an opt-in cache of
+successfully decoded credentials.
+
+munged accepts each credential only once: decoding it again (e.g. when
+a client retries a request, or when a request passes through several
+services using the same munged) fails with `EMUNGE_CRED_REPLAYED`. A
+`CredentialCache` remembers the `DecodeResult` of the first successful
+decode of a credential until the credential expires, and answers
+repeated presentations of it without contacting munged.
+
+A cache deliberately disables replay detection for the credentials it
+holds, so it should only be used where a credential being presented
+more than once is expected and acceptable."""
+
+from pymunge.error import MungeError
+from pymunge.result import DecodeResult
+import pymunge.pool
+import collections
+import hashlib
+import threading
+import time
+
+#: Default maximum number of credentials kept by a cache.
+DEFAULT_MAX_ENTRIES = 4096
+
+#: Cache statistics, as returned by `CredentialCache.stats()`:
+#:
+#: * `hits`: lookups answered from the cache
+#: * `misses`: lookups of credentials which were not cached (or had
+#:   expired)
+#: * `evictions`: entries removed since the cache was full
+#: * `expirations`: entries removed since their credential had expired
+#: * `size`: number of entries currently in the cache
+CacheStats = collections.namedtuple('CacheStats', [
+    'hits', 'misses', 'evictions', 'expirations', 'size'])
+
+class CredentialCache(object):
+    """A cache of verified credentials, keyed by the SHA-256 digest of
+    the credential.
+
+    `decode(cred)` returns the cached `DecodeResult` of `cred` if there
+    is one, otherwise it decodes `cred` and caches the result if the
+    decode succeeded. An entry expires at the `encode_time` plus the
+    `ttl` of its credential, i.e. when munged would reject the
+    credential as expired. At most `max_entries` entries are kept; when
+    the cache is full, the least recently used entry is evicted.
+
+    The cached result is the one of the first decode; in particular, its
+    `decode_time` is the time of the first decode. Entries are not keyed
+    by the socket, so a cache should only be used with credentials
+    verified by the same munged (or the same MUNGE key). A cache can be
+    shared between threads.
+
+    >>> cache = CredentialCache()
+    >>> payload, uid, gid = cache.decode(cred)
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        if max_entries < 1:
+            raise ValueError('max_entries must be at least 1')
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._flights = {}
+        self._hits = self._misses = 0
+        self._evictions = self._expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def decode(self, cred, ctx=None):
+        """Validate the MUNGE credential `cred`, answering from the cache
+        if possible. Returns a `DecodeResult` or raises a `MungeError`.
+
+        Credentials which are not cached are decoded with the
+        `MungeContext` `ctx`, or with a context of the default
+        `pymunge.pool.MungeContextPool` if `ctx` is None, and cached if
+        the decode succeeds. Failed decodes are never cached. If a
+        credential is being decoded for another thread, the calling
+        thread waits for and shares the outcome of that decode, so that
+        a credential presented several times at once is only decoded by
+        munged once.
+
+        For expired, rewound and replayed credentials, the `result` of
+        the raised `MungeError` is a `DecodeResult` (which unpacks as
+        `(payload, uid, gid)`)."""
+        if not isinstance(cred, bytes):
+            raise TypeError('Credential must be bytes, got %s' %
+                            type(cred).__name__)
+        key = hashlib.sha256(cred).digest()
+        with self._lock:
+            result = self._lookup(key)
+            if result is not None:
+                return result
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            return flight.outcome()
+        try:
+            if ctx is None:
+                with pymunge.pool.default_pool().acquire() as ctx:
+                    result = _decode(ctx, cred)
+            else:
+                result = _decode(ctx, cred)
+            self._store(key, result)
+            flight.result = result
+            return result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+
+    def get(self, cred):
+        """Return the cached `DecodeResult` of the credential `cred`, or
+        None if it is not cached or has expired."""
+        key = hashlib.sha256(cred).digest()
+        with self._lock:
+            return self._lookup(key)
+
+    def put(self, cred, result):
+        """Cache `result`, the `DecodeResult` of a successful decode of the
+        credential `cred`. Results of expired credentials are not
+        cached."""
+        self._store(hashlib.sha256(cred).digest(), result)
+
+    def discard(self, cred):
+        """Remove the credential `cred` from the cache, if it is cached."""
+        with self._lock:
+            self._entries.pop(hashlib.sha256(cred).digest(), None)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return the statistics of this cache as a `CacheStats`."""
+        with self._lock:
+            return CacheStats(self._hits, self._misses, self._evictions,
+                              self._expirations, len(self._entries))
+
+    def _lookup(self, key):
+        """pymunge internal - return the cached result for key, or None;
+        must be called with the lock held"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, result = entry
+            if expires > time.time():
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return result
+            del self._entries[key]
+            self._expirations += 1
+        self._misses += 1
+        return None
+
+    def _store(self, key, result):
+        expires = result.encode_time + result.ttl
+        if expires <= time.time():
+            return
+        entries = self._entries
+        with self._lock:
+            entries[key] = (expires, result)
+            entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+                self._evictions += 1
+
+class _Flight(object):
+    """pymunge internal - a decode in progress, whose outcome is shared
+    with the threads presenting the same credential meanwhile"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def outcome(self):
+        self.event.wait()
+        error = self.error
+        if isinstance(error, MungeError):
+            raise MungeError(error.code, error.message, error.result)
+        if error is not None:
+            raise error
+        return self.result
+
+def _decode(ctx, cred):
+    """pymunge internal - decode cred with ctx into a `DecodeResult`; if
+    the decode fails with a result, the result of the raised `MungeError`
+    is a `DecodeResult`"""
+    try:
+        return ctx.decode(cred, True)
+    except MungeError as e:
+        if e.result is None:
+            raise
+        raise MungeError(e.code, e.message,
+                         DecodeResult.from_context(ctx, *e.result))
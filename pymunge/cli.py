@@ -0,0 +1,328 @@
+#########################################################################
+# Module pymunge.cli - command line interface
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""This module implements the command line interface run by
+`python -m pymunge`.
+
+The `encode` and `decode` commands read one record per line from
+standard input and write one NDJSON (newline-delimited JSON) record per
+input record to standard output. Input lines are credentials (for
+`decode`) or payloads (for `encode`), or, with `--ndjson`, JSON objects
+with a 'cred' key (for `decode`) or a 'payload' or 'payload_base64' key
+(for `encode`), whose other keys are copied to the output record.
+
+Each output record has an 'index' (the 0-based number of the input
+line) and an 'error' (null, or the name of the `MungeErrorCode`, with a
+'message'). `encode` adds the 'cred'; `decode` adds the 'payload' (or
+'payload_base64' if it is not valid UTF-8, or with `--base64`), 'uid',
+'gid', 'encode_time', 'decode_time', 'cipher_type', 'mac_type' and
+'zip_type'. These are also present for expired, rewound and replayed
+credentials.
+
+Lines are processed in batches of `--batch-size` records on the worker
+threads of a `MungeExecutor`, with `MungeContext.encode_many()` and
+`MungeContext.decode_many()`. The output is in input order unless
+`--unordered` is given. The exit status is 0 if all records succeeded,
+1 otherwise.
+
+$ python -m pymunge decode < creds.txt > results.ndjson
+
+The `audit` command decodes the credentials found in log files into a
+columnar audit file with `pymunge.audit.audit()`, resuming an
+interrupted audit of the same log files, and writes a summary (see
+`pymunge.audit.summarize()`) as a JSON object to standard output.
+
+$ python -m pymunge audit -o jobs.audit /var/log/jobs/*.log
+"""
+
+from pymunge.enums import CipherType, MACType, ZipType, \
+    TTL_DEFAULT, UID_ANY, GID_ANY
+from pymunge.error import MungeError, MungeErrorCode
+from pymunge.spec import ContextSpec
+import pymunge.audit
+import pymunge.executor
+import argparse
+import base64
+import itertools
+import json
+import sys
+
+#: Default number of records per batch.
+DEFAULT_BATCH_SIZE = 256
+
+_SUCCESS = MungeErrorCode.EMUNGE_SUCCESS.value
+_BAD_ARG = MungeErrorCode.EMUNGE_BAD_ARG.name
+
+def main(argv=None):
+    """Run the command line interface with the arguments `argv` (default:
+    `sys.argv[1:]`). Returns the exit status."""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if getattr(args, 'run', None) is None:
+        parser.print_help(sys.stderr)
+        return 2
+    return args.run(args)
+
+def build_parser():
+    """Return the `argparse.ArgumentParser` of the command line
+    interface; commands are added as subparsers with a `run` default."""
+    parser = argparse.ArgumentParser(
+        prog='python -m pymunge',
+        description='Encode and decode MUNGE credentials in bulk.')
+    commands = parser.add_subparsers(title='commands')
+
+    encode = commands.add_parser(
+        'encode', help='encode one credential per input line',
+        description='Encode one credential for each payload read from '
+        'standard input, writing NDJSON records to standard output.')
+    _add_options(encode)
+    encode.add_argument('--cipher', choices=_names(CipherType),
+                        default='Default', help='cipher type')
+    encode.add_argument('--mac', choices=_names(MACType),
+                        default='Default', help='MAC type')
+    encode.add_argument('--zip', choices=_names(ZipType),
+                        default='Default', help='compression type')
+    encode.add_argument('--ttl', type=int, default=TTL_DEFAULT,
+                        help='time-to-live in seconds (0: default of '
+                        'munged, -1: maximum)')
+    encode.add_argument('--restrict-uid', type=int, default=UID_ANY,
+                        help='only allow this UID to decode')
+    encode.add_argument('--restrict-gid', type=int, default=GID_ANY,
+                        help='only allow this GID to decode')
+    encode.set_defaults(run=run_encode)
+
+    decode = commands.add_parser(
+        'decode', help='decode one credential per input line',
+        description='Decode the credentials read from standard input, '
+        'writing NDJSON records to standard output.')
+    _add_options(decode)
+    decode.add_argument('--base64', action='store_true',
+                        help='always write payloads base64-encoded')
+    decode.set_defaults(run=run_decode)
+
+    audit = commands.add_parser(
+        'audit', help='audit the credentials found in log files',
+        description='Decode the credentials found in log files (at most '
+        'one per line) into an audit file, resuming an interrupted '
+        'audit, and write a JSON summary to standard output.')
+    audit.add_argument('logs', nargs='+', help='log files')
+    audit.add_argument('-o', '--output', required=True,
+                       help='audit file')
+    _add_executor_options(audit, pymunge.audit.DEFAULT_BATCH_SIZE,
+                          pymunge.audit.DEFAULT_MAX_IN_FLIGHT)
+    audit.add_argument('--restart', action='store_true',
+                       help='overwrite the audit file instead of resuming')
+    audit.add_argument('--no-sync', action='store_true',
+                       help='do not flush each block to disk')
+    audit.add_argument('--time-bucket', type=int,
+                       default=pymunge.audit.DEFAULT_TIME_BUCKET,
+                       help='width of the encode time histogram buckets '
+                       'in seconds (default: %(default)s)')
+    audit.set_defaults(run=run_audit)
+    return parser
+
+def _add_options(parser):
+    parser.add_argument('--ndjson', action='store_true',
+                        help='read JSON objects instead of plain lines')
+    _add_executor_options(parser, DEFAULT_BATCH_SIZE)
+    parser.add_argument('--unordered', action='store_true',
+                        help='write records as they complete instead of '
+                        'in input order')
+
+def _add_executor_options(parser, batch_size, max_in_flight=None):
+    parser.add_argument('--socket', help='munged socket path')
+    parser.add_argument('-w', '--workers', type=int,
+                        help='number of worker threads (default: based '
+                        'on the measured daemon latency)')
+    parser.add_argument('-b', '--batch-size', type=int,
+                        default=batch_size,
+                        help='lines per batch (default: %(default)s)')
+    if max_in_flight is None:
+        default = 'twice the number of workers'
+    else:
+        default = '%(default)s'
+    parser.add_argument('--max-in-flight', type=int, default=max_in_flight,
+                        help='maximum number of batches being processed '
+                        '(default: %s)' % default)
+
+def _names(enum_class):
+    return [member.name for member in enum_class]
+
+def run_encode(args):
+    """Run the `encode` command."""
+    spec = ContextSpec(cipher_type=CipherType[args.cipher],
+                       mac_type=MACType[args.mac], zip_type=ZipType[args.zip],
+                       ttl=args.ttl, socket=args.socket,
+                       uid_restriction=args.restrict_uid,
+                       gid_restriction=args.restrict_gid)
+    return _run(args, spec, _encode_batch)
+
+def run_decode(args):
+    """Run the `decode` command."""
+    return _run(args, ContextSpec(socket=args.socket), _decode_batch)
+
+def run_audit(args):
+    """Run the `audit` command."""
+    if args.batch_size < 1:
+        raise SystemExit('--batch-size must be at least 1')
+    try:
+        with ContextSpec(socket=args.socket).create_context() as ctx:
+            pymunge.audit.audit(args.logs, args.output, ctx, args.workers,
+                                args.batch_size, args.max_in_flight,
+                                not args.restart, not args.no_sync)
+        summary = pymunge.audit.summarize(args.output, args.time_bucket)
+    except KeyboardInterrupt:
+        sys.stderr.write('Interrupted; run the same command again to '
+                         'resume the audit\n')
+        return 130
+    except (OSError, ValueError) as e:
+        raise SystemExit(str(e))
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    stdout.write(json.dumps(summary._asdict(), sort_keys=True)
+                 .encode('utf-8') + b'\n')
+    stdout.flush()
+    return 0
+
+def _run(args, spec, process):
+    """pymunge internal - process the records read from stdin in batches
+    with process(ctx, args, batch) on a `MungeExecutor`, writing the
+    output to stdout"""
+    if args.batch_size < 1:
+        raise SystemExit('--batch-size must be at least 1')
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    batches = _batches(stdin, args.batch_size)
+    failed = False
+    with spec.create_context() as ctx:
+        with pymunge.executor.MungeExecutor(args.workers, ctx) as executor:
+            results = executor.imap(
+                lambda ctx, batch: process(ctx, args, batch), batches,
+                args.max_in_flight, not args.unordered)
+            for result in results:
+                if args.unordered:
+                    result = result[1]
+                output, errors = result
+                stdout.write(output)
+                stdout.flush()
+                failed = failed or errors
+    return 1 if failed else 0
+
+def _batches(lines, batch_size):
+    """pymunge internal - yield lists of up to batch_size (index, line)
+    tuples"""
+    numbered = enumerate(lines)
+    while True:
+        batch = list(itertools.islice(numbered, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def _parse(args, index, line, key):
+    """pymunge internal - return the record (a dict) for an input line,
+    with the credential or payload (bytes) under key, or an error record
+    (without key) if the line is invalid"""
+    if not args.ndjson:
+        return {'index': index, key: line.rstrip(b'\r\n')}
+    try:
+        record = json.loads(line.decode('utf-8'))
+        if not isinstance(record, dict):
+            raise ValueError('not a JSON object')
+        if key == 'cred':
+            record['cred'] = record['cred'].encode('ascii')
+        elif 'payload_base64' in record:
+            record['payload'] = base64.b64decode(
+                record.pop('payload_base64'))
+        elif record.get('payload') is not None:
+            record['payload'] = record['payload'].encode('utf-8')
+        else:
+            record['payload'] = None
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        return {'index': index, 'error': _BAD_ARG,
+                'message': 'Invalid input record: %s' % e}
+    record['index'] = index
+    return record
+
+def _encode_batch(ctx, args, batch):
+    records = [_parse(args, index, line, 'payload')
+               for index, line in batch if line.strip() or not args.ndjson]
+    valid = [record for record in records if 'payload' in record]
+    creds = ctx.encode_many([record.pop('payload') or None
+                             for record in valid])
+    for record, cred in zip(valid, creds):
+        if isinstance(cred, MungeError):
+            record['error'] = cred.code.name
+            record['message'] = cred.message
+        else:
+            record['error'] = None
+            record['cred'] = cred.decode('ascii')
+    return _dump(records)
+
+def _decode_batch(ctx, args, batch):
+    records = [_parse(args, index, line, 'cred')
+               for index, line in batch if line.strip()]
+    valid = [record for record in records if 'cred' in record]
+    results = ctx.decode_many([record.pop('cred') for record in valid],
+                              use_numpy=False)
+    for row, record in enumerate(valid):
+        code = results.codes[row]
+        record['error'] = None
+        if code != _SUCCESS:
+            record['error'] = _name(MungeErrorCode, code)
+            record['message'] = ctx.backend.strerror(code).decode('utf-8')
+        payload = results.payloads[row]
+        if payload is None:
+            continue
+        if args.base64:
+            record['payload_base64'] = _base64(payload)
+        else:
+            try:
+                record['payload'] = payload.decode('utf-8')
+            except UnicodeDecodeError:
+                record['payload_base64'] = _base64(payload)
+        record['uid'] = results.uids[row]
+        record['gid'] = results.gids[row]
+        record['encode_time'] = results.encode_times[row]
+        record['decode_time'] = results.decode_times[row]
+        record['cipher_type'] = _name(CipherType, results.cipher_types[row])
+        record['mac_type'] = _name(MACType, results.mac_types[row])
+        record['zip_type'] = _name(ZipType, results.zip_types[row])
+    return _dump(records)
+
+def _name(enum_class, value):
+    """pymunge internal - return the name of the member of enum_class with
+    the given value, or the value itself if it is not a known member
+    (e.g. an error code added by a newer libmunge)"""
+    try:
+        return enum_class(value).name
+    except ValueError:
+        return value
+
+def _base64(data):
+    return base64.b64encode(data).decode('ascii')
+
+def _dump(records):
+    """pymunge internal - return (output, number of failed records) for
+    a list of output records"""
+    lines = [json.dumps(record, sort_keys=True) for record in records]
+    lines.append('')
+    errors = sum(1 for record in records if record.get('error'))
+    return '\n'.join(lines).encode('utf-8') if records else b'', errors
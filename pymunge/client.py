@@ -0,0 +1,444 @@
+#########################################################################
+# Module pymunge.client - pure-Python, non-blocking munged client
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""This module provides `SelectorClient`, an alternative to libmunge
+which talks to munged directly over its Unix domain socket, using the
+protocol implemented in `pymunge.wire`.
+
+Unlike the blocking libmunge calls, a `SelectorClient` keeps many
+requests in flight on a single thread, multiplexing their connections
+with the `selectors` module. An asyncio version is provided by
+`pymunge.aio.AsyncWireClient`.
+
+libmunge remains the default and reference implementation; like
+libmunge, this client retries connections refused because munged's
+listen backlog is full, but it does not retry failed requests and does
+not support the file-descriptor based authentication used by munged on
+some non-Linux platforms."""
+
+from pymunge.context import MungeContext
+from pymunge.error import MungeError, MungeErrorCode
+from pymunge.spec import ContextSpec
+import pymunge.wire
+import collections
+import errno
+import selectors
+import socket
+import time
+
+#: Default maximum number of simultaneously open connections.
+DEFAULT_MAX_CONNECTIONS = 64
+
+#: Default timeout for a request, in seconds.
+DEFAULT_TIMEOUT = 10
+
+#: Number of attempts to connect to munged while its listen backlog is
+#: full (`EAGAIN`), as in libmunge.
+CONNECT_ATTEMPTS = 10
+
+#: Delay before retrying a connection, in seconds. The n-th retry waits
+#: n times this delay, as in libmunge.
+CONNECT_RETRY_DELAY = 0.05
+
+def as_spec(options):
+    """pymunge internal - return the `ContextSpec` for options, which is
+    a `ContextSpec`, a `MungeContext` or None (default options). If the
+    socket is not set, it is set to the default socket."""
+    if options is None:
+        options = ContextSpec()
+    elif isinstance(options, MungeContext):
+        options = ContextSpec.from_context(options)
+    if options.socket is None:
+        options = options._replace(socket=default_socket())
+    return options
+
+def default_socket():
+    """Return the path of the default munged socket. This is the default
+    compiled into libmunge, if libmunge is available, otherwise
+    `pymunge.wire.DEFAULT_SOCKET`."""
+    try:
+        with MungeContext() as ctx:
+            return ctx.socket
+    except ImportError:
+        return pymunge.wire.DEFAULT_SOCKET
+
+def start_connect(path):
+    """pymunge internal - start a non-blocking connection to the munged
+    socket at `path`. Returns the socket, or None if munged's listen
+    backlog is full and the connection should be retried later. Raises a
+    `MungeError` if the connection fails."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        sock.connect(path)
+    except (socket.error, OSError) as e:
+        if e.errno == errno.EINPROGRESS:
+            return sock
+        sock.close()
+        # on Unix domain sockets, EAGAIN means that the listen backlog
+        # is full; the socket is not connected
+        if e.errno == errno.EAGAIN:
+            return None
+        raise MungeError(MungeErrorCode.EMUNGE_SOCKET,
+                         'Failed to connect to "%s": %s' %
+                         (path, e.strerror))
+    return sock
+
+def connect_failed(path, attempts):
+    """pymunge internal - return the `MungeError` for a connection to
+    `path` which was refused `attempts` times because munged's listen
+    backlog was full."""
+    return MungeError(MungeErrorCode.EMUNGE_SOCKET,
+                      'Failed to connect to "%s": listen backlog full '
+                      'after %d attempts' % (path, attempts))
+
+def check_response_type(msg_type, expected):
+    """pymunge internal - raise a `MungeError` if the response message
+    type `msg_type` is not `expected`."""
+    if msg_type != expected:
+        raise MungeError(MungeErrorCode.EMUNGE_SOCKET,
+                         "Received unexpected message type %d" % msg_type)
+
+class Request(object):
+    """A request submitted to a `SelectorClient`.
+
+    Once the request is done (see `done()`), `result()` returns its result
+    or raises a `MungeError`. For decode requests, the `response`
+    attribute holds the complete `pymunge.wire.DecodeResponse`
+    (including the options used to encode the credential), or None if
+    no response was received."""
+
+    def __init__(self, kind, message, deadline):
+        self.kind = kind
+        self.response = None
+        self._message = message
+        self._deadline = deadline
+        self._sock = None
+        self._attempts = 0
+        self._retry_at = None
+        self._sent = 0
+        self._received = bytearray()
+        self._body_length = None
+        self._result = None
+        self._error = None
+        self._done = False
+
+    def done(self):
+        """True if the request has completed (successfully or not)."""
+        return self._done
+
+    def result(self):
+        """Return the result of the request: the credential (for encode
+        requests) or `(payload, uid, gid)` (for decode requests). Raises
+        the `MungeError` the request failed with."""
+        if not self._done:
+            raise MungeError(MungeErrorCode.EMUNGE_BAD_ARG,
+                             "Request is not done")
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def _finish(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._done = True
+        self._message = None
+        self._received = None
+
+class SelectorClient(object):
+    """A non-blocking munged client keeping many requests in flight on
+    one thread.
+
+    `SelectorClient(options, timeout, max_connections)` creates a client
+    which encodes credentials with `options` (a `ContextSpec`, a
+    `MungeContext` whose options are used, or None for the default
+    options), and connects to the socket given by its `socket` option.
+
+    Requests are submitted with `submit_encode()` and `submit_decode()`
+    and are processed by `poll()`, which waits for I/O on all open
+    connections. At most `max_connections` connections are open at the
+    same time; further requests are queued. Requests that do not
+    complete within `timeout` seconds (`DEFAULT_TIMEOUT` by default, None
+    means no timeout) fail with `EMUNGE_TIMEOUT`.
+
+    >>> with SelectorClient() as client:
+    >>>     requests = [client.submit_decode(cred) for cred in creds]
+    >>>     client.wait(requests)
+    >>>     results = [request.result() for request in requests]
+    """
+
+    def __init__(self, options=None, timeout=DEFAULT_TIMEOUT,
+                 max_connections=DEFAULT_MAX_CONNECTIONS):
+        if max_connections < 1:
+            raise ValueError('max_connections must be at least 1')
+        self._spec = as_spec(options)
+        self.timeout = timeout
+        self._max_connections = max_connections
+        self._selector = selectors.DefaultSelector()
+        self._queue = collections.deque()
+        self._active = set()
+        # requests waiting to retry their connection
+        self._delayed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def spec(self):
+        """The `ContextSpec` used by this client."""
+        return self._spec
+
+    @property
+    def pending(self):
+        """Number of requests that are not yet done."""
+        return len(self._queue) + len(self._active) + len(self._delayed)
+
+    def close(self):
+        """Close all connections. Requests that are not yet done fail with
+        `EMUNGE_SOCKET`."""
+        error = MungeError(MungeErrorCode.EMUNGE_SOCKET, "Client closed")
+        for request in list(self._active):
+            self._fail(request, error)
+        for request in self._delayed:
+            request._finish(error=error)
+        del self._delayed[:]
+        while self._queue:
+            self._queue.popleft()._finish(error=error)
+        self._selector.close()
+
+    def submit_encode(self, payload=None):
+        """Submit a request to encode a credential with the given payload
+        (bytes or None). Returns a `Request`."""
+        if payload is not None and not isinstance(payload, bytes):
+            raise TypeError('Payload must be bytes or None, got %s' %
+                            type(payload).__name__)
+        message = pymunge.wire.pack_encode_request(self._spec, payload)
+        return self._submit('encode', message)
+
+    def submit_decode(self, cred):
+        """Submit a request to decode the credential `cred` (bytes).
+        Returns a `Request`."""
+        if not isinstance(cred, bytes):
+            raise TypeError('Credential must be bytes, got %s' %
+                            type(cred).__name__)
+        return self._submit('decode', pymunge.wire.pack_decode_request(cred))
+
+    def encode(self, payload=None):
+        """Encode a credential, blocking until it is done."""
+        request = self.submit_encode(payload)
+        self.wait([request])
+        return request.result()
+
+    def decode(self, cred):
+        """Decode a credential, blocking until it is done. Returns
+        `(payload, uid, gid)` or raises a `MungeError`."""
+        request = self.submit_decode(cred)
+        self.wait([request])
+        return request.result()
+
+    def wait(self, requests=None):
+        """Process I/O until all `requests` (all pending requests, if None)
+        are done."""
+        if requests is None:
+            while self.pending:
+                self.poll()
+        else:
+            for request in requests:
+                while not request.done():
+                    self.poll()
+
+    def poll(self, timeout=None):
+        """Wait up to `timeout` seconds (indefinitely if None, or until the
+        next request deadline) for I/O and process it. Returns a list of
+        the requests completed by this call."""
+        completed = []
+        self._start_queued(completed)
+        deadline = self._next_deadline()
+        if deadline is not None:
+            remaining = max(0, deadline - time.monotonic())
+            timeout = remaining if timeout is None else min(timeout,
+                                                            remaining)
+        if self._active:
+            for key, events in self._selector.select(timeout):
+                request = key.data
+                if events & selectors.EVENT_WRITE:
+                    self._on_writable(request)
+                elif events & selectors.EVENT_READ:
+                    self._on_readable(request)
+                if request.done():
+                    completed.append(request)
+        elif self._delayed and timeout is not None:
+            time.sleep(timeout)
+        self._expire(completed)
+        self._start_queued(completed)
+        return completed
+
+    def _submit(self, kind, message):
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        request = Request(kind, message, deadline)
+        self._queue.append(request)
+        return request
+
+    def _start_queued(self, completed):
+        # retried connections go before newly queued requests
+        now = time.monotonic()
+        ready = [request for request in self._delayed
+                 if request._retry_at <= now]
+        for request in ready:
+            if len(self._active) >= self._max_connections:
+                break
+            self._delayed.remove(request)
+            self._connect(request)
+            if request.done():
+                completed.append(request)
+        while self._queue and len(self._active) < self._max_connections:
+            request = self._queue.popleft()
+            self._connect(request)
+            if request.done():
+                completed.append(request)
+
+    def _connect(self, request):
+        request._attempts += 1
+        try:
+            sock = start_connect(self._spec.socket)
+        except MungeError as e:
+            request._finish(error=e)
+            return
+        if sock is None:
+            if request._attempts >= CONNECT_ATTEMPTS:
+                request._finish(error=connect_failed(self._spec.socket,
+                                                     request._attempts))
+            else:
+                request._retry_at = time.monotonic() + \
+                    request._attempts * CONNECT_RETRY_DELAY
+                self._delayed.append(request)
+            return
+        request._sock = sock
+        self._active.add(request)
+        self._selector.register(sock, selectors.EVENT_WRITE, request)
+
+    def _on_writable(self, request):
+        try:
+            request._sent += request._sock.send(
+                request._message[request._sent:])
+        except (socket.error, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._fail(request, MungeError(
+                    MungeErrorCode.EMUNGE_SOCKET,
+                    'Failed to send message: %s' % e.strerror))
+            return
+        if request._sent == len(request._message):
+            self._selector.modify(request._sock, selectors.EVENT_READ,
+                                  request)
+
+    def _on_readable(self, request):
+        try:
+            data = request._sock.recv(65536)
+        except (socket.error, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._fail(request, MungeError(
+                    MungeErrorCode.EMUNGE_SOCKET,
+                    'Failed to receive message: %s' % e.strerror))
+            return
+        if not data:
+            self._fail(request, MungeError(
+                MungeErrorCode.EMUNGE_SOCKET,
+                'Connection closed by munged'))
+            return
+        received = request._received
+        received += data
+        try:
+            if request._body_length is None:
+                if len(received) < pymunge.wire.HEADER_SIZE:
+                    return
+                msg_type, retry, request._body_length = \
+                    pymunge.wire.unpack_header(
+                        bytes(received[:pymunge.wire.HEADER_SIZE]))
+                check_response_type(msg_type,
+                                    pymunge.wire.MSG_ENC_RSP
+                                    if request.kind == 'encode' else
+                                    pymunge.wire.MSG_DEC_RSP)
+                del received[:pymunge.wire.HEADER_SIZE]
+            if len(received) < request._body_length:
+                return
+            body = bytes(received[:request._body_length])
+            if request.kind == 'encode':
+                response = pymunge.wire.unpack_encode_response(body)
+                request.response = response
+                result = pymunge.wire.encode_result(response)
+            else:
+                response = pymunge.wire.unpack_decode_response(body)
+                request.response = response
+                result = pymunge.wire.decode_result(response)
+        except MungeError as e:
+            self._fail(request, e)
+            return
+        self._close_connection(request)
+        request._finish(result=result)
+
+    def _fail(self, request, error):
+        self._close_connection(request)
+        request._finish(error=error)
+
+    def _close_connection(self, request):
+        if request._sock is not None:
+            self._selector.unregister(request._sock)
+            request._sock.close()
+            request._sock = None
+        self._active.discard(request)
+
+    def _next_deadline(self):
+        deadlines = [request._deadline
+                     for request in self._active.union(self._delayed)
+                     if request._deadline is not None]
+        deadlines.extend(request._retry_at for request in self._delayed)
+        return min(deadlines) if deadlines else None
+
+    def _expire(self, completed):
+        now = time.monotonic()
+        for request in list(self._active):
+            if request._deadline is not None and request._deadline <= now:
+                self._fail(request, MungeError(
+                    MungeErrorCode.EMUNGE_TIMEOUT,
+                    'Timed out waiting for munged'))
+                completed.append(request)
+        for request in list(self._delayed):
+            if request._deadline is not None and request._deadline <= now:
+                self._delayed.remove(request)
+                request._finish(error=MungeError(
+                    MungeErrorCode.EMUNGE_TIMEOUT,
+                    'Timed out waiting for a connection'))
+                completed.append(request)
+        # queued requests expire in submission order
+        queue = self._queue
+        while queue and queue[0]._deadline is not None and \
+                queue[0]._deadline <= now:
+            request = queue.popleft()
+            request._finish(error=MungeError(
+                MungeErrorCode.EMUNGE_TIMEOUT,
+                'Timed out waiting for a connection'))
+            completed.append(request)
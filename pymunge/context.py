@@ -25,10 +25,25 @@ and decode credentials. The core of pymunge."""
 
 from pymunge.error import MungeError, MungeErrorCode
 from pymunge.enums import CipherType, MACType, ZipType
+from pymunge.batch import DecodeBatch, RESULT_CODES, iter_packed
+from pymunge.result import DecodeResult
+import pymunge.backend
+import pymunge._instrument as _instrument
 import pymunge.raw
 import ctypes
-import socket
-import struct
+import functools
+
+class _LazyBuffers(object):
+    """pymunge internal - creates the preallocated out-parameters of a
+    `MungeContext` (see `pymunge.backend.Backend.new_buffers()`) on first
+    access, and stores them in the instance"""
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        buffers = instance.__dict__['_buffers'] = \
+            instance._backend.new_buffers()
+        return buffers
 
 class MungeContext(object):
     """A MUNGE context. Encapsulates a collection of options used when
@@ -65,18 +80,42 @@ class MungeContext(object):
     >>> with MungeContext() as ctx:
     >>>     payload, uid, gid = ctx.decode(cred)
     >>>     (check attributes of ctx, if needed)
+
+    A `MungeContext` must not be used by several threads at the same
+    time. To encode or decode credentials concurrently, use a
+    `MungeExecutor`, which manages one context per worker thread.
+
+    libmunge is called through the default backend (see
+    `pymunge.backend`), or through `backend` (a backend name or a
+    `pymunge.backend.Backend`) if given. A copy uses the backend of the
+    context it copies.
     """
 
-    def __init__(self, ctx=None):
+    _buffers = _LazyBuffers()
+
+    def __init__(self, ctx=None, backend=None):
         """If ctx is None, create a new context (with all options set
         to their defaults initially).
 
         If ctx is not None, create a copy of ctx.
         """
         if ctx is not None:
-            self.ctx = pymunge.raw.munge_ctx_copy(ctx.ctx)
+            if backend is not None and \
+                    pymunge.backend.get_backend(backend) is not ctx._backend:
+                raise ValueError('Cannot copy a context to another backend')
+            self._backend = ctx._backend
+            if _instrument.active:
+                self.ctx = _instrument.call(
+                    'ctx_copy', self._backend.ctx_copy, ctx.ctx)
+            else:
+                self.ctx = self._backend.ctx_copy(ctx.ctx)
         else:
-            self.ctx = pymunge.raw.munge_ctx_create()
+            self._backend = pymunge.backend.get_backend(backend)
+            if _instrument.active:
+                self.ctx = _instrument.call(
+                    'ctx_create', self._backend.ctx_create)
+            else:
+                self.ctx = self._backend.ctx_create()
 
     def __del__(self):
         if hasattr(self, 'ctx'):
@@ -95,9 +134,18 @@ class MungeContext(object):
         than `closed`) be read or set (in each case, a `MungeError` is raised).
         Calling `close()` on an already closed context has no effect."""
         if self.ctx is not None:
-            pymunge.raw.munge_ctx_destroy(self.ctx)
+            if _instrument.active:
+                _instrument.call('ctx_destroy', self._backend.ctx_destroy,
+                                 self.ctx)
+            else:
+                self._backend.ctx_destroy(self.ctx)
             self.ctx = None
 
+    @property
+    def backend(self):
+        """The `pymunge.backend.Backend` used by this context."""
+        return self._backend
+
     @property
     def closed(self):
         """True if this context is closed, False otherwise.
@@ -112,16 +160,58 @@ class MungeContext(object):
 
         If successful, returns the credential (a byte string), otherwise
         raises a `MungeError`."""
-        self._ensure_is_open()
-        if isinstance(payload, bytes):
-            return pymunge.raw.munge_encode(self.ctx, payload, len(payload))
-        elif payload is None:
-            return pymunge.raw.munge_encode(self.ctx, None, 0)
-        else:
+        ctx = self.ctx
+        if ctx is None:
+            self._ensure_is_open()
+        if payload is not None and not isinstance(payload, bytes):
             raise TypeError('Payload must be bytes or None, got %s' %
                             type(payload).__name__)
-
-    def decode(self, cred):
+        backend = self._backend
+        if _instrument.active:
+            error_code, cred = _instrument.encode(backend, self._buffers,
+                                                  ctx, payload)
+        else:
+            error_code, cred = backend.encode(self._buffers, ctx, payload)
+        if error_code:
+            raise backend.make_error(error_code, ctx, None)
+        return cred
+
+    def encode_many(self, payloads):
+        """Create one MUNGE credential per payload in `payloads` (an
+        iterable of byte strings or None), using the options defined in
+        this context.
+
+        Returns a list with one entry per payload, in the same order.
+        Each entry is either the credential (a byte string) or, if
+        encoding that payload failed, the `MungeError` describing the
+        failure. A failed payload does not abort the remaining ones.
+
+        This is equivalent to calling `encode()` once per payload, but
+        considerably faster for large batches. A TypeError is raised,
+        before any credential is created, if a payload is neither bytes
+        nor None."""
+        self._ensure_is_open()
+        payloads = list(payloads)
+        for payload in payloads:
+            if payload is not None and not isinstance(payload, bytes):
+                raise TypeError('Payload must be bytes or None, got %s' %
+                                type(payload).__name__)
+        ctx = self.ctx
+        backend = self._backend
+        encode = backend.encode
+        if _instrument.active:
+            encode = functools.partial(_instrument.encode, backend)
+        buffers = self._buffers
+        results = []
+        for payload in payloads:
+            error_code, cred = encode(buffers, ctx, payload)
+            if error_code:
+                results.append(backend.make_error(error_code, ctx, None))
+            else:
+                results.append(cred)
+        return results
+
+    def decode(self, cred, snapshot=False):
         """Validate a MUNGE credential. The attributes of this context will be
         set to those used to encode the credential.
 
@@ -131,13 +221,170 @@ class MungeContext(object):
         Otherwise a `MungeError` is raised. For certain errors
         (i.e. `EMUNGE_CRED_EXPIRED`, `EMUNGE_CRED_REWOUND`,
         `EMUNGE_CRED_REPLAYED`), the `payload`, `uid` and `gid` can still
-        be obtained via the `result` property of the raised `MungeError`."""
-        self._ensure_is_open()
-        if isinstance(cred, bytes):
-            return pymunge.raw.munge_decode(cred, self.ctx)
-        else:
+        be obtained via the `result` property of the raised `MungeError`.
+
+        If `snapshot` is True, a `DecodeResult` is returned (and used as
+        the `result` of the `MungeError` for the errors above) instead of
+        the tuple. It iterates as `(payload, uid, gid)` and additionally
+        holds the attributes of this context after the decode, so that
+        they do not need to be read from the context one by one."""
+        error_code, address, length, uid, gid = self._decode_raw(cred)
+        backend = self._backend
+        if not snapshot:
+            result = (backend.take_bytes(address, length), uid, gid)
+            if error_code:
+                raise backend.make_error(error_code, self.ctx, result)
+            return result
+        payload = backend.take_bytes(address, length)
+        error = None
+        if error_code != MungeErrorCode.EMUNGE_SUCCESS.value:
+            # reading the options below clears the context's error message
+            error = backend.make_error(error_code, self.ctx,
+                                       (payload, uid, gid))
+        if error_code in RESULT_CODES:
+            result = DecodeResult.from_context(self, payload, uid, gid)
+            if error is not None:
+                error.result = result
+        if error is not None:
+            raise error
+        return result
+
+    def decode_into(self, cred, buffer):
+        """Validate a MUNGE credential like `decode()`, but write the payload
+        into `buffer` (a writable object supporting the buffer protocol,
+        e.g. a bytearray, a writable memoryview or an mmap) instead of
+        returning it as a new byte string.
+
+        If successful, returns `(nbytes, uid, gid)`, where `nbytes` is the
+        length of the payload written to the start of `buffer`. Otherwise
+        a `MungeError` is raised; as with `decode()`, its `result` is
+        `(nbytes, uid, gid)` for certain errors, with the payload written
+        to `buffer`. If `buffer` is too small for the payload, a
+        `MungeError` with code `EMUNGE_OVERFLOW` is raised, with `nbytes`
+        in its `result` set to the required size."""
+        with memoryview(buffer) as view:
+            if view.readonly:
+                raise TypeError('Buffer must be writable')
+            error_code, address, length, uid, gid = self._decode_raw(cred)
+            backend = self._backend
+            try:
+                if length > view.nbytes:
+                    raise MungeError(MungeErrorCode.EMUNGE_OVERFLOW,
+                                     'Payload of %d bytes does not fit into '
+                                     'buffer of %d bytes' %
+                                     (length, view.nbytes),
+                                     (length, uid, gid))
+                backend.copy_into(view, address, length)
+            finally:
+                backend.free(address)
+        result = (length, uid, gid)
+        if error_code:
+            raise backend.make_error(error_code, self.ctx, result)
+        return result
+
+    def decode_view(self, cred):
+        """Validate a MUNGE credential like `decode()`, but return the
+        payload as a read-only memoryview over the memory allocated by
+        libmunge, without copying it.
+
+        If successful, returns `(view, uid, gid)`, otherwise raises a
+        `MungeError` (whose `result`, for certain errors, is
+        `(view, uid, gid)`). The native memory is freed as soon as the
+        memoryview is released, i.e. `view.release()` is called or a
+        'with' block over the view is left, or the view is garbage
+        collected:
+
+        >>> view, uid, gid = ctx.decode_view(cred)
+        >>> with view:
+        >>>     process(view)
+
+        Accessing a released view raises a ValueError. On Python versions
+        before 3.8, the memoryview is writable."""
+        error_code, address, length, uid, gid = self._decode_raw(cred)
+        backend = self._backend
+        result = (backend.take_view(address, length), uid, gid)
+        if error_code:
+            raise backend.make_error(error_code, self.ctx, result)
+        return result
+
+    def _decode_raw(self, cred):
+        """pymunge internal - call munge_decode without error checking;
+        returns (error_code, address, length, uid, gid). The caller must
+        free the payload at address with the context's backend."""
+        ctx = self.ctx
+        if ctx is None:
+            self._ensure_is_open()
+        if not isinstance(cred, bytes):
             raise TypeError('Credential must be bytes, got %s' %
                             type(cred).__name__)
+        if _instrument.active:
+            return _instrument.decode(self._backend, self._buffers, ctx,
+                                      cred)
+        return self._backend.decode(self._buffers, ctx, cred)
+
+    def decode_many(self, creds, offsets=None, use_numpy=None):
+        """Validate a batch of MUNGE credentials, returning the results
+        as a `DecodeBatch` (with one row per credential, in order).
+
+        `creds` is either an iterable of credentials (byte strings), or,
+        if `offsets` is given, a packed buffer (any object supporting
+        the buffer protocol, e.g. bytes, bytearray or mmap) containing
+        all credentials back to back. In the latter case, `offsets` is a
+        sequence of `n + 1` integers such that credential `i` is
+        `creds[offsets[i]:offsets[i + 1]]`.
+
+        Decode errors (including expired, rewound and replayed
+        credentials) do not raise a `MungeError`, but are recorded in
+        the `codes` column of the returned batch. If use_numpy is None,
+        NumPy arrays are returned if NumPy is installed; if it is True
+        and NumPy is not installed, ImportError is raised before any
+        credential is decoded. Likewise, TypeError (for an item which is
+        not bytes) and ValueError (for invalid offsets) are raised before
+        any credential is decoded.
+
+        After the call, the attributes of this context are set to those
+        used to encode the last credential of the batch."""
+        self._ensure_is_open()
+        # check all credentials first: munged consumes each one decoded
+        if offsets is not None:
+            creds = iter_packed(creds, offsets)
+        else:
+            creds = list(creds)
+            for cred in creds:
+                if not isinstance(cred, (bytes, ctypes.Array)):
+                    raise TypeError('Credential must be bytes, got %s' %
+                                    type(cred).__name__)
+        ctx = self.ctx
+        backend = self._backend
+        decode = backend.decode
+        if _instrument.active:
+            decode = functools.partial(_instrument.decode, backend)
+        take_bytes = backend.take_bytes
+        read_options = backend.read_options
+        buffers = self._buffers
+
+        batch = DecodeBatch(use_numpy)
+        payloads = batch.payloads
+        columns = (batch.uids, batch.gids, batch.codes,
+                   batch.encode_times, batch.decode_times,
+                   batch.cipher_types, batch.mac_types, batch.zip_types)
+        for cred in creds:
+            error_code, address, length, uid, gid = decode(buffers, ctx,
+                                                           cred)
+            payload = take_bytes(address, length)
+            if error_code not in RESULT_CODES:
+                payloads.append(None)
+                row = (0, 0, error_code, 0, 0, 0, 0, 0)
+            else:
+                payloads.append(payload)
+                status, values = read_options(buffers, ctx, _BATCH_OPTIONS)
+                if status:
+                    raise backend.make_error(status, ctx, None)
+                row = [uid, gid, error_code]
+                row.extend(values)
+            for column, value in zip(columns, row):
+                column.append(value)
+        return batch._finish()
 
     @property
     def cipher_type(self):
@@ -219,8 +466,10 @@ class MungeContext(object):
         """The IPv4 address of the host where the credential was encoded,
         in dotted-quad notation (e.g. '127.0.0.1'). This property cannot be
         explicitly set."""
-        ip = self._get_option(pymunge.raw.MUNGE_OPT_ADDR4, ctypes.c_ulong)
-        return socket.inet_ntoa(struct.pack('<L', ip))
+        import socket
+        import struct
+        ip = self._get_option(pymunge.raw.MUNGE_OPT_ADDR4, ctypes.c_uint)
+        return socket.inet_ntoa(struct.pack('=I', ip))
 
     @property
     def encode_time(self):
@@ -298,16 +547,37 @@ class MungeContext(object):
                             (argname, argtype.__name__))
 
     def _get_option(self, option, option_type):
-        self._ensure_is_open()
-        val = option_type()
-        result = pymunge.raw.munge_ctx_get(self.ctx, option,
-                                           ctypes.byref(val))
-        return val.value
+        ctx = self.ctx
+        if ctx is None:
+            self._ensure_is_open()
+        if _instrument.active:
+            return _instrument.option('option_get', self._backend.get_option,
+                                      self._buffers, ctx, option,
+                                      option_type)
+        return self._backend.get_option(self._buffers, ctx, option,
+                                        option_type)
 
     def _set_option(self, option, option_type, value):
-        self._ensure_is_open()
-        val = option_type(value)
-        pymunge.raw.munge_ctx_set(self.ctx, option, val)
+        ctx = self.ctx
+        if ctx is None:
+            self._ensure_is_open()
+        if _instrument.active:
+            _instrument.option('option_set', self._backend.set_option,
+                               self._buffers, ctx, option, option_type,
+                               value)
+        else:
+            self._backend.set_option(self._buffers, ctx, option,
+                                     option_type, value)
+
+# options read per credential by MungeContext.decode_many(), in the order
+# of the DecodeBatch columns
+_BATCH_OPTIONS = (
+    (pymunge.raw.MUNGE_OPT_ENCODE_TIME, pymunge.raw.time_t),
+    (pymunge.raw.MUNGE_OPT_DECODE_TIME, pymunge.raw.time_t),
+    (pymunge.raw.MUNGE_OPT_CIPHER_TYPE, ctypes.c_int),
+    (pymunge.raw.MUNGE_OPT_MAC_TYPE, ctypes.c_int),
+    (pymunge.raw.MUNGE_OPT_ZIP_TYPE, ctypes.c_int))
+
 
 def encode(payload=None):
     """Create a MUNGE credential using the default context.
@@ -315,10 +585,29 @@ def encode(payload=None):
 
     If successful, returns the credential (a byte string), otherwise
     raises a `MungeError`."""
-    with MungeContext() as ctx:
+    with pymunge.pool.default_pool().acquire() as ctx:
         return ctx.encode(payload)
 
-def decode(cred):
+def encode_many(payloads):
+    """Create one MUNGE credential per payload in `payloads` (an iterable
+    of byte strings or None) using the default context.
+
+    Returns a list with one entry per payload, in the same order: either
+    the credential (a byte string) or the `MungeError` raised while
+    encoding that payload. See `MungeContext.encode_many()`."""
+    with pymunge.pool.default_pool().acquire() as ctx:
+        return ctx.encode_many(payloads)
+
+def decode_many(creds, offsets=None, use_numpy=None):
+    """Validate a batch of MUNGE credentials using the default context.
+
+    Returns a `DecodeBatch` with one row per credential; decode errors
+    are recorded per row instead of raising a `MungeError`. See
+    `MungeContext.decode_many()` for a description of the arguments."""
+    with pymunge.pool.default_pool().acquire() as ctx:
+        return ctx.decode_many(creds, offsets, use_numpy)
+
+def decode(cred, snapshot=False):
     """Validate a MUNGE credential using the default context.
 
     If successful, returns `(payload, uid, gid, ctx)`, where `payload` is the
@@ -331,7 +620,25 @@ def decode(cred):
     the `payload`, `uid` and `gid` can still be obtained via the `result`
     property of the raised `MungeError`. Note that the context cannot
     be obtained from the `MungeError`; if you need it, manually create
-    a `MungeContext` and use its decode() method."""
-    ctx = MungeContext()
-    payload, uid, gid = ctx.decode(cred)
+    a `MungeContext` and use its decode() method.
+
+    `ctx` is taken from the default `pymunge.pool.MungeContextPool`;
+    closing it returns it to the pool.
+
+    If `snapshot` is True, a `DecodeResult` holding the payload, UID, GID
+    and all attributes of the context is returned instead, and the
+    context is returned to the pool right away. See
+    `MungeContext.decode()`."""
+    ctx = pymunge.pool.default_pool().acquire()
+    if snapshot:
+        with ctx:
+            return ctx.decode(cred, True)
+    try:
+        payload, uid, gid = ctx.decode(cred)
+    except:
+        ctx.close()
+        raise
     return payload, uid, gid, ctx
+
+# imported last, since pymunge.pool depends on this module
+import pymunge.pool
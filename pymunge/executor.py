@@ -0,0 +1,443 @@
+#########################################################################
+# Module pymunge.executor - concurrent encoding and decoding
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""This module provides the `MungeExecutor` class, which encodes and
+decodes credentials concurrently on a pool of worker threads, and the
+`ProcessPoolDecoder` class, which does the same on a pool of worker
+processes.
+
+libmunge is called via ctypes, which releases the GIL for the duration
+of each call, so the daemon round trips of several worker threads
+overlap. Worker processes additionally allow CPU-heavy processing of
+the decoded payloads to run in parallel."""
+
+from pymunge.context import MungeContext
+from pymunge.error import MungeError, MungeErrorCode
+from pymunge.spec import ContextSpec
+import collections
+import concurrent.futures
+import functools
+import itertools
+import math
+import os
+import threading
+import time
+
+#: Number of worker threads used if the daemon latency cannot be measured.
+DEFAULT_WORKERS = 4
+
+#: Upper bound for the automatically determined number of worker threads.
+MAX_AUTO_WORKERS = 32
+
+# CPU time of the calling thread (Python 3.7+), or of the whole process
+_thread_time = getattr(time, 'thread_time', time.process_time)
+
+def measure_latency(ctx=None, samples=10):
+    """Measure the latency of the munged daemon, by encoding `samples`
+    empty credentials with a copy of the context `ctx` (or a default
+    context, if `ctx` is None).
+
+    Returns a tuple `(latency, overhead)` of the median time (in seconds)
+    of an encode round trip and of the CPU time the calling thread
+    spends per encode (the part of a call which does not overlap with
+    other threads' calls). Raises a `MungeError` if the credentials
+    cannot be encoded."""
+    with MungeContext(ctx) as ctx:
+        latencies = []
+        overheads = []
+        for i in range(samples):
+            start = time.perf_counter()
+            cpu_start = _thread_time()
+            ctx.encode()
+            overheads.append(_thread_time() - cpu_start)
+            latencies.append(time.perf_counter() - start)
+    return _median(latencies), _median(overheads)
+
+def auto_workers(ctx=None):
+    """Return a suitable number of worker threads for a `MungeExecutor`,
+    based on the measured daemon latency (see `measure_latency()`).
+
+    While one thread waits for the daemon, other threads can spend
+    about `latency / overhead` calls' worth of CPU time, so that many
+    threads (but at least 2 and at most `MAX_AUTO_WORKERS`) are used.
+    If the latency cannot be measured, `DEFAULT_WORKERS` is returned."""
+    try:
+        latency, overhead = measure_latency(ctx)
+    except MungeError:
+        return DEFAULT_WORKERS
+    workers = int(math.ceil(latency / max(overhead, 1e-6)))
+    return max(2, min(workers, MAX_AUTO_WORKERS))
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def _bounded_map(executor, fn, iterable, max_in_flight):
+    """pymunge internal - like executor.map(fn, iterable), but only
+    consumes iterable as results are taken, keeping at most
+    max_in_flight calls submitted at any time"""
+    pending = collections.deque()
+    try:
+        for item in iterable:
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+            pending.append(executor.submit(fn, item))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+class ThreadContexts(object):
+    """pymunge internal - manages one `MungeContext` per thread, each
+    created on first use as a copy of a template context.
+
+    The template's options can be changed with `set_option()`, after
+    which each thread's context is recreated on its next use."""
+
+    def __init__(self, ctx=None):
+        self.template = MungeContext(ctx)
+        self._local = threading.local()
+        self._contexts = []
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the calling thread's context."""
+        local = self._local
+        ctx = getattr(local, 'ctx', None)
+        if ctx is None or local.generation != self._generation:
+            with self._lock:
+                if ctx is not None:
+                    self._contexts.remove(ctx)
+                    ctx.close()
+                ctx = MungeContext(self.template)
+                local.ctx = ctx
+                local.generation = self._generation
+                self._contexts.append(ctx)
+        return ctx
+
+    def set_option(self, name, value):
+        """Set the option `name` of the template context to `value`."""
+        with self._lock:
+            setattr(self.template, name, value)
+            self._generation += 1
+
+    def contexts(self):
+        """Return a list of the contexts of all threads."""
+        with self._lock:
+            return list(self._contexts)
+
+    def close(self):
+        """Close the template and all thread contexts. Must not be called
+        while other threads may still use their contexts."""
+        with self._lock:
+            for ctx in self._contexts:
+                ctx.close()
+            del self._contexts[:]
+            self.template.close()
+
+class MungeExecutor(object):
+    """Encodes and decodes credentials concurrently on a pool of worker
+    threads. Each worker thread uses its own MUNGE context, which is
+    created on first use as a copy of the executor's context.
+
+    `MungeExecutor(max_workers, ctx)` creates an executor with
+    `max_workers` worker threads. If `max_workers` is None, the number of
+    threads is determined from the measured daemon latency (see
+    `auto_workers()`). The options (cipher type, TTL, socket, etc.)
+    of the worker contexts are copied from the `MungeContext` `ctx`,
+    or are the defaults if `ctx` is None.
+
+    A `MungeExecutor` should be shut down when it is no longer used,
+    preferably by using it as a context manager:
+
+    >>> with MungeExecutor() as executor:
+    >>>     for result in executor.imap_decode(creds):
+    >>>         (handle result)
+
+    Results are returned as from `MungeContext.encode()` and
+    `MungeContext.decode()`, except that a `MungeError` raised for a
+    particular credential is returned in place of the result instead of
+    being raised, so that one failure does not abort the whole stream.
+    """
+
+    def __init__(self, max_workers=None, ctx=None):
+        self._contexts = ThreadContexts(ctx)
+        if max_workers is None:
+            max_workers = auto_workers(self._contexts.template)
+        if max_workers < 1:
+            raise ValueError('max_workers must be at least 1')
+        self._max_workers = max_workers
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    @property
+    def max_workers(self):
+        """The number of worker threads."""
+        return self._max_workers
+
+    def shutdown(self, wait=True):
+        """Shut down the executor, releasing its worker threads. If `wait`
+        is True, wait for pending calls to finish and close the worker
+        contexts; otherwise they are closed when garbage collected."""
+        self._executor.shutdown(wait)
+        if wait:
+            self._contexts.close()
+
+    def submit_encode(self, payload=None):
+        """Schedule encoding a credential with the given payload. Returns a
+        `concurrent.futures.Future` for the result (or `MungeError`)."""
+        return self._executor.submit(self._encode, payload)
+
+    def submit_decode(self, cred):
+        """Schedule decoding the credential `cred`. Returns a
+        `concurrent.futures.Future` for the result (or `MungeError`)."""
+        return self._executor.submit(self._decode, cred)
+
+    def submit(self, fn, *args):
+        """Schedule calling `fn(ctx, *args)`, where `ctx` is the
+        `MungeContext` of the worker thread. Returns a
+        `concurrent.futures.Future` for the result of `fn`."""
+        return self._executor.submit(self._call, fn, *args)
+
+    def imap_encode(self, payloads, max_in_flight=None, ordered=True):
+        """Encode a credential for each payload in the iterable
+        `payloads`, returning an iterator over the results.
+
+        At most `max_in_flight` payloads (twice the number of worker
+        threads, if None) are being encoded or waiting for their result
+        to be consumed at any time; `payloads` is only consumed as
+        results are taken from the iterator.
+
+        If `ordered` is True, results are returned in the order of
+        `payloads`. Otherwise, pairs `(index, result)` are returned in
+        the order in which the credentials are encoded, where `index`
+        is the position of the payload in `payloads`."""
+        return self._imap(self._encode, payloads, max_in_flight, ordered)
+
+    def imap_decode(self, creds, max_in_flight=None, ordered=True):
+        """Decode each credential in the iterable `creds`, returning an
+        iterator over the results, i.e. tuples `(payload, uid, gid)`, or
+        `MungeError` instances for credentials that failed to decode.
+
+        See `imap_encode()` for the meaning of `max_in_flight` and
+        `ordered`."""
+        return self._imap(self._decode, creds, max_in_flight, ordered)
+
+    def imap(self, fn, iterable, max_in_flight=None, ordered=True):
+        """Call `fn(ctx, item)` for each item in the iterable `iterable`,
+        where `ctx` is the `MungeContext` of the worker thread, returning
+        an iterator over the results. This allows processing several
+        credentials per call, e.g. with `MungeContext.decode_many()`.
+        Exceptions raised by `fn` are raised by the iterator.
+
+        See `imap_encode()` for the meaning of `max_in_flight` and
+        `ordered`."""
+        return self._imap(functools.partial(self._call, fn), iterable,
+                          max_in_flight, ordered)
+
+    def _imap(self, fn, iterable, max_in_flight, ordered):
+        if max_in_flight is None:
+            max_in_flight = 2 * self._max_workers
+        if max_in_flight < 1:
+            raise ValueError('max_in_flight must be at least 1')
+        if ordered:
+            return _bounded_map(self._executor, fn, iterable, max_in_flight)
+        else:
+            return self._imap_unordered(fn, iterable, max_in_flight)
+
+    def _imap_unordered(self, fn, iterable, max_in_flight):
+        pending = set()
+        try:
+            for index, item in enumerate(iterable):
+                if len(pending) >= max_in_flight:
+                    done, pending = concurrent.futures.wait(
+                        pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                pending.add(self._executor.submit(self._indexed,
+                                                  fn, index, item))
+            for future in concurrent.futures.as_completed(pending):
+                yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _call(self, fn, *args):
+        return fn(self._contexts.get(), *args)
+
+    def _encode(self, payload):
+        try:
+            return self._contexts.get().encode(payload)
+        except MungeError as e:
+            return e
+
+    def _decode(self, cred):
+        try:
+            return self._contexts.get().decode(cred)
+        except MungeError as e:
+            return e
+
+    @staticmethod
+    def _indexed(fn, index, item):
+        return index, fn(item)
+
+class ProcessPoolDecoder(object):
+    """Encodes and decodes credentials on a pool of worker processes.
+
+    `ProcessPoolDecoder(processes, spec, postprocess)` starts `processes`
+    worker processes (one per CPU, if None). Each worker process creates
+    its MUNGE context from the `ContextSpec` `spec` (or uses the default
+    options, if `spec` is None), since a native context cannot be passed
+    between processes.
+
+    If `postprocess` is not None, it must be a picklable function (e.g.
+    a module-level function) taking `(payload, uid, gid)`. It is called
+    in the worker process for each credential that yields a decode
+    result, and its return value replaces the payload in the result.
+
+    Credentials and payloads are sent to the workers in chunks of
+    `chunksize` items. To keep inter-process communication cheap, results
+    are compact tuples rather than `MungeError` instances (see `encode()`
+    and `decode()`).
+
+    A `ProcessPoolDecoder` should be shut down when it is no longer used,
+    preferably by using it as a context manager.
+    """
+
+    def __init__(self, processes=None, spec=None, postprocess=None,
+                 chunksize=64):
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if processes < 1:
+            raise ValueError('processes must be at least 1')
+        if chunksize < 1:
+            raise ValueError('chunksize must be at least 1')
+        self._processes = processes
+        self._spec = spec if spec is not None else ContextSpec()
+        self._postprocess = postprocess
+        self._chunksize = chunksize
+        self._executor = concurrent.futures.ProcessPoolExecutor(processes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    @property
+    def processes(self):
+        """The number of worker processes."""
+        return self._processes
+
+    @property
+    def spec(self):
+        """The `ContextSpec` used by the worker processes."""
+        return self._spec
+
+    def shutdown(self, wait=True):
+        """Shut down the worker processes."""
+        self._executor.shutdown(wait)
+
+    def encode(self, payloads, max_in_flight=None):
+        """Encode a credential for each payload in the iterable `payloads`.
+        Returns an iterator over tuples `(code, cred)`, in order, where
+        `code` is the error code (an integer) and `cred` is the
+        credential, or None if `code` is not `EMUNGE_SUCCESS`.
+
+        At most `max_in_flight` chunks (twice the number of processes, if
+        None) are submitted to the workers at any time."""
+        return self._map(_encode_chunk, payloads, max_in_flight)
+
+    def decode(self, creds, max_in_flight=None):
+        """Decode each credential in the iterable `creds`. Returns an
+        iterator over tuples `(code, payload, uid, gid)`, in order,
+        where `code` is the error code (an integer). For credentials
+        that yield no decode result (i.e. all errors other than
+        `EMUNGE_CRED_EXPIRED`, `EMUNGE_CRED_REWOUND` and
+        `EMUNGE_CRED_REPLAYED`), `payload` is None and `uid`, `gid`
+        are 0.
+
+        See `encode()` for the meaning of `max_in_flight`."""
+        return self._map(_decode_chunk, creds, max_in_flight)
+
+    def _map(self, fn, iterable, max_in_flight):
+        if max_in_flight is None:
+            max_in_flight = 2 * self._processes
+        if max_in_flight < 1:
+            raise ValueError('max_in_flight must be at least 1')
+        args = ((self._spec, self._postprocess, chunk)
+                for chunk in _chunks(iterable, self._chunksize))
+        results = _bounded_map(self._executor, _call_chunk(fn), args,
+                               max_in_flight)
+        return itertools.chain.from_iterable(results)
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+class _call_chunk(object):
+    """pymunge internal - picklable adapter calling fn(*args)"""
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __call__(self, args):
+        return self.fn(*args)
+
+#: pymunge internal - contexts of a worker process, by spec
+_worker_contexts = {}
+
+def _worker_context(spec):
+    ctx = _worker_contexts.get(spec)
+    if ctx is None:
+        ctx = _worker_contexts[spec] = spec.create_context()
+    return ctx
+
+def _encode_chunk(spec, postprocess, payloads):
+    results = []
+    for cred in _worker_context(spec).encode_many(payloads):
+        if isinstance(cred, MungeError):
+            results.append((cred.code.value, None))
+        else:
+            results.append((MungeErrorCode.EMUNGE_SUCCESS.value, cred))
+    return results
+
+def _decode_chunk(spec, postprocess, creds):
+    batch = _worker_context(spec).decode_many(creds, use_numpy=False)
+    results = list(zip(batch.codes, batch.payloads, batch.uids, batch.gids))
+    if postprocess is not None:
+        for i, (code, payload, uid, gid) in enumerate(results):
+            if payload is not None:
+                results[i] = (code, postprocess(payload, uid, gid), uid, gid)
+    return results
@@ -0,0 +1,301 @@
+#########################################################################
+# Module pymunge.files - authentication of files
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""This module authenticates files of any size with a single credential,
+like `pymunge.stream` does for streams. `encode_file()` maps the file
+into memory, hashes it in chunks on a pool of threads (`hashlib`
+releases the GIL while hashing), and creates a credential whose payload
+holds a `FileManifest`: the size of the file, the chunk size and a
+digest of the chunk digests. `verify_file()` checks a file against such
+a credential.
+
+If the manifest also holds the digest of each chunk (see
+`encode_file()`), individual chunks can be verified, and
+`changed_chunks()` finds the chunks of a file which were modified or
+appended since the credential was created."""
+
+from pymunge.error import MungeError, MungeErrorCode
+from pymunge.result import DecodeResult
+import pymunge.context
+import pymunge.stream
+import collections
+import concurrent.futures
+import hashlib
+import hmac
+import mmap
+import os
+import struct
+
+#: Default chunk size in bytes.
+DEFAULT_CHUNK_SIZE = 1 << 22
+
+PAYLOAD_MAGIC = b'PMSF'     #: Magic number at the start of the payload
+VERSION = 1                 #: Version of the payload format
+
+_FLAG_CHUNK_DIGESTS = 1
+_sizes = struct.Struct('>QQ')
+
+_FileManifestBase = collections.namedtuple('FileManifest', [
+    'algorithm', 'size', 'chunk_size', 'digest', 'chunk_digests'])
+
+class FileManifest(_FileManifestBase):
+    """The contents of a file, as held by the payload of a credential
+    created by `encode_file()`: the name of the hash `algorithm`, the
+    `size` of the file in bytes, the `chunk_size`, the `digest` of the
+    file and the digests of its chunks (`chunk_digests`, a tuple, or None
+    if not included).
+
+    The file is split into chunks of `chunk_size` bytes (the last one
+    may be shorter). Its digest is that of the size and the chunk size
+    (uint64 each, in network byte order) followed by the digests of the
+    chunks.
+
+    The payload consists of: magic (`PAYLOAD_MAGIC`), version (uint8),
+    length of the algorithm name (uint8), algorithm name (ASCII), size
+    and chunk size (uint64 each), flags (uint8, bit 0 set if the chunk
+    digests are included), length of a digest (uint8), the digest of
+    the file, the chunk digests (if included)."""
+
+    __slots__ = ()
+
+    @property
+    def chunk_count(self):
+        """The number of chunks of the file."""
+        return -(-self.size // self.chunk_size)
+
+    def payload(self):
+        """Return the payload of a credential bound to this manifest."""
+        name = self.algorithm.encode('ascii')
+        flags = 0
+        chunk_digests = b''
+        if self.chunk_digests is not None:
+            flags = _FLAG_CHUNK_DIGESTS
+            chunk_digests = b''.join(self.chunk_digests)
+        return b''.join([PAYLOAD_MAGIC, bytearray([VERSION, len(name)]),
+                         name, _sizes.pack(self.size, self.chunk_size),
+                         bytearray([flags, len(self.digest)]), self.digest,
+                         chunk_digests])
+
+    @classmethod
+    def from_payload(cls, payload, result=None):
+        """Return the `FileManifest` held by a payload created by
+        `payload()`. Raises a `MungeError` with the code `EMUNGE_BAD_CRED`
+        (and the given `result`) if the payload is not valid."""
+        try:
+            if payload[:4] != PAYLOAD_MAGIC or \
+                    bytearray(payload[4:5]) != bytearray([VERSION]):
+                raise ValueError
+            pos = 6 + bytearray(payload[5:6])[0]
+            algorithm = payload[6:pos].decode('ascii')
+            size, chunk_size = _sizes.unpack(payload[pos:pos + 16])
+            flags, length = bytearray(payload[pos + 16:pos + 18])
+            pos += 18
+            digest = payload[pos:pos + length]
+            pos += length
+            chunk_digests = None
+            if flags & _FLAG_CHUNK_DIGESTS:
+                chunk_digests = tuple(payload[start:start + length]
+                                      for start in range(pos, len(payload),
+                                                         length))
+                pos += len(chunk_digests) * length
+            manifest = cls(algorithm, size, chunk_size, digest,
+                           chunk_digests)
+            if chunk_size < 1 or len(digest) != length or \
+                    pos != len(payload) or (chunk_digests is not None and
+                    len(chunk_digests) != manifest.chunk_count):
+                raise ValueError
+        except (ValueError, IndexError, struct.error):
+            raise MungeError(MungeErrorCode.EMUNGE_BAD_CRED,
+                             "Credential is not bound to a file", result)
+        return manifest
+
+def hash_file(path, chunk_size=DEFAULT_CHUNK_SIZE,
+              algorithm=pymunge.stream.DEFAULT_ALGORITHM, workers=None,
+              chunk_digests=False, size=None):
+    """Hash the file at `path` and return its `FileManifest`, including
+    the chunk digests if `chunk_digests` is True. Only the first `size`
+    bytes are hashed if `size` is not None.
+
+    The chunks are hashed on `workers` threads (by default, one per CPU,
+    but no more than there are chunks)."""
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be at least 1')
+    with _MappedFile(path, size) as mapped:
+        size = mapped.size
+        count = -(-size // chunk_size)
+        digests = mapped.hash_chunks(range(count), chunk_size, algorithm,
+                                     workers)
+    digest = _root_digest(algorithm, size, chunk_size, digests)
+    return FileManifest(algorithm, size, chunk_size, digest,
+                        tuple(digests) if chunk_digests else None)
+
+def encode_file(path, ctx=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                algorithm=pymunge.stream.DEFAULT_ALGORITHM, workers=None,
+                chunk_digests=False):
+    """Create a credential bound to the contents of the file at `path`,
+    using the `MungeContext` `ctx` (or the default context, if None).
+
+    The file is hashed by `hash_file()`, and the credential's payload
+    holds the resulting `FileManifest`. If `chunk_digests` is True, the
+    manifest includes the digest of each chunk, which allows verifying
+    individual chunks; this adds one digest per chunk to the payload,
+    which must stay below the maximum payload size of munged."""
+    manifest = hash_file(path, chunk_size, algorithm, workers,
+                         chunk_digests)
+    if ctx is None:
+        return pymunge.context.encode(manifest.payload())
+    return ctx.encode(manifest.payload())
+
+def verify_file(path, cred, ctx=None, workers=None, allow_append=False,
+                chunks=None):
+    """Validate the credential `cred`, created by `encode_file()`, and
+    check that it is bound to the contents of the file at `path`.
+    Returns the `DecodeResult` of the credential (the `FileManifest` can
+    be obtained with `FileManifest.from_payload(result.payload)`), or
+    raises a `MungeError`: with the code `EMUNGE_BAD_CRED` if the
+    credential is not bound to a file, or `EMUNGE_CRED_INVALID` (and the
+    `DecodeResult` as its `result`) if the file does not match.
+
+    Since munged accepts a credential only once, the file is verified
+    again by passing the `DecodeResult` returned by an earlier call as
+    `cred`, which is then not decoded again.
+
+    If `allow_append` is True, data appended to the file after the
+    credential was created is ignored. If `chunks` is not None, only the
+    chunks with the given indices are verified; this requires a
+    credential with chunk digests."""
+    if isinstance(cred, DecodeResult):
+        result = cred
+    elif ctx is None:
+        result = pymunge.context.decode(cred, True)
+    else:
+        result = ctx.decode(cred, True)
+    manifest = FileManifest.from_payload(result.payload, result)
+    try:
+        hashlib.new(manifest.algorithm)
+    except ValueError:
+        raise MungeError(MungeErrorCode.EMUNGE_BAD_CRED,
+                         "Unsupported hash algorithm %r" %
+                         manifest.algorithm, result)
+    with _MappedFile(path, manifest.size) as mapped:
+        if mapped.file_size < manifest.size or \
+                (mapped.file_size > manifest.size and not allow_append):
+            _mismatch(result)
+        if chunks is None:
+            count = manifest.chunk_count
+            digests = mapped.hash_chunks(range(count), manifest.chunk_size,
+                                         manifest.algorithm, workers)
+            matches = hmac.compare_digest(
+                _root_digest(manifest.algorithm, manifest.size,
+                             manifest.chunk_size, digests),
+                manifest.digest)
+        else:
+            if manifest.chunk_digests is None:
+                raise MungeError(MungeErrorCode.EMUNGE_BAD_ARG,
+                                 "Credential has no chunk digests", result)
+            indices = sorted(set(chunks))
+            if indices and not 0 <= indices[0] <= indices[-1] < \
+                    manifest.chunk_count:
+                raise ValueError('Invalid chunk index')
+            digests = mapped.hash_chunks(indices, manifest.chunk_size,
+                                         manifest.algorithm, workers)
+            matches = all(
+                hmac.compare_digest(digest, manifest.chunk_digests[index])
+                for index, digest in zip(indices, digests))
+    if not matches:
+        _mismatch(result)
+    return result
+
+def changed_chunks(path, manifest, workers=None):
+    """Return the sorted list of the indices of the chunks of the file at
+    `path` which differ from the `FileManifest` `manifest` (which must
+    include chunk digests): modified chunks, chunks which were appended
+    and, if the file was truncated, the chunks that are missing."""
+    if manifest.chunk_digests is None:
+        raise ValueError('Manifest has no chunk digests')
+    current = hash_file(path, manifest.chunk_size, manifest.algorithm,
+                        workers, True)
+    old, new = manifest.chunk_digests, current.chunk_digests
+    changed = [index for index, (old_digest, new_digest)
+               in enumerate(zip(old, new)) if old_digest != new_digest]
+    changed.extend(range(min(len(old), len(new)), max(len(old), len(new))))
+    return changed
+
+class _MappedFile(object):
+    """pymunge internal - the first size bytes (or all, if size is None)
+    of the file at path, mapped into memory"""
+
+    def __init__(self, path, size):
+        self._file = open(path, 'rb')
+        try:
+            self.file_size = os.fstat(self._file.fileno()).st_size
+            self.size = self.file_size if size is None else \
+                min(size, self.file_size)
+            self._mmap = None
+            self._view = memoryview(b'')
+            if self.size:
+                self._mmap = mmap.mmap(self._file.fileno(), self.size,
+                                       access=mmap.ACCESS_READ)
+                self._view = memoryview(self._mmap)
+        except:
+            self._file.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._view.release()
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+    def hash_chunks(self, indices, chunk_size, algorithm, workers):
+        """Return the digests of the chunks with the given indices."""
+        view = self._view
+
+        def hash_chunk(index):
+            start = index * chunk_size
+            chunk = view[start:start + chunk_size]
+            try:
+                return hashlib.new(algorithm, chunk).digest()
+            finally:
+                chunk.release()
+
+        indices = list(indices)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = min(workers, len(indices))
+        if workers <= 1:
+            return [hash_chunk(index) for index in indices]
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            return list(executor.map(hash_chunk, indices))
+
+def _root_digest(algorithm, size, chunk_size, digests):
+    root = hashlib.new(algorithm, _sizes.pack(size, chunk_size))
+    for digest in digests:
+        root.update(digest)
+    return root.digest()
+
+def _mismatch(result):
+    raise MungeError(MungeErrorCode.EMUNGE_CRED_INVALID,
+                     "File does not match the credential", result)
@@ -0,0 +1,329 @@
+#########################################################################
+# Module pymunge.hooks - tracing and profiling hooks for libmunge calls
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""This module provides hooks for tracing and profiling the libmunge
+calls made by pymunge. Callbacks registered with `on_call_start()` are
+called before each call, callbacks registered with `on_call_end()`
+after it, on the thread making the call. Both are passed the same
+`CallInfo`, which describes the call:
+
+>>> @pymunge.hooks.on_call_end
+>>> def trace(info):
+>>>     print(info.function, info.elapsed, info.native_time)
+
+Hooks cover the libmunge functions of `pymunge.raw` (`munge_encode`,
+`munge_decode`, `munge_strerror`, the `munge_ctx_*` and the
+`munge_enum_*` functions) as well as the calls made by `MungeContext`
+and `MungeContextPool`, with either backend. While callbacks are
+registered, the functions of `pymunge.raw` are replaced by wrappers;
+references to them obtained earlier (e.g. by
+`from pymunge.raw import munge_encode`) are not hooked.
+
+The elapsed time of a call is split into:
+
+* `native_time`: the time spent in the C function, including the
+  conversion of its arguments by ctypes or cffi. For `munge_encode` and
+  `munge_decode`, this is mostly the time taken by munged.
+* `error_time`: the time spent constructing the `MungeError` in
+  `pymunge.raw.check_and_raise()` (0 if no error was raised). It is None
+  for calls made by `MungeContext`, which constructs errors after the
+  call.
+* `wrapper_time`: the remaining time spent in pymunge's Python code
+  around the C function, e.g. converting out-parameters and copying
+  and freeing memory returned by libmunge.
+
+`set_sample_rate()` reduces the overhead by reporting only a random
+fraction of the calls; calls which are not sampled are not reported to
+any callback. Callbacks should not raise exceptions: an exception
+raised by a callback propagates to the caller of the libmunge function.
+"""
+
+from pymunge.error import MungeError
+import pymunge._instrument
+import pymunge.raw
+import ctypes
+import random
+import threading
+import time
+
+#: True if any callbacks are registered.
+active = False
+
+class CallInfo(object):
+    """Describes a libmunge call, for the callbacks of `on_call_start()` and
+    `on_call_end()`. Its attributes are:
+
+    * `function`: the name of the libmunge function (e.g. 'munge_encode')
+    * `socket`: the path of the munged socket used by `munge_encode` and
+      `munge_decode`; None for other functions, or if no context was
+      passed to the `pymunge.raw` function
+    * `payload_length`: the length of the payload in bytes, for
+      `munge_encode` and `munge_decode` (for the latter, known only when
+      the call has ended); None for other functions
+    * `start`: the time (as returned by `time.time()`) the call started
+    * `elapsed`, `native_time`, `error_time`, `wrapper_time`: the
+      duration of the call in seconds and its parts (see `pymunge.hooks`)
+    * `error_code`: the `munge_err_t` returned by the call (0 on success;
+      see `MungeErrorCode`), or None if the call raised an exception
+      other than `MungeError` (e.g. a TypeError for invalid arguments)
+    * `data`: a dict in which callbacks can keep data from the start to
+      the end of the call, e.g. a tracing span
+
+    The durations and the error code are None until the call has ended.
+    """
+
+    __slots__ = ('function', 'socket', 'payload_length', 'start',
+                 'elapsed', 'native_time', 'error_time', 'wrapper_time',
+                 'error_code', 'data', '_clock')
+
+    def __init__(self, function, socket=None, payload_length=None):
+        self.function = function
+        self.socket = socket
+        self.payload_length = payload_length
+        self.start = time.time()
+        self.elapsed = None
+        self.native_time = None
+        self.error_time = None
+        self.wrapper_time = None
+        self.error_code = None
+        self.data = {}
+        self._clock = None
+
+    def __repr__(self):
+        return '<CallInfo %s elapsed=%r native=%r error=%r wrapper=%r ' \
+            'error_code=%r>' % (self.function, self.elapsed,
+                                self.native_time, self.error_time,
+                                self.wrapper_time, self.error_code)
+
+def on_call_start(callback):
+    """Register `callback` to be called with a `CallInfo` before each
+    (sampled) libmunge call. Returns `callback`, so that this can be used
+    as a decorator."""
+    global _start_callbacks
+    with _lock:
+        _start_callbacks += (callback,)
+        _update()
+    return callback
+
+def on_call_end(callback):
+    """Register `callback` to be called with a `CallInfo` after each
+    (sampled) libmunge call, including calls that failed. Returns
+    `callback`, so that this can be used as a decorator."""
+    global _end_callbacks
+    with _lock:
+        _end_callbacks += (callback,)
+        _update()
+    return callback
+
+def remove(callback):
+    """Unregister `callback` (registered with `on_call_start()` and/or
+    `on_call_end()`). Raises ValueError if it is not registered."""
+    global _start_callbacks, _end_callbacks
+    with _lock:
+        if callback not in _start_callbacks + _end_callbacks:
+            raise ValueError('Callback %r is not registered' % (callback,))
+        _start_callbacks = tuple(registered for registered in
+                                 _start_callbacks if registered != callback)
+        _end_callbacks = tuple(registered for registered in _end_callbacks
+                               if registered != callback)
+        _update()
+
+def clear():
+    """Unregister all callbacks."""
+    global _start_callbacks, _end_callbacks
+    with _lock:
+        _start_callbacks = _end_callbacks = ()
+        _update()
+
+def set_sample_rate(rate):
+    """Report only the fraction `rate` (between 0 and 1) of the calls,
+    chosen at random, to the callbacks. The default rate is 1, i.e. all
+    calls are reported."""
+    global _sample_rate
+    if not 0 <= rate <= 1:
+        raise ValueError('Sample rate must be between 0 and 1')
+    _sample_rate = rate
+
+def get_sample_rate():
+    """Return the fraction of the calls reported to the callbacks."""
+    return _sample_rate
+
+def sample():
+    """pymunge internal - return True if the next call is to be reported"""
+    return _sample_rate >= 1 or _random() < _sample_rate
+
+def begin(function, socket, payload_length):
+    """pymunge internal - return the `CallInfo` of a sampled call that is
+    about to start, after calling the start callbacks"""
+    info = CallInfo(function, socket, payload_length)
+    for callback in _start_callbacks:
+        callback(info)
+    return info
+
+def end(info, error_code, elapsed):
+    """pymunge internal - complete the `CallInfo` of a call which took
+    elapsed seconds and call the end callbacks"""
+    info.error_code = error_code
+    info.elapsed = elapsed
+    error_time = info.error_time or 0
+    if info.native_time is None:
+        info.native_time = elapsed - error_time
+    info.wrapper_time = max(0.0, elapsed - info.native_time - error_time)
+    for callback in _end_callbacks:
+        callback(info)
+
+_lock = threading.Lock()
+_start_callbacks = ()
+_end_callbacks = ()
+_sample_rate = 1
+_random = random.random
+_clock = getattr(time, 'perf_counter', time.time)
+# CallInfo of the pymunge.raw call in progress on each thread, used by
+# the timed error checks below
+_local = threading.local()
+
+def _update():
+    """pymunge internal - install or remove the wrappers of the pymunge.raw
+    functions after callbacks were registered or removed; must be called
+    with the lock held"""
+    global active
+    registered = bool(_start_callbacks or _end_callbacks)
+    if registered and not active:
+        _install_raw()
+    elif active and not registered:
+        _uninstall_raw()
+    active = registered
+    pymunge._instrument.update()
+
+# Wrappers of the pymunge.raw functions. The checked prototypes of
+# pymunge._libmunge call their error check function right after the C
+# function returns, which marks the end of the native time, and the
+# error check function calls check_and_raise(), which is timed as the
+# error time.
+
+_RAW_FUNCTIONS = (
+    'munge_encode', 'munge_decode', 'munge_strerror', 'munge_ctx_create',
+    'munge_ctx_copy', 'munge_ctx_destroy', 'munge_ctx_strerror',
+    'munge_ctx_get', 'munge_ctx_set', 'munge_enum_is_valid',
+    'munge_enum_int_to_str', 'munge_enum_str_to_int')
+_CHECKED_FUNCTIONS = ('munge_encode', 'munge_decode', '_munge_ctx_get',
+                      '_munge_ctx_set')
+_errchecks = {}
+
+def _install_raw():
+    pymunge.raw.load()
+    import pymunge._libmunge as libmunge
+    namespace = vars(pymunge.raw)
+    for name in _RAW_FUNCTIONS:
+        namespace[name] = _wrap_raw(name, getattr(libmunge, name))
+    for name in _CHECKED_FUNCTIONS:
+        function = getattr(libmunge, name)
+        errcheck = getattr(function, 'errcheck', None)
+        if errcheck is not None:
+            _errchecks[name] = errcheck
+            function.errcheck = _timed_errcheck(errcheck)
+    libmunge.check_and_raise = _timed_check_and_raise
+
+def _uninstall_raw():
+    import pymunge._libmunge as libmunge
+    namespace = vars(pymunge.raw)
+    for name in _RAW_FUNCTIONS:
+        namespace[name] = getattr(libmunge, name)
+    for name, errcheck in _errchecks.items():
+        getattr(libmunge, name).errcheck = errcheck
+    _errchecks.clear()
+    libmunge.check_and_raise = pymunge.raw.check_and_raise
+
+def _wrap_raw(name, function):
+    def wrapper(*args, **kwargs):
+        if not sample():
+            return function(*args, **kwargs)
+        ctx, payload_length = _raw_arguments(name, args, kwargs)
+        info = begin(name, _raw_socket(ctx), payload_length)
+        previous = getattr(_local, 'info', None)
+        _local.info = info
+        error_code = None
+        info._clock = start = _clock()
+        try:
+            result = function(*args, **kwargs)
+            error_code = 0
+            if name == 'munge_decode':
+                info.payload_length = len(result[0])
+            return result
+        except MungeError as e:
+            error_code = e.code.value
+            if name == 'munge_decode' and e.result is not None:
+                info.payload_length = len(e.result[0])
+            raise
+        finally:
+            elapsed = _clock() - start
+            _local.info = previous
+            if info.error_time is None:
+                info.error_time = 0.0
+            end(info, error_code, elapsed)
+
+    wrapper.__name__ = name
+    return wrapper
+
+def _raw_arguments(name, args, kwargs):
+    """pymunge internal - return (ctx, payload_length) from the arguments
+    of the pymunge.raw function name"""
+    if name == 'munge_encode':
+        # munge_encode(ctx=None, buf=None, len=0)
+        ctx = args[0] if len(args) > 0 else kwargs.get('ctx')
+        length = args[2] if len(args) > 2 else kwargs.get('len', 0)
+        return ctx, length
+    if name == 'munge_decode':
+        # munge_decode(cred, ctx=None)
+        return args[1] if len(args) > 1 else kwargs.get('ctx'), None
+    return None, None
+
+def _raw_socket(ctx):
+    if ctx is None:
+        return None
+    import pymunge._libmunge as libmunge
+    value = ctypes.c_char_p()
+    try:
+        if libmunge._munge_ctx_get_str(ctx, pymunge.raw.MUNGE_OPT_SOCKET,
+                                       ctypes.byref(value)):
+            return None
+    except (ImportError, TypeError, ctypes.ArgumentError):
+        return None
+    return value.value.decode('utf-8') if value.value is not None else None
+
+def _timed_errcheck(errcheck):
+    def timed(error_code, func, arguments):
+        info = getattr(_local, 'info', None)
+        if info is not None and info.native_time is None:
+            info.native_time = _clock() - info._clock
+        return errcheck(error_code, func, arguments)
+    return timed
+
+def _timed_check_and_raise(error_code, ctx, result):
+    info = getattr(_local, 'info', None)
+    if info is None or not error_code:
+        return pymunge.raw.check_and_raise(error_code, ctx, result)
+    start = _clock()
+    try:
+        pymunge.raw.check_and_raise(error_code, ctx, result)
+    finally:
+        info.error_time = _clock() - start
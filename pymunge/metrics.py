@@ -0,0 +1,385 @@
+#########################################################################
+# Module pymunge.metrics - latency histograms and error counters
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""This module keeps optional latency histograms and error counters for
+the libmunge calls made by `MungeContext` (and `MungeContextPool`):
+encoding, decoding, creating, copying and destroying contexts, and
+getting and setting options.
+
+Metrics are disabled by default; `enable()` turns them on for all
+contexts. While neither metrics nor hooks (`pymunge.hooks`) are
+enabled, each call only checks a single flag.
+Each series is identified by the operation and its labels:
+
+* `code`: the `MungeErrorCode` name of the result
+* `cipher`, `mac`, `zip`: the `CipherType`, `MACType` and `ZipType`
+  names of successfully decoded credentials, and of the options of the
+  context for successful encodes (which may be 'Default')
+* `size`: the payload size bucket of encodes and decodes, i.e. the
+  smallest bound in `SIZE_BUCKETS` not below the payload size, or
+  '+Inf'
+* `option`: the option name (e.g. 'ttl') for option access
+
+Labels which do not apply to an operation are empty strings. Each
+thread records into its own histograms, without locking; `snapshot()`
+merges them into a `MetricsSnapshot`, and `render_prometheus()`
+renders a snapshot in the Prometheus text exposition format.
+
+>>> pymunge.metrics.enable()
+>>> ...
+>>> snapshot = pymunge.metrics.snapshot()
+>>> snapshot.histogram('decode').percentile(99)
+"""
+
+from pymunge.error import MungeErrorCode
+from pymunge.enums import CipherType, MACType, ZipType
+import pymunge._instrument
+import pymunge.raw
+import collections
+import ctypes
+import threading
+import weakref
+
+#: True if metrics are recorded. Use `enable()` and `disable()` to
+#: change it.
+enabled = False
+
+#: Operations for which metrics are recorded
+OPERATIONS = ('encode', 'decode', 'ctx_create', 'ctx_copy', 'ctx_destroy',
+              'option_get', 'option_set')
+
+#: Upper bounds (in bytes) of the payload size buckets
+SIZE_BUCKETS = (0, 64, 1024, 16384, 262144, 1048576)
+
+#: Upper bounds (in seconds) of the buckets of the Prometheus histograms
+PROMETHEUS_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                      0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                      0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Histogram buckets: values below 2 ** (_SUB_BITS + 1) nanoseconds have
+# one bucket each; above, each power of two is split into 2 ** _SUB_BITS
+# buckets, which bounds the relative error by 2 ** -_SUB_BITS.
+_SUB_BITS = 4
+_SUB_COUNT = 1 << _SUB_BITS
+_LINEAR_LIMIT = _SUB_COUNT << 1
+
+#: A series of a `MetricsSnapshot`: an operation, its labels and the
+#: `Histogram` of its call durations.
+Series = collections.namedtuple('Series', [
+    'operation', 'code', 'cipher', 'mac', 'zip', 'size', 'option',
+    'histogram'])
+
+_LABELS = Series._fields[1:-1]
+
+class Histogram(object):
+    """A histogram of durations with logarithmic buckets (in the manner of
+    HdrHistogram), recorded in nanoseconds. The bucket of a value is at
+    most 1/16 of the value wide, so percentiles are accurate to within
+    6.25%. Durations are returned in seconds."""
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        """Record a duration of `value` nanoseconds (an int)."""
+        if value < _LINEAR_LIMIT:
+            if value < 0:
+                value = 0
+            index = value
+        else:
+            shift = value.bit_length() - _SUB_BITS - 1
+            index = (shift << _SUB_BITS) + (value >> shift)
+        counts = self.counts
+        counts[index] = counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add the values recorded by the `Histogram` `other`."""
+        counts = self.counts
+        for index, count in list(other.counts.items()):
+            counts[index] = counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    @property
+    def sum(self):
+        """The sum of all recorded durations, in seconds."""
+        return self.total / 1e9
+
+    def mean(self):
+        """Return the mean duration in seconds (0 if empty)."""
+        return self.total / 1e9 / self.count if self.count else 0.0
+
+    def buckets(self):
+        """Return a list of `(lower, upper, count)` tuples for the
+        non-empty buckets, in increasing order; `lower` and `upper` are the
+        bounds of the bucket in nanoseconds (`upper` exclusive)."""
+        return [_bucket_bounds(index) + (count,)
+                for index, count in sorted(self.counts.items())]
+
+    def percentile(self, percent):
+        """Return the duration in seconds below which `percent` percent
+        of the recorded durations lie (0 if empty)."""
+        if not self.count:
+            return 0.0
+        rank = max(1, int(round(self.count * percent / 100.0)))
+        seen = 0
+        for lower, upper, count in self.buckets():
+            seen += count
+            if seen >= rank:
+                return min(upper - 1, self.max) / 1e9
+        return self.max / 1e9
+
+def _bucket_bounds(index):
+    if index < _LINEAR_LIMIT:
+        return index, index + 1
+    shift = (index >> _SUB_BITS) - 1
+    mantissa = index - (shift << _SUB_BITS)
+    return mantissa << shift, (mantissa + 1) << shift
+
+class MetricsSnapshot(object):
+    """The metrics recorded up to some point in time, as returned by
+    `snapshot()`. `series` is a list of `Series`, one per operation and
+    combination of labels."""
+
+    def __init__(self, series):
+        self.series = series
+
+    def select(self, operation=None, **labels):
+        """Return the series of `operation` (all operations if None) whose
+        labels have the given values, e.g. `select('decode',
+        code='EMUNGE_CRED_REPLAYED')`."""
+        for name in labels:
+            if name not in _LABELS:
+                raise ValueError('Unknown label %r' % name)
+        return [series for series in self.series
+                if (operation is None or series.operation == operation) and
+                all(getattr(series, name) == value
+                    for name, value in labels.items())]
+
+    def histogram(self, operation=None, **labels):
+        """Return a `Histogram` merging the series selected like
+        `select()`."""
+        histogram = Histogram()
+        for series in self.select(operation, **labels):
+            histogram.merge(series.histogram)
+        return histogram
+
+    def count(self, operation=None, **labels):
+        """Return the number of calls in the series selected like
+        `select()`."""
+        return sum(series.histogram.count
+                   for series in self.select(operation, **labels))
+
+    def errors(self, operation=None):
+        """Return a dict mapping `MungeErrorCode` names to the number of
+        calls of `operation` (all operations if None) which failed with
+        that code."""
+        errors = {}
+        for series in self.select(operation):
+            if series.code != _SUCCESS:
+                errors[series.code] = errors.get(series.code, 0) + \
+                    series.histogram.count
+        return errors
+
+def enable():
+    """Start recording metrics."""
+    global enabled
+    enabled = True
+    pymunge._instrument.update()
+
+def disable():
+    """Stop recording metrics. The metrics recorded so far are kept."""
+    global enabled
+    enabled = False
+    pymunge._instrument.update()
+
+def reset():
+    """Discard all recorded metrics."""
+    with _lock:
+        for series in list(_thread_series.values()):
+            series.clear()
+        _retired.clear()
+
+def snapshot():
+    """Return a `MetricsSnapshot` of the metrics recorded so far, merging
+    the histograms of all threads."""
+    merged = {}
+    with _lock:
+        thread_series = list(_thread_series.values())
+        for key, histogram in list(_retired.items()):
+            merged[key] = Histogram()
+            merged[key].merge(histogram)
+    for series in thread_series:
+        for key, histogram in list(series.items()):
+            if key not in merged:
+                merged[key] = Histogram()
+            merged[key].merge(histogram)
+    return MetricsSnapshot([Series(*(key + (merged[key],)))
+                            for key in sorted(merged)])
+
+def render_prometheus(metrics=None, prefix='pymunge'):
+    """Render `metrics` (a `MetricsSnapshot`; a new snapshot if None) in
+    the Prometheus text exposition format, as the histogram
+    `<prefix>_call_duration_seconds` and the counter
+    `<prefix>_errors_total`. The histogram buckets are those of
+    `PROMETHEUS_BUCKETS`, to the precision of `Histogram`."""
+    if metrics is None:
+        metrics = snapshot()
+    name = prefix + '_call_duration_seconds'
+    lines = ['# HELP %s Duration of libmunge calls made by pymunge.' % name,
+             '# TYPE %s histogram' % name]
+    errors = collections.OrderedDict()
+    for series in metrics.series:
+        labels = ','.join('%s="%s"' % (label, _escape(value))
+                          for label, value in zip(('operation',) + _LABELS,
+                                                  series[:-1])
+                          if value)
+        buckets = series.histogram.buckets()
+        position = seen = 0
+        for bound in PROMETHEUS_BUCKETS:
+            limit = bound * 1e9
+            while position < len(buckets) and \
+                    buckets[position][0] <= limit:
+                seen += buckets[position][2]
+                position += 1
+            lines.append('%s_bucket{%s,le="%r"} %d' % (name, labels, bound,
+                                                      seen))
+        count = series.histogram.count
+        lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, count))
+        lines.append('%s_sum{%s} %r' % (name, labels, series.histogram.sum))
+        lines.append('%s_count{%s} %d' % (name, labels, count))
+        if series.code != _SUCCESS:
+            key = series.operation, series.code
+            errors[key] = errors.get(key, 0) + count
+    name = prefix + '_errors_total'
+    lines += ['# HELP %s libmunge calls made by pymunge which failed.' %
+              name,
+              '# TYPE %s counter' % name]
+    for (operation, code), count in errors.items():
+        lines.append('%s{operation="%s",code="%s"} %d' % (
+            name, _escape(operation), _escape(code), count))
+    return '\n'.join(lines) + '\n'
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+# Recording. Each thread records into its own dict mapping series keys
+# (operation and labels) to histograms; the dicts of all live threads
+# are kept in _thread_series. When a thread exits, its thread-local
+# _ThreadSeries is destroyed and its histograms are merged into
+# _retired, so that the metrics of finished threads are kept without
+# keeping one dict per thread ever started. The lock is reentrant, as
+# a _ThreadSeries may be finalized by the garbage collector while the
+# lock is held.
+
+_lock = threading.RLock()
+_thread_series = {}
+_retired = {}
+_local = threading.local()
+
+class _ThreadSeries(object):
+    """pymunge internal - holder of a thread's series, whose finalizer
+    retires them when the thread exits"""
+
+    def __init__(self):
+        self.series = {}
+        token = object()
+        with _lock:
+            _thread_series[token] = self.series
+        weakref.finalize(self, _retire, token)
+
+def _retire(token):
+    with _lock:
+        series = _thread_series.pop(token, None)
+        if not series:
+            return
+        for key, histogram in list(series.items()):
+            if key not in _retired:
+                _retired[key] = Histogram()
+            _retired[key].merge(histogram)
+
+_SUCCESS = MungeErrorCode.EMUNGE_SUCCESS.name
+_CODE_NAMES = dict((code.value, code.name) for code in MungeErrorCode)
+_TYPE_NAMES = tuple(dict((member.value, member.name) for member in enum)
+                    for enum in (CipherType, MACType, ZipType))
+_TYPE_OPTIONS = ((pymunge.raw.MUNGE_OPT_CIPHER_TYPE, ctypes.c_int),
+                 (pymunge.raw.MUNGE_OPT_MAC_TYPE, ctypes.c_int),
+                 (pymunge.raw.MUNGE_OPT_ZIP_TYPE, ctypes.c_int))
+_NO_TYPES = ('', '', '')
+_OPTION_NAMES = dict(
+    (getattr(pymunge.raw, 'MUNGE_OPT_' + name.upper()), name)
+    for name in ('cipher_type', 'mac_type', 'zip_type', 'realm', 'ttl',
+                 'addr4', 'encode_time', 'decode_time', 'socket',
+                 'uid_restriction', 'gid_restriction'))
+
+def _record(key, elapsed):
+    try:
+        series = _local.holder.series
+    except AttributeError:
+        holder = _local.holder = _ThreadSeries()
+        series = holder.series
+    histogram = series.get(key)
+    if histogram is None:
+        histogram = series[key] = Histogram()
+    histogram.record(int(elapsed * 1e9))
+
+def _code_name(code):
+    return _CODE_NAMES.get(code) or str(code)
+
+def _size_bucket(size):
+    for bound in SIZE_BUCKETS:
+        if size <= bound:
+            return str(bound)
+    return '+Inf'
+
+def _types(backend, buffers, handle):
+    status, values = backend.read_options(buffers, handle, _TYPE_OPTIONS)
+    if status:
+        return _NO_TYPES
+    return tuple(names.get(value) or str(value)
+                 for names, value in zip(_TYPE_NAMES, values))
+
+def record_codec(operation, backend, buffers, handle, error_code, size,
+                 elapsed):
+    """pymunge internal - record an encode or decode of a payload of size
+    bytes which took elapsed seconds (see `pymunge._instrument`)"""
+    # the types are read only after a successful call, since reading
+    # them clears the error message of the context
+    types = _types(backend, buffers, handle) if not error_code else _NO_TYPES
+    _record((operation, _code_name(error_code)) + types +
+            (_size_bucket(size), ''), elapsed)
+
+def record_call(operation, error_code, option, elapsed):
+    """pymunge internal - record a call other than encode or decode, with
+    option the `MUNGE_OPT_*` value of option access (None otherwise)"""
+    name = '' if option is None else _OPTION_NAMES.get(option) or str(option)
+    _record((operation, _code_name(error_code), '', '', '', '', name),
+            elapsed)
@@ -0,0 +1,403 @@
+#########################################################################
+# Module pymunge.middleware - WSGI and ASGI authentication
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""This module provides WSGI and ASGI middleware which authenticate HTTP
+requests by a MUNGE credential sent in a request header, by default
+
+    Authorization: MUNGE <credential>
+
+`MungeWSGIMiddleware` and `MungeASGIMiddleware` extract the credential
+and validate it with a `MungeAuthenticator`, which decodes credentials
+on the worker threads of a `MungeExecutor` instead of the thread (or, for
+ASGI, the event loop) serving the request. The `DecodeResult` of the
+credential (its payload, UID, GID and the metadata of the context used
+to create it) is passed to the application under the key `RESULT_KEY`
+of the WSGI environ or the ASGI scope. Requests without a valid
+credential are answered by the middleware:
+
+* 401 (Unauthorized) if the credential is missing or invalid (including
+  expired, rewound and replayed credentials),
+* 403 (Forbidden) if the credential is restricted to another UID/GID
+  (`EMUNGE_CRED_UNAUTHORIZED`),
+* 503 (Service Unavailable) if the credential could not be validated,
+  e.g. since munged is not reachable or too many validations are
+  pending.
+
+munged rejects a credential presented more than once, e.g. by a client
+retrying a request, with `EMUNGE_CRED_REPLAYED`. How this is treated is
+configured by the `replay` argument of `MungeAuthenticator`; repeated
+presentations can also be answered without contacting munged by a cache
+of verified credentials such as `pymunge.cache.CredentialCache`.
+
+This module requires Python 3.5 or later and is not imported by
+`import pymunge`; use `import pymunge.middleware`."""
+
+from pymunge.context import MungeContext
+from pymunge.error import MungeError, MungeErrorCode
+from pymunge.result import DecodeResult
+import pymunge.executor
+import asyncio
+import concurrent.futures
+import threading
+
+#: Key of the `DecodeResult` in the WSGI environ and the ASGI scope.
+RESULT_KEY = 'pymunge.result'
+
+#: Replay policy rejecting replayed credentials (the default).
+REPLAY_REJECT = 'reject'
+
+#: Replay policy accepting replayed credentials like valid ones.
+REPLAY_ACCEPT = 'accept'
+
+# errors caused by the credential itself, answered with 401
+_CREDENTIAL_ERRORS = frozenset([
+    MungeErrorCode.EMUNGE_BAD_LENGTH, MungeErrorCode.EMUNGE_BAD_CRED,
+    MungeErrorCode.EMUNGE_BAD_VERSION, MungeErrorCode.EMUNGE_BAD_CIPHER,
+    MungeErrorCode.EMUNGE_BAD_MAC, MungeErrorCode.EMUNGE_BAD_ZIP,
+    MungeErrorCode.EMUNGE_BAD_REALM, MungeErrorCode.EMUNGE_CRED_INVALID,
+    MungeErrorCode.EMUNGE_CRED_EXPIRED, MungeErrorCode.EMUNGE_CRED_REWOUND,
+    MungeErrorCode.EMUNGE_CRED_REPLAYED,
+])
+
+_REASONS = {401: 'Unauthorized', 403: 'Forbidden',
+            503: 'Service Unavailable'}
+
+class MungeAuthenticator(object):
+    """Validates the credentials of HTTP requests on a bounded pool of
+    worker threads. One authenticator can be shared by several
+    middleware instances.
+
+    `MungeAuthenticator(ctx, workers, max_pending, timeout, cache, replay,
+    header, scheme)` creates an authenticator which decodes credentials
+    with the options of the `MungeContext` `ctx` (e.g. its socket;
+    default options if None) on a `MungeExecutor` with `workers` threads.
+    If `workers` is None, the number of threads is determined from the
+    measured daemon latency when the authenticator is created (see
+    `pymunge.executor.auto_workers()`), not on a request. At most
+    `max_pending` (by default, four times the number of workers)
+    validations are running or waiting for a thread; further requests
+    fail with `EMUNGE_TIMEOUT` at once instead of queueing up, as do
+    validations which do not finish within `timeout` seconds (None means
+    no timeout). The decode of a validation which timed out still runs
+    to completion and counts as pending until then.
+
+    If `cache` is not None, credentials are looked up with its
+    `get(cred)` method on the request thread, and decoded with its
+    `decode(cred, ctx)` method on the worker threads (see
+    `pymunge.cache.CredentialCache`, or any object with these methods).
+    A cached credential is accepted until it expires, however often it
+    is presented; a `CredentialCache` also lets requests presenting a
+    credential which is being decoded for another request (e.g. a retry
+    sent while the first request is still being authenticated) share
+    that decode.
+
+    `replay` is `REPLAY_REJECT`, `REPLAY_ACCEPT` or a callable
+    `replay(result, request)` which returns True if a replayed
+    credential with the `DecodeResult` `result` is accepted for the
+    request (the WSGI environ or the ASGI scope), e.g. only for
+    idempotent requests.
+
+    The credential is read from the request header `header`. If `scheme`
+    is not None, the header value must be the scheme followed by the
+    credential (as in the Authorization header); otherwise it is the
+    credential itself. An authenticator should be closed with `close()`
+    when no longer used."""
+
+    def __init__(self, ctx=None, workers=None, max_pending=None,
+                 timeout=None, cache=None, replay=REPLAY_REJECT,
+                 header='Authorization', scheme='MUNGE'):
+        if workers is not None and workers < 1:
+            raise ValueError('workers must be at least 1')
+        if max_pending is not None and max_pending < 1:
+            raise ValueError('max_pending must be at least 1')
+        if replay not in (REPLAY_REJECT, REPLAY_ACCEPT) and \
+                not callable(replay):
+            raise ValueError('Invalid replay policy %r' % (replay,))
+        self._template = MungeContext(ctx)
+        self._executor = pymunge.executor.MungeExecutor(workers,
+                                                        self._template)
+        if max_pending is None:
+            max_pending = 4 * self._executor.max_workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.cache = cache
+        self.replay = replay
+        self.header = header
+        self.scheme = scheme
+        self._scheme = None
+        if scheme is not None:
+            self._scheme = scheme.lower().encode('latin-1')
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._closed = False
+
+    def close(self):
+        """Shut down the worker threads, waiting for running validations
+        to finish. Calling `close()` again has no effect."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._executor.shutdown()
+        self._template.close()
+
+    @property
+    def pending(self):
+        """Number of validations running or waiting for a thread."""
+        return self._pending
+
+    def credential(self, value):
+        """Return the credential (bytes) held by a value (str or bytes)
+        of the request header, or None if `value` is None or does not
+        hold a credential."""
+        if value is None:
+            return None
+        if not isinstance(value, bytes):
+            value = value.encode('latin-1')
+        value = value.strip()
+        if self._scheme is not None:
+            scheme, _, value = value.partition(b' ')
+            if scheme.lower() != self._scheme:
+                return None
+            value = value.strip()
+        return value or None
+
+    def validate(self, cred, request=None):
+        """Validate the credential `cred` of `request`, blocking until the
+        validation is done. Returns a `DecodeResult` or raises a
+        `MungeError`."""
+        result = self._lookup(cred)
+        if result is not None:
+            return result
+        future = self._submit(cred)
+        try:
+            outcome = future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            raise self._timeout_error()
+        return self._finish(cred, request, outcome)
+
+    async def validate_async(self, cred, request=None):
+        """Validate the credential `cred` of `request` without blocking the
+        event loop. Returns a `DecodeResult` or raises a `MungeError`."""
+        result = self._lookup(cred)
+        if result is not None:
+            return result
+        future = asyncio.wrap_future(self._submit(cred))
+        try:
+            outcome = await asyncio.wait_for(asyncio.shield(future),
+                                             self.timeout)
+        except asyncio.TimeoutError:
+            raise self._timeout_error()
+        return self._finish(cred, request, outcome)
+
+    def _lookup(self, cred):
+        if self._closed:
+            raise MungeError(MungeErrorCode.EMUNGE_BAD_ARG,
+                             "Authenticator is closed")
+        if self.cache is None:
+            return None
+        return self.cache.get(cred)
+
+    def _submit(self, cred):
+        """pymunge internal - schedule decoding cred on the executor,
+        unless max_pending validations are pending"""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise MungeError(MungeErrorCode.EMUNGE_TIMEOUT,
+                                 "Too many pending validations")
+            self._pending += 1
+        try:
+            future = self._executor.submit(_decode, cred, self.cache)
+        except:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def _timeout_error(self):
+        return MungeError(MungeErrorCode.EMUNGE_TIMEOUT,
+                          "Timed out after %g seconds" % self.timeout)
+
+    def _finish(self, cred, request, outcome):
+        """pymunge internal - return the result of a decode, or raise its
+        error, applying the replay policy"""
+        result, error = outcome
+        if error is None:
+            return result
+        if result is not None and (self.replay == REPLAY_ACCEPT or
+                                   (callable(self.replay) and
+                                    self.replay(result, request))):
+            return result
+        raise error
+
+def _decode(ctx, cred, cache):
+    """pymunge internal - decode cred (with the cache, if not None),
+    returning (result, error); result is also set for replayed
+    credentials"""
+    try:
+        if cache is not None:
+            return cache.decode(cred, ctx), None
+        return ctx.decode(cred, True), None
+    except MungeError as e:
+        if e.code != MungeErrorCode.EMUNGE_CRED_REPLAYED:
+            return None, e
+        result = e.result
+        if not isinstance(result, DecodeResult):
+            result = DecodeResult.from_context(ctx, *result)
+        return result, e
+
+def _error_status(error):
+    """pymunge internal - return the HTTP status code for a `MungeError`"""
+    if error.code == MungeErrorCode.EMUNGE_CRED_UNAUTHORIZED:
+        return 403
+    if error.code in _CREDENTIAL_ERRORS:
+        return 401
+    return 503
+
+def _error_response(authenticator, status, message):
+    """pymunge internal - return (status line, headers as a list of (name,
+    value) tuples, body) of an error response"""
+    headers = [('Content-Type', 'text/plain; charset=utf-8')]
+    if status == 401 and authenticator.scheme is not None:
+        headers.append(('WWW-Authenticate', authenticator.scheme))
+    elif status == 503:
+        headers.append(('Retry-After', '1'))
+    body = (message + '\n').encode('utf-8')
+    headers.append(('Content-Length', str(len(body))))
+    return '%d %s' % (status, _REASONS[status]), headers, body
+
+def _missing_credential(authenticator):
+    return 'Missing MUNGE credential in the %s header' % authenticator.header
+
+def _error_message(error):
+    return '%s: %s' % (error.code.name, error.message)
+
+class MungeWSGIMiddleware(object):
+    """WSGI middleware authenticating requests by a MUNGE credential.
+
+    `MungeWSGIMiddleware(app, authenticator, required)` wraps the WSGI
+    application `app`. The credential of each request is validated by
+    the `MungeAuthenticator` `authenticator` (a new one with default
+    arguments, if None); the request thread waits for the validation,
+    but the number of concurrent decodes is bounded by the
+    authenticator. The `DecodeResult` is stored in the environ under
+    `RESULT_KEY`. If `required` is False, requests without a credential
+    are passed to `app` without a result; requests with an invalid
+    credential are always rejected.
+
+    >>> app = MungeWSGIMiddleware(app, MungeAuthenticator(workers=8))
+    """
+
+    def __init__(self, app, authenticator=None, required=True):
+        if authenticator is None:
+            authenticator = MungeAuthenticator()
+        self.app = app
+        self.authenticator = authenticator
+        self.required = required
+        self._environ_key = 'HTTP_' + \
+            authenticator.header.upper().replace('-', '_')
+
+    def __call__(self, environ, start_response):
+        authenticator = self.authenticator
+        cred = authenticator.credential(environ.get(self._environ_key))
+        if cred is None:
+            if not self.required:
+                return self.app(environ, start_response)
+            return self._reject(start_response, 401,
+                                _missing_credential(authenticator))
+        try:
+            result = authenticator.validate(cred, environ)
+        except MungeError as e:
+            return self._reject(start_response, _error_status(e),
+                                _error_message(e))
+        environ[RESULT_KEY] = result
+        return self.app(environ, start_response)
+
+    def _reject(self, start_response, status, message):
+        status, headers, body = _error_response(self.authenticator, status,
+                                                message)
+        start_response(status, headers)
+        return [body]
+
+class MungeASGIMiddleware(object):
+    """ASGI middleware authenticating HTTP and WebSocket requests by a
+    MUNGE credential.
+
+    `MungeASGIMiddleware(app, authenticator, required)` wraps the ASGI
+    application `app`, like `MungeWSGIMiddleware`. The credential is
+    validated without blocking the event loop, and the `DecodeResult` is
+    stored under `RESULT_KEY` in a copy of the scope passed to `app`.
+    Rejected WebSocket connections are closed with code 1008 (policy
+    violation). Other scopes (e.g. lifespan) are passed to `app`
+    unchanged."""
+
+    def __init__(self, app, authenticator=None, required=True):
+        if authenticator is None:
+            authenticator = MungeAuthenticator()
+        self.app = app
+        self.authenticator = authenticator
+        self.required = required
+        self._header = authenticator.header.lower().encode('latin-1')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] not in ('http', 'websocket'):
+            await self.app(scope, receive, send)
+            return
+        authenticator = self.authenticator
+        value = None
+        for name, header_value in scope.get('headers', ()):
+            if name == self._header:
+                value = header_value
+                break
+        cred = authenticator.credential(value)
+        if cred is None:
+            if not self.required:
+                await self.app(scope, receive, send)
+            else:
+                await self._reject(scope, send, 401,
+                                   _missing_credential(authenticator))
+            return
+        try:
+            result = await authenticator.validate_async(cred, scope)
+        except MungeError as e:
+            await self._reject(scope, send, _error_status(e),
+                               _error_message(e))
+            return
+        scope = dict(scope)
+        scope[RESULT_KEY] = result
+        await self.app(scope, receive, send)
+
+    async def _reject(self, scope, send, status, message):
+        if scope['type'] == 'websocket':
+            await send({'type': 'websocket.close', 'code': 1008})
+            return
+        status_line, headers, body = _error_response(self.authenticator,
+                                                     status, message)
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(name.lower().encode('latin-1'),
+                                 value.encode('latin-1'))
+                                for name, value in headers]})
+        await send({'type': 'http.response.body', 'body': body})
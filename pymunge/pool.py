@@ -0,0 +1,301 @@
+#########################################################################
+# Module pymunge.pool - reuse of MUNGE contexts
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""This module provides the `MungeContextPool` class, which reuses
+native MUNGE contexts instead of creating and destroying one for each
+use. The module-level `pymunge.encode()` and `pymunge.decode()`
+functions use the pool returned by `default_pool()`."""
+
+from pymunge.context import MungeContext
+from pymunge.error import MungeError
+from pymunge.spec import ContextSpec
+import pymunge.backend
+import pymunge._instrument
+import collections
+import threading
+
+#: Default maximum number of idle contexts kept by a pool.
+DEFAULT_MAX_IDLE = 16
+
+#: Pool statistics, as returned by `MungeContextPool.stats()`:
+#:
+#: * `hits`: contexts handed out that already had the requested options
+#: * `reuses`: contexts handed out after reconfiguring an idle context
+#:   that had different options
+#: * `misses`: contexts handed out that had to be created
+#: * `resets`: contexts whose options were reset when returned, after
+#:   a decode or after their options were changed
+#: * `option_sets`: number of options set on pooled contexts
+#: * `discarded`: returned contexts that were destroyed since the pool
+#:   already held `max_idle` idle contexts
+#: * `idle`: number of idle contexts currently in the pool
+PoolStats = collections.namedtuple('PoolStats', [
+    'hits', 'reuses', 'misses', 'resets', 'option_sets', 'discarded',
+    'idle'])
+
+class PooledMungeContext(MungeContext):
+    """A `MungeContext` handed out by a `MungeContextPool`. Closing it
+    (explicitly, by a 'with' statement or when it is garbage collected)
+    returns its native context to the pool instead of destroying it.
+
+    Methods that may change the options of the context (i.e. decoding
+    and setting options) mark it as modified, so that its options are
+    reset when it is returned to the pool. Decoding also marks it as
+    decoded, so that its native context is replaced when it is returned
+    (discarding the decode state, such as `encode_time` and `addr4`)."""
+
+    def __init__(self, pool, handle, spec, buffers=None):
+        self._backend = pool._backend
+        self.ctx = handle
+        self._pool = pool
+        self._spec = spec
+        self._modified = False
+        self._decoded = False
+        if buffers is not None:
+            self._buffers = buffers
+
+    def close(self):
+        if self.ctx is not None:
+            handle = self.ctx
+            self.ctx = None
+            self._pool._checkin((handle, self.__dict__.get('_buffers')),
+                                self._spec, self._modified, self._decoded)
+
+    def decode(self, cred, snapshot=False):
+        self._modified = self._decoded = True
+        return super(PooledMungeContext, self).decode(cred, snapshot)
+
+    def _decode_raw(self, cred):
+        self._modified = self._decoded = True
+        return super(PooledMungeContext, self)._decode_raw(cred)
+
+    def decode_many(self, creds, offsets=None, use_numpy=None):
+        self._modified = self._decoded = True
+        return super(PooledMungeContext, self).decode_many(creds, offsets,
+                                                           use_numpy)
+
+    def _set_option(self, option, option_type, value):
+        self._modified = True
+        super(PooledMungeContext, self)._set_option(option, option_type,
+                                                    value)
+
+class MungeContextPool(object):
+    """A pool of native MUNGE contexts, keyed by their options.
+
+    `acquire(spec)` hands out a `MungeContext` with the options of the
+    `ContextSpec` `spec`. Closing that context returns it to the pool.
+    Returned contexts are reset to the options they were handed out
+    with if their options were changed. If they were used to decode a
+    credential (which sets the options and the decode-only attributes
+    to those of the credential), their native context is replaced by a
+    copy of a pristine one with those options. When a context with
+    different options is reused, only the options that differ are set.
+
+    At most `max_idle` idle contexts are kept; further returned contexts
+    are destroyed. The contexts use `backend` (see `pymunge.backend`; the
+    default backend if None). A pool can be shared between threads, but each
+    context handed out must only be used by one thread at a time.
+
+    >>> pool = MungeContextPool()
+    >>> with pool.acquire(ContextSpec(ttl=60)) as ctx:
+    >>>     cred = ctx.encode(payload)
+    """
+
+    def __init__(self, max_idle=DEFAULT_MAX_IDLE, backend=None):
+        if max_idle < 0:
+            raise ValueError('max_idle must not be negative')
+        self.max_idle = max_idle
+        self._backend = pymunge.backend.get_backend(backend)
+        self._lock = threading.Lock()
+        self._free = {}
+        self._idle = 0
+        # Contexts are returned without taking the lock (they may be
+        # returned by MungeContext.__del__ at any time), and are only
+        # sorted into _free by the next acquire().
+        self._returned = collections.deque()
+        self._default_spec = None
+        self._pristine = None
+        self._hits = self._reuses = self._misses = 0
+        self._resets = self._option_sets = self._discarded = 0
+
+    def acquire(self, spec=None):
+        """Return a `MungeContext` with the options of the `ContextSpec`
+        `spec` (default options, if None). The context is returned to the
+        pool when it is closed."""
+        spec = self._normalize(spec)
+        with self._lock:
+            self._process_returned()
+            entries = self._free.get(spec)
+            if entries:
+                self._idle -= 1
+                self._hits += 1
+                handle, buffers = entries.pop()
+                return PooledMungeContext(self, handle, spec, buffers)
+            for current, entries in self._free.items():
+                if entries:
+                    self._idle -= 1
+                    self._reuses += 1
+                    entry = entries.pop()
+                    break
+            else:
+                self._misses += 1
+                current = self._default_spec
+                entry = (self._create(), None)
+            ctx = self._reconfigure(entry, current, spec)
+        ctx._spec = spec
+        return ctx
+
+    def stats(self):
+        """Return the statistics of this pool as a `PoolStats`."""
+        with self._lock:
+            self._process_returned()
+            return PoolStats(self._hits, self._reuses, self._misses,
+                             self._resets, self._option_sets,
+                             self._discarded, self._idle)
+
+    def clear(self):
+        """Destroy all idle contexts."""
+        with self._lock:
+            self._process_returned()
+            for entries in self._free.values():
+                for handle, buffers in entries:
+                    self._destroy(handle)
+            self._free.clear()
+            self._idle = 0
+            if self._pristine is not None:
+                self._destroy(self._pristine)
+                self._pristine = None
+
+    def _normalize(self, spec):
+        """pymunge internal - return spec with the socket filled in, so that
+        equivalent specs are equal"""
+        if self._default_spec is None:
+            with MungeContext(backend=self._backend) as ctx:
+                self._default_spec = ContextSpec.from_context(ctx)
+        if spec is None:
+            return self._default_spec
+        if spec.socket is None:
+            return spec._replace(socket=self._default_spec.socket)
+        return spec
+
+    def _create(self):
+        if pymunge._instrument.active:
+            return pymunge._instrument.call('ctx_create',
+                                            self._backend.ctx_create)
+        return self._backend.ctx_create()
+
+    def _copy_pristine(self):
+        """pymunge internal - return a copy of a native context which has
+        never been used, with the default options; must be called with
+        the lock held"""
+        if self._pristine is None:
+            self._pristine = self._create()
+        if pymunge._instrument.active:
+            return pymunge._instrument.call('ctx_copy',
+                                            self._backend.ctx_copy,
+                                            self._pristine)
+        return self._backend.ctx_copy(self._pristine)
+
+    def _destroy(self, handle):
+        if pymunge._instrument.active:
+            pymunge._instrument.call('ctx_destroy',
+                                     self._backend.ctx_destroy, handle)
+        else:
+            self._backend.ctx_destroy(handle)
+
+    def _checkin(self, entry, spec, modified, decoded):
+        self._returned.append((entry, spec, modified, decoded))
+
+    def _process_returned(self):
+        """pymunge internal - sort returned contexts into the pool; must be
+        called with the lock held"""
+        returned = self._returned
+        while returned:
+            entry, spec, modified, decoded = returned.popleft()
+            if self._idle >= self.max_idle:
+                self._discarded += 1
+                self._destroy(entry[0])
+                continue
+            current = None
+            if decoded:
+                # the decode state (encode_time, addr4, ...) of a native
+                # context cannot be reset, so the context is replaced
+                self._destroy(entry[0])
+                entry = (self._copy_pristine(), entry[1])
+                current = self._default_spec
+                self._resets += 1
+            if modified:
+                option_sets = self._option_sets
+                try:
+                    ctx = self._reconfigure(entry, current, spec)
+                except (MungeError, ValueError):
+                    # e.g. a failed decode can leave options which are
+                    # not valid enumeration values; the native context
+                    # has been destroyed
+                    self._discarded += 1
+                    continue
+                if self._option_sets != option_sets and not decoded:
+                    self._resets += 1
+                entry = (ctx.ctx, ctx.__dict__.get('_buffers'))
+                ctx.ctx = None
+            self._free.setdefault(spec, []).append(entry)
+            self._idle += 1
+
+    def _reconfigure(self, entry, current, spec):
+        """pymunge internal - set the options of the native context of
+        entry (a (handle, buffers) tuple) from current to spec, setting
+        only the options that differ. If current is None, the current
+        options are read from the context. Returns a `PooledMungeContext`
+        for the native context, without a spec."""
+        handle, buffers = entry
+        ctx = PooledMungeContext(self, handle, None, buffers)
+        try:
+            if current is None:
+                current = ContextSpec.from_context(ctx)
+            for name, value, current_value in zip(spec._fields, spec,
+                                                  current):
+                if value != current_value:
+                    MungeContext.__dict__[name].__set__(ctx, value)
+                    self._option_sets += 1
+        except:
+            ctx.ctx = None
+            self._destroy(handle)
+            raise
+        return ctx
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+def default_pool():
+    """Return the default `MungeContextPool`, used by the module-level
+    `pymunge.encode()` and `pymunge.decode()` functions. Its contexts use
+    the default backend; if the default backend is changed, a new pool is
+    created."""
+    global _default_pool
+    pool = _default_pool
+    if pool is None or pool._backend is not pymunge.backend.get_backend():
+        with _default_pool_lock:
+            backend = pymunge.backend.get_backend()
+            pool = _default_pool
+            if pool is None or pool._backend is not backend:
+                pool = _default_pool = MungeContextPool(backend=backend)
+    return pool
@@ -0,0 +1,296 @@
+#########################################################################
+# Module pymunge.prefetch - pre-encoded credentials
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""This module provides the `CredentialPrefetcher` class, which keeps
+reserves of credentials encoded ahead of time, so that a sender can take
+a fresh credential without waiting for munged."""
+
+from pymunge.enums import TTL_DEFAULT, TTL_MAXIMUM
+from pymunge.error import MungeError, MungeErrorCode
+from pymunge.pool import MungeContextPool
+import collections
+import math
+import threading
+import time
+
+#: Default number of seconds before their expiry at which credentials
+#: are discarded.
+DEFAULT_MARGIN = 10
+
+#: TTL assumed for credentials encoded with `TTL_DEFAULT` or
+#: `TTL_MAXIMUM` (the default TTL of munged).
+DEFAULT_TTL = 300
+
+# seconds between two runs of the refill thread if it is not woken up
+_INTERVAL = 0.1
+
+# maximum delay of the refill of a reserve after failed encodes
+_MAX_BACKOFF = 5.0
+
+#: Statistics of the reserve of one `ContextSpec`, as returned by
+#: `CredentialPrefetcher.stats()`:
+#:
+#: * `level`: number of credentials currently in the reserve
+#: * `target`: number of credentials the refill thread currently keeps
+#:   in the reserve
+#: * `rate`: observed demand, in credentials taken per second
+#: * `oldest_age`: age in seconds of the oldest credential in the
+#:   reserve (0 if it is empty)
+#: * `takes`: credentials taken
+#: * `hits`: credentials taken from the reserve
+#: * `misses`: credentials encoded on demand, since the reserve was empty
+#: * `minted`: credentials encoded by the refill thread
+#: * `evicted`: credentials discarded since they came within the safety
+#:   margin of their expiry
+#: * `errors`: failed encodes of the refill thread
+PrefetchStats = collections.namedtuple('PrefetchStats', [
+    'level', 'target', 'rate', 'oldest_age', 'takes', 'hits', 'misses',
+    'minted', 'evicted', 'errors'])
+
+class _Reserve(object):
+    """pymunge internal - the prefetched credentials of one spec, as a
+    deque of (deadline, cred) tuples in the order they were encoded"""
+
+    def __init__(self, spec, lifetime, target):
+        self.spec = spec
+        self.lifetime = lifetime
+        self.creds = collections.deque()
+        self.target = target
+        self.rate = 0.0
+        self.takes = self.hits = self.misses = 0
+        self.minted = self.evicted = self.errors = 0
+        self.last_takes = 0
+        self.last_update = time.time()
+        self.backoff = 0.0
+        self.retry_at = 0.0
+
+class CredentialPrefetcher(object):
+    """Keeps reserves of credentials (without payload) encoded ahead of
+    time, one for each `ContextSpec` in use, and refills them on a
+    background thread.
+
+    `take(spec)` returns a credential encoded with the options of `spec`
+    from its reserve, without contacting munged. Taking a credential
+    does not lock; the refill thread is only woken up when the reserve
+    runs low. If the reserve is empty, the credential is encoded on
+    demand.
+
+    Credentials are discarded `margin` seconds before they expire, so
+    that a credential taken from a reserve remains valid for at least
+    `margin` seconds. The expiry is computed from the `ttl` of the spec;
+    for `TTL_DEFAULT` and `TTL_MAXIMUM`, `default_ttl` (which should
+    not exceed the default TTL of munged) is assumed.
+
+    The number of credentials kept in each reserve adapts to the
+    observed demand: it is the number of credentials taken in `horizon`
+    seconds, but at least `min_level` and at most `max_level`.
+
+    A prefetcher should be closed when no longer used, which stops its
+    refill thread:
+
+    >>> with CredentialPrefetcher([ContextSpec(ttl=60)]) as prefetcher:
+    >>>     cred = prefetcher.take(ContextSpec(ttl=60))
+    """
+
+    def __init__(self, specs=(), min_level=2, max_level=64, horizon=1.0,
+                 margin=DEFAULT_MARGIN, default_ttl=DEFAULT_TTL,
+                 backend=None):
+        if not 0 <= min_level <= max_level or max_level < 1:
+            raise ValueError('Invalid min_level/max_level')
+        self.min_level = min_level
+        self.max_level = max_level
+        self.horizon = horizon
+        self.margin = margin
+        self.default_ttl = default_ttl
+        self._pool = MungeContextPool(backend=backend)
+        self._reserves = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        for spec in specs:
+            self.add(spec)
+        self._thread = threading.Thread(target=self._run,
+                                        name='CredentialPrefetcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Stop the refill thread and discard all reserves. Calling
+        `close()` on an already closed prefetcher has no effect."""
+        if not self._closed:
+            self._closed = True
+            self._wakeup.set()
+            if self._thread is not threading.current_thread():
+                self._thread.join()
+            for reserve in list(self._reserves.values()):
+                reserve.creds.clear()
+            self._pool.clear()
+
+    @property
+    def closed(self):
+        """True if this prefetcher is closed, False otherwise."""
+        return self._closed
+
+    def add(self, spec=None):
+        """Start keeping a reserve of credentials for the `ContextSpec`
+        `spec` (default options, if None). `take()` does this for
+        specs it has not seen yet."""
+        return self._reserve(self._pool._normalize(spec))
+
+    def take(self, spec=None):
+        """Return a credential (without payload) encoded with the options
+        of the `ContextSpec` `spec` (default options, if None). It is
+        taken from the reserve of `spec` if possible, otherwise encoded
+        on demand; in that case, a `MungeError` may be raised."""
+        if self._closed:
+            raise MungeError(MungeErrorCode.EMUNGE_BAD_ARG,
+                             "Prefetcher is closed")
+        spec = self._pool._normalize(spec)
+        reserve = self._reserves.get(spec)
+        if reserve is None:
+            reserve = self._reserve(spec)
+        reserve.takes += 1
+        creds = reserve.creds
+        now = time.time()
+        while True:
+            try:
+                deadline, cred = creds.popleft()
+            except IndexError:
+                break
+            if deadline > now:
+                reserve.hits += 1
+                if len(creds) * 2 < reserve.target:
+                    self._wakeup.set()
+                return cred
+            reserve.evicted += 1
+        reserve.misses += 1
+        self._wakeup.set()
+        return self._encode(reserve)[1]
+
+    def stats(self, spec=None):
+        """Return the statistics of the reserve of the `ContextSpec`
+        `spec` (default options, if None) as a `PrefetchStats`."""
+        reserve = self._reserves.get(self._pool._normalize(spec))
+        if reserve is None:
+            return PrefetchStats(0, 0, 0.0, 0.0, 0, 0, 0, 0, 0, 0)
+        creds = reserve.creds
+        oldest_age = 0.0
+        try:
+            oldest_age = max(0.0, time.time() - creds[0][0] +
+                             reserve.lifetime)
+        except IndexError:
+            pass
+        return PrefetchStats(len(creds), reserve.target, reserve.rate,
+                             oldest_age, reserve.takes, reserve.hits,
+                             reserve.misses, reserve.minted,
+                             reserve.evicted, reserve.errors)
+
+    def _reserve(self, spec):
+        """pymunge internal - return the reserve of the normalized spec,
+        creating it if necessary"""
+        with self._lock:
+            reserve = self._reserves.get(spec)
+            if reserve is None:
+                ttl = spec.ttl
+                if ttl in (TTL_DEFAULT, TTL_MAXIMUM):
+                    ttl = self.default_ttl
+                lifetime = ttl - self.margin
+                if lifetime <= 0:
+                    raise ValueError('TTL of %d seconds leaves no time '
+                                     'before the margin of %d seconds' %
+                                     (ttl, self.margin))
+                reserve = _Reserve(spec, lifetime, max(self.min_level, 1))
+                self._reserves[spec] = reserve
+                self._wakeup.set()
+            return reserve
+
+    def _encode(self, reserve):
+        """pymunge internal - encode a credential for reserve, returning
+        (deadline, cred)"""
+        # the credential is encoded no earlier than this, so it remains
+        # valid until at least deadline + margin
+        deadline = time.time() + reserve.lifetime
+        with self._pool.acquire(reserve.spec) as ctx:
+            return deadline, ctx.encode()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(_INTERVAL)
+            self._wakeup.clear()
+            for reserve in list(self._reserves.values()):
+                if self._closed:
+                    break
+                self._update(reserve)
+                # a reserve whose encodes fail (e.g. since its socket is
+                # unreachable) is retried with a growing delay, without
+                # holding up the other reserves
+                if reserve.retry_at <= time.time():
+                    self._refill(reserve)
+
+    def _update(self, reserve):
+        """pymunge internal - discard expiring credentials of reserve and
+        adapt its target level to the demand"""
+        creds = reserve.creds
+        now = time.time()
+        while creds:
+            try:
+                entry = creds.popleft()
+            except IndexError:
+                break
+            if entry[0] > now:
+                creds.appendleft(entry)
+                break
+            reserve.evicted += 1
+        elapsed = now - reserve.last_update
+        if elapsed >= _INTERVAL:
+            takes = reserve.takes
+            rate = (takes - reserve.last_takes) / elapsed
+            reserve.rate = (reserve.rate + rate) / 2
+            reserve.last_takes = takes
+            reserve.last_update = now
+            target = int(math.ceil(reserve.rate * self.horizon))
+            reserve.target = max(self.min_level,
+                                 min(self.max_level, target))
+
+    def _refill(self, reserve):
+        """pymunge internal - encode credentials until reserve reaches its
+        target level; after a failed encode, the refill of reserve is
+        postponed"""
+        creds = reserve.creds
+        while len(creds) < reserve.target and not self._closed:
+            try:
+                entry = self._encode(reserve)
+            except MungeError:
+                reserve.errors += 1
+                reserve.backoff = min(max(2 * reserve.backoff, _INTERVAL),
+                                      _MAX_BACKOFF)
+                reserve.retry_at = time.time() + reserve.backoff
+                return
+            reserve.backoff = 0.0
+            creds.append(entry)
+            reserve.minted += 1
@@ -23,7 +23,12 @@
 """This module contains declarations of raw libmunge C functions
 and constants.
 
-Importing this module causes the libmunge shared library to be loaded.
+The libmunge shared library is loaded when one of its functions is first
+used (or when `load()` is called), not when this module is imported.
+On Python versions before 3.7, it is loaded on import. The environment
+variable `PYMUNGE_LIBMUNGE` can be set to the path of the libmunge shared
+library to use; otherwise the known sonames of libmunge are tried before
+searching for the library with `ctypes.util.find_library()`.
 
 Note that most function prototypes differ slightly from their C counterparts,
 as follows:
@@ -37,62 +42,179 @@ as follows:
   output arguments (e.g. uid and gid in `munge_decode`). The Python wrapper
   does not take these arguments and instead returns the multiple values
   as a tuple.
+
+* Memory allocated by libmunge and returned to the caller (the credential
+  of `munge_encode` and the payload of `munge_decode`) is copied into a
+  Python byte string and freed by the wrapper, also when an error is
+  raised. Code calling the unchecked prototypes directly can use
+  `take_bytes()`, `take_view()` or `NativeBuffer` to release such memory.
+
+The wrappers described above are kept for compatibility. `MungeContext`
+(with the default ctypes backend, see `pymunge.backend`) uses a faster
+path instead: unchecked prototypes of `munge_encode` and `munge_decode`,
+typed prototypes of `munge_ctx_get`/`munge_ctx_set` (one per option
+type), preallocated out-parameters (`ContextBuffers`) and error checks
+done by the caller.
 """
 
 import ctypes
-import ctypes.util
 import pymunge.error
+import sys
+import weakref
+
+# Names declared by pymunge._libmunge, which is imported (loading
+# libmunge) when one of them is first accessed.
+_LIBMUNGE_NAMES = frozenset([
+    "libmunge_filename", "libmunge", "libc", "_free", "load_function",
+    "errcheck_munge_encode", "munge_encode", "_munge_encode",
+    "errcheck_munge_decode", "munge_decode", "_munge_decode",
+    "munge_strerror", "munge_ctx_create", "munge_ctx_copy",
+    "munge_ctx_destroy", "munge_ctx_strerror", "errcheck_munge_ctx_getset",
+    "_munge_ctx_get", "munge_ctx_get", "_munge_ctx_set", "munge_ctx_set",
+    "load_option_function", "_VARIADIC_CALLS",
+    "_munge_ctx_get_int", "_munge_ctx_get_uint", "_munge_ctx_get_time",
+    "_munge_ctx_get_str", "_munge_ctx_set_int", "_munge_ctx_set_uint",
+    "_munge_ctx_set_str", "munge_enum_is_valid", "munge_enum_int_to_str",
+    "munge_enum_str_to_int",
+])
 
-#: Name of the libmunge shared object.
-libmunge_filename = ctypes.util.find_library('munge')
+_loaded = False
 
-#: Handle to the loaded libmunge shared object (a `ctypes.CDLL` object).
-libmunge = None
-if libmunge_filename is not None:
-    libmunge = ctypes.CDLL(libmunge_filename)
-else:
-    import warnings
-    warnings.warn("libmunge not found. All calls to pymunge.raw will fail.")
 
+def load():
+    """Load libmunge and declare its functions in this module, if not done
+    yet. This happens automatically when a libmunge function (or one of
+    `libmunge`, `libmunge_filename` and `libc`) is first accessed;
+    calling `load()` moves the cost of loading the library to a chosen
+    point. See `pymunge._libmunge` for how libmunge is located."""
+    global _loaded
+    if not _loaded:
+        import pymunge._libmunge
+        namespace = globals()
+        for name in _LIBMUNGE_NAMES:
+            namespace[name] = getattr(pymunge._libmunge, name)
+        _loaded = True
+
+
+def __getattr__(name):
+    if name in _LIBMUNGE_NAMES:
+        load()
+        return globals()[name]
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
-def load_function(name, restype, argtypes, paramflags, errcheck=None):
-    """pymunge internal - helper to load functions from libmunge
-    raises a `MungeError` if error_code is not `EMUNGE_SUCCESS`"""
-    if libmunge is None:
-        # Mock libmunge functions if the library was not found. This allows
-        # readthedocs to build the sphinx docs for the package without
-        # having libmunge installed.
-        if argtypes == "*":
-            args = "*args"
-        else:
-            argnames = [flag[1] for flag in paramflags if flag[0] & 2 == 0]
-            args = ", ".join(argnames)
-        l = {}
-        exec("def function(" + args + "):\n" +
-             "\traise ImportError('Failed to call C function " + name +
-             ": libmunge C library not found')", {}, l)
-        return l['function']
-    else:
-        if argtypes == "*":
-            function = getattr(libmunge, name)
-            function.restype = restype
-        else:
-            prototype = ctypes.CFUNCTYPE(restype, *argtypes)
-            function = prototype((name, libmunge), paramflags)
-        if errcheck is not None:
-            function.errcheck = errcheck
-        return function
+
+def _free(address):
+    """pymunge internal - replaced by the C library's free() when libmunge
+    is loaded"""
+    load()
+    return _free(address)
 
 
 def check_and_raise(error_code, ctx, result):
     """pymunge internal - helper for error check functions;
     raises a `MungeError` if error_code is not `EMUNGE_SUCCESS`"""
     if error_code != pymunge.error.MungeErrorCode.EMUNGE_SUCCESS.value:
-        if ctx is not None:
-            message = munge_ctx_strerror(ctx).decode("utf-8")
-        else:
-            message = munge_strerror(error_code).decode("utf-8")
-        raise pymunge.error.MungeError(error_code, message, result)
+        raise make_error(error_code, ctx, result)
+
+
+def make_error(error_code, ctx, result):
+    """pymunge internal - returns a `MungeError` for the (non-success)
+    error_code, with the message taken from ctx if ctx is not None (see
+    `pymunge.backend.Backend.make_error()`)"""
+    import pymunge.backend
+    return pymunge.backend.get_backend('ctypes').make_error(error_code, ctx,
+                                                            result)
+
+
+def free(address):
+    """Release memory at `address` (an integer, or None for no memory)
+    that was allocated by libmunge with `malloc()`."""
+    if address:
+        _free(address)
+
+
+def take_bytes(address, length=-1):
+    """Copy `length` bytes at `address` into a byte string and release the
+    memory with `free()`. If `length` is -1, the memory must hold a
+    NUL-terminated string. Returns b'' if `address` is None."""
+    if not address:
+        return b''
+    try:
+        return ctypes.string_at(address, length)
+    finally:
+        _free(address)
+
+
+def take_view(address, length):
+    """Return a memoryview of the `length` bytes at `address` which owns
+    the memory: it is released with `free()` once the memoryview has been
+    released (by `release()` or by leaving a 'with' block over it) or
+    garbage collected. The memoryview is read-only on Python 3.8 and
+    later. Returns an empty memoryview if `address` is None."""
+    if not address or length <= 0:
+        free(address)
+        return memoryview(b'')
+    array = (ctypes.c_char * length).from_address(address)
+    weakref.finalize(array, _free, address)
+    view = memoryview(array).cast('B')
+    if hasattr(view, 'toreadonly'):
+        view = view.toreadonly()
+    return view
+
+
+class NativeBuffer(object):
+    """Owner of `length` bytes of memory at `address`, allocated by libmunge
+    with `malloc()`. The memory is released when `free()` is called, when
+    the buffer is used as a context manager and the 'with' block is left,
+    or when the `NativeBuffer` is garbage collected.
+
+    >>> with NativeBuffer(address, length) as buf:
+    >>>     data = buf.tobytes()
+    """
+
+    __slots__ = ('address', 'length')
+
+    def __init__(self, address, length):
+        self.address = address or None
+        self.length = length if address else 0
+
+    def __len__(self):
+        return self.length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.free()
+
+    def __del__(self):
+        self.free()
+
+    @property
+    def freed(self):
+        """True if the memory has been released (or there was none)."""
+        return self.address is None
+
+    def tobytes(self):
+        """Return a copy of the memory as a byte string."""
+        if self.address is None:
+            return b''
+        return ctypes.string_at(self.address, self.length)
+
+    def take(self):
+        """Return a copy of the memory as a byte string and release it."""
+        try:
+            return self.tobytes()
+        finally:
+            self.free()
+
+    def free(self):
+        """Release the memory. Calling `free()` again has no effect."""
+        address = self.address
+        if address is not None:
+            self.address = None
+            self.length = 0
+            _free(address)
 
 
 # Type declarations
@@ -121,204 +243,51 @@ gid_t = ctypes.c_uint
 time_t = ctypes.c_long
 
 
-# libmunge functions
-
-def errcheck_munge_encode(error_code, func, arguments):
-    """pymunge internal - error check function for munge_encode"""
-    ctx = arguments[1]
-    result = arguments[0].value
-    check_and_raise(error_code, ctx, result)
-    return result
-
-munge_encode = load_function("munge_encode",
-    munge_err_t, [ctypes.POINTER(ctypes.c_char_p),
-        munge_ctx_t, ctypes.c_void_p, ctypes.c_int],
-    ((2, "cred"), (1, "ctx", None), (1, "buf", None), (1, "len", 0)),
-    errcheck_munge_encode)
-"""
-C prototype: `munge_err_t munge_encode(char **cred, munge_ctx_t ctx,
-const void *buf, int len);`
-
-Note: when called from Python, returns `cred` instead of the `munge_err_t`.
-
-Creates a credential contained in a base64 string.
-A payload specified by a buffer `buf` (a byte string) of length `len`
-can be encapsulated in as well.
-If the munge context `ctx` is None, the default context will be used.
-Returns the credential `cred` if the credential is successfully created;
-otherwise, raises a `MungeError` containing the error code and message.
-The error message may be more detailed if a `ctx` was specified.
-"""
-
-def errcheck_munge_decode(error_code, func, arguments):
-    """pymunge internal - error check function for munge_decode"""
-    ctx = arguments[1]
-    buf = ctypes.string_at(arguments[2].value, arguments[3].value)
-    result = (buf, arguments[4].value, arguments[5].value)
-    check_and_raise(error_code, ctx, result)
-    return result
-
-munge_decode = load_function("munge_decode",
-    munge_err_t, [ctypes.c_char_p, munge_ctx_t,
-        ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_int),
-        ctypes.POINTER(uid_t), ctypes.POINTER(gid_t)],
-    ((1, "cred"), (1, "ctx", None), (2, "buf"), (2, "len"),
-     (2, "uid"), (2, "gid")),
-    errcheck_munge_decode)
-"""
-C prototype: `munge_err_t munge_decode(const char *cred, munge_ctx_t ctx,
-void **buf, int *len, uid_t *uid, gid_t *gid);`
-
-Note: when called from Python, returns `(payload, uid, gid)` instead of the
-`munge_err_t`, where `payload` is the contents of `buf` of length `len`.
-Example usage:
-
->>> payload, uid, gid = munge_decode(cred, ctx)
-
-Validates the credential `cred`.
-If the munge context `ctx` is not None, it will be set to that used
-to encode the credential.
-If the credential is valid, returns the encapsulated payload byte string
-`payload` as well as the numeric UID `uid` and GID `gid` of the process
-that created the credential.
-If the credential is not valid, raises a `MungeError` containing the
-error code and message. The error message may be more detailed if a `ctx`
-was specified. For certain errors (ie, `EMUNGE_CRED_EXPIRED`,
-`EMUNGE_CRED_REWOUND`, `EMUNGE_CRED_REPLAYED`), the raised `MungeError` will
-contain the result `(payload, uid, gid)` which would have been returned
-if the credential were still valid.
-"""
-
-munge_strerror = load_function("munge_strerror",
-    ctypes.c_char_p, [munge_err_t],
-    ((1, "e"),))
-"""
-C prototype: `const char * munge_strerror(munge_err_t e);`
-
-Returns a descriptive string describing the munge errno `e`.
-"""
-
-munge_ctx_create = load_function("munge_ctx_create",
-    munge_ctx_t, [], ())
-"""
-C prototype: `munge_ctx_t munge_ctx_create(void);`
-
-Creates and returns a new munge context or None on error.
-Abandoning a context without calling `munge_ctx_destroy()` will result
-in a memory leak.
-"""
-
-munge_ctx_copy = load_function("munge_ctx_copy",
-    munge_ctx_t, [munge_ctx_t],
-    ((1, "ctx"),))
-"""
-C prototype: `munge_ctx_t munge_ctx_copy(munge_ctx_t ctx);`
-
-Copies the context `ctx`, returning a new munge context or None on error.
-Abandoning a context without calling `munge_ctx_destroy()` will result
-in a memory leak.
-"""
-
-munge_ctx_destroy = load_function("munge_ctx_destroy",
-    None, [munge_ctx_t],
-    ((1, "ctx"),))
-"""
-C prototype: `void munge_ctx_destroy(munge_ctx_t ctx);`
-
-Destroys the context `ctx`.
-"""
-
-munge_ctx_strerror = load_function("munge_ctx_strerror",
-    ctypes.c_char_p, [munge_ctx_t],
-    ((1, "ctx"),))
-"""
-C prototype: `const char * munge_ctx_strerror(munge_ctx_t ctx);`
-
-Returns a descriptive text string describing the munge error number
-according to the context `ctx`, or None if no error condition exists.
-This message may be more detailed than that returned by `munge_strerror()`.
-"""
-
-def errcheck_munge_ctx_getset(error_code, func, arguments):
-    """pymunge internal - error check function for munge_ctx_get
-    and munge_ctx_set"""
-    ctx = arguments[0]
-    check_and_raise(error_code, ctx, None)
-    return arguments
-
-_munge_ctx_get = load_function("munge_ctx_get",
-    munge_err_t, "*",
-    (),
-    errcheck_munge_ctx_getset)
-
-def munge_ctx_get(ctx, opt, ptr):
-    """
-    C prototype: `munge_err_t munge_ctx_get(munge_ctx_t ctx,
-    munge_opt_t opt, ...);`
-
-    Note: when called from Python, returns nothing.
-
-    Gets the value for the option `opt` associated with the munge context
-    `ctx`, storing the result in the subsequent pointer argument. Refer to
-    the `munge_opt_t` enum comments for argument types. If the result is a
-    string, that string should not be freed or modified by the caller.
-    Raises a `MungeError` upon failure.
-    """
-    return _munge_ctx_get(munge_ctx_t(ctx), munge_opt_t(opt), ptr)
-
-_munge_ctx_set = load_function("munge_ctx_set",
-    munge_err_t, "*",
-    (),
-    errcheck_munge_ctx_getset)
-
-def munge_ctx_set(ctx, opt, val):
-    """
-    C prototype: `munge_err_t munge_ctx_set(munge_ctx_t ctx,
-    munge_opt_t opt, ...);`
-
-    Note: when called from Python, returns nothing.
-
-    Sets the value for the option `opt` associated with the munge context
-    `ctx`, using the value of the subsequent argument. Refer to the
-    `munge_opt_t` enum comments for argument types. Raises a `MungeError`
-    upon failure.
-    """
-    return _munge_ctx_set(munge_ctx_t(ctx), munge_opt_t(opt), val)
-
-munge_enum_is_valid = load_function("munge_enum_is_valid",
-    ctypes.c_bool, [munge_enum_t, ctypes.c_int],
-    ((1, "type"), (1, "val")))
-"""
-C prototype: `int munge_enum_is_valid(munge_enum_t type, int val);`
-
-Note: when called from Python, the returned int is converted to a boolean.
-
-Returns True if the given value `val` is a valid enumeration of the
-specified type `type` in the software configuration as currently compiled;
-otherwise returns False. Some enumerations correspond to options that can
-only be enabled at compile-time.
-"""
-
-munge_enum_int_to_str = load_function("munge_enum_int_to_str",
-    ctypes.c_char_p, [munge_enum_t, ctypes.c_int],
-    ((1, "type"), (1, "val")))
-"""
-C prototype: `const char * munge_enum_int_to_str(munge_enum_t type, int val);`
-
-Converts the munge enumeration `val` of the specified type `type`
-into a text string. Returns the text string, or None on error.
-"""
-
-munge_enum_str_to_int = load_function("munge_enum_str_to_int",
-    ctypes.c_int, [munge_enum_t, ctypes.c_char_p],
-    ((1, "type"), (1, "str")))
-"""
-C prototype: `int munge_enum_str_to_int(munge_enum_t type, const char *str);`
-
-Converts the case-insensitive byte string `str` into the corresponding
-munge enumeration of the specified type `type`. Returns a munge
-enumeration on success (>= 0), or -1 on error.
-"""
+class ContextBuffers(object):
+    """pymunge internal - preallocated out-parameters for one MUNGE
+    context, used by the fast call path of `MungeContext`: the unchecked
+    `munge_encode`/`munge_decode` prototypes and the typed option
+    getters/setters, with errors checked inline. Like the context it
+    belongs to, it must not be used by several threads at the same time.
+
+    `munge_encode` and `munge_decode` are the unchecked prototypes (they
+    are kept per context so that `pymunge.hooks` can time the native
+    call of one context). `getters` maps the ctypes type of an option
+    (`c_int`, `c_uint`, `time_t` or `c_char_p`) to `(function, value,
+    ref)`, `setters` maps `c_int`, `c_uint` and `c_char_p` to the setter
+    function."""
+
+    def __init__(self):
+        load()
+        self.munge_encode = _munge_encode
+        self.munge_decode = _munge_decode
+        self.cred = ctypes.c_void_p()
+        self.cred_ref = ctypes.byref(self.cred)
+        self.buf = ctypes.c_void_p()
+        self.buf_ref = ctypes.byref(self.buf)
+        self.buflen = ctypes.c_int()
+        self.buflen_ref = ctypes.byref(self.buflen)
+        self.uid = uid_t()
+        self.uid_ref = ctypes.byref(self.uid)
+        self.gid = gid_t()
+        self.gid_ref = ctypes.byref(self.gid)
+        self.getters = {}
+        for option_type, function in (
+                (ctypes.c_int, _munge_ctx_get_int),
+                (ctypes.c_uint, _munge_ctx_get_uint),
+                (time_t, _munge_ctx_get_time),
+                (ctypes.c_char_p, _munge_ctx_get_str)):
+            value = option_type()
+            self.getters[option_type] = (function, value,
+                                         ctypes.byref(value))
+        self.setters = {
+            ctypes.c_int: _munge_ctx_set_int,
+            ctypes.c_uint: _munge_ctx_set_uint,
+            ctypes.c_char_p: _munge_ctx_set_str,
+        }
+        # (function, value, ref, option) tuples by option list, used by
+        # pymunge.backend.CtypesBackend.read_options()
+        self.readers = {}
 
 
 # Enumerations (excluding those already present in pymunge.enums)
@@ -349,7 +318,8 @@ __all__ = [
     "munge_enum_is_valid", "munge_enum_int_to_str",
     "munge_enum_str_to_int",
 
-    "libmunge_filename", "libmunge",
+    "libmunge_filename", "libmunge", "libc", "load",
+    "free", "take_bytes", "take_view", "NativeBuffer",
 
     "uid_t", "gid_t", "time_t", "munge_ctx_t", "munge_err_t",
 
@@ -362,3 +332,8 @@ __all__ = [
     "munge_enum_t",
     "MUNGE_ENUM_CIPHER", "MUNGE_ENUM_MAC", "MUNGE_ENUM_ZIP",
 ]
+
+
+if sys.version_info < (3, 7):
+    # module __getattr__ (PEP 562) is not supported
+    load()
@@ -0,0 +1,244 @@
+#########################################################################
+# Module pymunge.result - decode result snapshots
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""This module provides `DecodeResult`, an immutable snapshot of the
+result of decoding a credential, including all metadata of the context
+used to encode it."""
+
+from pymunge.enums import CipherType, MACType, ZipType, UID_ANY, GID_ANY
+import pymunge.error
+import pymunge.raw
+import ctypes
+
+# lookup tables from raw values to enumeration members
+_CIPHER_TYPES = dict((member.value, member) for member in CipherType)
+_MAC_TYPES = dict((member.value, member) for member in MACType)
+_ZIP_TYPES = dict((member.value, member) for member in ZipType)
+
+_NO_RESTRICTION = pymunge.raw.uid_t(UID_ANY).value
+
+# options read by read_result(), in the order of the DecodeResult slots
+_RESULT_OPTIONS = (
+    (pymunge.raw.MUNGE_OPT_CIPHER_TYPE, ctypes.c_int),
+    (pymunge.raw.MUNGE_OPT_MAC_TYPE, ctypes.c_int),
+    (pymunge.raw.MUNGE_OPT_ZIP_TYPE, ctypes.c_int),
+    (pymunge.raw.MUNGE_OPT_TTL, ctypes.c_int),
+    (pymunge.raw.MUNGE_OPT_REALM, ctypes.c_char_p),
+    (pymunge.raw.MUNGE_OPT_ADDR4, ctypes.c_uint),
+    (pymunge.raw.MUNGE_OPT_ENCODE_TIME, pymunge.raw.time_t),
+    (pymunge.raw.MUNGE_OPT_DECODE_TIME, pymunge.raw.time_t),
+    (pymunge.raw.MUNGE_OPT_UID_RESTRICTION, ctypes.c_uint),
+    (pymunge.raw.MUNGE_OPT_GID_RESTRICTION, ctypes.c_uint))
+
+class DecodeResult(object):
+    """The result of decoding a credential, as returned by
+    `MungeContext.decode(cred, snapshot=True)`.
+
+    A `DecodeResult` captures the payload, UID and GID as well as all
+    metadata of the credential (the attributes a `MungeContext` has after
+    a decode) at once, so that it does not need an open context. It is
+    immutable and iterates as `(payload, uid, gid)`, so it can be used in
+    place of the tuple returned by `MungeContext.decode()`:
+
+    >>> payload, uid, gid = ctx.decode(cred, snapshot=True)
+
+    Attributes: `payload`, `uid`, `gid`, `cipher_type`, `mac_type`,
+    `zip_type`, `realm`, `ttl`, `addr4`, `encode_time`, `decode_time`,
+    `uid_restriction` and `gid_restriction`, with the same meaning and
+    types as the corresponding `MungeContext` attributes.
+    """
+
+    __slots__ = ('_payload', '_uid', '_gid', '_cipher_type', '_mac_type',
+                 '_zip_type', '_realm', '_ttl', '_addr4', '_encode_time',
+                 '_decode_time', '_uid_restriction', '_gid_restriction')
+
+    def __init__(self, payload, uid, gid, cipher_type, mac_type, zip_type,
+                 realm, ttl, addr4, encode_time, decode_time,
+                 uid_restriction=UID_ANY, gid_restriction=GID_ANY):
+        self._payload = payload
+        self._uid = uid
+        self._gid = gid
+        self._cipher_type = getattr(cipher_type, 'value', cipher_type)
+        self._mac_type = getattr(mac_type, 'value', mac_type)
+        self._zip_type = getattr(zip_type, 'value', zip_type)
+        self._realm = realm
+        self._ttl = ttl
+        self._addr4 = addr4
+        self._encode_time = encode_time
+        self._decode_time = decode_time
+        self._uid_restriction = uid_restriction
+        self._gid_restriction = gid_restriction
+
+    @classmethod
+    def from_context(cls, ctx, payload, uid, gid):
+        """Return a `DecodeResult` with the given payload, UID and GID and
+        the metadata of the `MungeContext` `ctx`, which has just been used
+        to decode a credential."""
+        ctx._ensure_is_open()
+        return read_result(ctx._backend, ctx.ctx, ctx._buffers, payload,
+                           uid, gid)
+
+    def __iter__(self):
+        yield self._payload
+        yield self._uid
+        yield self._gid
+
+    def __eq__(self, other):
+        if not isinstance(other, DecodeResult):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name)
+                   for name in self.__slots__)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return ('DecodeResult(payload=%r, uid=%d, gid=%d, cipher_type=%s, '
+                'mac_type=%s, zip_type=%s, realm=%r, ttl=%d, addr4=%r, '
+                'encode_time=%d, decode_time=%d, uid_restriction=%d, '
+                'gid_restriction=%d)' %
+                (self._payload, self._uid, self._gid, self.cipher_type,
+                 self.mac_type, self.zip_type, self.realm, self._ttl,
+                 self.addr4, self._encode_time, self._decode_time,
+                 self._uid_restriction, self._gid_restriction))
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    @property
+    def payload(self):
+        """The payload encapsulated in the credential (a byte string)."""
+        return self._payload
+
+    @property
+    def uid(self):
+        """The UID of the process that created the credential."""
+        return self._uid
+
+    @property
+    def gid(self):
+        """The GID of the process that created the credential."""
+        return self._gid
+
+    @property
+    def cipher_type(self):
+        """Symmetric cipher type (a `CipherType`)."""
+        value = self._cipher_type
+        return _CIPHER_TYPES.get(value) or CipherType(value)
+
+    @property
+    def mac_type(self):
+        """Message authentication code type (a `MACType`)."""
+        value = self._mac_type
+        return _MAC_TYPES.get(value) or MACType(value)
+
+    @property
+    def zip_type(self):
+        """Compression type (a `ZipType`)."""
+        value = self._zip_type
+        return _ZIP_TYPES.get(value) or ZipType(value)
+
+    @property
+    def realm(self):
+        """Security realm (a str), or None."""
+        realm = self._realm
+        if isinstance(realm, bytes):
+            return realm.decode('utf-8')
+        return realm
+
+    @property
+    def ttl(self):
+        """Time-to-live of the credential (in seconds)."""
+        return self._ttl
+
+    @property
+    def addr4(self):
+        """The IPv4 address of the host where the credential was encoded,
+        in dotted-quad notation."""
+        addr4 = self._addr4
+        if isinstance(addr4, int):
+            import socket
+            import struct
+            return socket.inet_ntoa(struct.pack('=I', addr4))
+        return addr4
+
+    @property
+    def encode_time(self):
+        """The time (in seconds since the epoch) at which the credential
+        was encoded."""
+        return self._encode_time
+
+    @property
+    def decode_time(self):
+        """The time (in seconds since the epoch) at which the credential
+        was decoded."""
+        return self._decode_time
+
+    @property
+    def uid_restriction(self):
+        """Numeric UID allowed to decode the credential, or `UID_ANY`."""
+        return self._uid_restriction
+
+    @property
+    def gid_restriction(self):
+        """Numeric GID allowed to decode the credential, or `GID_ANY`."""
+        return self._gid_restriction
+
+def read_result(backend, ctx, buffers, payload, uid, gid):
+    """pymunge internal - return a `DecodeResult` with the given payload,
+    UID and GID and the metadata of the native context ctx, read at once
+    with `read_options()` of backend (a `pymunge.backend.Backend`) and the
+    context's preallocated buffers. Enumerations, the realm and the
+    address are stored as raw values and only converted when accessed."""
+    status, values = backend.read_options(buffers, ctx, _RESULT_OPTIONS)
+    if status:
+        # getting an option of a valid context does not fail; if it
+        # does, report the generic error of the context
+        raise backend.make_error(
+            pymunge.error.MungeErrorCode.EMUNGE_SNAFU.value, ctx, None)
+    cipher_type, mac_type, zip_type, ttl, realm, addr4, encode_time, \
+        decode_time, uid_restriction, gid_restriction = values
+
+    result = DecodeResult.__new__(DecodeResult)
+    result._payload = payload
+    result._uid = uid
+    result._gid = gid
+    result._cipher_type = cipher_type
+    result._mac_type = mac_type
+    result._zip_type = zip_type
+    result._realm = realm
+    result._ttl = ttl
+    result._addr4 = addr4
+    result._encode_time = encode_time
+    result._decode_time = decode_time
+    result._uid_restriction = UID_ANY if uid_restriction == _NO_RESTRICTION \
+        else uid_restriction
+    result._gid_restriction = GID_ANY if gid_restriction == _NO_RESTRICTION \
+        else gid_restriction
+    return result
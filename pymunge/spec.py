@@ -0,0 +1,108 @@
+#########################################################################
+# Module pymunge.spec - immutable MUNGE context specifications
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""This module provides the `ContextSpec` class, an immutable and
+picklable description of the options of a `MungeContext`."""
+
+from pymunge.context import MungeContext
+from pymunge.enums import CipherType, MACType, ZipType, \
+    TTL_DEFAULT, UID_ANY, GID_ANY
+import collections
+
+_ContextSpecBase = collections.namedtuple('ContextSpec', [
+    'cipher_type', 'mac_type', 'zip_type', 'realm', 'ttl', 'socket',
+    'uid_restriction', 'gid_restriction'])
+
+class ContextSpec(_ContextSpecBase):
+    """An immutable specification of the options of a `MungeContext`
+    that are used when encoding a credential (and of the socket, which
+    is also used when decoding).
+
+    Unlike a `MungeContext`, which wraps a native libmunge context, a
+    `ContextSpec` is a plain named tuple: it is hashable, can be pickled
+    (e.g. to send it to another process) and can be used to create any
+    number of equivalent contexts:
+
+    >>> spec = ContextSpec(cipher_type=CipherType.AES128, ttl=60)
+    >>> with spec.create_context() as ctx:
+    >>>     cred = ctx.encode(payload)
+
+    All fields default to the defaults of a new `MungeContext`. A
+    `socket` of None means the default socket compiled into libmunge.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, cipher_type=CipherType.Default,
+                mac_type=MACType.Default, zip_type=ZipType.Default,
+                realm=None, ttl=TTL_DEFAULT, socket=None,
+                uid_restriction=UID_ANY, gid_restriction=GID_ANY):
+        _check_arg_type(cipher_type, 'cipher_type', CipherType)
+        _check_arg_type(mac_type, 'mac_type', MACType)
+        _check_arg_type(zip_type, 'zip_type', ZipType)
+        if realm is not None:
+            _check_arg_type(realm, 'realm', str)
+        _check_arg_type(ttl, 'ttl', int)
+        if socket is not None:
+            _check_arg_type(socket, 'socket', str)
+        _check_arg_type(uid_restriction, 'uid_restriction', int)
+        _check_arg_type(gid_restriction, 'gid_restriction', int)
+        return super(ContextSpec, cls).__new__(
+            cls, cipher_type, mac_type, zip_type, realm, ttl, socket,
+            uid_restriction, gid_restriction)
+
+    @classmethod
+    def from_context(cls, ctx):
+        """Return the specification of the options of the `MungeContext`
+        `ctx`."""
+        return cls(ctx.cipher_type, ctx.mac_type, ctx.zip_type,
+                   ctx.realm, ctx.ttl, ctx.socket,
+                   ctx.uid_restriction, ctx.gid_restriction)
+
+    def apply_to(self, ctx):
+        """Set the options of the `MungeContext` `ctx` to this
+        specification."""
+        ctx.cipher_type = self.cipher_type
+        ctx.mac_type = self.mac_type
+        ctx.zip_type = self.zip_type
+        ctx.realm = self.realm
+        ctx.ttl = self.ttl
+        if self.socket is not None:
+            ctx.socket = self.socket
+        ctx.uid_restriction = self.uid_restriction
+        ctx.gid_restriction = self.gid_restriction
+
+    def create_context(self):
+        """Create a new `MungeContext` with the options of this
+        specification."""
+        ctx = MungeContext()
+        try:
+            self.apply_to(ctx)
+        except:
+            ctx.close()
+            raise
+        return ctx
+
+def _check_arg_type(arg, argname, argtype):
+    if not isinstance(arg, argtype):
+        raise TypeError("%s must be of type %s" %
+                        (argname, argtype.__name__))
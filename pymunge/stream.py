@@ -0,0 +1,417 @@
+#########################################################################
+# Module pymunge.stream - authenticated byte streams
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""This module authenticates byte streams of any size with a single
+credential. Instead of the stream itself, the payload of the credential
+holds the length of the stream and a digest of it (see `StreamDigest`),
+so that munged only encrypts a few dozen bytes, whatever the size of
+the stream, and the stream is hashed incrementally in constant memory.
+
+`encode_stream()` and `verify_stream()` create and check such a
+credential for a stream which is transferred separately.
+`StreamWriter` and `StreamReader` transfer the stream together with its
+credential over a file object (e.g. a file, a pipe or
+`socket.makefile()`), using the following framing:
+
+* Stream header: magic (b'PMST'), version (uint8), length of the name
+  of the hash algorithm (uint8), name of the hash algorithm (ASCII).
+* Any number of data frames: type 1 (uint8), length (uint32), data.
+* A trailer frame: type 2 (uint8), length (uint32), credential.
+
+All integers are in network byte order. The credential is sent after
+the data, since the digest is only known at the end; a `StreamReader`
+returns the data as it is received, and the data must be considered
+unauthenticated until the stream has been read to the end without an
+error."""
+
+from pymunge.error import MungeError, MungeErrorCode
+import pymunge.context
+import hashlib
+import hmac
+import struct
+
+#: Default hash algorithm (any algorithm supported by `hashlib.new()`
+#: can be used).
+DEFAULT_ALGORITHM = 'sha256'
+
+#: Default size of the chunks in which streams are read and written.
+DEFAULT_CHUNK_SIZE = 1 << 16
+
+STREAM_MAGIC = b'PMST'      #: Magic number at the start of a stream
+PAYLOAD_MAGIC = b'PMSD'     #: Magic number at the start of the payload
+VERSION = 1                 #: Version of the stream and payload format
+
+FRAME_DATA = 1              #: Type of data frames
+FRAME_TRAILER = 2           #: Type of the trailer frame
+
+_MAX_FRAME = 1 << 30
+# credentials are a few hundred bytes; longer trailers are rejected
+_MAX_TRAILER = 1 << 12
+_frame = struct.Struct('>BI')
+_u64 = struct.Struct('>Q')
+
+class StreamDigest(object):
+    """An incremental digest of a byte stream, which can be bound to a
+    MUNGE credential.
+
+    `update(data)` hashes the next part of the stream. `encode()` then
+    creates a credential whose payload holds the algorithm, the length
+    and the digest of the stream, and `verify(result)` checks that the
+    `DecodeResult` of such a credential matches the stream."""
+
+    def __init__(self, algorithm=DEFAULT_ALGORITHM):
+        if len(algorithm) > 255:
+            raise ValueError('Invalid hash algorithm %r' % (algorithm,))
+        self.algorithm = algorithm
+        self._hash = hashlib.new(algorithm)
+        self.length = 0
+
+    def update(self, data):
+        """Hash `data` (a bytes-like object), the next part of the
+        stream."""
+        view = memoryview(data)
+        self._hash.update(view)
+        self.length += view.nbytes
+
+    def digest(self):
+        """Return the digest of the stream hashed so far."""
+        return self._hash.digest()
+
+    def payload(self):
+        """Return the payload of a credential bound to the stream hashed
+        so far (see `pack_payload()`)."""
+        return pack_payload(self.algorithm, self.length, self.digest())
+
+    def encode(self, ctx=None):
+        """Create a credential bound to the stream hashed so far, using the
+        `MungeContext` `ctx` (or the default context, if None)."""
+        if ctx is None:
+            return pymunge.context.encode(self.payload())
+        return ctx.encode(self.payload())
+
+    def verify(self, result):
+        """Check that `result`, the `DecodeResult` of a credential, is
+        bound to the stream hashed so far. Raises a `MungeError` with the
+        code `EMUNGE_BAD_CRED` if the credential is not bound to a stream,
+        or `EMUNGE_CRED_INVALID` if it is bound to a different stream; its
+        `result` is set to `result`."""
+        algorithm, length, digest = unpack_payload(result.payload, result)
+        if algorithm != self.algorithm or length != self.length or \
+                not hmac.compare_digest(digest, self.digest()):
+            raise MungeError(MungeErrorCode.EMUNGE_CRED_INVALID,
+                             "Stream does not match the credential",
+                             result)
+
+def pack_payload(algorithm, length, digest):
+    """Return the payload of a credential bound to a stream of `length`
+    bytes with the given digest: magic (`PAYLOAD_MAGIC`), version
+    (uint8), length of the algorithm name (uint8), algorithm name
+    (ASCII), stream length (uint64), length of the digest (uint8),
+    digest."""
+    name = algorithm.encode('ascii')
+    return b''.join([PAYLOAD_MAGIC, bytearray([VERSION, len(name)]), name,
+                     _u64.pack(length), bytearray([len(digest)]), digest])
+
+def unpack_payload(payload, result=None):
+    """Return `(algorithm, length, digest)` from a payload created by
+    `pack_payload()`. Raises a `MungeError` with the code
+    `EMUNGE_BAD_CRED` (and the given `result`) if the payload is not
+    valid."""
+    try:
+        if payload[:4] != PAYLOAD_MAGIC or bytearray(payload[4:5]) != \
+                bytearray([VERSION]):
+            raise ValueError
+        end = 6 + bytearray(payload[5:6])[0]
+        algorithm = payload[6:end].decode('ascii')
+        length, = _u64.unpack(payload[end:end + 8])
+        digest = payload[end + 9:]
+        if len(digest) != bytearray(payload[end + 8:end + 9])[0]:
+            raise ValueError
+    except (ValueError, IndexError, struct.error):
+        raise MungeError(MungeErrorCode.EMUNGE_BAD_CRED,
+                         "Credential is not bound to a stream", result)
+    return algorithm, length, digest
+
+def encode_stream(fileobj, ctx=None, algorithm=DEFAULT_ALGORITHM,
+                  chunk_size=DEFAULT_CHUNK_SIZE):
+    """Read the binary file object `fileobj` to the end and return a
+    credential bound to its contents, created with the `MungeContext`
+    `ctx` (or the default context, if None)."""
+    digest = StreamDigest(algorithm)
+    _hash_file(digest, fileobj, chunk_size)
+    return digest.encode(ctx)
+
+def verify_stream(fileobj, cred, ctx=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Validate the credential `cred`, created by `encode_stream()`, and
+    check that it is bound to the contents of the binary file object
+    `fileobj`, which is read to the end. Returns the `DecodeResult` of
+    the credential, or raises a `MungeError` (see
+    `StreamDigest.verify()`)."""
+    result = _decode(cred, ctx)
+    algorithm = unpack_payload(result.payload, result)[0]
+    try:
+        digest = StreamDigest(algorithm)
+    except ValueError:
+        raise MungeError(MungeErrorCode.EMUNGE_BAD_CRED,
+                         "Unsupported hash algorithm %r" % algorithm,
+                         result)
+    _hash_file(digest, fileobj, chunk_size)
+    digest.verify(result)
+    return result
+
+class StreamWriter(object):
+    """Writes an authenticated stream to the binary file object `fileobj`
+    (see `pymunge.stream` for the format).
+
+    Data written with `write()` is hashed and sent in frames of up to
+    `chunk_size` bytes (smaller writes are buffered). `close()` sends
+    the credential, created with the `MungeContext` `ctx` (or the
+    default context, if None), and returns it. `fileobj` is not closed.
+
+    >>> with StreamWriter(sock.makefile('wb')) as writer:
+    >>>     for chunk in chunks:
+    >>>         writer.write(chunk)
+
+    If the 'with' block is left by an exception, the credential is not
+    sent, and the reader fails when it reaches the end of the stream.
+    """
+
+    def __init__(self, fileobj, ctx=None, algorithm=DEFAULT_ALGORITHM,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be at least 1')
+        self.digest = StreamDigest(algorithm)
+        self._fileobj = fileobj
+        self._ctx = ctx
+        self._chunk_size = min(chunk_size, _MAX_FRAME)
+        self._buffer = bytearray()
+        self._cred = None
+        self._closed = False
+        name = algorithm.encode('ascii')
+        fileobj.write(STREAM_MAGIC + bytearray([VERSION, len(name)]) + name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._closed = True
+
+    @property
+    def closed(self):
+        """True if this writer is closed, False otherwise."""
+        return self._closed
+
+    def write(self, data):
+        """Write `data` (a bytes-like object) to the stream. Returns the
+        number of bytes written."""
+        if self._closed:
+            raise ValueError('Stream is closed')
+        view = memoryview(data).cast('B')
+        written = len(view)
+        self.digest.update(view)
+        buffer = self._buffer
+        chunk_size = self._chunk_size
+        if len(buffer) + written < chunk_size:
+            buffer += view
+            return written
+        if buffer:
+            taken = chunk_size - len(buffer)
+            buffer += view[:taken]
+            view = view[taken:]
+            self._write_frame(FRAME_DATA, buffer)
+            del buffer[:]
+        while len(view) >= chunk_size:
+            self._write_frame(FRAME_DATA, view[:chunk_size])
+            view = view[chunk_size:]
+        buffer += view
+        return written
+
+    def flush(self):
+        """Send the buffered data and flush `fileobj`."""
+        if self._buffer:
+            self._write_frame(FRAME_DATA, self._buffer)
+            del self._buffer[:]
+        if hasattr(self._fileobj, 'flush'):
+            self._fileobj.flush()
+
+    def close(self):
+        """Send the remaining data and the credential, and return the
+        credential. Calling `close()` on an already closed writer has no
+        effect (and returns the credential, if it was sent)."""
+        if not self._closed:
+            if self._buffer:
+                self._write_frame(FRAME_DATA, self._buffer)
+                del self._buffer[:]
+            self._cred = self.digest.encode(self._ctx)
+            self._write_frame(FRAME_TRAILER, self._cred)
+            self._closed = True
+            if hasattr(self._fileobj, 'flush'):
+                self._fileobj.flush()
+        return self._cred
+
+    def _write_frame(self, frame_type, data):
+        self._fileobj.write(_frame.pack(frame_type, len(data)))
+        self._fileobj.write(data)
+
+class StreamReader(object):
+    """Reads an authenticated stream written by a `StreamWriter` from the
+    binary file object `fileobj`, verifying it as it is consumed.
+
+    `read()` returns the data of the stream; when it reaches the end of
+    the stream, the credential is decoded with the `MungeContext` `ctx`
+    (or the default context, if None) and checked against the data read,
+    and a `MungeError` is raised if it does not match (see
+    `StreamDigest.verify()`) or if the stream is malformed or truncated.
+    Only when `read()` has returned b'' (after which `result` holds the
+    `DecodeResult` of the credential) has the data been authenticated.
+    Frame lengths are taken from the unauthenticated stream, so data is
+    read from `fileobj` in chunks of at most `DEFAULT_CHUNK_SIZE` bytes,
+    and oversized frames are rejected with `EMUNGE_BAD_CRED`.
+
+    >>> reader = StreamReader(sock.makefile('rb'))
+    >>> for chunk in reader:
+    >>>     process(chunk)
+    >>> uid = reader.result.uid
+    """
+
+    def __init__(self, fileobj, ctx=None):
+        self._fileobj = fileobj
+        self._ctx = ctx
+        self.digest = None
+        self._frame_left = 0
+        self._result = None
+
+    def __iter__(self):
+        while True:
+            data = self.read(DEFAULT_CHUNK_SIZE)
+            if not data:
+                return
+            yield data
+
+    @property
+    def result(self):
+        """The `DecodeResult` of the credential once the whole stream has
+        been read and verified, None before."""
+        return self._result
+
+    def read(self, size=-1):
+        """Read up to `size` bytes (or the rest of the stream, if `size` is
+        negative, which holds all of it in memory; iterate over the
+        reader to process large streams). Fewer bytes may be returned at
+        the end of a frame. Returns b'' once the end of the stream has
+        been reached and the stream has been verified."""
+        if self._result is not None:
+            return b''
+        if self.digest is None:
+            self._read_header()
+        parts = []
+        while size != 0:
+            if self._frame_left == 0:
+                if parts and size > 0:
+                    break
+                frame_type, length = _frame.unpack(
+                    self._read_exactly(_frame.size))
+                if frame_type == FRAME_TRAILER:
+                    if length > _MAX_TRAILER:
+                        raise MungeError(MungeErrorCode.EMUNGE_BAD_CRED,
+                                         "Stream trailer of %d bytes is "
+                                         "too long" % length)
+                    self._finish(self._read_exactly(length))
+                    break
+                if frame_type != FRAME_DATA:
+                    raise MungeError(MungeErrorCode.EMUNGE_BAD_CRED,
+                                     "Invalid stream frame type %d" %
+                                     frame_type)
+                if length > _MAX_FRAME:
+                    raise MungeError(MungeErrorCode.EMUNGE_BAD_CRED,
+                                     "Stream frame of %d bytes is too "
+                                     "long" % length)
+                self._frame_left = length
+                continue
+            # never trust the frame length for the size of a single read
+            count = min(self._frame_left, DEFAULT_CHUNK_SIZE)
+            if size > 0:
+                count = min(count, size)
+            data = self._read_exactly(count)
+            self.digest.update(data)
+            self._frame_left -= count
+            parts.append(data)
+            if size > 0:
+                size -= count
+        return b''.join(parts)
+
+    def _read_header(self):
+        header = self._read_exactly(6)
+        if header[:4] != STREAM_MAGIC or bytearray(header[4:5]) != \
+                bytearray([VERSION]):
+            raise MungeError(MungeErrorCode.EMUNGE_BAD_CRED,
+                             "Not an authenticated stream")
+        name = self._read_exactly(bytearray(header[5:6])[0])
+        try:
+            self.digest = StreamDigest(name.decode('ascii'))
+        except (ValueError, UnicodeDecodeError):
+            raise MungeError(MungeErrorCode.EMUNGE_BAD_CRED,
+                             "Unsupported hash algorithm %r" % name)
+
+    def _read_exactly(self, length):
+        data = self._fileobj.read(length)
+        if len(data) < length:
+            parts = [data]
+            length -= len(data)
+            while length > 0 and data:
+                data = self._fileobj.read(length)
+                parts.append(data)
+                length -= len(data)
+            if length > 0:
+                raise MungeError(MungeErrorCode.EMUNGE_BAD_LENGTH,
+                                 "Stream is truncated")
+            data = b''.join(parts)
+        return data
+
+    def _finish(self, cred):
+        result = _decode(cred, self._ctx)
+        self.digest.verify(result)
+        self._result = result
+
+def _decode(cred, ctx):
+    if ctx is None:
+        return pymunge.context.decode(cred, True)
+    return ctx.decode(cred, True)
+
+def _hash_file(digest, fileobj, chunk_size):
+    readinto = getattr(fileobj, 'readinto', None)
+    if readinto is None:
+        while True:
+            data = fileobj.read(chunk_size)
+            if not data:
+                return
+            digest.update(data)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    while True:
+        count = readinto(buffer)
+        if not count:
+            return
+        digest.update(view[:count])
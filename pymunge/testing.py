@@ -0,0 +1,495 @@
+#########################################################################
+# Module pymunge.testing - stand-in munged for tests
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""This module provides `FakeMungeDaemon`, a stand-in for munged which
+listens on a Unix domain socket and answers encode and decode requests
+in the protocol of `pymunge.wire`, so that libmunge (and thus every
+pymunge backend) can talk to it. It allows tests and benchmarks to run
+without a munged installation, shared key or root privileges, and can
+inject latency and errors.
+
+Credentials created by a `FakeMungeDaemon` are authenticated with a
+random key of the daemon, but are not encrypted; they must only be used
+for testing.
+
+For pytest, the `fake_munged` fixture starts a daemon and points all
+`MungeContext` objects created during the test at it (see
+`FakeMungeDaemon.install()`). Make it available with
+`pytest_plugins = ['pymunge.testing']` in a conftest.py."""
+
+from pymunge.enums import CipherType, MACType, ZipType, UID_ANY, GID_ANY
+from pymunge.error import MungeErrorCode
+from pymunge.raw import MUNGE_OPT_SOCKET
+import pymunge.backend
+import pymunge.pool
+import pymunge.wire as wire
+import base64
+import collections
+import ctypes
+import hashlib
+import heapq
+import hmac
+import os
+import queue
+import random
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+#: Default TTL of the daemon, in seconds (as in munged).
+DEFAULT_TTL = 300
+
+#: Maximum TTL of the daemon, in seconds (as in munged).
+MAX_TTL = 3600
+
+#: Cipher type used for `CipherType.Default` (as in munged).
+DEFAULT_CIPHER = CipherType.AES128
+
+#: MAC type used for `MACType.Default` (as in munged).
+DEFAULT_MAC = MACType.SHA256
+
+#: Compression type used for `ZipType.Default` (as in munged).
+DEFAULT_ZIP = ZipType.Disabled
+
+#: Errors which can be injected into responses (see `FakeMungeDaemon`).
+#: `EMUNGE_SOCKET` closes the connection without a response and
+#: `EMUNGE_TIMEOUT` keeps it open without a response; the other errors
+#: are sent as error responses, the credential errors with the decoded
+#: payload and metadata.
+INJECTABLE_ERRORS = frozenset([
+    MungeErrorCode.EMUNGE_SNAFU, MungeErrorCode.EMUNGE_SOCKET,
+    MungeErrorCode.EMUNGE_TIMEOUT, MungeErrorCode.EMUNGE_NO_MEMORY,
+    MungeErrorCode.EMUNGE_CRED_INVALID, MungeErrorCode.EMUNGE_CRED_EXPIRED,
+    MungeErrorCode.EMUNGE_CRED_REWOUND, MungeErrorCode.EMUNGE_CRED_REPLAYED,
+    MungeErrorCode.EMUNGE_CRED_UNAUTHORIZED])
+
+#: Statistics of a `FakeMungeDaemon`, as returned by
+#: `FakeMungeDaemon.stats()`:
+#:
+#: * `encodes`: encode requests answered
+#: * `decodes`: decode requests answered
+#: * `injected`: errors injected, by `MungeErrorCode`
+#: * `connections`: connections accepted
+DaemonStats = collections.namedtuple('DaemonStats', [
+    'encodes', 'decodes', 'injected', 'connections'])
+
+# cipher, mac, zip, realm length, ttl, uid, gid, uid and gid restriction,
+# encode time
+_cred_header = struct.Struct('>BBBBiIIIIq')
+_MAC_SIZE = 16
+_CRED_PREFIX = b'MUNGE:'
+_CRED_SUFFIX = b':'
+
+# decode errors for which munged returns the payload and metadata
+_RESULT_ERRORS = frozenset([MungeErrorCode.EMUNGE_CRED_EXPIRED,
+                            MungeErrorCode.EMUNGE_CRED_REWOUND,
+                            MungeErrorCode.EMUNGE_CRED_REPLAYED])
+
+
+class FakeMungeDaemon(object):
+    """A stand-in for munged, serving requests on a Unix domain socket.
+
+    `FakeMungeDaemon(socket_path, workers, latency, error_rates, seed)`
+    creates a daemon listening on `socket_path` (a socket in a new
+    temporary directory, if None) once it is started with `start()` or a
+    'with' statement:
+
+    >>> with FakeMungeDaemon() as daemon:
+    >>>     with MungeContext() as ctx:
+    >>>         ctx.socket = daemon.socket_path
+    >>>         cred = ctx.encode(b'payload')
+
+    Requests are served by `workers` threads, so at most `workers`
+    requests are processed at the same time. Each response is delayed by
+    `latency` seconds (a number, or a callable returning the number of
+    seconds for each request). `error_rates` maps error codes (see
+    `INJECTABLE_ERRORS`) to the probability with which a request fails
+    with that error; credential errors only apply to decode requests.
+    `seed` seeds the random numbers used to inject errors. `latency` and
+    `error_rates` can also be changed while the daemon is running.
+
+    Like munged, the daemon rejects expired, rewound (by more than
+    `clock_skew` seconds) and replayed credentials, as well as decodes
+    by processes other than the UID/GID restriction of the credential
+    (on platforms where the peer of a Unix socket can be determined).
+    As in munged, decoded credentials are only remembered until they
+    expire, so that the memory used stays bounded in long load tests.
+    Credentials are not encrypted."""
+
+    def __init__(self, socket_path=None, workers=4, latency=0,
+                 error_rates=None, seed=None, clock_skew=60):
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        self._tempdir = None
+        if socket_path is None:
+            self._tempdir = tempfile.mkdtemp(prefix='pymunge-')
+            socket_path = os.path.join(self._tempdir, 'munge.socket.2')
+        self.socket_path = socket_path
+        self.workers = workers
+        self.latency = latency
+        self.error_rates = dict(error_rates or {})
+        for code in self.error_rates:
+            if MungeErrorCode(code) not in INJECTABLE_ERRORS:
+                raise ValueError('Cannot inject error %s' %
+                                 MungeErrorCode(code).name)
+        self.clock_skew = clock_skew
+        self._random = random.Random(seed)
+        self._key = os.urandom(32)
+        self._lock = threading.Lock()
+        # digests of decoded credentials, and a heap of (expiry time,
+        # digest) from which expired credentials are pruned
+        self._decoded = set()
+        self._expiries = []
+        self._connections = queue.Queue()
+        self._threads = []
+        self._listener = None
+        self._stopping = False
+        self._encodes = self._decodes = self._accepted = 0
+        self._injected = collections.Counter()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def running(self):
+        """True if the daemon has been started and not yet stopped."""
+        return self._listener is not None
+
+    def start(self):
+        """Start listening on the socket and serving requests."""
+        if self._listener is not None:
+            return
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        listener.listen(128)
+        self._listener = listener
+        self._stopping = False
+        self._threads = [threading.Thread(target=self._accept_loop)]
+        self._threads += [threading.Thread(target=self._worker_loop)
+                          for i in range(self.workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """Stop serving requests and remove the socket (and the temporary
+        directory created for it, if any)."""
+        listener = self._listener
+        if listener is None:
+            return
+        self._stopping = True
+        # wake up the accept loop
+        try:
+            waker = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            waker.connect(self.socket_path)
+            waker.close()
+        except (socket.error, OSError):
+            pass
+        for i in range(self.workers):
+            self._connections.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        listener.close()
+        self._listener = None
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        if self._tempdir is not None:
+            shutil.rmtree(self._tempdir, ignore_errors=True)
+
+    def stats(self):
+        """Return the statistics of this daemon as a `DaemonStats`."""
+        with self._lock:
+            return DaemonStats(self._encodes, self._decodes,
+                               dict(self._injected), self._accepted)
+
+    def install(self):
+        """Return a context manager which makes this daemon the default
+        socket of all `MungeContext` objects created within its 'with'
+        block (as if munged listened on `socket_path`), and replaces the
+        default `MungeContextPool` (used by `pymunge.encode()` etc.) by a
+        pool of such contexts. Copies of contexts keep their socket."""
+        return _Installation(self.socket_path)
+
+    def _accept_loop(self):
+        listener = self._listener
+        while True:
+            try:
+                connection, address = listener.accept()
+            except (socket.error, OSError):
+                if self._stopping:
+                    return
+                continue
+            if self._stopping:
+                connection.close()
+                return
+            with self._lock:
+                self._accepted += 1
+            self._connections.put(connection)
+
+    def _worker_loop(self):
+        while True:
+            connection = self._connections.get()
+            if connection is None:
+                return
+            try:
+                self._serve(connection)
+            except (socket.error, OSError, EOFError):
+                pass
+            finally:
+                connection.close()
+
+    def _serve(self, connection):
+        header = _recv_exactly(connection, wire.HEADER_SIZE)
+        msg_type, retry, length = wire.unpack_header(header)
+        body = _recv_exactly(connection, length)
+        uid, gid = _peer_ids(connection)
+
+        latency = self.latency
+        if callable(latency):
+            latency = latency()
+        if latency > 0:
+            time.sleep(latency)
+
+        injected = self._inject(msg_type == wire.MSG_DEC_REQ)
+        if injected == MungeErrorCode.EMUNGE_SOCKET:
+            return
+        if injected == MungeErrorCode.EMUNGE_TIMEOUT:
+            # hold the connection until the client gives up
+            connection.settimeout(0.1)
+            while not self._stopping:
+                try:
+                    if not connection.recv(1):
+                        break
+                except socket.timeout:
+                    pass
+            return
+
+        if msg_type == wire.MSG_ENC_REQ:
+            response = self._encode(wire.unpack_encode_request(body), uid,
+                                    gid, injected)
+            with self._lock:
+                self._encodes += 1
+        elif msg_type == wire.MSG_DEC_REQ:
+            response = wire.pack_decode_response(self._decode(
+                wire.unpack_decode_request(body), uid, gid, injected))
+            with self._lock:
+                self._decodes += 1
+        else:
+            return
+        connection.sendall(response)
+
+    def _inject(self, decode):
+        """Return the error to inject into a request, or None."""
+        if not self.error_rates:
+            return None
+        with self._lock:
+            value = self._random.random()
+            rates = sorted((MungeErrorCode(code).value, rate)
+                           for code, rate in self.error_rates.items())
+            for code, rate in rates:
+                code = MungeErrorCode(code)
+                if code.name.startswith('EMUNGE_CRED_') and not decode:
+                    continue
+                if value < rate:
+                    self._injected[code] += 1
+                    return code
+                value -= rate
+        return None
+
+    def _encode(self, request, uid, gid, injected):
+        if injected is not None:
+            return wire.pack_encode_response(injected.value)
+        ttl = request.ttl
+        if ttl == 0:
+            ttl = DEFAULT_TTL
+        elif ttl < 0 or ttl > MAX_TTL:
+            ttl = MAX_TTL
+        realm = (request.realm or '').encode('utf-8')
+        data = _cred_header.pack(
+            _resolve(request.cipher_type, CipherType.Default, DEFAULT_CIPHER),
+            _resolve(request.mac_type, MACType.Default, DEFAULT_MAC),
+            _resolve(request.zip_type, ZipType.Default, DEFAULT_ZIP),
+            len(realm), ttl, uid, gid,
+            request.uid_restriction & 0xffffffff,
+            request.gid_restriction & 0xffffffff,
+            int(time.time())) + realm + os.urandom(8) + request.payload
+        mac = hmac.new(self._key, data, hashlib.sha256).digest()[:_MAC_SIZE]
+        cred = _CRED_PREFIX + base64.b64encode(data + mac) + _CRED_SUFFIX
+        return wire.pack_encode_response(0, None, cred)
+
+    def _decode(self, cred, uid, gid, injected):
+        try:
+            if not (cred.startswith(_CRED_PREFIX) and
+                    cred.endswith(_CRED_SUFFIX)):
+                raise ValueError
+            data = base64.b64decode(
+                cred[len(_CRED_PREFIX):-len(_CRED_SUFFIX)])
+            if len(data) < _cred_header.size + _MAC_SIZE:
+                raise ValueError
+        except (ValueError, TypeError):
+            return _error_response(MungeErrorCode.EMUNGE_BAD_CRED)
+        data, mac = data[:-_MAC_SIZE], data[-_MAC_SIZE:]
+        expected = hmac.new(self._key, data, hashlib.sha256).digest()
+        if not hmac.compare_digest(mac, expected[:_MAC_SIZE]):
+            return _error_response(MungeErrorCode.EMUNGE_CRED_INVALID)
+        cipher_type, mac_type, zip_type, realm_length, ttl, cred_uid, \
+            cred_gid, uid_restriction, gid_restriction, encode_time = \
+            _cred_header.unpack_from(data)
+        start = _cred_header.size
+        realm = data[start:start + realm_length].decode('utf-8') or None
+        payload = data[start + realm_length + 8:]
+
+        now = int(time.time())
+        error = injected
+        if error is None:
+            if uid_restriction != 0xffffffff and uid_restriction != uid or \
+                    gid_restriction != 0xffffffff and gid_restriction != gid:
+                error = MungeErrorCode.EMUNGE_CRED_UNAUTHORIZED
+            elif encode_time > now + self.clock_skew:
+                error = MungeErrorCode.EMUNGE_CRED_REWOUND
+            elif encode_time + ttl < now:
+                error = MungeErrorCode.EMUNGE_CRED_EXPIRED
+            else:
+                digest = hashlib.sha256(cred).digest()
+                with self._lock:
+                    if digest in self._decoded:
+                        error = MungeErrorCode.EMUNGE_CRED_REPLAYED
+                    else:
+                        self._remember(digest, encode_time + ttl, now)
+        if error is not None and error not in _RESULT_ERRORS:
+            return _error_response(error)
+        return wire.DecodeResponse(
+            error.value if error is not None else 0, None, cipher_type,
+            mac_type, zip_type, realm, ttl, '127.0.0.1',
+            encode_time, now, cred_uid, cred_gid,
+            UID_ANY if uid_restriction == 0xffffffff else uid_restriction,
+            GID_ANY if gid_restriction == 0xffffffff else gid_restriction,
+            payload)
+
+    def _remember(self, digest, expiry, now):
+        """pymunge internal - add digest to the decoded credentials, and
+        forget the credentials which have expired (and would be rejected
+        as such); must be called with the lock held"""
+        expiries = self._expiries
+        while expiries and expiries[0][0] < now:
+            self._decoded.discard(heapq.heappop(expiries)[1])
+        self._decoded.add(digest)
+        heapq.heappush(expiries, (expiry, digest))
+
+class _Installation(object):
+    """pymunge internal - the context manager returned by
+    `FakeMungeDaemon.install()`. It wraps `ctx_create()` of the available
+    backends, so that new native contexts (including those created by
+    `MungeContextPool`) have the socket of the daemon as their default."""
+
+    def __init__(self, socket_path):
+        self._socket_path = socket_path.encode('utf-8')
+        self._saved = None
+
+    def __enter__(self):
+        saved = []
+        for name in pymunge.backend.available_backends():
+            backend = pymunge.backend.get_backend(name)
+            saved.append((backend, backend.__dict__.get('ctx_create')))
+            backend.ctx_create = self._wrap(backend)
+        self._saved = (saved, pymunge.pool._default_pool)
+        pymunge.pool._default_pool = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        saved, pool = self._saved
+        for backend, ctx_create in saved:
+            if ctx_create is None:
+                del backend.ctx_create
+            else:
+                backend.ctx_create = ctx_create
+        installed = pymunge.pool._default_pool
+        pymunge.pool._default_pool = pool
+        if installed is not None:
+            installed.clear()
+
+    def _wrap(self, backend):
+        ctx_create = backend.ctx_create
+        buffers = backend.new_buffers()
+        socket_path = self._socket_path
+
+        def create():
+            handle = ctx_create()
+            try:
+                backend.set_option(buffers, handle, MUNGE_OPT_SOCKET,
+                                   ctypes.c_char_p, socket_path)
+            except:
+                backend.ctx_destroy(handle)
+                raise
+            return handle
+        return create
+
+def _resolve(value, default, resolved):
+    return resolved.value if value == default.value else value
+
+def _recv_exactly(connection, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = connection.recv(length - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return bytes(data)
+
+def _peer_ids(connection):
+    """Return the UID and GID of the peer of a Unix domain socket, or
+    those of this process if they cannot be determined."""
+    if hasattr(socket, 'SO_PEERCRED'):
+        data = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                     struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', data)
+        return uid, gid
+    return os.getuid(), os.getgid()
+
+def _error_response(code):
+    # without a message, libmunge reports the message of the error code
+    return wire.DecodeResponse(code.value, None, 0, 0, 0, None, 0,
+                               '0.0.0.0', 0, 0, 0, 0, UID_ANY, GID_ANY, b'')
+
+try:
+    import pytest
+except ImportError:
+    pytest = None
+
+if pytest is not None:
+    @pytest.fixture
+    def fake_munged():
+        """A running `FakeMungeDaemon`, installed for the duration of the
+        test (see `FakeMungeDaemon.install()`)."""
+        with FakeMungeDaemon() as daemon:
+            with daemon.install():
+                yield daemon
@@ -0,0 +1,365 @@
+#########################################################################
+# Module pymunge.tune - selection of cipher, MAC and zip types
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""This module chooses the cipher, MAC and compression types of
+credentials from measurements instead of guesses. Their costs depend on
+how munged was built and on the hardware, so `benchmark()` measures the
+encode and decode latency and the credential length of each combination
+of types available in libmunge (see `available_types()`), for a range
+of payload sizes, and returns a `TuningProfile`.
+
+A profile can be saved to and loaded from a JSON file. For each payload
+size, `TuningProfile.spec_for()` returns a `ContextSpec` with the
+fastest combination accepted by a `Policy` (e.g. one requiring a
+minimum MAC strength), and `TuningProfile.encode()` encodes a payload
+with it. `auto_profile()` loads the profile saved for the local munged,
+benchmarking it first if there is none:
+
+>>> profile = pymunge.tune.auto_profile()
+>>> cred = profile.encode(payload)
+"""
+
+from pymunge.enums import CipherType, MACType, ZipType
+from pymunge.error import MungeError
+from pymunge.spec import ContextSpec
+import pymunge.pool
+import pymunge.raw
+import binascii
+import collections
+import json
+import os
+import socket
+import time
+
+#: Payload sizes (in bytes) measured by default.
+DEFAULT_SIZES = (0, 64, 1024, 16384, 262144)
+
+#: Version of the JSON format of saved profiles.
+FORMAT_VERSION = 1
+
+#: Strength of the MAC types, for `Policy.min_mac`.
+MAC_STRENGTH = {
+    MACType.MD5: 1,
+    MACType.SHA1: 2,
+    MACType.RIPEMD160: 2,
+    MACType.SHA256: 3,
+    MACType.SHA512: 4,
+}
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+#: The measurements of one combination of types for one payload size:
+#: the median `encode_time` and `decode_time` in seconds and the length
+#: of the credential in bytes.
+Measurement = collections.namedtuple('Measurement', [
+    'cipher_type', 'mac_type', 'zip_type', 'size', 'encode_time',
+    'decode_time', 'cred_length'])
+
+def available_types():
+    """Return a dict mapping 'cipher_type', 'mac_type' and 'zip_type' to
+    the lists of the `CipherType`, `MACType` and `ZipType` values
+    supported by libmunge (as reported by `munge_enum_is_valid()`),
+    except for the 'Default' values."""
+    raw = pymunge.raw
+    types = {}
+    for name, enum_type, enum_class in (
+            ('cipher_type', raw.MUNGE_ENUM_CIPHER, CipherType),
+            ('mac_type', raw.MUNGE_ENUM_MAC, MACType),
+            ('zip_type', raw.MUNGE_ENUM_ZIP, ZipType)):
+        types[name] = [member for member in enum_class
+                       if member.name != 'Default' and
+                       raw.munge_enum_is_valid(enum_type, member.value)]
+    return types
+
+class Policy(object):
+    """The combinations of types a `TuningProfile` may choose from.
+
+    `ciphers`, `macs` and `zips` restrict the types to the given values
+    (None allows all). Unencrypted credentials (`CipherType.Disabled`)
+    are only chosen if `encrypt` is False, and only MAC types with at
+    least the `MAC_STRENGTH` of `min_mac` (a `MACType` other than Default
+    and Disabled, by default `MACType.SHA256`, or None to allow all) are
+    chosen. Credentials longer than `max_cred_length` bytes (if not
+    None) are not chosen.
+
+    Among the remaining combinations, the one with the lowest
+    `objective` is chosen: 'encode' (encode time), 'decode' (decode
+    time), 'total' (the sum of both, the default) or 'length'
+    (credential length)."""
+
+    def __init__(self, ciphers=None, macs=None, zips=None,
+                 min_mac=MACType.SHA256, encrypt=True, max_cred_length=None,
+                 objective='total'):
+        if objective not in _OBJECTIVES:
+            raise ValueError('Invalid objective %r' % (objective,))
+        if min_mac is not None and min_mac not in MAC_STRENGTH:
+            raise ValueError('Invalid min_mac %r' % (min_mac,))
+        self.ciphers = None if ciphers is None else frozenset(ciphers)
+        self.macs = None if macs is None else frozenset(macs)
+        self.zips = None if zips is None else frozenset(zips)
+        self.min_mac = min_mac
+        self.encrypt = encrypt
+        self.max_cred_length = max_cred_length
+        self.objective = objective
+
+    def accepts(self, measurement):
+        """Return True if the combination of types of the `Measurement`
+        `measurement` is acceptable."""
+        if self.ciphers is not None and \
+                measurement.cipher_type not in self.ciphers:
+            return False
+        if self.macs is not None and measurement.mac_type not in self.macs:
+            return False
+        if self.zips is not None and measurement.zip_type not in self.zips:
+            return False
+        if self.encrypt and measurement.cipher_type == CipherType.Disabled:
+            return False
+        if self.min_mac is not None and \
+                MAC_STRENGTH.get(measurement.mac_type, 0) < \
+                MAC_STRENGTH[self.min_mac]:
+            return False
+        if self.max_cred_length is not None and \
+                measurement.cred_length > self.max_cred_length:
+            return False
+        return True
+
+    def cost(self, measurement):
+        """Return the cost of `measurement` according to the objective."""
+        return _OBJECTIVES[self.objective](measurement)
+
+_OBJECTIVES = {
+    'encode': lambda m: m.encode_time,
+    'decode': lambda m: m.decode_time,
+    'total': lambda m: m.encode_time + m.decode_time,
+    'length': lambda m: (m.cred_length, m.encode_time + m.decode_time),
+}
+
+class TuningProfile(object):
+    """The `Measurement`s of a `benchmark()` run, and the `Policy` used to
+    choose from them.
+
+    `environment` is a dict describing where the measurements were taken
+    (the host name, the munged socket and the time)."""
+
+    def __init__(self, measurements, environment=None, policy=None):
+        self.measurements = list(measurements)
+        self.environment = dict(environment or {})
+        self.policy = policy if policy is not None else Policy()
+        self._choices = {}
+
+    @property
+    def sizes(self):
+        """The sorted payload sizes of the measurements."""
+        return sorted(set(m.size for m in self.measurements))
+
+    def with_policy(self, policy):
+        """Return a profile with the same measurements and `policy`."""
+        return TuningProfile(self.measurements, self.environment, policy)
+
+    def best(self, size):
+        """Return the `Measurement` of the fastest acceptable combination
+        (see `Policy`) for payloads of `size` bytes, measured at the
+        smallest measured size not below `size` (or the largest measured
+        size). Raises ValueError if no combination is acceptable."""
+        sizes = self.sizes
+        if not sizes:
+            raise ValueError('Profile has no measurements')
+        bucket = next((s for s in sizes if s >= size), sizes[-1])
+        choice = self._choices.get(bucket)
+        if choice is None:
+            policy = self.policy
+            candidates = [m for m in self.measurements
+                          if m.size == bucket and policy.accepts(m)]
+            if not candidates:
+                raise ValueError('No combination of types is acceptable')
+            choice = self._choices[bucket] = min(candidates,
+                                                 key=policy.cost)
+        return choice
+
+    def spec_for(self, size, spec=None):
+        """Return the `ContextSpec` `spec` (default options, if None) with
+        the cipher, MAC and zip type chosen for payloads of `size`
+        bytes."""
+        best = self.best(size)
+        if spec is None:
+            spec = ContextSpec()
+        return spec._replace(cipher_type=best.cipher_type,
+                             mac_type=best.mac_type, zip_type=best.zip_type)
+
+    def encode(self, payload=None, spec=None):
+        """Create a credential for `payload` with the options of `spec`
+        and the types chosen for the size of `payload`, using a context
+        of the default `pymunge.pool.MungeContextPool`."""
+        size = len(payload) if payload is not None else 0
+        with pymunge.pool.default_pool().acquire(
+                self.spec_for(size, spec)) as ctx:
+            return ctx.encode(payload)
+
+    def to_dict(self):
+        """Return the profile (without the policy) as a JSON-compatible
+        dict."""
+        return {
+            'version': FORMAT_VERSION,
+            'environment': self.environment,
+            'measurements': [
+                [m.cipher_type.name, m.mac_type.name, m.zip_type.name,
+                 m.size, m.encode_time, m.decode_time, m.cred_length]
+                for m in self.measurements],
+        }
+
+    @classmethod
+    def from_dict(cls, data, policy=None):
+        """Return the profile stored in `data`, a dict returned by
+        `to_dict()`."""
+        if data.get('version') != FORMAT_VERSION:
+            raise ValueError('Unsupported profile version %r' %
+                             (data.get('version'),))
+        measurements = [
+            Measurement(CipherType[cipher], MACType[mac], ZipType[zip_type],
+                        size, encode_time, decode_time, cred_length)
+            for cipher, mac, zip_type, size, encode_time, decode_time,
+            cred_length in data['measurements']]
+        return cls(measurements, data.get('environment'), policy)
+
+    def save(self, path):
+        """Save the profile to the JSON file `path`."""
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1, sort_keys=True)
+        os.rename(temporary, path)
+
+    @classmethod
+    def load(cls, path, policy=None):
+        """Load a profile saved by `save()` from the JSON file `path`."""
+        with open(path) as f:
+            return cls.from_dict(json.load(f), policy)
+
+def benchmark(sizes=DEFAULT_SIZES, samples=5, types=None, spec=None,
+              make_payload=None):
+    """Measure each combination of the types in `types` (a dict like the
+    one returned by `available_types()`, which is the default) for each
+    payload size in `sizes`, and return a `TuningProfile`.
+
+    For each combination and size, `samples` credentials are encoded and
+    decoded with the options of `spec` (a `ContextSpec`; default options
+    if None) and the median times are recorded. Payloads are created by
+    `make_payload(size)`; by default, they are text-like (hexadecimal
+    digits of random bytes), so that compression has an effect.
+    Combinations which munged rejects are skipped."""
+    if types is None:
+        types = available_types()
+    if spec is None:
+        spec = ContextSpec()
+    if make_payload is None:
+        make_payload = _text_payload
+    pool = pymunge.pool.MungeContextPool()
+    measurements = []
+    try:
+        for cipher_type in types['cipher_type']:
+            for mac_type in types['mac_type']:
+                for zip_type in types['zip_type']:
+                    combination = spec._replace(cipher_type=cipher_type,
+                                                mac_type=mac_type,
+                                                zip_type=zip_type)
+                    for size in sizes:
+                        measurement = _measure(pool, combination, size,
+                                               samples, make_payload)
+                        if measurement is not None:
+                            measurements.append(measurement)
+    finally:
+        pool.clear()
+    environment = {
+        'host': socket.gethostname(),
+        'socket': pool._normalize(spec).socket,
+        'sizes': sorted(sizes),
+        'time': int(time.time()),
+    }
+    return TuningProfile(measurements, environment)
+
+def default_path():
+    """Return the path where `auto_profile()` saves profiles: the file
+    'pymunge/tune.json' in the directory given by the XDG_CACHE_HOME
+    environment variable, or in ~/.cache."""
+    cache = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache, 'pymunge', 'tune.json')
+
+def auto_profile(path=None, policy=None, **kwargs):
+    """Return the `TuningProfile` saved at `path` (`default_path()` if
+    None) with `policy`, if it was measured on this host with the munged
+    socket and payload sizes that `benchmark(**kwargs)` would use.
+    Otherwise, run `benchmark(**kwargs)` and save its profile to `path`
+    first."""
+    if path is None:
+        path = default_path()
+    if 'sizes' in kwargs:
+        kwargs['sizes'] = tuple(kwargs['sizes'])
+    environment = {
+        'host': socket.gethostname(),
+        'socket': pymunge.pool.default_pool()._normalize(
+            kwargs.get('spec')).socket,
+        'sizes': sorted(kwargs.get('sizes', DEFAULT_SIZES)),
+    }
+    try:
+        profile = TuningProfile.load(path, policy)
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        profile = None
+    if profile is None or any(profile.environment.get(key) != value
+                              for key, value in environment.items()):
+        profile = benchmark(**kwargs).with_policy(policy)
+        profile.save(path)
+    return profile
+
+def _measure(pool, spec, size, samples, make_payload):
+    """pymunge internal - return the `Measurement` of spec for payloads of
+    size bytes, or None if munged rejects the combination of types"""
+    encode_times = []
+    decode_times = []
+    cred_length = 0
+    try:
+        with pool.acquire(spec) as ctx:
+            for i in range(samples):
+                payload = make_payload(size)
+                start = _clock()
+                cred = ctx.encode(payload)
+                encode_times.append(_clock() - start)
+                cred_length = len(cred)
+                start = _clock()
+                ctx.decode(cred)
+                decode_times.append(_clock() - start)
+    except MungeError:
+        return None
+    return Measurement(spec.cipher_type, spec.mac_type, spec.zip_type,
+                       size, _median(encode_times), _median(decode_times),
+                       cred_length)
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def _text_payload(size):
+    if not size:
+        return None
+    return binascii.hexlify(os.urandom((size + 1) // 2))[:size]
@@ -0,0 +1,299 @@
+#########################################################################
+# Module pymunge.wire - the munged socket protocol
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""This module implements the messages of the local socket protocol
+spoken between libmunge and munged (protocol version 4, as used by
+MUNGE 0.5.x).
+
+libmunge opens one connection to the munged socket per request, sends
+a request message, reads the response message and closes the
+connection. Each message consists of a header followed by a body:
+
+* Header: magic (uint32), version (uint8), message type (uint8),
+  retry count (uint8), body length (uint32).
+* Encode request body: cipher, MAC and zip type (uint8 each), realm
+  length (uint8), realm, TTL (uint32), UID and GID restriction
+  (uint32 each), payload length (uint32), payload.
+* Encode response body: error code (uint8), error message length
+  (uint8), error message, credential length (uint32), credential.
+* Decode request body: credential length (uint32), credential.
+* Decode response body: error code (uint8), error message length
+  (uint8), error message, cipher, MAC and zip type (uint8 each), realm
+  length (uint8), realm, TTL (uint32), address length (uint8), IPv4
+  address, encode and decode time (uint32 each), UID and GID of the
+  credential (uint32 each), UID and GID restriction (uint32 each),
+  payload length (uint32), payload.
+
+All integers are in network byte order. Strings (error message, realm,
+credential) are NUL-terminated, with the NUL included in the length.
+
+Both directions are implemented: the request packing and response
+unpacking functions are used by the pure-Python clients in
+`pymunge.client` and `pymunge.aio`, the others by test daemons.
+"""
+
+from pymunge.error import MungeError, MungeErrorCode
+from pymunge.enums import UID_ANY, GID_ANY
+import collections
+import socket
+import struct
+
+MAGIC = 0x00606d4b          #: Magic number at the start of each message
+VERSION = 4                 #: Protocol version
+
+# Message types
+MSG_ENC_REQ = 2             #: encode request
+MSG_ENC_RSP = 3             #: encode response
+MSG_DEC_REQ = 4             #: decode request
+MSG_DEC_RSP = 5             #: decode response
+
+#: Default path of the munged socket
+DEFAULT_SOCKET = '/run/munge/munge.socket.2'
+
+#: Maximum accepted message body length
+MAX_BODY_LENGTH = 1 << 30
+
+_header = struct.Struct('>IBBBI')
+_u8 = struct.Struct('>B')
+_u32 = struct.Struct('>I')
+_enc_req_fields = struct.Struct('>IIII')
+_dec_rsp_fields = struct.Struct('>IIIIIII')
+
+#: Size of a message header in bytes
+HEADER_SIZE = _header.size
+
+#: An encode request. `uid_restriction`/`gid_restriction` are `UID_ANY`/
+#: `GID_ANY` if not restricted.
+EncodeRequest = collections.namedtuple('EncodeRequest', [
+    'cipher_type', 'mac_type', 'zip_type', 'realm', 'ttl',
+    'uid_restriction', 'gid_restriction', 'payload'])
+
+#: An encode response. `cred` is None if `error` is not 0.
+EncodeResponse = collections.namedtuple('EncodeResponse', [
+    'error', 'message', 'cred'])
+
+#: A decode response. Enumerations are plain integers, `realm` and
+#: `message` are str (or None), `addr4` is the IPv4 address in
+#: dotted-quad notation, `uid_restriction`/`gid_restriction` are
+#: `UID_ANY`/`GID_ANY` if not restricted.
+DecodeResponse = collections.namedtuple('DecodeResponse', [
+    'error', 'message', 'cipher_type', 'mac_type', 'zip_type', 'realm',
+    'ttl', 'addr4', 'encode_time', 'decode_time', 'uid', 'gid',
+    'uid_restriction', 'gid_restriction', 'payload'])
+
+def pack_header(msg_type, length, retry=0):
+    """Pack a message header for a body of `length` bytes."""
+    return _header.pack(MAGIC, VERSION, msg_type, retry, length)
+
+def unpack_header(data):
+    """Unpack the message header `data` (`HEADER_SIZE` bytes). Returns
+    `(msg_type, retry, length)`. Raises a `MungeError` if the header is
+    invalid."""
+    magic, version, msg_type, retry, length = _header.unpack(data)
+    if magic != MAGIC:
+        raise MungeError(MungeErrorCode.EMUNGE_SOCKET,
+                         "Received invalid message magic %#x" % magic)
+    if version != VERSION:
+        raise MungeError(MungeErrorCode.EMUNGE_SOCKET,
+                         "Received unsupported message version %d" %
+                         version)
+    if length > MAX_BODY_LENGTH:
+        raise MungeError(MungeErrorCode.EMUNGE_BAD_LENGTH,
+                         "Received message of %d bytes" % length)
+    return msg_type, retry, length
+
+def pack_encode_request(spec, payload=None, retry=0):
+    """Pack an encode request (header and body) for the payload (bytes or
+    None), using the options of the `ContextSpec` `spec`."""
+    realm = _pack_str(spec.realm)
+    if payload is None:
+        payload = b''
+    body = b''.join([
+        bytearray([spec.cipher_type.value, spec.mac_type.value,
+                   spec.zip_type.value, len(realm)]),
+        realm,
+        _enc_req_fields.pack(spec.ttl & 0xffffffff,
+                             spec.uid_restriction & 0xffffffff,
+                             spec.gid_restriction & 0xffffffff,
+                             len(payload)),
+        payload])
+    return pack_header(MSG_ENC_REQ, len(body), retry) + body
+
+def unpack_encode_request(body):
+    """Unpack the body of an encode request into an `EncodeRequest`."""
+    reader = _Reader(body)
+    cipher_type = reader.u8()
+    mac_type = reader.u8()
+    zip_type = reader.u8()
+    realm = reader.str8()
+    ttl, uid_restriction, gid_restriction, length = \
+        reader.unpack(_enc_req_fields)
+    payload = reader.read(length)
+    return EncodeRequest(cipher_type, mac_type, zip_type, realm,
+                         _signed(ttl), _restriction(uid_restriction, UID_ANY),
+                         _restriction(gid_restriction, GID_ANY), payload)
+
+def pack_encode_response(error, message=None, cred=None):
+    """Pack an encode response (header and body)."""
+    data = _pack_str(cred)
+    body = b''.join([_pack_error(error, message), _u32.pack(len(data)),
+                     data])
+    return pack_header(MSG_ENC_RSP, len(body)) + body
+
+def unpack_encode_response(body):
+    """Unpack the body of an encode response into an `EncodeResponse`."""
+    reader = _Reader(body)
+    error, message = reader.error()
+    cred = _strip_nul(reader.read(reader.u32()))
+    return EncodeResponse(error, message, cred if error == 0 else None)
+
+def pack_decode_request(cred, retry=0):
+    """Pack a decode request (header and body) for the credential `cred`
+    (bytes)."""
+    data = _pack_str(cred)
+    body = _u32.pack(len(data)) + data
+    return pack_header(MSG_DEC_REQ, len(body), retry) + body
+
+def unpack_decode_request(body):
+    """Unpack the body of a decode request. Returns the credential."""
+    reader = _Reader(body)
+    return _strip_nul(reader.read(reader.u32()))
+
+def pack_decode_response(response):
+    """Pack a decode response (header and body) from a `DecodeResponse`."""
+    realm = _pack_str(response.realm)
+    payload = response.payload or b''
+    body = b''.join([
+        _pack_error(response.error, response.message),
+        bytearray([response.cipher_type, response.mac_type,
+                   response.zip_type, len(realm)]),
+        realm,
+        _u32.pack(response.ttl & 0xffffffff),
+        _u8.pack(4),
+        socket.inet_aton(response.addr4),
+        _dec_rsp_fields.pack(response.encode_time, response.decode_time,
+                             response.uid, response.gid,
+                             response.uid_restriction & 0xffffffff,
+                             response.gid_restriction & 0xffffffff,
+                             len(payload)),
+        payload])
+    return pack_header(MSG_DEC_RSP, len(body)) + body
+
+def unpack_decode_response(body):
+    """Unpack the body of a decode response into a `DecodeResponse`."""
+    reader = _Reader(body)
+    error, message = reader.error()
+    cipher_type = reader.u8()
+    mac_type = reader.u8()
+    zip_type = reader.u8()
+    realm = reader.str8()
+    ttl = reader.u32()
+    addr = reader.read(reader.u8())
+    addr4 = socket.inet_ntoa(addr) if len(addr) == 4 else '0.0.0.0'
+    encode_time, decode_time, uid, gid, uid_restriction, gid_restriction, \
+        length = reader.unpack(_dec_rsp_fields)
+    payload = reader.read(length)
+    return DecodeResponse(error, message, cipher_type, mac_type, zip_type,
+                          realm, ttl, addr4, encode_time, decode_time,
+                          uid, gid, _restriction(uid_restriction, UID_ANY),
+                          _restriction(gid_restriction, GID_ANY), payload)
+
+def encode_result(response):
+    """Return the credential of the `EncodeResponse` `response`, or raise
+    a `MungeError` if it contains an error."""
+    if response.error != 0:
+        raise _response_error(response, None)
+    return response.cred
+
+def decode_result(response):
+    """Return `(payload, uid, gid)` from the `DecodeResponse` `response`,
+    or raise a `MungeError` if it contains an error. As with
+    `MungeContext.decode()`, the `result` of the `MungeError` is
+    `(payload, uid, gid)`."""
+    result = (response.payload, response.uid, response.gid)
+    if response.error != 0:
+        raise _response_error(response, result)
+    return result
+
+def _response_error(response, result):
+    code = MungeErrorCode(response.error)
+    message = response.message
+    if not message:
+        message = code.name
+    return MungeError(code, message, result)
+
+def _pack_str(value):
+    if value is None:
+        return b''
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return value + b'\0'
+
+def _strip_nul(value):
+    if value.endswith(b'\0'):
+        value = value[:-1]
+    return value
+
+def _pack_error(error, message):
+    if message is not None:
+        message = message.encode('utf-8')[:254]
+    message = _pack_str(message)
+    return bytearray([error, len(message)]) + message
+
+def _signed(value):
+    return value - (1 << 32) if value & 0x80000000 else value
+
+def _restriction(value, any_value):
+    return any_value if value == 0xffffffff else value
+
+class _Reader(object):
+    """pymunge internal - sequential reader for message bodies"""
+
+    def __init__(self, data):
+        self.data = bytes(data)
+        self.pos = 0
+
+    def read(self, length):
+        end = self.pos + length
+        if end > len(self.data):
+            raise MungeError(MungeErrorCode.EMUNGE_SOCKET,
+                             "Received truncated message")
+        value = self.data[self.pos:end]
+        self.pos = end
+        return value
+
+    def unpack(self, fmt):
+        return fmt.unpack(self.read(fmt.size))
+
+    def u8(self):
+        return self.unpack(_u8)[0]
+
+    def u32(self):
+        return self.unpack(_u32)[0]
+
+    def str8(self):
+        value = _strip_nul(self.read(self.u8()))
+        return value.decode('utf-8') if value else None
+
+    def error(self):
+        error = self.u8()
+        return error, self.str8()
@@ -15,7 +15,6 @@ import os
 from os import path
 import re
 import subprocess
-import sys
 
 here = path.abspath(path.dirname(__file__))
 
@@ -48,11 +47,6 @@ class SdistCommand(sdist):
             print('changing file ownerships in archive ' + archive)
             subprocess.call([tar_chown_script, archive])
 
-if sys.version_info >= (3,4):
-    install_requires = []
-else:
-    install_requires = ['enum34']
-
 setup(
     name='pymunge',
     version=about['__version__'],
@@ -73,13 +67,14 @@ setup(
         'License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)',
         'License :: OSI Approved :: GNU Lesser General Public License v3 or later (LGPLv3+)',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
         'Programming Language :: Python :: 3.4',
         'Programming Language :: Python :: 3.5',
         'Programming Language :: Python :: 3.6',
     ],
     keywords='munge libmunge hpc cluster authentication credentials',
     packages=['pymunge'],
-    install_requires=install_requires,
+    python_requires='>=3.4',
     cmdclass={
         'clean': CleanCommand,
         'sdist': SdistCommand,
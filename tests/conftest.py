@@ -0,0 +1,42 @@
+#########################################################################
+# pytest configuration for the pymunge tests
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+
+from pymunge.testing import FakeMungeDaemon, fake_munged
+
+import pytest
+
+def pytest_addoption(parser):
+    parser.addoption('--fake-munged', action='store_true',
+                     help='run the tests against a '
+                     'pymunge.testing.FakeMungeDaemon instead of munged')
+
+@pytest.fixture(scope='session', autouse=True)
+def munged(request):
+    """The FakeMungeDaemon all tests run against if --fake-munged is
+    given, None otherwise (the tests use the munged of the system)."""
+    if not request.config.getoption('--fake-munged'):
+        yield None
+        return
+    with FakeMungeDaemon() as daemon:
+        with daemon.install():
+            yield daemon
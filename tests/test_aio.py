@@ -0,0 +1,153 @@
+#########################################################################
+# Tests for module pymunge.aio
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+
+from pymunge.context import encode, decode
+from pymunge.enums import CipherType, TTL_DEFAULT
+from pymunge.error import MungeError, MungeErrorCode
+from pymunge.result import DecodeResult
+import pymunge.aio
+from pymunge.aio import AsyncMungeContext
+
+import asyncio
+import concurrent.futures
+import os
+import pytest
+import threading
+
+def run(coroutine):
+    return asyncio.new_event_loop().run_until_complete(coroutine)
+
+def test_encode_decode():
+    async def main():
+        cred = await pymunge.aio.encode(b'async')
+        return await pymunge.aio.decode(cred)
+    payload, uid, gid, ctx = run(main())
+    assert payload == b'async'
+    assert uid == os.getuid()
+    assert gid == os.getgid()
+    assert ctx.cipher_type != CipherType.Default
+    assert isinstance(ctx, DecodeResult)
+    assert ctx.payload == b'async'
+
+def test_context_options():
+    async def main():
+        async with AsyncMungeContext(max_concurrency=2) as actx:
+            assert actx.ttl == TTL_DEFAULT
+            actx.cipher_type = CipherType.CAST5
+            assert actx.cipher_type == CipherType.CAST5
+            cred1 = await actx.encode(b'one')
+            actx.cipher_type = CipherType.AES128
+            cred2 = await actx.encode(b'two')
+            return cred1, cred2
+    cred1, cred2 = run(main())
+    assert decode(cred1)[3].cipher_type == CipherType.CAST5
+    assert decode(cred2)[3].cipher_type == CipherType.AES128
+
+def test_concurrent_decode():
+    creds = [encode(('payload %d' % i).encode('ascii')) for i in range(20)]
+    async def main():
+        async with AsyncMungeContext(max_concurrency=4) as actx:
+            return await asyncio.gather(*[actx.decode(c) for c in creds])
+    results = run(main())
+    assert [payload for payload, uid, gid in results] == \
+        [('payload %d' % i).encode('ascii') for i in range(20)]
+
+def test_decode_error():
+    cred = encode()
+    decode(cred)
+    async def main():
+        async with AsyncMungeContext() as actx:
+            await actx.decode(cred)
+    with pytest.raises(MungeError) as excinfo:
+        run(main())
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_CRED_REPLAYED
+
+class BlockingExecutor(concurrent.futures.ThreadPoolExecutor):
+    """Executor whose calls wait until the event is set."""
+
+    def __init__(self):
+        super(BlockingExecutor, self).__init__(2)
+        self.event = threading.Event()
+
+    def submit(self, fn, *args):
+        def blocked(*args):
+            self.event.wait()
+            return fn(*args)
+        return super(BlockingExecutor, self).submit(blocked, *args)
+
+def test_timeout_and_concurrency_limit():
+    executor = BlockingExecutor()
+    async def main():
+        actx = AsyncMungeContext(max_concurrency=1, executor=executor)
+        with pytest.raises(MungeError) as excinfo:
+            await actx.encode(timeout=0.05)
+        assert excinfo.value.code == MungeErrorCode.EMUNGE_TIMEOUT
+        # the timed out call still occupies the only slot
+        second = asyncio.ensure_future(actx.encode())
+        await asyncio.sleep(0.05)
+        assert not second.done()
+        executor.event.set()
+        cred = await second
+        actx.close()
+        return cred
+    assert decode(run(main()))[0] == b''
+    executor.shutdown()
+
+def test_slot_released_after_loop_closed():
+    executor = BlockingExecutor()
+    actx = AsyncMungeContext(max_concurrency=1, executor=executor)
+    with pytest.raises(MungeError) as excinfo:
+        run(actx.encode(timeout=0.05))
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_TIMEOUT
+    # the timed out call finishes after its event loop is gone
+    executor.event.set()
+    cred = run(actx.encode(timeout=5))
+    assert decode(cred)[0] == b''
+    actx.close()
+    executor.shutdown()
+
+def test_cancel():
+    executor = BlockingExecutor()
+    async def main():
+        actx = AsyncMungeContext(max_concurrency=1, executor=executor)
+        first = asyncio.ensure_future(actx.encode())
+        second = asyncio.ensure_future(actx.encode())
+        await asyncio.sleep(0.05)
+        second.cancel()
+        executor.event.set()
+        await first
+        with pytest.raises(asyncio.CancelledError):
+            await second
+        actx.close()
+    run(main())
+    executor.shutdown()
+
+def test_closed_context():
+    async def main():
+        actx = AsyncMungeContext()
+        actx.close()
+        assert actx.closed
+        await actx.encode()
+    with pytest.raises(MungeError) as excinfo:
+        run(main())
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_BAD_ARG
@@ -0,0 +1,157 @@
+#########################################################################
+# Tests for module pymunge.audit
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+from pymunge.context import encode, decode
+from pymunge.error import MungeErrorCode
+from pymunge.audit import audit, read_audit, iter_blocks, summarize
+import pymunge.batch
+import pymunge.cli
+
+import io
+import json
+import os
+import pytest
+import sys
+
+def write_log(path, count, replayed=()):
+    with open(path, 'wb') as f:
+        for i in range(count):
+            if i % 5 == 0:
+                f.write(('job %d: no credential\n' % i).encode('ascii'))
+                continue
+            cred = encode(b'job')
+            if i in replayed:
+                decode(cred)
+            f.write(('job %d: cred=%s uid=%d\n' %
+                     (i, cred.decode('ascii'), os.getuid())).encode('ascii'))
+
+def test_audit(tmp_path):
+    log1 = str(tmp_path / 'log1')
+    log2 = str(tmp_path / 'log2')
+    output = str(tmp_path / 'audit')
+    write_log(log1, 100, replayed=(1, 2, 3))
+    write_log(log2, 10)
+    with open(log2, 'ab') as f:
+        f.write(b'MUNGE:AAAA:\n')
+    assert audit([log1, log2], output, workers=3, batch_size=16) == 89
+    table = read_audit(output, use_numpy=False)
+    assert table.paths == [log1, log2]
+    assert len(table) == 89
+    assert list(table.inputs) == [0] * 80 + [1] * 9
+    assert list(table.lines[:4]) == [1, 2, 3, 4]
+    assert list(table.lines[-2:]) == [9, 10]
+    assert table.error_code(0) == MungeErrorCode.EMUNGE_CRED_REPLAYED
+    assert table.error_code(3) == MungeErrorCode.EMUNGE_SUCCESS
+    assert table.error_code(88) == MungeErrorCode.EMUNGE_BAD_CRED
+    assert set(table.uids[:88]) == set([os.getuid()])
+    assert table.uids[88] == 0
+    blocks = list(iter_blocks(output))
+    assert len(blocks) == 8
+    assert blocks[0].start_line == 0 and blocks[0].end_line == 16
+    assert blocks[-1].input == 1 and blocks[-1].end_line == 11
+
+    summary = summarize(output, time_bucket=60)
+    assert summary.rows == 89
+    assert summary.lines == 111
+    assert summary.skipped == 22
+    assert summary.statuses == {'EMUNGE_SUCCESS': 85,
+                                'EMUNGE_CRED_REPLAYED': 3,
+                                'EMUNGE_BAD_CRED': 1}
+    assert summary.uids == {os.getuid(): 88}
+    assert summary.gids == {os.getgid(): 88}
+    assert sum(summary.cipher_types.values()) == 88
+    assert sum(summary.encode_times.values()) == 88
+    assert all(time % 60 == 0 for time in summary.encode_times)
+
+def test_resume(tmp_path):
+    log = str(tmp_path / 'log')
+    output = str(tmp_path / 'audit')
+    write_log(log, 50)
+    with open(log, 'rb') as f:
+        lines = f.readlines()
+    with open(log, 'wb') as f:
+        f.writelines(lines[:30])
+    assert audit([log], output, batch_size=8) == 24
+    # a torn block at the end is discarded
+    size = os.path.getsize(output)
+    with open(output, 'ab') as f:
+        f.write(b'PMAB\0\0')
+    with open(log, 'ab') as f:
+        f.writelines(lines[30:])
+    assert audit([log], output, batch_size=8) == 16
+    assert os.path.getsize(output) > size
+    table = read_audit(output, use_numpy=False)
+    assert list(table.lines) == [i for i in range(50) if i % 5]
+    # credentials audited before the interruption were not decoded again
+    assert set(table.codes) == set([0])
+    assert audit([log], output) == 0
+    with pytest.raises(ValueError):
+        audit([log, log], output)
+    with pytest.raises(ValueError):
+        read_audit(log)
+    assert audit([log], output, resume=False, sync=False) == 40
+    assert set(read_audit(output, use_numpy=False).codes) == \
+        set([MungeErrorCode.EMUNGE_CRED_REPLAYED.value])
+
+def test_lost_blocks(tmp_path):
+    # blocks decoded but not written before an interruption are decoded
+    # again on resume, and recorded as replayed
+    log = str(tmp_path / 'log')
+    output = str(tmp_path / 'audit')
+    write_log(log, 30)
+    assert audit([log], output, batch_size=10) == 24
+    infos = list(iter_blocks(output))
+    with open(output, 'rb') as f:
+        data = f.read()
+    end = data.rindex(b'PMAB')
+    with open(output, 'wb') as f:
+        f.write(data[:end])
+    assert audit([log], output, batch_size=10) == infos[-1].rows
+    table = read_audit(output, use_numpy=False)
+    assert list(table.codes) == [0] * 16 + \
+        [MungeErrorCode.EMUNGE_CRED_REPLAYED.value] * 8
+
+def test_read_without_numpy(tmp_path, monkeypatch):
+    log = str(tmp_path / 'log')
+    output = str(tmp_path / 'audit')
+    write_log(log, 3)
+    audit([log], output)
+    monkeypatch.setattr(pymunge.batch, '_numpy', False)
+    with pytest.raises(ImportError):
+        read_audit(output, use_numpy=True)
+    assert len(read_audit(output)) == 2
+
+def test_cli(tmp_path, monkeypatch):
+    log = str(tmp_path / 'log')
+    output = str(tmp_path / 'audit')
+    write_log(log, 20)
+    stdout = io.BytesIO()
+    monkeypatch.setattr(sys, 'stdout', type('Stream', (object,),
+                                            {'buffer': stdout})())
+    assert pymunge.cli.main(['audit', '-o', output, '-b', '4', log]) == 0
+    summary = json.loads(stdout.getvalue().decode('utf-8'))
+    assert summary['rows'] == 16
+    assert summary['skipped'] == 4
+    assert summary['statuses'] == {'EMUNGE_SUCCESS': 16}
+    assert summary['uids'] == {str(os.getuid()): 16}
+    with pytest.raises(SystemExit):
+        pymunge.cli.main(['audit', '-o', output, log, log])
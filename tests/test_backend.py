@@ -0,0 +1,90 @@
+#########################################################################
+# Tests for module pymunge.backend
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+
+from pymunge.context import MungeContext
+from pymunge.error import MungeError, MungeErrorCode
+import pymunge.backend
+
+import os
+import pytest
+import subprocess
+import sys
+
+BAD_SOCKET = '/this/socket/path/should/really/not/exist'
+
+def test_default_backend():
+    assert pymunge.backend.get_backend() is pymunge.backend.get_backend()
+    assert 'ctypes' in pymunge.backend.available_backends()
+    with MungeContext() as ctx:
+        assert ctx.backend is pymunge.backend.get_backend()
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        pymunge.backend.get_backend('no-such-backend')
+    with pytest.raises(ValueError):
+        MungeContext(backend='no-such-backend')
+
+def test_set_backend():
+    ctypes_backend = pymunge.backend.get_backend('ctypes')
+    try:
+        assert pymunge.backend.set_backend('ctypes') is ctypes_backend
+        assert pymunge.backend.get_backend() is ctypes_backend
+    finally:
+        pymunge.backend.set_backend(None)
+
+def test_backend_env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(
+            pymunge.__file__)))] + sys.path)
+    env[pymunge.backend.BACKEND_ENV] = 'no-such-backend'
+    process = subprocess.Popen(
+        [sys.executable, '-c', 'import pymunge; pymunge.MungeContext()'],
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    assert process.returncode != 0
+    assert b'no-such-backend' in stderr
+
+def test_cffi_backend():
+    pytest.importorskip('cffi')
+    with MungeContext(backend='cffi') as ctx:
+        assert ctx.backend.name == 'cffi'
+        ctx.ttl = 120
+        with MungeContext(ctx) as copy:
+            assert copy.backend is ctx.backend
+            assert copy.ttl == 120
+        with pytest.raises(ValueError):
+            MungeContext(ctx, backend='ctypes')
+
+def test_same_errors():
+    errors = []
+    for name in pymunge.backend.available_backends():
+        with MungeContext(backend=name) as ctx:
+            ctx.socket = BAD_SOCKET
+            with pytest.raises(MungeError) as excinfo:
+                ctx.encode(b'payload')
+            errors.append(excinfo.value)
+    for error in errors:
+        assert error.code == MungeErrorCode.EMUNGE_SOCKET
+        assert error.message == errors[0].message
+        assert error.result is None
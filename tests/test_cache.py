@@ -0,0 +1,135 @@
+#########################################################################
+# Tests for module pymunge.cache
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+from pymunge.cache import CredentialCache
+from pymunge.context import MungeContext, encode, decode
+from pymunge.error import MungeError, MungeErrorCode
+from pymunge.result import DecodeResult
+import pymunge.cache
+
+import os
+import pytest
+import threading
+import time
+
+def make_result(payload, encode_time, ttl):
+    return DecodeResult(payload, os.getuid(), os.getgid(), 2, 1, 0, None,
+                        ttl, '127.0.0.1', encode_time, encode_time)
+
+class Clock(object):
+    def __init__(self, monkeypatch):
+        self.now = time.time()
+        monkeypatch.setattr(pymunge.cache, 'time', self)
+
+    def time(self):
+        return self.now
+
+def test_repeated_decode():
+    cache = CredentialCache()
+    cred = encode(b'abc')
+    result = cache.decode(cred)
+    assert tuple(result) == (b'abc', os.getuid(), os.getgid())
+    # a second decode by munged would fail with EMUNGE_CRED_REPLAYED
+    assert cache.decode(cred) is result
+    assert cache.get(cred) is result
+    assert cache.stats() == (2, 1, 0, 0, 1)
+
+def test_decode_with_context():
+    cache = CredentialCache()
+    with MungeContext() as ctx:
+        cred = ctx.encode(b'xyz')
+        assert cache.decode(cred, ctx).payload == b'xyz'
+        assert cache.decode(cred, ctx).payload == b'xyz'
+
+def test_failed_decode_not_cached():
+    cache = CredentialCache()
+    cred = encode()
+    decode(cred, True)
+    for i in range(2):
+        with pytest.raises(MungeError) as excinfo:
+            cache.decode(cred)
+        assert excinfo.value.code == MungeErrorCode.EMUNGE_CRED_REPLAYED
+    assert len(cache) == 0
+    with pytest.raises(TypeError):
+        cache.decode(u'MUNGE:')
+
+def test_expiry(monkeypatch):
+    clock = Clock(monkeypatch)
+    cache = CredentialCache()
+    cache.put(b'expired', make_result(b'', int(clock.now) - 60, 60))
+    assert len(cache) == 0
+    cache.put(b'valid', make_result(b'', int(clock.now), 60))
+    assert cache.get(b'valid') is not None
+    clock.now += 60
+    assert cache.get(b'valid') is None
+    assert cache.stats() == (1, 1, 0, 1, 0)
+
+def test_lru_eviction():
+    cache = CredentialCache(max_entries=2)
+    now = int(time.time())
+    for name in (b'a', b'b'):
+        cache.put(name, make_result(name, now, 60))
+    cache.get(b'a')
+    cache.put(b'c', make_result(b'c', now, 60))
+    assert cache.get(b'b') is None
+    assert cache.get(b'a').payload == b'a'
+    assert cache.get(b'c').payload == b'c'
+    assert cache.stats().evictions == 1
+    cache.discard(b'a')
+    assert len(cache) == 1
+    cache.clear()
+    assert len(cache) == 0
+    with pytest.raises(ValueError):
+        CredentialCache(max_entries=0)
+
+def test_concurrent_decode():
+    cache = CredentialCache()
+    for trial in range(10):
+        cred = encode(b'retry')
+        barrier = threading.Barrier(4)
+        outcomes = []
+
+        def present():
+            barrier.wait()
+            try:
+                outcomes.append(cache.decode(cred).payload)
+            except MungeError as e:
+                outcomes.append(e.code.name)
+        threads = [threading.Thread(target=present) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert outcomes == [b'retry'] * 4
+
+def test_error_result():
+    cache = CredentialCache()
+    with MungeContext() as ctx:
+        ctx.ttl = 77
+        cred = ctx.encode(b'abc')
+    decode(cred)
+    with pytest.raises(MungeError) as excinfo:
+        cache.decode(cred)
+    result = excinfo.value.result
+    assert isinstance(result, DecodeResult)
+    assert tuple(result) == (b'abc', os.getuid(), os.getgid())
+    assert result.ttl == 77
@@ -0,0 +1,137 @@
+#########################################################################
+# Tests for module pymunge.cli
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+from pymunge.batch import DecodeBatch
+from pymunge.context import MungeContext, encode
+import pymunge.cli
+
+import base64
+import io
+import json
+import os
+import subprocess
+import sys
+
+class Stream(object):
+    def __init__(self, data=b''):
+        self.buffer = io.BytesIO(data)
+
+def run(monkeypatch, argv, data):
+    stdout = Stream()
+    monkeypatch.setattr(sys, 'stdin', Stream(data))
+    monkeypatch.setattr(sys, 'stdout', stdout)
+    status = pymunge.cli.main(argv)
+    lines = stdout.buffer.getvalue().decode('utf-8').splitlines()
+    return status, [json.loads(line) for line in lines]
+
+def test_encode_decode(monkeypatch):
+    payloads = ['payload %d' % i for i in range(50)] + ['']
+    data = ''.join(payload + '\n' for payload in payloads).encode('utf-8')
+    status, records = run(monkeypatch, ['encode', '-w', '3', '-b', '7',
+                                        '--ttl', '60'], data)
+    assert status == 0
+    assert [record['index'] for record in records] == list(range(51))
+    assert all(record['error'] is None for record in records)
+    creds = [record['cred'] for record in records]
+    data = ''.join(cred + '\n' for cred in creds).encode('ascii')
+    status, records = run(monkeypatch, ['decode', '-b', '4'], data)
+    assert status == 0
+    assert [record['payload'] for record in records] == payloads
+    assert records[0]['uid'] == os.getuid()
+    assert records[0]['gid'] == os.getgid()
+    assert records[0]['cipher_type'] != 'Default'
+    status, records = run(monkeypatch, ['decode', '--unordered',
+                                        '--base64'], data)
+    assert status == 1
+    assert sorted(record['index'] for record in records) == \
+        list(range(51))
+    for record in records:
+        assert record['error'] == 'EMUNGE_CRED_REPLAYED'
+        assert base64.b64decode(record['payload_base64']) == \
+            payloads[record['index']].encode('utf-8')
+
+def test_ndjson(monkeypatch):
+    data = b'\n'.join([
+        json.dumps({'id': 'a', 'payload': 'text'}).encode('utf-8'),
+        json.dumps({'id': 'b', 'payload_base64': 'gAE='}).encode('utf-8'),
+        b'',
+        b'not json',
+        json.dumps({'id': 'c'}).encode('utf-8'), b''])
+    status, records = run(monkeypatch, ['encode', '--ndjson'], data)
+    assert status == 1
+    assert [record.get('id') for record in records] == ['a', 'b', None, 'c']
+    assert records[2]['error'] == 'EMUNGE_BAD_ARG'
+    creds = [record.get('cred') for record in records]
+    data = b'\n'.join(json.dumps({'cred': cred, 'n': i}).encode('utf-8')
+                      for i, cred in enumerate(creds))
+    status, records = run(monkeypatch, ['decode', '--ndjson'], data)
+    assert status == 1
+    assert records[0]['payload'] == 'text'
+    assert records[0]['n'] == 0
+    assert base64.b64decode(records[1]['payload_base64']) == b'\x80\x01'
+    assert records[2]['error'] == 'EMUNGE_BAD_ARG'
+    assert records[3]['payload'] == ''
+    assert 'cred' not in records[0]
+
+def test_decode_errors(monkeypatch):
+    data = b'MUNGE:invalid:\n' + encode(b'ok') + b'\n'
+    status, records = run(monkeypatch, ['decode'], data)
+    assert status == 1
+    assert records[0]['error'] == 'EMUNGE_BAD_CRED'
+    assert records[0]['message']
+    assert 'payload' not in records[0]
+    assert records[1]['error'] is None
+
+def test_unknown_error_code(monkeypatch):
+    # an error code unknown to MungeErrorCode (e.g. from a newer libmunge)
+    # is reported by number instead of aborting the run
+    def decode_many(self, creds, offsets=None, use_numpy=None):
+        batch = DecodeBatch(use_numpy)
+        for cred in creds:
+            batch.payloads.append(None)
+            for column in (batch.uids, batch.gids, batch.encode_times,
+                           batch.decode_times, batch.cipher_types,
+                           batch.mac_types, batch.zip_types):
+                column.append(0)
+            batch.codes.append(200)
+        return batch
+
+    monkeypatch.setattr(MungeContext, 'decode_many', decode_many)
+    status, records = run(monkeypatch, ['decode'], b'MUNGE:x:\n')
+    assert status == 1
+    assert records[0]['error'] == 200
+    assert records[0]['message']
+
+def test_main_module(munged):
+    with MungeContext() as ctx:
+        socket = ctx.socket
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'pymunge', 'encode', '--socket', socket],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    output, _ = process.communicate(b'abc\n')
+    assert process.returncode == 0
+    assert json.loads(output.decode('utf-8'))['cred'].startswith('MUNGE:')
+    process = subprocess.Popen([sys.executable, '-m', 'pymunge'],
+                               stderr=subprocess.PIPE)
+    process.communicate()
+    assert process.returncode == 2
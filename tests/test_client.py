@@ -0,0 +1,168 @@
+#########################################################################
+# Tests for module pymunge.client
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+
+from pymunge.client import SelectorClient
+import pymunge.client
+from pymunge.context import MungeContext, encode, decode
+from pymunge.enums import CipherType
+from pymunge.error import MungeError, MungeErrorCode
+from pymunge.spec import ContextSpec
+from pymunge.aio import AsyncWireClient
+import pymunge.wire
+
+import asyncio
+import os
+import pytest
+import socket
+import tempfile
+import threading
+import time
+
+def test_encode_decode():
+    with MungeContext() as ctx:
+        ctx.cipher_type = CipherType.CAST5
+        with SelectorClient(ctx) as client:
+            assert client.spec.cipher_type == CipherType.CAST5
+            cred = client.encode(b'wire')
+
+    # credentials are interchangeable with those of libmunge
+    payload, uid, gid, ctx = decode(cred)
+    assert payload == b'wire'
+    assert uid == os.getuid()
+    assert gid == os.getgid()
+    assert ctx.cipher_type == CipherType.CAST5
+
+    cred = encode(b'libmunge')
+    with SelectorClient() as client:
+        assert client.decode(cred) == (b'libmunge', os.getuid(), os.getgid())
+
+def test_many_in_flight():
+    creds = [encode(('payload %d' % i).encode('ascii')) for i in range(50)]
+    with SelectorClient(max_connections=8) as client:
+        requests = [client.submit_decode(cred) for cred in creds]
+        assert client.pending == 50
+        client.wait()
+        assert client.pending == 0
+    for i, request in enumerate(requests):
+        assert request.done()
+        assert request.result()[0] == ('payload %d' % i).encode('ascii')
+        assert request.response.cipher_type != CipherType.Default.value
+
+def test_decode_error():
+    cred = encode(b'Fred')
+    decode(cred)
+    with SelectorClient() as client:
+        with pytest.raises(MungeError) as excinfo:
+            client.decode(cred)
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_CRED_REPLAYED
+    assert excinfo.value.result == (b'Fred', os.getuid(), os.getgid())
+
+def test_bad_socket():
+    spec = ContextSpec(socket='/this/socket/path/should/really/not/exist')
+    with SelectorClient(spec) as client:
+        with pytest.raises(MungeError) as excinfo:
+            client.encode()
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_SOCKET
+
+def test_async_wire_client():
+    creds = [encode(('payload %d' % i).encode('ascii')) for i in range(20)]
+    async def main():
+        client = AsyncWireClient(max_connections=4)
+        results = await asyncio.gather(*[client.decode(c) for c in creds])
+        cred = await client.encode(b'async wire')
+        return results, cred
+    results, cred = asyncio.new_event_loop().run_until_complete(main())
+    assert [payload for payload, uid, gid in results] == \
+        [('payload %d' % i).encode('ascii') for i in range(20)]
+    assert decode(cred)[0] == b'async wire'
+
+def _full_backlog(path):
+    # a listener with backlog 0 accepts one pending connection; further
+    # non-blocking connections fail with EAGAIN
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(0)
+    filler = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    filler.connect(path)
+    return listener, filler
+
+def _serve(listener, response, delay):
+    # drain the backlog after `delay` seconds, then answer one request
+    threading.Event().wait(delay)
+    listener.accept()[0].close()
+    conn = listener.accept()[0]
+    header = conn.recv(pymunge.wire.HEADER_SIZE, socket.MSG_WAITALL)
+    length = pymunge.wire.unpack_header(header)[2]
+    conn.recv(length, socket.MSG_WAITALL)
+    conn.sendall(response)
+    conn.close()
+
+def _exchange(response, delay, encode):
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'munge.socket')
+    listener, filler = _full_backlog(path)
+    thread = threading.Thread(target=_serve,
+                              args=(listener, response, delay))
+    thread.start()
+    try:
+        return encode(ContextSpec(socket=path))
+    finally:
+        thread.join()
+        filler.close()
+        listener.close()
+        os.unlink(path)
+        os.rmdir(tmpdir)
+
+def _selector_encode(spec):
+    with SelectorClient(spec) as client:
+        return client.encode()
+
+def _async_encode(spec):
+    client = AsyncWireClient(spec)
+    return asyncio.new_event_loop().run_until_complete(client.encode())
+
+@pytest.mark.parametrize('encode', [_selector_encode, _async_encode])
+def test_backlog_full(encode):
+    response = pymunge.wire.pack_encode_response(0, cred=b'MUNGE:cred:')
+    assert _exchange(response, 0.2, encode) == b'MUNGE:cred:'
+
+@pytest.mark.parametrize('encode', [_selector_encode, _async_encode])
+def test_unexpected_response(encode):
+    response = pymunge.wire.pack_header(pymunge.wire.MSG_DEC_RSP, 0)
+    with pytest.raises(MungeError) as excinfo:
+        _exchange(response, 0, encode)
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_SOCKET
+    assert 'message type' in str(excinfo.value)
+
+def test_default_timeout():
+    assert SelectorClient().timeout == pymunge.client.DEFAULT_TIMEOUT
+    assert AsyncWireClient().timeout == pymunge.client.DEFAULT_TIMEOUT
+
+def test_wall_clock_step(monkeypatch):
+    # deadlines do not depend on the wall clock
+    with SelectorClient(timeout=5) as client:
+        request = client.submit_encode(b'step')
+        now = time.time()
+        monkeypatch.setattr(time, 'time', lambda: now + 3600)
+        client.wait([request])
+    assert request.result().startswith(b'MUNGE:')
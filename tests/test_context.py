@@ -20,24 +20,39 @@
 # <http://www.gnu.org/licenses/>.
 #########################################################################
 
-from pymunge.context import MungeContext, encode, decode
+from pymunge.context import MungeContext, encode, encode_many, decode, \
+    decode_many
 from pymunge.enums import CipherType, MACType, ZipType, \
     TTL_DEFAULT, UID_ANY, GID_ANY
 from pymunge.error import MungeError, MungeErrorCode
+import pymunge.backend
+import pymunge.batch
 import pymunge.raw
 
 import pytest
+import array
 import os
 import time
 
+@pytest.fixture(autouse=True, params=['ctypes', 'cffi'])
+def backend(request):
+    """Runs each test with the ctypes and the cffi backend as the default
+    backend (the latter only if cffi is installed)."""
+    if request.param == 'cffi':
+        pytest.importorskip('cffi')
+    pymunge.backend.set_backend(request.param)
+    yield pymunge.backend.get_backend()
+    pymunge.backend.set_backend(None)
+
 class MockContextDestroy(object):
-    """Mocks/monkeypatches pymunge.raw.munge_ctx_destroy and counts
+    """Mocks/monkeypatches ctx_destroy of the default backend and counts
     how often it has been called"""
 
     def __init__(self, monkeypatch):
         self.history = []
-        self.mocked_function = pymunge.raw.munge_ctx_destroy
-        monkeypatch.setattr(pymunge.raw, 'munge_ctx_destroy', self)
+        backend = pymunge.backend.get_backend()
+        self.mocked_function = backend.ctx_destroy
+        monkeypatch.setattr(backend, 'ctx_destroy', self)
 
     def __call__(self, ctx):
         self.history.append(ctx)
@@ -268,6 +283,196 @@ def test_encode_decode():
     assert ctx2.mac_type == ctx1.mac_type
     assert ctx2.zip_type == ctx1.zip_type
 
+def test_ctx_encode_many():
+    payloads = [None, b'', b'stuff', b'more stuff']
+    with MungeContext() as ctx:
+        ctx.cipher_type = CipherType.CAST5
+        creds = ctx.encode_many(payloads)
+    assert len(creds) == len(payloads)
+    assert len(set(creds)) == len(creds)
+
+    my_uid = os.getuid()
+    my_gid = os.getgid()
+
+    for cred, payload in zip(creds, payloads):
+        assert isinstance(cred, bytes)
+        assert cred.startswith(b'MUNGE:')
+        with MungeContext() as ctx:
+            assert ctx.decode(cred) == (payload or b'', my_uid, my_gid)
+            assert ctx.cipher_type == CipherType.CAST5
+
+def test_encode_many():
+    creds = encode_many(iter([b'foo', b'bar']))
+    assert len(creds) == 2
+    assert decode(creds[0])[0] == b'foo'
+    assert decode(creds[1])[0] == b'bar'
+    assert encode_many([]) == []
+
+def test_encode_many_bad_payload_type(monkeypatch):
+    calls = []
+    with MungeContext() as ctx:
+        encode = ctx._backend.encode
+        monkeypatch.setattr(ctx._backend, 'encode',
+                            lambda *args: calls.append(args) or
+                            encode(*args))
+        with pytest.raises(TypeError):
+            ctx.encode_many([b'foo', u'bar'])
+    # no credential was created for the payloads before the bad one
+    assert calls == []
+
+def test_encode_many_returns_errors():
+    with MungeContext() as ctx:
+        ctx.socket = '/this/socket/path/should/really/not/exist'
+        results = ctx.encode_many([b'foo', None])
+    assert len(results) == 2
+    for result in results:
+        assert isinstance(result, MungeError)
+        assert result.code == MungeErrorCode.EMUNGE_SOCKET
+
+def test_ctx_decode_many():
+    with MungeContext() as ctx:
+        ctx.cipher_type = CipherType.AES128
+        creds = ctx.encode_many([b'one', b'two'])
+    replayed = encode(b'three')
+    decode(replayed)
+
+    my_uid = os.getuid()
+    my_gid = os.getgid()
+
+    with MungeContext() as ctx:
+        batch = ctx.decode_many(creds + [replayed, b'MUNGE:garbage:'],
+                                use_numpy=False)
+    assert len(batch) == 4
+    assert isinstance(batch.uids, array.array)
+    assert batch.payloads == [b'one', b'two', b'three', None]
+    assert list(batch.codes) == [
+        MungeErrorCode.EMUNGE_SUCCESS.value,
+        MungeErrorCode.EMUNGE_SUCCESS.value,
+        MungeErrorCode.EMUNGE_CRED_REPLAYED.value,
+        MungeErrorCode.EMUNGE_BAD_CRED.value]
+    assert batch.error_code(2) == MungeErrorCode.EMUNGE_CRED_REPLAYED
+    assert list(batch.uids) == [my_uid, my_uid, my_uid, 0]
+    assert list(batch.gids) == [my_gid, my_gid, my_gid, 0]
+    assert batch.cipher_types[0] == CipherType.AES128.value
+    assert batch.mac_types[0] not in (MACType.Default.value,
+                                      MACType.Disabled.value)
+    assert batch.encode_times[0] > 0
+    assert batch.decode_times[0] >= batch.encode_times[0]
+    assert batch.encode_times[3] == 0
+
+def test_decode_many_packed():
+    creds = encode_many([b'a', b'bb', b'ccc'])
+    packed = bytearray(b''.join(creds))
+    offsets = [0]
+    for cred in creds:
+        offsets.append(offsets[-1] + len(cred))
+
+    batch = decode_many(packed, offsets)
+    assert batch.payloads == [b'a', b'bb', b'ccc']
+    assert list(batch.codes) == [MungeErrorCode.EMUNGE_SUCCESS.value] * 3
+
+    assert len(decode_many(b'', [0])) == 0
+
+def test_decode_many_bad_input():
+    cred = encode(b'kept')
+    with MungeContext() as ctx:
+        with pytest.raises(TypeError):
+            ctx.decode_many([cred, u'x'])
+        with pytest.raises(ValueError):
+            ctx.decode_many(cred + cred, [0, len(cred), 0])
+        with pytest.raises(ValueError):
+            ctx.decode_many(cred, [0, len(cred), len(cred) + 1])
+    # the credential has not been consumed
+    assert decode(cred)[0] == b'kept'
+
+def test_decode_many_without_numpy(monkeypatch):
+    monkeypatch.setattr(pymunge.batch, '_numpy', False)
+    cred = encode(b'unused')
+    with MungeContext() as ctx:
+        with pytest.raises(ImportError):
+            ctx.decode_many([cred], use_numpy=True)
+        assert isinstance(ctx.decode_many([], use_numpy=None).uids,
+                          array.array)
+    # the credential has not been consumed
+    assert decode(cred)[0] == b'unused'
+
+def test_decode_into():
+    payload = b'into' * 1000
+    with MungeContext() as ctx:
+        buf = bytearray(8192)
+        assert ctx.decode_into(encode(payload), buf) == \
+            (len(payload), os.getuid(), os.getgid())
+        assert bytes(buf[:len(payload)]) == payload
+
+        view = memoryview(bytearray(len(payload) + 10))[5:]
+        nbytes, uid, gid = ctx.decode_into(encode(payload), view)
+        assert view[:nbytes].tobytes() == payload
+
+        assert ctx.decode_into(encode(), bytearray())[0] == 0
+
+        with pytest.raises(TypeError):
+            ctx.decode_into(encode(payload), payload)
+
+def test_decode_into_overflow():
+    with MungeContext() as ctx:
+        buf = bytearray(3)
+        with pytest.raises(MungeError) as excinfo:
+            ctx.decode_into(encode(b'too long'), buf)
+        assert excinfo.value.code == MungeErrorCode.EMUNGE_OVERFLOW
+        assert excinfo.value.result == (8, os.getuid(), os.getgid())
+        assert buf == bytearray(3)
+
+def test_decode_into_replayed():
+    cred = encode(b'Fred')
+    decode(cred)
+    buf = bytearray(10)
+    with MungeContext() as ctx:
+        with pytest.raises(MungeError) as excinfo:
+            ctx.decode_into(cred, buf)
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_CRED_REPLAYED
+    assert excinfo.value.result == (4, os.getuid(), os.getgid())
+    assert bytes(buf[:4]) == b'Fred'
+
+def test_decode_view():
+    with MungeContext() as ctx:
+        view, uid, gid = ctx.decode_view(encode(b'view'))
+        assert (uid, gid) == (os.getuid(), os.getgid())
+        with view:
+            assert view.tobytes() == b'view'
+            if hasattr(view, 'toreadonly'):
+                assert view.readonly
+        with pytest.raises(ValueError):
+            view.tobytes()
+
+        view, uid, gid = ctx.decode_view(encode())
+        assert len(view) == 0
+
+def test_decode_view_frees_memory(monkeypatch):
+    freed = []
+    # the C library's free() as called by the backend
+    if pymunge.backend.get_backend().name == 'cffi':
+        owner = pymunge.backend.get_backend()
+    else:
+        owner = pymunge.raw
+    free = owner._free
+    def counting_free(address):
+        freed.append(address)
+        free(address)
+    cred = encode(b'freed on release')
+    monkeypatch.setattr(owner, '_free', counting_free)
+    with MungeContext() as ctx:
+        view, uid, gid = ctx.decode_view(cred)
+        assert freed == []
+        view.release()
+        assert len(freed) == 1
+
+        with pytest.raises(MungeError) as excinfo:
+            ctx.decode_view(cred)
+        assert excinfo.value.code == MungeErrorCode.EMUNGE_CRED_REPLAYED
+        assert excinfo.value.result[0].tobytes() == b'freed on release'
+        excinfo.value.result[0].release()
+        assert len(freed) == 2
+
 def test_get_option_on_closed_context_fails():
     with pytest.raises(MungeError) as excinfo:
         ctx = MungeContext()
@@ -289,6 +494,13 @@ def test_encode_on_closed_context_fails():
         ctx.encode()
     assert excinfo.value.code == MungeErrorCode.EMUNGE_BAD_ARG
 
+def test_encode_many_on_closed_context_fails():
+    with pytest.raises(MungeError) as excinfo:
+        ctx = MungeContext()
+        ctx.close()
+        ctx.encode_many([b'foo'])
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_BAD_ARG
+
 def test_decode_on_closed_context_fails():
     cred = encode()
     with pytest.raises(MungeError) as excinfo:
@@ -304,6 +516,17 @@ def test_bad_socket():
             cred = ctx.encode()
     assert excinfo.value.code == MungeErrorCode.EMUNGE_SOCKET
 
+def test_decode_into_on_closed_context_fails():
+    cred = encode()
+    ctx = MungeContext()
+    ctx.close()
+    with pytest.raises(MungeError) as excinfo:
+        ctx.decode_into(cred, bytearray(10))
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_BAD_ARG
+    with pytest.raises(MungeError) as excinfo:
+        ctx.decode_view(cred)
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_BAD_ARG
+
 def test_credential_replayed():
     cred = encode(b'Fred')
 
@@ -0,0 +1,142 @@
+#########################################################################
+# Tests for module pymunge.executor
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+
+from pymunge.context import MungeContext, encode, encode_many, decode
+from pymunge.enums import CipherType
+from pymunge.error import MungeError, MungeErrorCode
+from pymunge.executor import MungeExecutor, ProcessPoolDecoder, \
+    auto_workers, measure_latency, MAX_AUTO_WORKERS
+from pymunge.spec import ContextSpec
+from pymunge.testing import FakeMungeDaemon
+
+import pytest
+import os
+
+def test_imap_encode_decode():
+    payloads = [('payload %d' % i).encode('ascii') for i in range(20)]
+    with MungeContext() as ctx:
+        ctx.cipher_type = CipherType.CAST5
+        with MungeExecutor(4, ctx) as executor:
+            creds = list(executor.imap_encode(payloads))
+            results = list(executor.imap_decode(creds))
+
+    assert len(creds) == 20
+    assert all(isinstance(cred, bytes) for cred in creds)
+    assert results == [(payload, os.getuid(), os.getgid())
+                       for payload in payloads]
+
+def test_imap_unordered():
+    payloads = [('payload %d' % i).encode('ascii') for i in range(20)]
+    with MungeExecutor(4) as executor:
+        indexed = list(executor.imap_encode(payloads, ordered=False))
+        assert sorted(index for index, cred in indexed) == list(range(20))
+        for index, cred in indexed:
+            assert decode(cred)[0] == payloads[index]
+
+def test_imap_decode_returns_errors():
+    cred = encode(b'once')
+    with MungeExecutor(2) as executor:
+        results = list(executor.imap_decode([cred, cred]))
+    assert len(results) == 2
+    errors = [result for result in results if isinstance(result, MungeError)]
+    assert len(errors) == 1
+    assert errors[0].code == MungeErrorCode.EMUNGE_CRED_REPLAYED
+    assert errors[0].result[0] == b'once'
+
+def test_imap_bounded_in_flight():
+    consumed = []
+    def payloads():
+        for i in range(100):
+            consumed.append(i)
+            yield b'x'
+
+    with MungeExecutor(2) as executor:
+        results = executor.imap_encode(payloads(), max_in_flight=3)
+        next(results)
+        assert len(consumed) <= 4
+        results.close()
+
+def test_one_context_per_thread():
+    with MungeExecutor(3) as executor:
+        list(executor.imap_encode([None] * 30))
+        contexts = executor._contexts.contexts()
+        assert 1 <= len(contexts) <= 3
+        assert len(set(ctx.ctx for ctx in contexts)) == len(contexts)
+    assert all(ctx.closed for ctx in contexts)
+
+def test_submit():
+    with MungeExecutor(2) as executor:
+        cred = executor.submit_encode(b'future').result()
+        assert executor.submit_decode(cred).result()[0] == b'future'
+
+def test_auto_workers():
+    workers = auto_workers()
+    assert 2 <= workers <= MAX_AUTO_WORKERS
+    with MungeExecutor() as executor:
+        assert 2 <= executor.max_workers <= MAX_AUTO_WORKERS
+
+def test_auto_workers_slow_daemon():
+    # the CPU time per call does not grow with the daemon latency
+    with FakeMungeDaemon(latency=0.02) as daemon:
+        with MungeContext() as ctx:
+            ctx.socket = daemon.socket_path
+            latency, overhead = measure_latency(ctx)
+            assert latency >= 0.02
+            assert overhead < latency / 10
+            assert auto_workers(ctx) == MAX_AUTO_WORKERS
+
+def test_invalid_arguments():
+    with pytest.raises(ValueError):
+        MungeExecutor(0)
+    with MungeExecutor(1) as executor:
+        with pytest.raises(ValueError):
+            executor.imap_encode([b'x'], max_in_flight=0)
+
+def payload_length(payload, uid, gid):
+    return len(payload)
+
+def test_process_pool_encode_decode():
+    spec = ContextSpec(cipher_type=CipherType.CAST5)
+    payloads = [b'x' * i for i in range(10)]
+    with ProcessPoolDecoder(2, spec, chunksize=3) as decoder:
+        assert decoder.processes == 2
+        assert decoder.spec == spec
+        encoded = list(decoder.encode(payloads))
+        assert [code for code, cred in encoded] == [0] * 10
+        creds = [cred for code, cred in encoded]
+        results = list(decoder.decode(creds + [creds[0], b'MUNGE:bad:']))
+
+    my_uid = os.getuid()
+    my_gid = os.getgid()
+    assert results[:10] == [(0, payload, my_uid, my_gid)
+                            for payload in payloads]
+    assert results[10] == (MungeErrorCode.EMUNGE_CRED_REPLAYED.value,
+                           b'', my_uid, my_gid)
+    assert results[11] == (MungeErrorCode.EMUNGE_BAD_CRED.value,
+                           None, 0, 0)
+
+def test_process_pool_postprocess():
+    creds = encode_many([b'a', b'bb', b'ccc'])
+    with ProcessPoolDecoder(2, postprocess=payload_length) as decoder:
+        results = list(decoder.decode(creds))
+    assert [payload for code, payload, uid, gid in results] == [1, 2, 3]
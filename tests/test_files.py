@@ -0,0 +1,113 @@
+#########################################################################
+# Tests for module pymunge.files
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+from pymunge.context import MungeContext, encode
+from pymunge.error import MungeError, MungeErrorCode
+from pymunge.files import FileManifest, encode_file, verify_file, \
+    hash_file, changed_chunks
+import pymunge
+
+import hashlib
+import os
+import pytest
+
+@pytest.fixture
+def data_file(tmp_path):
+    path = str(tmp_path / 'data')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(10000))
+    return path
+
+def modify(path, offset, data):
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
+
+def test_roundtrip(data_file):
+    cred = pymunge.encode_file(data_file, chunk_size=1000, workers=4)
+    result = pymunge.verify_file(data_file, cred)
+    assert result.uid == os.getuid()
+    manifest = FileManifest.from_payload(result.payload)
+    assert manifest.size == 10000
+    assert manifest.chunk_size == 1000
+    assert manifest.chunk_count == 10
+    assert manifest.chunk_digests is None
+    assert manifest == hash_file(data_file, 1000, workers=1)
+    # verifying again needs the DecodeResult, since munged rejects
+    # replayed credentials
+    assert verify_file(data_file, result) is result
+
+def test_mismatch(data_file):
+    with MungeContext() as ctx:
+        cred = encode_file(data_file, ctx, chunk_size=4096)
+        result = verify_file(data_file, cred, ctx)
+    modify(data_file, 5000, b'\0' * 2)
+    with pytest.raises(MungeError) as excinfo:
+        verify_file(data_file, result)
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_CRED_INVALID
+    assert excinfo.value.result is result
+    with pytest.raises(MungeError) as excinfo:
+        verify_file(data_file, encode(b'payload'))
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_BAD_CRED
+
+def test_append_and_chunks(data_file):
+    result = verify_file(data_file, encode_file(data_file, chunk_size=3000,
+                                                chunk_digests=True))
+    manifest = FileManifest.from_payload(result.payload)
+    assert len(manifest.chunk_digests) == 4
+    with open(data_file, 'rb') as f:
+        f.seek(3000)
+        assert manifest.chunk_digests[1] == \
+            hashlib.sha256(f.read(3000)).digest()
+    with open(data_file, 'ab') as f:
+        f.write(b'appended')
+    with pytest.raises(MungeError):
+        verify_file(data_file, result)
+    verify_file(data_file, result, allow_append=True)
+    assert changed_chunks(data_file, manifest) == [3]
+    modify(data_file, 100, b'modified')
+    assert changed_chunks(data_file, manifest) == [0, 3]
+    verify_file(data_file, result, allow_append=True, chunks=[1, 2])
+    with pytest.raises(MungeError):
+        verify_file(data_file, result, allow_append=True, chunks=[0])
+    with pytest.raises(ValueError):
+        verify_file(data_file, result, allow_append=True, chunks=[4])
+    with open(data_file, 'r+b') as f:
+        f.truncate(5000)
+    assert changed_chunks(data_file, manifest) == [0, 1, 2, 3]
+
+def test_empty_file(tmp_path):
+    path = str(tmp_path / 'empty')
+    open(path, 'wb').close()
+    result = verify_file(path, encode_file(path, chunk_digests=True))
+    manifest = FileManifest.from_payload(result.payload)
+    assert manifest.size == manifest.chunk_count == 0
+    assert manifest.chunk_digests == ()
+
+def test_manifest_payload():
+    manifest = FileManifest('sha1', 5, 2, b'd' * 20, (b'a' * 20,) * 3)
+    payload = manifest.payload()
+    assert FileManifest.from_payload(payload) == manifest
+    for invalid in (payload[:-1], payload + b'x', b'PMSF\x02' + payload[5:],
+                    manifest._replace(chunk_digests=(b'a' * 20,)).payload()):
+        with pytest.raises(MungeError):
+            FileManifest.from_payload(invalid)
@@ -0,0 +1,150 @@
+#########################################################################
+# Tests for module pymunge.hooks
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+
+
+from pymunge.context import MungeContext
+from pymunge.error import MungeError, MungeErrorCode
+from pymunge.pool import MungeContextPool
+import pymunge._instrument
+import pymunge._libmunge
+import pymunge.hooks as hooks
+import pymunge.metrics
+import pymunge.raw
+
+import pytest
+
+@pytest.fixture
+def calls():
+    """List of the CallInfos of all calls that ended while it is used."""
+    ended = []
+    hooks.on_call_end(ended.append)
+    yield ended
+    hooks.clear()
+    hooks.set_sample_rate(1)
+
+def test_context_calls(calls):
+    started = []
+    hooks.on_call_start(lambda info: started.append(info.function))
+    with MungeContext() as ctx:
+        socket = ctx.socket
+        del calls[:], started[:]
+        cred = ctx.encode(b'abcd')
+        assert ctx.decode(cred)[0] == b'abcd'
+        with pytest.raises(MungeError):
+            ctx.decode(cred)
+    assert started == ['munge_encode', 'munge_decode', 'munge_decode',
+                       'munge_ctx_destroy']
+    encode, decode, replayed, destroy = calls
+    for info in (encode, decode, replayed):
+        assert info.socket == socket
+        assert info.payload_length == 4
+        assert 0 <= info.native_time <= info.elapsed
+        assert info.wrapper_time >= 0
+        assert info.error_time is None
+    assert encode.error_code == decode.error_code == 0
+    assert replayed.error_code == MungeErrorCode.EMUNGE_CRED_REPLAYED.value
+    assert destroy.socket is None and destroy.payload_length is None
+    assert destroy.error_code == 0
+
+def test_pool_and_option_calls(calls):
+    pool = MungeContextPool()
+    with pool.acquire() as ctx:
+        ctx.ttl = 60
+        assert ctx.ttl == 60
+    pool.acquire().close()
+    pool.clear()
+    functions = [info.function for info in calls]
+    assert 'munge_ctx_set' in functions
+    assert 'munge_ctx_get' in functions
+    assert functions[-1] == 'munge_ctx_destroy'
+    assert all(info.error_code == 0 for info in calls)
+
+def test_raw_calls(calls):
+    ctx = pymunge.raw.munge_ctx_create()
+    try:
+        cred = pymunge.raw.munge_encode(ctx, b'xyz', 3)
+        assert pymunge.raw.munge_decode(cred, ctx)[0] == b'xyz'
+        with pytest.raises(MungeError) as excinfo:
+            pymunge.raw.munge_decode(b'MUNGE:invalid:', ctx)
+    finally:
+        pymunge.raw.munge_ctx_destroy(ctx)
+    by_function = {}
+    for info in calls:
+        by_function.setdefault(info.function, []).append(info)
+    encode, = by_function['munge_encode']
+    decode, invalid = by_function['munge_decode']
+    assert encode.payload_length == decode.payload_length == 3
+    assert encode.socket == decode.socket == invalid.socket
+    assert encode.error_code == decode.error_code == 0
+    assert encode.error_time == decode.error_time == 0
+    assert invalid.error_code == excinfo.value.code.value
+    assert invalid.error_time > 0
+    for info in (encode, decode, invalid):
+        assert info.native_time + info.error_time + info.wrapper_time == \
+            pytest.approx(info.elapsed)
+
+def test_sampling(calls):
+    with pytest.raises(ValueError):
+        hooks.set_sample_rate(1.5)
+    hooks.set_sample_rate(0)
+    assert hooks.get_sample_rate() == 0
+    with MungeContext() as ctx:
+        ctx.decode(ctx.encode())
+    pymunge.raw.munge_strerror(0)
+    assert calls == []
+    hooks.set_sample_rate(1)
+    pymunge.raw.munge_strerror(0)
+    assert [info.function for info in calls] == ['munge_strerror']
+
+def test_register_and_remove():
+    original = pymunge.raw.munge_encode
+    errcheck = pymunge._libmunge.munge_encode.errcheck
+
+    @hooks.on_call_start
+    def callback(info):
+        info.data['seen'] = True
+
+    assert hooks.active and pymunge._instrument.active
+    assert pymunge.raw.munge_encode is not original
+    pymunge.metrics.enable()
+    hooks.remove(callback)
+    with pytest.raises(ValueError):
+        hooks.remove(callback)
+    assert not hooks.active
+    assert pymunge._instrument.active
+    pymunge.metrics.disable()
+    assert not pymunge._instrument.active
+    assert pymunge.raw.munge_encode is original
+    assert pymunge._libmunge.munge_encode.errcheck is errcheck
+    assert pymunge._libmunge.check_and_raise is \
+        pymunge.raw.check_and_raise
+
+def test_callback_exception(calls):
+    def fail(info):
+        raise RuntimeError(info.function)
+
+    hooks.on_call_start(fail)
+    with pytest.raises(RuntimeError):
+        pymunge.raw.munge_strerror(0)
+    hooks.remove(fail)
+    assert calls == []
@@ -0,0 +1,208 @@
+#########################################################################
+# Tests for module pymunge.metrics
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+
+from pymunge.context import MungeContext, encode, decode
+from pymunge.error import MungeError
+from pymunge.pool import MungeContextPool, default_pool
+import pymunge.metrics as metrics
+
+import pytest
+import re
+import threading
+
+@pytest.fixture
+def enabled():
+    metrics.reset()
+    metrics.enable()
+    yield
+    metrics.disable()
+    metrics.reset()
+
+def test_histogram():
+    histogram = metrics.Histogram()
+    for value in range(1, 100001):
+        histogram.record(value * 10)
+    assert histogram.count == 100000
+    assert histogram.max == 1000000
+    for percent in (1, 50, 90, 99, 99.9):
+        expected = percent * 1e-5
+        assert abs(histogram.percentile(percent) - expected) <= \
+            expected / 16
+    assert histogram.percentile(100) == 1000000 / 1e9
+    assert histogram.mean() == pytest.approx(500005 / 1e9)
+    buckets = histogram.buckets()
+    for (lower, upper, count), (next_lower, _, _) in zip(buckets,
+                                                          buckets[1:]):
+        assert lower < upper <= next_lower
+        assert upper - lower <= max(1, lower // 16)
+    assert sum(count for lower, upper, count in buckets) == 100000
+
+def test_histogram_merge():
+    first = metrics.Histogram()
+    second = metrics.Histogram()
+    first.record(0)
+    first.record(1000)
+    second.record(1000)
+    second.record(-5)
+    first.merge(second)
+    assert first.count == 4
+    assert first.max == 1000
+    assert first.buckets() == [(0, 1, 2), (992, 1024, 2)]
+    assert metrics.Histogram().percentile(50) == 0.0
+
+def test_disabled():
+    metrics.reset()
+    assert not metrics.enabled
+    with MungeContext() as ctx:
+        ctx.decode(ctx.encode(b'x'))
+        ctx.ttl = 60
+    assert metrics.snapshot().series == []
+
+def test_encode_decode(enabled):
+    with MungeContext() as ctx:
+        cred = ctx.encode(b'x' * 100)
+        ctx.decode(cred)
+        with pytest.raises(MungeError):
+            ctx.decode(cred)
+        ttl = ctx.ttl
+        ctx.ttl = ttl
+    snapshot = metrics.snapshot()
+    [series] = snapshot.select('encode')
+    assert series.code == 'EMUNGE_SUCCESS'
+    # encodes are labelled with the types requested by the context
+    assert series.cipher == 'Default'
+    assert series.size == '1024'
+    assert series.option == ''
+    assert series.histogram.count == 1
+    assert snapshot.count('decode') == 2
+    [series] = snapshot.select('decode', code='EMUNGE_SUCCESS')
+    assert series.cipher == decoded_type(cred, 'cipher_type')
+    assert series.mac == decoded_type(cred, 'mac_type')
+    assert series.size == '1024'
+    assert snapshot.errors() == {'EMUNGE_CRED_REPLAYED': 1}
+    assert snapshot.count('option_get', option='ttl') == 1
+    assert snapshot.count('option_set', option='ttl') == 1
+    assert snapshot.count('ctx_create') == 1
+    assert snapshot.count('ctx_destroy') == 1
+    assert snapshot.histogram('decode').sum > 0
+    with pytest.raises(ValueError):
+        snapshot.select('decode', color='red')
+
+def decoded_type(cred, option):
+    with MungeContext() as ctx:
+        try:
+            ctx.decode(cred)
+        except MungeError:
+            pass
+        return getattr(ctx, option).name
+
+def test_errors(enabled):
+    with MungeContext() as ctx:
+        with pytest.raises(MungeError):
+            ctx.decode(b'MUNGE:invalid:')
+        ctx.close()
+        with pytest.raises(MungeError):
+            ctx.ttl
+    snapshot = metrics.snapshot()
+    [series] = snapshot.select('decode')
+    assert series.code != 'EMUNGE_SUCCESS'
+    assert (series.cipher, series.mac, series.zip) == ('', '', '')
+    # a closed context does not call libmunge
+    assert snapshot.select('option_get') == []
+
+def test_batches_and_pool(enabled):
+    # contexts returned to the default pool by earlier tests are only
+    # sorted (and replaced after a decode) by its next use
+    default_pool().clear()
+    metrics.reset()
+    pool = MungeContextPool()
+    with pool.acquire() as ctx:
+        creds = ctx.encode_many([b'a', None, b'c'])
+        ctx.decode_many(creds)
+        copy = MungeContext(ctx)
+        copy.close()
+    payload, uid, gid, ctx = decode(encode(b'pooled'))
+    ctx.close()
+    pool.clear()
+    default_pool().clear()
+    snapshot = metrics.snapshot()
+    assert snapshot.count('encode') == 4
+    assert snapshot.count('encode', size='0') == 1
+    assert snapshot.count('decode') == 4
+    # the explicit copy, and a fresh copy for each pooled context
+    # returned after a decode
+    assert snapshot.count('ctx_copy') == 3
+    assert snapshot.count('ctx_destroy') >= 2
+    assert snapshot.count('ctx_create') >= 1
+
+def test_threads(enabled):
+    def work():
+        with MungeContext() as ctx:
+            for i in range(10):
+                ctx.ttl = 60
+
+    threads = [threading.Thread(target=work) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert metrics.snapshot().count('option_set') == 40
+    metrics.reset()
+    assert metrics.snapshot().count('option_set') == 0
+
+def test_short_lived_threads(enabled):
+    def work():
+        with MungeContext() as ctx:
+            ctx.ttl = 60
+
+    for i in range(100):
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+    # the series of finished threads are merged, not kept per thread
+    assert len(metrics._thread_series) <= 1
+    assert metrics.snapshot().count('option_set') == 100
+
+def test_prometheus(enabled):
+    with MungeContext() as ctx:
+        cred = ctx.encode()
+        ctx.decode(cred)
+        with pytest.raises(MungeError):
+            ctx.decode(cred)
+    text = metrics.render_prometheus(prefix='test')
+    assert text.endswith('\n')
+    assert '# TYPE test_call_duration_seconds histogram' in text
+    assert '# TYPE test_errors_total counter' in text
+    assert 'test_errors_total{operation="decode",' \
+        'code="EMUNGE_CRED_REPLAYED"} 1' in text
+    pattern = re.compile(r'^test_call_duration_seconds_bucket\{'
+                         r'operation="encode",code="EMUNGE_SUCCESS",'
+                         r'(.*),le="([^"]+)"\} (\d+)$')
+    counts = [int(match.group(3)) for match in
+              map(pattern.match, text.splitlines()) if match]
+    assert len(counts) == len(metrics.PROMETHEUS_BUCKETS) + 1
+    assert counts == sorted(counts)
+    assert counts[-1] == 1
+    assert 'test_call_duration_seconds_count{operation="encode",' in text
+    assert 'option=' not in text.split('operation="encode"')[1] \
+        .splitlines()[0]
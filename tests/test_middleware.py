@@ -0,0 +1,244 @@
+#########################################################################
+# Tests for module pymunge.middleware
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+from pymunge.cache import CredentialCache
+from pymunge.context import MungeContext, encode, decode
+from pymunge.error import MungeError, MungeErrorCode
+from pymunge.middleware import MungeAuthenticator, MungeWSGIMiddleware, \
+    MungeASGIMiddleware, RESULT_KEY, REPLAY_ACCEPT
+from pymunge.testing import FakeMungeDaemon
+
+import asyncio
+import os
+import pytest
+import threading
+import wsgiref.util
+
+def run(coroutine):
+    return asyncio.new_event_loop().run_until_complete(coroutine)
+
+def wsgi_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    result = environ.get(RESULT_KEY)
+    return [b'anonymous' if result is None else result.payload]
+
+def call_wsgi(app, cred=None, method='GET', header='HTTP_AUTHORIZATION'):
+    environ = {'REQUEST_METHOD': method}
+    wsgiref.util.setup_testing_defaults(environ)
+    if cred is not None:
+        environ[header] = cred
+    response = {}
+
+    def start_response(status, headers):
+        response['status'] = status
+        response['headers'] = dict(headers)
+    body = b''.join(app(environ, start_response))
+    return response['status'], response['headers'], body
+
+def auth(cred):
+    return 'MUNGE ' + cred.decode('ascii')
+
+@pytest.fixture
+def authenticator():
+    authenticator = MungeAuthenticator(workers=2)
+    yield authenticator
+    authenticator.close()
+
+def test_wsgi(authenticator):
+    app = MungeWSGIMiddleware(wsgi_app, authenticator)
+    cred = encode(b'user data')
+    assert call_wsgi(app, auth(cred)) == \
+        ('200 OK', {'Content-Type': 'text/plain'}, b'user data')
+    status, headers, body = call_wsgi(app, auth(cred))
+    assert status == '401 Unauthorized'
+    assert headers['WWW-Authenticate'] == 'MUNGE'
+    assert body.startswith(b'EMUNGE_CRED_REPLAYED: ')
+    status, headers, body = call_wsgi(app)
+    assert status == '401 Unauthorized'
+    assert body.startswith(b'Missing MUNGE credential')
+    assert call_wsgi(app, 'Bearer abc')[0] == '401 Unauthorized'
+    status, headers, body = call_wsgi(app, 'MUNGE MUNGE:AAAA:')
+    assert status == '401 Unauthorized'
+    assert body.startswith(b'EMUNGE_BAD_CRED: ')
+    app = MungeWSGIMiddleware(wsgi_app, authenticator, required=False)
+    assert call_wsgi(app)[2] == b'anonymous'
+    assert call_wsgi(app, 'MUNGE MUNGE:AAAA:')[0] == '401 Unauthorized'
+
+def test_result(authenticator):
+    with MungeContext() as ctx:
+        ctx.ttl = 123
+        cred = ctx.encode(b'abc')
+    result = authenticator.validate(authenticator.credential(auth(cred)))
+    assert result.payload == b'abc'
+    assert result.uid == os.getuid()
+    assert result.gid == os.getgid()
+    assert result.ttl == 123
+    assert authenticator.pending == 0
+    with pytest.raises(MungeError) as excinfo:
+        authenticator.validate(cred)
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_CRED_REPLAYED
+    assert authenticator.credential(None) is None
+    assert authenticator.credential(b'munge  ' + cred + b' ') == cred
+    assert authenticator.credential('MUNGE') is None
+
+def test_replay_policy():
+    methods = []
+
+    def idempotent(result, environ):
+        methods.append(environ['REQUEST_METHOD'])
+        assert result.uid == os.getuid()
+        return environ['REQUEST_METHOD'] in ('GET', 'PUT')
+
+    with MungeContext() as ctx:
+        ctx.ttl = 60
+        creds = [ctx.encode(b'retry') for i in range(2)]
+    for cred in creds:
+        decode(cred)
+    authenticator = MungeAuthenticator(workers=1, replay=idempotent)
+    app = MungeWSGIMiddleware(wsgi_app, authenticator)
+    assert call_wsgi(app, auth(creds[0]), 'PUT')[2] == b'retry'
+    assert call_wsgi(app, auth(creds[0]), 'POST')[0] == '401 Unauthorized'
+    assert methods == ['PUT', 'POST']
+    authenticator.close()
+    authenticator = MungeAuthenticator(workers=1, replay=REPLAY_ACCEPT)
+    assert authenticator.validate(creds[1]).payload == b'retry'
+    authenticator.close()
+    with pytest.raises(MungeError):
+        authenticator.validate(creds[1])
+    with pytest.raises(ValueError):
+        MungeAuthenticator(replay='sometimes')
+
+def test_cache():
+    cache = CredentialCache()
+    authenticator = MungeAuthenticator(workers=1, cache=cache,
+                                       header='X-Munge-Credential',
+                                       scheme=None)
+    app = MungeWSGIMiddleware(wsgi_app, authenticator)
+    with MungeContext() as ctx:
+        ctx.ttl = 60
+        cred = ctx.encode(b'cached')
+    for i in range(3):
+        assert call_wsgi(app, cred.decode('ascii'),
+                         header='HTTP_X_MUNGE_CREDENTIAL')[2] == b'cached'
+    assert cache.stats().hits == 2
+    authenticator.close()
+
+def test_busy():
+    with FakeMungeDaemon(latency=0.5) as daemon:
+        with MungeContext() as ctx:
+            ctx.socket = daemon.socket_path
+            cred = ctx.encode()
+            authenticator = MungeAuthenticator(ctx, workers=1, max_pending=1,
+                                               timeout=0.1)
+        app = MungeWSGIMiddleware(wsgi_app, authenticator)
+        responses = []
+        thread = threading.Thread(
+            target=lambda: responses.append(call_wsgi(app, auth(cred))))
+        thread.start()
+        thread.join()
+        status, headers, body = responses[0]
+        assert status == '503 Service Unavailable'
+        assert headers['Retry-After'] == '1'
+        assert body.startswith(b'EMUNGE_TIMEOUT: Timed out')
+        # the decode is still running
+        assert authenticator.pending == 1
+        status, headers, body = call_wsgi(app, auth(cred))
+        assert status == '503 Service Unavailable'
+        assert b'Too many pending validations' in body
+        authenticator.close()
+        assert authenticator.pending == 0
+
+def test_auto_workers():
+    # the pool is sized when the authenticator is created, so that no
+    # request (possibly on an event loop) waits for the measurement
+    with FakeMungeDaemon() as daemon:
+        with MungeContext() as ctx:
+            ctx.socket = daemon.socket_path
+            cred = ctx.encode()
+            authenticator = MungeAuthenticator(ctx)
+        encodes = daemon.stats().encodes
+        assert encodes > 1
+        assert authenticator.max_pending == \
+            4 * authenticator._executor.max_workers
+        run(authenticator.validate_async(cred))
+        assert daemon.stats().encodes == encodes
+        authenticator.close()
+
+def test_asgi(authenticator):
+    async def asgi_app(scope, receive, send):
+        scopes.append(scope)
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': []})
+        await send({'type': 'http.response.body', 'body': b'ok'})
+
+    async def call(scope_type, headers):
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        async def receive():
+            return {'type': 'http.request'}
+
+        await app({'type': scope_type, 'headers': headers}, receive, send)
+        return messages
+
+    scopes = []
+    app = MungeASGIMiddleware(asgi_app, authenticator)
+    cred = encode(b'asgi')
+    messages = run(call('http', [(b'host', b'localhost'),
+                                 (b'authorization', b'MUNGE ' + cred)]))
+    assert messages[0]['status'] == 200
+    assert scopes[-1][RESULT_KEY].payload == b'asgi'
+    messages = run(call('http', [(b'authorization', b'MUNGE ' + cred)]))
+    assert messages[0]['status'] == 401
+    assert (b'www-authenticate', b'MUNGE') in messages[0]['headers']
+    assert messages[1]['body'].startswith(b'EMUNGE_CRED_REPLAYED: ')
+    messages = run(call('websocket', []))
+    assert messages == [{'type': 'websocket.close', 'code': 1008}]
+    run(call('lifespan', []))
+    assert scopes[-1] == {'type': 'lifespan', 'headers': []}
+    app = MungeASGIMiddleware(asgi_app, authenticator, required=False)
+    assert run(call('http', []))[0]['status'] == 200
+    assert RESULT_KEY not in scopes[-1]
+
+def test_shared_decode():
+    with FakeMungeDaemon(latency=0.2) as daemon:
+        with MungeContext() as ctx:
+            ctx.socket = daemon.socket_path
+            ctx.ttl = 60
+            cred = ctx.encode(b'retried')
+            authenticator = MungeAuthenticator(ctx, workers=2,
+                                               cache=CredentialCache())
+        app = MungeWSGIMiddleware(wsgi_app, authenticator)
+        responses = []
+        threads = [threading.Thread(
+            target=lambda: responses.append(call_wsgi(app, auth(cred))))
+            for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert [body for status, headers, body in responses] == \
+            [b'retried'] * 3
+        assert daemon.stats().decodes == 1
+        authenticator.close()
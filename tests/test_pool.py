@@ -0,0 +1,178 @@
+#########################################################################
+# Tests for module pymunge.pool
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+
+
+from pymunge.context import MungeContext, encode, decode
+from pymunge.enums import CipherType, MACType, UID_ANY
+from pymunge.spec import ContextSpec
+from pymunge.pool import MungeContextPool, default_pool
+
+import os
+import pytest
+
+class CountingSet(object):
+    def __init__(self, monkeypatch):
+        self.calls = 0
+        self._set_option = MungeContext._set_option
+        counter = self
+
+        def _set_option(self, *args):
+            counter.calls += 1
+            return counter._set_option(self, *args)
+        monkeypatch.setattr(MungeContext, '_set_option', _set_option)
+
+def test_acquire_reuses_context():
+    pool = MungeContextPool()
+    with pool.acquire() as ctx:
+        handle = ctx.ctx
+    assert ctx.closed
+    with pool.acquire() as ctx:
+        assert ctx.ctx == handle
+    stats = pool.stats()
+    assert stats.misses == 1
+    assert stats.hits == 1
+    assert stats.idle == 1
+
+def test_acquire_applies_spec():
+    pool = MungeContextPool()
+    spec = ContextSpec(cipher_type=CipherType.AES128, ttl=120,
+                       uid_restriction=os.getuid())
+    with pool.acquire(spec) as ctx:
+        assert ctx.cipher_type == CipherType.AES128
+        assert ctx.ttl == 120
+        assert ctx.uid_restriction == os.getuid()
+        cred = ctx.encode(b'pooled')
+    with MungeContext() as ctx:
+        assert ctx.decode(cred) == (b'pooled', os.getuid(), os.getgid())
+        assert ctx.cipher_type == CipherType.AES128
+
+def test_reuse_sets_only_differing_options(monkeypatch):
+    pool = MungeContextPool()
+    pool.acquire(ContextSpec(ttl=120)).close()
+    counter = CountingSet(monkeypatch)
+    with pool.acquire(ContextSpec(ttl=120)) as ctx:
+        pass
+    assert counter.calls == 0
+    with pool.acquire(ContextSpec(ttl=120, mac_type=MACType.SHA256)) as ctx:
+        assert ctx.ttl == 120
+        assert ctx.mac_type == MACType.SHA256
+    assert counter.calls == 1
+    stats = pool.stats()
+    assert stats.hits == 1
+    assert stats.reuses == 1
+    assert stats.misses == 1
+
+def test_reset_after_modification():
+    pool = MungeContextPool()
+    with pool.acquire() as ctx:
+        ctx.ttl = 77
+        ctx.uid_restriction = os.getuid()
+    with pool.acquire() as ctx:
+        assert ctx.ttl == ContextSpec().ttl
+        assert ctx.uid_restriction == UID_ANY
+    assert pool.stats().resets == 1
+
+def test_reset_after_decode():
+    with MungeContext() as ctx:
+        ctx.cipher_type = CipherType.AES128
+        ctx.ttl = 33
+        cred = ctx.encode()
+    pool = MungeContextPool()
+    with pool.acquire() as ctx:
+        ctx.decode(cred)
+        assert ctx.ttl == 33
+    with pool.acquire() as ctx:
+        assert ctx.cipher_type == CipherType.Default
+        assert ctx.ttl == ContextSpec().ttl
+    stats = pool.stats()
+    assert stats.resets == 1
+    assert stats.hits == 1
+
+def test_decode_state_reset():
+    with MungeContext() as ctx:
+        ctx.ttl = 60
+        creds = [ctx.encode() for i in range(2)]
+    pool = MungeContextPool()
+    spec = ContextSpec(ttl=120)
+    for cred in creds:
+        with pool.acquire(spec) as ctx:
+            assert ctx.encode_time == 0
+            assert ctx.decode_time == 0
+            assert ctx.addr4 == '0.0.0.0'
+            assert ctx.ttl == 120
+            ctx.decode(cred)
+            assert ctx.encode_time != 0
+            assert ctx.decode_time != 0
+    with pool.acquire(spec) as ctx:
+        assert ctx.encode_time == 0
+        assert ctx.decode_time == 0
+        assert ctx.addr4 == '0.0.0.0'
+        assert ctx.ttl == 120
+    stats = pool.stats()
+    assert stats.hits == 2
+    assert stats.resets == 2
+
+def test_unmodified_context_not_reset(monkeypatch):
+    pool = MungeContextPool()
+    with pool.acquire() as ctx:
+        ctx.encode()
+    counter = CountingSet(monkeypatch)
+    pool.acquire().close()
+    assert counter.calls == 0
+    assert pool.stats().resets == 0
+
+def test_garbage_collected_context_returned():
+    pool = MungeContextPool()
+    ctx = pool.acquire()
+    handle = ctx.ctx
+    del ctx
+    with pool.acquire() as ctx:
+        assert ctx.ctx == handle
+
+def test_max_idle():
+    pool = MungeContextPool(max_idle=1)
+    contexts = [pool.acquire() for i in range(3)]
+    for ctx in contexts:
+        ctx.close()
+    stats = pool.stats()
+    assert stats.misses == 3
+    assert stats.idle == 1
+    assert stats.discarded == 2
+    pool.clear()
+    assert pool.stats().idle == 0
+    with pytest.raises(ValueError):
+        MungeContextPool(max_idle=-1)
+
+def test_module_functions_use_default_pool():
+    pool = default_pool()
+    assert default_pool() is pool
+    before = pool.stats()
+    cred = encode(b'default')
+    payload, uid, gid, ctx = decode(cred)
+    assert payload == b'default'
+    ctx.close()
+    encode()
+    after = pool.stats()
+    assert after.hits + after.reuses + after.misses == \
+        before.hits + before.reuses + before.misses + 3
+    assert after.hits >= before.hits + 2
@@ -0,0 +1,100 @@
+#########################################################################
+# Tests for module pymunge.prefetch
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+from pymunge.context import decode
+from pymunge.error import MungeError, MungeErrorCode
+from pymunge.prefetch import CredentialPrefetcher
+from pymunge.spec import ContextSpec
+
+import os
+import pytest
+import subprocess
+import sys
+import time
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+def test_take_from_reserve():
+    spec = ContextSpec(ttl=60)
+    with CredentialPrefetcher([spec], min_level=3) as prefetcher:
+        wait_for(lambda: prefetcher.stats(spec).level == 3)
+        assert prefetcher.stats(spec).oldest_age >= 0
+        result = decode(prefetcher.take(spec), True)
+        assert result.ttl == 60
+        assert result.payload == b''
+        stats = prefetcher.stats(spec)
+        assert stats.takes == stats.hits == 1
+        assert stats.misses == 0
+        assert stats.minted >= 3
+
+def test_take_unknown_spec():
+    with CredentialPrefetcher() as prefetcher:
+        cred = prefetcher.take()
+        assert decode(cred, True).payload == b''
+        assert prefetcher.stats().takes == 1
+        wait_for(lambda: prefetcher.stats().level >= 2)
+    assert prefetcher.closed
+    prefetcher.close()
+    with pytest.raises(MungeError) as excinfo:
+        prefetcher.take()
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_BAD_ARG
+
+def test_expiring_credentials_evicted():
+    spec = ContextSpec(ttl=30)
+    with CredentialPrefetcher(min_level=0, max_level=1) as prefetcher:
+        reserve = prefetcher.add(spec)
+        reserve.creds.appendleft((time.time() - 1, b'stale'))
+        assert prefetcher.take(spec) != b'stale'
+        assert prefetcher.stats(spec).evicted == 1
+    with pytest.raises(ValueError):
+        CredentialPrefetcher([ContextSpec(ttl=10)], margin=10)
+
+def test_target_adapts_to_demand():
+    spec = ContextSpec(ttl=60)
+    with CredentialPrefetcher([spec], min_level=1, max_level=8,
+                              horizon=1.0) as prefetcher:
+        for i in range(100):
+            prefetcher.take(spec)
+            time.sleep(0.002)
+        wait_for(lambda: prefetcher.stats(spec).target == 8)
+        wait_for(lambda: prefetcher.stats(spec).level == 8)
+        assert prefetcher.stats(spec).rate > 8
+
+def test_failing_reserve_does_not_block_others():
+    bad = ContextSpec(socket='/nonexistent/munge.socket')
+    good = ContextSpec(ttl=60)
+    with CredentialPrefetcher([bad, good], min_level=2) as prefetcher:
+        wait_for(lambda: prefetcher.stats(good).level == 2)
+        wait_for(lambda: prefetcher.stats(bad).errors >= 2)
+        assert prefetcher.stats(bad).level == 0
+
+def test_lazy_import():
+    code = ('import sys, pymunge; '
+            'assert "pymunge.prefetch" not in sys.modules; '
+            'assert pymunge.CredentialPrefetcher is '
+            'sys.modules["pymunge.prefetch"].CredentialPrefetcher')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    assert subprocess.call([sys.executable, '-c', code], cwd=root) == 0
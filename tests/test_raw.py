@@ -0,0 +1,205 @@
+#########################################################################
+# Tests for module pymunge.raw
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+
+
+from pymunge.context import MungeContext
+from pymunge.error import MungeError, MungeErrorCode
+from pymunge._libmunge import LIBMUNGE_ENV
+import pymunge
+import pymunge.raw
+
+import ctypes
+import os
+import pytest
+import subprocess
+import sys
+
+libc_malloc = pymunge.raw.libc.malloc
+libc_malloc.restype = ctypes.c_void_p
+libc_malloc.argtypes = [ctypes.c_size_t]
+
+def malloc_bytes(data):
+    address = libc_malloc(len(data) + 1)
+    ctypes.memmove(address, data + b'\0', len(data) + 1)
+    return address
+
+class CountingFree(object):
+    def __init__(self, monkeypatch):
+        self.addresses = []
+        self._free = pymunge.raw._free
+        monkeypatch.setattr(pymunge.raw, '_free', self)
+
+    def __call__(self, address):
+        self.addresses.append(address)
+        self._free(address)
+
+def test_take_bytes(monkeypatch):
+    counter = CountingFree(monkeypatch)
+    address = malloc_bytes(b'native')
+    assert pymunge.raw.take_bytes(address) == b'native'
+    address2 = malloc_bytes(b'native')
+    assert pymunge.raw.take_bytes(address2, 3) == b'nat'
+    assert counter.addresses == [address, address2]
+    assert pymunge.raw.take_bytes(None) == b''
+    assert pymunge.raw.take_bytes(None, 0) == b''
+    assert len(counter.addresses) == 2
+
+def test_native_buffer(monkeypatch):
+    counter = CountingFree(monkeypatch)
+    address = malloc_bytes(b'buffer')
+    with pymunge.raw.NativeBuffer(address, 6) as buf:
+        assert len(buf) == 6
+        assert not buf.freed
+        assert buf.tobytes() == b'buffer'
+    assert buf.freed
+    buf.free()
+    assert counter.addresses == [address]
+
+    address = malloc_bytes(b'take')
+    buf = pymunge.raw.NativeBuffer(address, 4)
+    assert buf.take() == b'take'
+    assert buf.freed
+    assert buf.tobytes() == b''
+
+    address = malloc_bytes(b'collected')
+    buf = pymunge.raw.NativeBuffer(address, 9)
+    del buf
+    assert counter.addresses[-1] == address
+    assert pymunge.raw.NativeBuffer(None, 0).freed
+
+def test_encode_decode_free(monkeypatch):
+    with MungeContext() as ctx:
+        counter = CountingFree(monkeypatch)
+        cred = pymunge.raw.munge_encode(ctx.ctx, b'payload', 7)
+        assert len(counter.addresses) == 1
+        assert pymunge.raw.munge_decode(cred, ctx.ctx)[0] == b'payload'
+        assert len(counter.addresses) == 2
+
+def test_decode_error_path_frees(monkeypatch):
+    with MungeContext() as ctx:
+        cred = ctx.encode(b'replayed')
+        ctx.decode(cred)
+        counter = CountingFree(monkeypatch)
+        with pytest.raises(MungeError) as exc_info:
+            ctx.decode(cred)
+        assert exc_info.value.code == MungeErrorCode.EMUNGE_CRED_REPLAYED
+        assert exc_info.value.result[0] == b'replayed'
+        assert len(counter.addresses) == 1
+
+def test_batch_free(monkeypatch):
+    with MungeContext() as ctx:
+        counter = CountingFree(monkeypatch)
+        creds = ctx.encode_many([b'a', b'b', None])
+        assert len(counter.addresses) == 3
+        batch = ctx.decode_many(creds + [creds[0]])
+        assert batch.payloads == [b'a', b'b', b'', b'a']
+        # all payloads are freed, including that of the replayed one;
+        # munge_decode may not allocate a buffer for an empty payload
+        assert len(counter.addresses) >= 6
+
+def test_compat_ctx_get_set():
+    with MungeContext() as ctx:
+        pymunge.raw.munge_ctx_set(ctx.ctx, pymunge.raw.MUNGE_OPT_TTL,
+                                  ctypes.c_int(123))
+        val = ctypes.c_int()
+        pymunge.raw.munge_ctx_get(ctx.ctx, pymunge.raw.MUNGE_OPT_TTL,
+                                  ctypes.byref(val))
+        assert val.value == 123
+        assert ctx.ttl == 123
+
+def test_typed_ctx_get_set():
+    with MungeContext() as ctx:
+        buffers = pymunge.raw.ContextBuffers()
+        set_uint = buffers.setters[ctypes.c_uint]
+        assert set_uint(ctx.ctx, pymunge.raw.MUNGE_OPT_UID_RESTRICTION,
+                        4321) == 0
+        get_uint, value, ref = buffers.getters[ctypes.c_uint]
+        assert get_uint(ctx.ctx, pymunge.raw.MUNGE_OPT_UID_RESTRICTION,
+                        ref) == 0
+        assert value.value == 4321
+        assert ctx.uid_restriction == 4321
+
+        set_str = buffers.setters[ctypes.c_char_p]
+        assert set_str(ctx.ctx, pymunge.raw.MUNGE_OPT_SOCKET,
+                       b'/tmp/typed.socket') == 0
+        get_str, value, ref = buffers.getters[ctypes.c_char_p]
+        assert get_str(ctx.ctx, pymunge.raw.MUNGE_OPT_SOCKET, ref) == 0
+        assert value.value == b'/tmp/typed.socket'
+
+        # an invalid option is reported through the return value
+        get_int, value, ref = buffers.getters[ctypes.c_int]
+        assert get_int(ctx.ctx, 1000, ref) != 0
+
+def test_encode_error_result():
+    with MungeContext() as ctx:
+        ctx.socket = '/this/socket/path/should/really/not/exist'
+        with pytest.raises(MungeError) as excinfo:
+            pymunge.raw.munge_encode(ctx.ctx, None, 0)
+        assert excinfo.value.code == MungeErrorCode.EMUNGE_SOCKET
+        assert excinfo.value.result is None
+        with pytest.raises(MungeError) as excinfo:
+            ctx.encode(b'fast path')
+        assert excinfo.value.code == MungeErrorCode.EMUNGE_SOCKET
+        assert excinfo.value.result is None
+
+def run_python(code, env=None):
+    environ = dict(os.environ)
+    environ['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(pymunge.__file__)))]
+        + sys.path)
+    environ.pop(LIBMUNGE_ENV, None)
+    if env:
+        environ.update(env)
+    process = subprocess.Popen([sys.executable, '-c', code], env=environ,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    return process.returncode, stdout, stderr
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason="libmunge is loaded on import before 3.7")
+def test_lazy_load():
+    returncode, stdout, stderr = run_python(
+        "import sys, pymunge\n"
+        "lazy = ['pymunge._libmunge', 'pymunge.executor', 'socket']\n"
+        "print([name for name in lazy if name in sys.modules])\n"
+        "pymunge.raw.munge_strerror\n"
+        "print('pymunge._libmunge' in sys.modules)\n")
+    assert returncode == 0, stderr
+    assert stdout.split() == [b'[]', b'True']
+
+def test_libmunge_env():
+    filename = pymunge.raw.libmunge._name
+    returncode, stdout, stderr = run_python(
+        "import pymunge.raw\n"
+        "print(pymunge.raw.libmunge_filename)\n",
+        {LIBMUNGE_ENV: filename})
+    assert returncode == 0, stderr
+    assert stdout.strip() == filename.encode()
+
+    returncode, stdout, stderr = run_python(
+        "import pymunge.raw\n"
+        "pymunge.raw.load()\n",
+        {LIBMUNGE_ENV: '/this/library/should/really/not/exist.so'})
+    assert returncode != 0
+    assert b'ImportError' in stderr
@@ -0,0 +1,101 @@
+#########################################################################
+# Tests for module pymunge.result
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+
+
+from pymunge.context import MungeContext, encode, decode
+from pymunge.enums import CipherType, MACType, ZipType, UID_ANY, GID_ANY
+from pymunge.error import MungeError, MungeErrorCode
+from pymunge.result import DecodeResult
+
+import os
+import pickle
+import pytest
+
+def test_snapshot_matches_context():
+    with MungeContext() as ctx:
+        ctx.cipher_type = CipherType.AES128
+        ctx.mac_type = MACType.SHA256
+        ctx.ttl = 180
+        ctx.uid_restriction = os.getuid()
+        cred = ctx.encode(b'snapshot')
+
+    with MungeContext() as ctx:
+        result = ctx.decode(cred, snapshot=True)
+        assert isinstance(result, DecodeResult)
+        assert result.payload == b'snapshot'
+        assert result.uid == os.getuid()
+        assert result.gid == os.getgid()
+        for name in ('cipher_type', 'mac_type', 'zip_type', 'realm', 'ttl',
+                     'addr4', 'encode_time', 'decode_time',
+                     'uid_restriction', 'gid_restriction'):
+            assert getattr(result, name) == getattr(ctx, name)
+    # no open context needed afterwards
+    assert result.cipher_type == CipherType.AES128
+    assert result.mac_type == MACType.SHA256
+    assert result.ttl == 180
+    assert result.uid_restriction == os.getuid()
+    assert result.gid_restriction == GID_ANY
+
+def test_snapshot_unpacks_like_tuple():
+    with MungeContext() as ctx:
+        payload, uid, gid = ctx.decode(encode(b'tuple'), snapshot=True)
+    assert (payload, uid, gid) == (b'tuple', os.getuid(), os.getgid())
+
+def test_snapshot_is_immutable():
+    result = decode(encode(), snapshot=True)
+    assert result.payload == b''
+    with pytest.raises(AttributeError):
+        result.uid = 0
+    with pytest.raises(AttributeError):
+        result.extra = 1
+
+def test_snapshot_replayed():
+    cred = encode(b'Fred')
+    decode(cred, snapshot=True)
+    with pytest.raises(MungeError) as excinfo:
+        decode(cred, snapshot=True)
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_CRED_REPLAYED
+    result = excinfo.value.result
+    assert isinstance(result, DecodeResult)
+    assert tuple(result) == (b'Fred', os.getuid(), os.getgid())
+    assert result.encode_time > 0
+
+def test_snapshot_invalid_credential():
+    with pytest.raises(MungeError) as excinfo:
+        decode(b'MUNGE:invalid:', snapshot=True)
+    assert excinfo.value.code != MungeErrorCode.EMUNGE_SUCCESS
+    assert not isinstance(excinfo.value.result, DecodeResult)
+
+def test_construct_and_pickle():
+    result = DecodeResult(b'data', 1000, 100, CipherType.AES256, 5, 1,
+                          None, 300, '127.0.0.1', 1500000000, 1500000001)
+    assert result.cipher_type == CipherType.AES256
+    assert result.mac_type == MACType.SHA256
+    assert result.zip_type == ZipType.Default
+    assert result.addr4 == '127.0.0.1'
+    assert result.uid_restriction == UID_ANY
+    copy = pickle.loads(pickle.dumps(result))
+    assert copy == result
+    assert copy != DecodeResult(b'other', 1000, 100, 5, 5, 1, None, 300,
+                                '127.0.0.1', 1500000000, 1500000001)
+    assert 'AES256' in repr(result)
@@ -0,0 +1,76 @@
+#########################################################################
+# Tests for module pymunge.spec
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+
+from pymunge.context import MungeContext
+from pymunge.enums import CipherType, MACType, ZipType, \
+    TTL_DEFAULT, UID_ANY, GID_ANY
+from pymunge.spec import ContextSpec
+
+import pickle
+import pytest
+
+def test_default_spec():
+    spec = ContextSpec()
+    assert spec.cipher_type == CipherType.Default
+    assert spec.mac_type == MACType.Default
+    assert spec.zip_type == ZipType.Default
+    assert spec.realm is None
+    assert spec.ttl == TTL_DEFAULT
+    assert spec.socket is None
+    assert spec.uid_restriction == UID_ANY
+    assert spec.gid_restriction == GID_ANY
+
+def test_spec_is_immutable_and_picklable():
+    spec = ContextSpec(cipher_type=CipherType.AES256, ttl=42)
+    with pytest.raises(AttributeError):
+        spec.ttl = 43
+    assert pickle.loads(pickle.dumps(spec)) == spec
+    assert hash(spec) == hash(ContextSpec(CipherType.AES256, ttl=42))
+
+def test_spec_type_checks():
+    with pytest.raises(TypeError):
+        ContextSpec(cipher_type=MACType.SHA1)
+    with pytest.raises(TypeError):
+        ContextSpec(ttl='42')
+    with pytest.raises(TypeError):
+        ContextSpec(socket=42)
+
+def test_spec_roundtrip():
+    spec = ContextSpec(CipherType.CAST5, MACType.RIPEMD160, ZipType.bzlib,
+                       'My Pretty Realm', 42, '/tmp/some.socket', 105, 1592)
+    with spec.create_context() as ctx:
+        assert ctx.cipher_type == CipherType.CAST5
+        assert ctx.mac_type == MACType.RIPEMD160
+        assert ctx.zip_type == ZipType.bzlib
+        assert ctx.realm == 'My Pretty Realm'
+        assert ctx.ttl == 42
+        assert ctx.socket == '/tmp/some.socket'
+        assert ctx.uid_restriction == 105
+        assert ctx.gid_restriction == 1592
+        assert ContextSpec.from_context(ctx) == spec
+
+def test_spec_default_socket():
+    with MungeContext() as ctx:
+        default_socket = ctx.socket
+    with ContextSpec().create_context() as ctx:
+        assert ctx.socket == default_socket
@@ -0,0 +1,155 @@
+#########################################################################
+# Tests for module pymunge.stream
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+from pymunge.context import MungeContext, encode
+from pymunge.error import MungeError, MungeErrorCode
+from pymunge.stream import StreamDigest, StreamReader, StreamWriter, \
+    encode_stream, verify_stream, pack_payload, unpack_payload, \
+    DEFAULT_CHUNK_SIZE, STREAM_MAGIC, VERSION
+
+import hashlib
+import io
+import os
+import pytest
+import socket
+import struct
+import threading
+
+def write_stream(chunks, **kwargs):
+    fileobj = io.BytesIO()
+    with StreamWriter(fileobj, **kwargs) as writer:
+        for chunk in chunks:
+            assert writer.write(chunk) == len(chunk)
+    return fileobj.getvalue()
+
+def test_roundtrip():
+    chunks = [os.urandom(n) for n in (0, 1, 100, 5000, 3, 70000)]
+    data = write_stream(chunks, chunk_size=4096)
+    reader = StreamReader(io.BytesIO(data))
+    assert reader.result is None
+    assert b''.join(reader) == b''.join(chunks)
+    assert reader.result.uid == os.getuid()
+    assert reader.read() == b''
+
+def test_read_sizes():
+    data = write_stream([b'abcdef', b'ghij'], chunk_size=4)
+    reader = StreamReader(io.BytesIO(data))
+    assert reader.read(3) == b'abc'
+    assert reader.read(3) == b'd'
+    assert reader.read() == b'efghij'
+    assert reader.result is not None
+
+class RecordingFile(io.BytesIO):
+    def __init__(self, data):
+        super(RecordingFile, self).__init__(data)
+        self.sizes = []
+
+    def read(self, size=-1):
+        self.sizes.append(size)
+        return super(RecordingFile, self).read(size)
+
+def test_bounded_reads():
+    data = write_stream([b'y' * (3 * DEFAULT_CHUNK_SIZE + 5)],
+                        chunk_size=4 * DEFAULT_CHUNK_SIZE)
+    fileobj = RecordingFile(data)
+    reader = StreamReader(fileobj)
+    assert reader.read() == b'y' * (3 * DEFAULT_CHUNK_SIZE + 5)
+    assert reader.result is not None
+    assert max(fileobj.sizes) <= DEFAULT_CHUNK_SIZE
+
+def test_oversized_frames():
+    header = STREAM_MAGIC + bytearray([VERSION, 6]) + b'sha256'
+    for frame_type, length in ((1, 0xffffffff), (2, 1 << 20)):
+        fileobj = RecordingFile(header + struct.pack('>BI', frame_type,
+                                                     length))
+        with pytest.raises(MungeError) as excinfo:
+            StreamReader(fileobj).read()
+        assert excinfo.value.code == MungeErrorCode.EMUNGE_BAD_CRED
+        assert max(fileobj.sizes) < 100
+
+def test_tampered_stream():
+    data = bytearray(write_stream([b'x' * 1000]))
+    data[100] ^= 1
+    reader = StreamReader(io.BytesIO(bytes(data)))
+    with pytest.raises(MungeError) as excinfo:
+        reader.read()
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_CRED_INVALID
+    assert excinfo.value.result.uid == os.getuid()
+
+def test_truncated_stream():
+    data = write_stream([b'x' * 1000])
+    for length in (3, 20, 1000):
+        with pytest.raises(MungeError) as excinfo:
+            StreamReader(io.BytesIO(data[:length])).read()
+        assert excinfo.value.code in (MungeErrorCode.EMUNGE_BAD_LENGTH,
+                                      MungeErrorCode.EMUNGE_BAD_CRED)
+    fileobj = io.BytesIO()
+    with pytest.raises(RuntimeError):
+        with StreamWriter(fileobj) as writer:
+            writer.write(b'data')
+            raise RuntimeError
+    with pytest.raises(MungeError) as excinfo:
+        StreamReader(io.BytesIO(fileobj.getvalue())).read()
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_BAD_LENGTH
+
+def test_socket():
+    left, right = socket.socketpair()
+    chunks = [os.urandom(10000) for i in range(20)]
+
+    def send():
+        with left, left.makefile('wb') as fileobj:
+            with StreamWriter(fileobj, algorithm='sha512') as writer:
+                for chunk in chunks:
+                    writer.write(chunk)
+
+    thread = threading.Thread(target=send)
+    thread.start()
+    with right, right.makefile('rb') as fileobj:
+        reader = StreamReader(fileobj)
+        assert b''.join(reader) == b''.join(chunks)
+    thread.join()
+    assert reader.digest.algorithm == 'sha512'
+
+def test_detached():
+    data = os.urandom(300000)
+    with MungeContext() as ctx:
+        cred = encode_stream(io.BytesIO(data), ctx, chunk_size=1000)
+        result = verify_stream(io.BytesIO(data), cred, ctx)
+    assert unpack_payload(result.payload) == \
+        ('sha256', len(data), hashlib.sha256(data).digest())
+    with pytest.raises(MungeError) as excinfo:
+        verify_stream(io.BytesIO(data[1:]), encode_stream(io.BytesIO(data)))
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_CRED_INVALID
+    with pytest.raises(MungeError) as excinfo:
+        verify_stream(io.BytesIO(data), encode(b'payload'))
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_BAD_CRED
+
+def test_payload():
+    digest = StreamDigest('sha1')
+    digest.update(b'abc')
+    digest.update(bytearray(b'def'))
+    payload = digest.payload()
+    assert payload == pack_payload('sha1', 6, digest.digest())
+    assert unpack_payload(payload) == ('sha1', 6, digest.digest())
+    for invalid in (b'', payload[:-1], b'PMSD\x02' + payload[5:]):
+        with pytest.raises(MungeError):
+            unpack_payload(invalid)
@@ -0,0 +1,169 @@
+#########################################################################
+# Tests for module pymunge.testing
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+
+from pymunge.client import SelectorClient
+from pymunge.context import MungeContext, encode, decode
+from pymunge.enums import CipherType, MACType, ZipType
+from pymunge.error import MungeError, MungeErrorCode
+from pymunge.spec import ContextSpec
+from pymunge.testing import FakeMungeDaemon, DEFAULT_TTL, MAX_TTL
+
+import os
+import pytest
+import time
+
+def test_fixture(fake_munged):
+    with MungeContext() as ctx:
+        assert ctx.socket == fake_munged.socket_path
+        cred = ctx.encode(b'payload')
+        assert ctx.decode(cred) == (b'payload', os.getuid(), os.getgid())
+        assert ctx.cipher_type == CipherType.AES128
+        assert ctx.mac_type == MACType.SHA256
+        assert ctx.zip_type == ZipType.Disabled
+        assert ctx.ttl == DEFAULT_TTL
+        assert ctx.addr4 == '127.0.0.1'
+    payload, uid, gid, ctx = decode(encode(b'pooled'))
+    ctx.close()
+    assert payload == b'pooled'
+    stats = fake_munged.stats()
+    assert stats.encodes == 2
+    assert stats.decodes == 2
+
+def test_options(fake_munged):
+    with MungeContext() as ctx:
+        ctx.cipher_type = CipherType.CAST5
+        ctx.ttl = 10 * MAX_TTL
+        cred = ctx.encode()
+    with MungeContext() as ctx:
+        ctx.decode(cred)
+        assert ctx.cipher_type == CipherType.CAST5
+        assert ctx.ttl == MAX_TTL
+
+def test_decode_errors(fake_munged):
+    with MungeContext() as ctx:
+        cred = ctx.encode(b'once')
+        ctx.decode(cred)
+        with pytest.raises(MungeError) as excinfo:
+            ctx.decode(cred)
+        assert excinfo.value.code == MungeErrorCode.EMUNGE_CRED_REPLAYED
+        assert excinfo.value.result[0] == b'once'
+
+        with pytest.raises(MungeError) as excinfo:
+            ctx.decode(b'MUNGE:not a credential:')
+        assert excinfo.value.code == MungeErrorCode.EMUNGE_BAD_CRED
+
+        tampered = cred[:10] + (b'B' if cred[10:11] == b'A' else b'A') + \
+            cred[11:]
+        with pytest.raises(MungeError) as excinfo:
+            ctx.decode(tampered)
+        assert excinfo.value.code == MungeErrorCode.EMUNGE_CRED_INVALID
+
+        ctx.uid_restriction = os.getuid() + 1
+        cred = ctx.encode()
+        with pytest.raises(MungeError) as excinfo:
+            ctx.decode(cred)
+        assert excinfo.value.code == \
+            MungeErrorCode.EMUNGE_CRED_UNAUTHORIZED
+
+def test_injected_errors():
+    replayed = MungeErrorCode.EMUNGE_CRED_REPLAYED
+    with FakeMungeDaemon(error_rates={replayed: 1.0}) as daemon:
+        with MungeContext() as ctx:
+            ctx.socket = daemon.socket_path
+            cred = ctx.encode(b'injected')
+            with pytest.raises(MungeError) as excinfo:
+                ctx.decode(cred)
+            assert excinfo.value.code == replayed
+            assert excinfo.value.result[0] == b'injected'
+        assert daemon.stats().injected == {replayed: 1}
+
+        spec = ContextSpec(socket=daemon.socket_path)
+        daemon.error_rates = {MungeErrorCode.EMUNGE_SOCKET: 1.0}
+        with SelectorClient(spec) as client:
+            with pytest.raises(MungeError) as excinfo:
+                client.encode()
+            assert excinfo.value.code == MungeErrorCode.EMUNGE_SOCKET
+
+        daemon.error_rates = {MungeErrorCode.EMUNGE_TIMEOUT: 1.0}
+        with SelectorClient(spec, timeout=0.2) as client:
+            with pytest.raises(MungeError) as excinfo:
+                client.encode()
+            assert excinfo.value.code == MungeErrorCode.EMUNGE_TIMEOUT
+
+    with pytest.raises(ValueError):
+        FakeMungeDaemon(error_rates={MungeErrorCode.EMUNGE_SUCCESS: 0.5})
+
+def test_error_rate():
+    rates = {MungeErrorCode.EMUNGE_CRED_REPLAYED: 0.5}
+    with FakeMungeDaemon(error_rates=rates, seed=1) as daemon:
+        spec = ContextSpec(socket=daemon.socket_path)
+        with SelectorClient(spec) as client:
+            creds = [client.encode() for i in range(200)]
+            requests = [client.submit_decode(cred) for cred in creds]
+            client.wait()
+        failed = sum(1 for request in requests if request._error)
+        assert failed == daemon.stats().injected[
+            MungeErrorCode.EMUNGE_CRED_REPLAYED]
+        assert 50 < failed < 150
+
+def test_latency_and_workers():
+    with FakeMungeDaemon(workers=2, latency=0.1) as daemon:
+        spec = ContextSpec(socket=daemon.socket_path)
+        with SelectorClient(spec) as client:
+            start = time.time()
+            requests = [client.submit_encode() for i in range(4)]
+            client.wait()
+            elapsed = time.time() - start
+        assert all(request.result() for request in requests)
+        # 4 requests on 2 workers take 2 rounds of 0.1 seconds
+        assert 0.2 <= elapsed < 0.35
+
+def test_replay_cache_pruned(monkeypatch):
+    with FakeMungeDaemon() as daemon:
+        with MungeContext() as ctx:
+            ctx.socket = daemon.socket_path
+            ctx.ttl = 10
+            creds = [ctx.encode() for i in range(5)]
+            for cred in creds:
+                ctx.decode(cred)
+            assert len(daemon._decoded) == 5
+            with pytest.raises(MungeError) as excinfo:
+                ctx.decode(creds[0])
+            assert excinfo.value.code == \
+                MungeErrorCode.EMUNGE_CRED_REPLAYED
+            # once they have expired, the credentials are forgotten
+            now = time.time()
+            monkeypatch.setattr(time, 'time', lambda: now + 60)
+            ctx.ttl = 300
+            ctx.decode(ctx.encode())
+            assert len(daemon._decoded) == 1
+
+def test_stop_removes_socket():
+    daemon = FakeMungeDaemon()
+    daemon.start()
+    assert daemon.running
+    assert os.path.exists(daemon.socket_path)
+    daemon.stop()
+    assert not daemon.running
+    assert not os.path.exists(daemon.socket_path)
+    daemon.stop()
@@ -0,0 +1,134 @@
+#########################################################################
+# Tests for module pymunge.tune
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+from pymunge.context import decode
+from pymunge.enums import CipherType, MACType, ZipType
+from pymunge.spec import ContextSpec
+from pymunge.tune import Measurement, Policy, TuningProfile
+import pymunge.tune
+
+import pytest
+
+def measurement(cipher_type, mac_type, size, encode_time, decode_time=0,
+                cred_length=100):
+    return Measurement(cipher_type, mac_type, ZipType.Disabled, size,
+                       encode_time, decode_time, cred_length)
+
+PROFILE = TuningProfile([
+    measurement(CipherType.Disabled, MACType.MD5, 64, 1),
+    measurement(CipherType.AES128, MACType.MD5, 64, 2, cred_length=150),
+    measurement(CipherType.AES128, MACType.SHA256, 64, 3),
+    measurement(CipherType.AES256, MACType.SHA512, 64, 2, 2),
+    measurement(CipherType.AES128, MACType.SHA256, 1024, 1),
+    measurement(CipherType.AES256, MACType.SHA512, 1024, 2),
+], {'host': 'test'})
+
+def test_available_types():
+    types = pymunge.tune.available_types()
+    assert sorted(types) == ['cipher_type', 'mac_type', 'zip_type']
+    assert CipherType.Default not in types['cipher_type']
+    assert MACType.Disabled not in types['mac_type']
+    assert ZipType.Disabled in types['zip_type']
+
+def test_best():
+    assert PROFILE.sizes == [64, 1024]
+    # MD5 and SHA-1 are not chosen by default
+    assert PROFILE.best(0).cipher_type == CipherType.AES128
+    assert PROFILE.best(0).mac_type == MACType.SHA256
+    assert PROFILE.best(100).mac_type == MACType.SHA256
+    assert PROFILE.best(10 ** 6).size == 1024
+    profile = PROFILE.with_policy(Policy(min_mac=None))
+    assert profile.best(0).cipher_type == CipherType.AES128
+    assert profile.best(0).mac_type == MACType.MD5
+    profile = PROFILE.with_policy(Policy(min_mac=None, encrypt=False))
+    assert profile.best(64).cipher_type == CipherType.Disabled
+    profile = PROFILE.with_policy(Policy(min_mac=MACType.SHA512))
+    assert profile.best(64).mac_type == MACType.SHA512
+    profile = PROFILE.with_policy(Policy(min_mac=None, objective='length'))
+    assert profile.best(64).mac_type == MACType.SHA256
+    profile = PROFILE.with_policy(Policy(ciphers=[CipherType.AES256],
+                                         objective='encode'))
+    assert profile.spec_for(64, ContextSpec(ttl=60)) == \
+        ContextSpec(CipherType.AES256, MACType.SHA512, ZipType.Disabled,
+                    ttl=60)
+    with pytest.raises(ValueError):
+        PROFILE.with_policy(Policy(zips=[ZipType.zlib])).best(64)
+    with pytest.raises(ValueError):
+        Policy(objective='fastest')
+    for mac_type in (MACType.Default, MACType.Disabled):
+        with pytest.raises(ValueError):
+            Policy(min_mac=mac_type)
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / 'profile' / 'tune.json')
+    PROFILE.save(path)
+    profile = TuningProfile.load(path)
+    assert profile.measurements == PROFILE.measurements
+    assert profile.environment == {'host': 'test'}
+
+def test_benchmark():
+    types = {
+        'cipher_type': [CipherType.AES128, CipherType.Disabled],
+        'mac_type': [MACType.SHA256, MACType.MD5],
+        'zip_type': [ZipType.Disabled],
+    }
+    profile = pymunge.tune.benchmark(sizes=(0, 100), samples=1,
+                                     types=types)
+    assert len(profile.measurements) == 8
+    assert all(m.encode_time > 0 and m.decode_time > 0 and m.cred_length
+               for m in profile.measurements)
+    profile = profile.with_policy(Policy(min_mac=MACType.SHA256))
+    best = profile.best(50)
+    assert (best.cipher_type, best.mac_type) == \
+        (CipherType.AES128, MACType.SHA256)
+    result = decode(profile.encode(b'x' * 50), True)
+    assert result.payload == b'x' * 50
+    assert result.mac_type == MACType.SHA256
+
+def test_auto_profile(tmp_path, monkeypatch):
+    runs = []
+    original = pymunge.tune.benchmark
+
+    def benchmark(**kwargs):
+        runs.append(kwargs)
+        return original(
+            sizes=kwargs.get('sizes', (0,)), samples=1,
+            spec=kwargs.get('spec'),
+            types={'cipher_type': [CipherType.AES128],
+                   'mac_type': [MACType.SHA256],
+                   'zip_type': [ZipType.Disabled]})
+
+    monkeypatch.setattr(pymunge.tune, 'benchmark', benchmark)
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    profile = pymunge.tune.auto_profile(samples=1, sizes=(0,))
+    assert runs == [{'samples': 1, 'sizes': (0,)}]
+    assert pymunge.tune.auto_profile(sizes=[0]).measurements == \
+        profile.measurements
+    assert len(runs) == 1
+    assert pymunge.tune.default_path().startswith(str(tmp_path))
+    # other sizes or another socket invalidate the saved profile
+    pymunge.tune.auto_profile(sizes=(0, 64))
+    assert len(runs) == 2
+    spec = ContextSpec(socket=str(tmp_path / 'munge.socket'))
+    pymunge.tune.auto_profile(sizes=(0, 64), spec=spec)
+    pymunge.tune.auto_profile(sizes=(0, 64), spec=spec)
+    assert len(runs) == 3
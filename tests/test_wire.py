@@ -0,0 +1,105 @@
+#########################################################################
+# Tests for module pymunge.wire
+# Copyright (C) 2017-2018 nomadictype <nomadictype AT tutanota.com>
+#
+# pymunge is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  Additionally, you can redistribute it
+# and/or modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation, either version 3
+# of the License, or (at your option) any later version.
+#
+# pymunge is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# and GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# and GNU Lesser General Public License along with pymunge.  If not, see
+# <http://www.gnu.org/licenses/>.
+#########################################################################
+
+
+from pymunge.enums import CipherType, MACType, ZipType, \
+    TTL_MAXIMUM, UID_ANY, GID_ANY
+from pymunge.error import MungeError, MungeErrorCode
+from pymunge.spec import ContextSpec
+import pymunge.wire as wire
+
+import pytest
+
+def split(message):
+    msg_type, retry, length = wire.unpack_header(message[:wire.HEADER_SIZE])
+    body = message[wire.HEADER_SIZE:]
+    assert len(body) == length
+    return msg_type, body
+
+def test_encode_request():
+    spec = ContextSpec(CipherType.AES256, MACType.SHA512, ZipType.zlib,
+                       'realm', TTL_MAXIMUM, uid_restriction=42)
+    msg_type, body = split(wire.pack_encode_request(spec, b'payload'))
+    assert msg_type == wire.MSG_ENC_REQ
+    request = wire.unpack_encode_request(body)
+    assert request == (CipherType.AES256.value, MACType.SHA512.value,
+                       ZipType.zlib.value, 'realm', TTL_MAXIMUM,
+                       42, GID_ANY, b'payload')
+
+def test_encode_request_layout():
+    # byte layout as sent by libmunge 0.5.x
+    spec = ContextSpec(ttl=77)
+    message = wire.pack_encode_request(spec, b'hello')
+    assert message == bytes(bytearray.fromhex(
+        '00606d4b04020000000019'
+        '01010100'
+        '0000004d' 'ffffffff' 'ffffffff'
+        '00000005')) + b'hello'
+
+def test_encode_response():
+    msg_type, body = split(wire.pack_encode_response(0, None, b'MUNGE:x:'))
+    assert msg_type == wire.MSG_ENC_RSP
+    response = wire.unpack_encode_response(body)
+    assert response == (0, None, b'MUNGE:x:')
+    assert wire.encode_result(response) == b'MUNGE:x:'
+
+    msg_type, body = split(wire.pack_encode_response(
+        MungeErrorCode.EMUNGE_BAD_LENGTH.value, 'Too long'))
+    response = wire.unpack_encode_response(body)
+    with pytest.raises(MungeError) as excinfo:
+        wire.encode_result(response)
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_BAD_LENGTH
+    assert excinfo.value.message == 'Too long'
+
+def test_decode_request():
+    msg_type, body = split(wire.pack_decode_request(b'MUNGE:abcd:'))
+    assert msg_type == wire.MSG_DEC_REQ
+    assert body == b'\x00\x00\x00\x0cMUNGE:abcd:\x00'
+    assert wire.unpack_decode_request(body) == b'MUNGE:abcd:'
+
+def test_decode_response():
+    response = wire.DecodeResponse(
+        MungeErrorCode.EMUNGE_CRED_REPLAYED.value, 'Replayed credential',
+        CipherType.AES128.value, MACType.SHA256.value, ZipType.Disabled.value,
+        None, 300, '10.1.2.3', 1000, 1005, 1234, 567, UID_ANY, 89,
+        b'payload')
+    msg_type, body = split(wire.pack_decode_response(response))
+    assert msg_type == wire.MSG_DEC_RSP
+    assert wire.unpack_decode_response(body) == response
+    with pytest.raises(MungeError) as excinfo:
+        wire.decode_result(response)
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_CRED_REPLAYED
+    assert excinfo.value.result == (b'payload', 1234, 567)
+
+    response = response._replace(error=0, message=None)
+    assert wire.decode_result(response) == (b'payload', 1234, 567)
+
+def test_invalid_header():
+    with pytest.raises(MungeError) as excinfo:
+        wire.unpack_header(b'\x00' * wire.HEADER_SIZE)
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_SOCKET
+
+def test_truncated_body():
+    msg_type, body = split(wire.pack_encode_response(0, None, b'MUNGE:x:'))
+    with pytest.raises(MungeError) as excinfo:
+        wire.unpack_encode_response(body[:-3])
+    assert excinfo.value.code == MungeErrorCode.EMUNGE_SOCKET